@@ -205,7 +205,7 @@ class AccountBroker(DatabaseBroker):
 
     def _commit_puts_load(self, item_list, entry):
         """See :func:`swift.common.db.DatabaseBroker._commit_puts_load`"""
-        loaded = pickle.loads(entry.decode('base64'))
+        loaded = pickle.loads(entry)
         # check to see if the update includes policy_index or not
         (name, put_timestamp, delete_timestamp, object_count, bytes_used,
          deleted) = loaded[:6]
@@ -447,6 +447,17 @@ class AccountBroker(DatabaseBroker):
                     break
             return results
 
+    def stream_containers(self, limit, marker, end_marker, prefix,
+                          delimiter):
+        """
+        Generate the same entries as :func:`list_containers_iter`, reading
+        them from the DB in batches.
+
+        :returns: iterator of tuples of (name, object_count, bytes_used, 0)
+        """
+        return self._stream_listing(self.list_containers_iter, limit, marker,
+                                    end_marker, prefix, delimiter)
+
     def merge_items(self, item_list, source=None):
         """
         Merge items into the container table.
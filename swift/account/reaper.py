@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import errno
 import os
 import random
 from swift import gettext_ as _
@@ -29,7 +30,7 @@ from swift.common.direct_client import direct_delete_container, \
 from swift.common.exceptions import ClientException
 from swift.common.ring import Ring
 from swift.common.utils import get_logger, whataremyips, ismount, \
-    config_true_value, Timestamp
+    config_true_value, Timestamp, walk_dir_tree
 from swift.common.daemon import Daemon
 from swift.common.storage_policy import POLICIES
 
@@ -74,6 +75,8 @@ class AccountReaper(Daemon):
         self.container_pool = GreenPool(size=self.container_concurrency)
         swift.common.db.DB_PREALLOCATION = \
             config_true_value(conf.get('db_preallocation', 'f'))
+        swift.common.db.DB_WAL_MODE = \
+            config_true_value(conf.get('db_wal_mode', 'f'))
         self.delay_reaping = int(conf.get('delay_reaping') or 0)
         reap_warn_after = float(conf.get('reap_warn_after') or 86400 * 30)
         self.reap_not_done_after = reap_warn_after + self.delay_reaping
@@ -162,24 +165,25 @@ class AccountReaper(Daemon):
             if nodes[0]['ip'] not in self.myips or \
                     not os.path.isdir(partition_path):
                 continue
-            for suffix in os.listdir(partition_path):
-                suffix_path = os.path.join(partition_path, suffix)
-                if not os.path.isdir(suffix_path):
+            for hsh_path, names, is_dir in walk_dir_tree(partition_path, 2):
+                if is_dir is False:
                     continue
-                for hsh in os.listdir(suffix_path):
-                    hsh_path = os.path.join(suffix_path, hsh)
-                    if not os.path.isdir(hsh_path):
-                        continue
-                    for fname in sorted(os.listdir(hsh_path), reverse=True):
-                        if fname.endswith('.ts'):
-                            break
-                        elif fname.endswith('.db'):
-                            self.start_time = time()
-                            broker = \
-                                AccountBroker(os.path.join(hsh_path, fname))
-                            if broker.is_status_deleted() and \
-                                    not broker.empty():
-                                self.reap_account(broker, partition, nodes)
+                try:
+                    fnames = sorted(os.listdir(hsh_path), reverse=True)
+                except OSError as err:
+                    if err.errno != errno.ENOTDIR:
+                        raise
+                    continue
+                for fname in fnames:
+                    if fname.endswith('.ts'):
+                        break
+                    elif fname.endswith('.db'):
+                        self.start_time = time()
+                        broker = \
+                            AccountBroker(os.path.join(hsh_path, fname))
+                        if broker.is_status_deleted() and \
+                                not broker.empty():
+                            self.reap_account(broker, partition, nodes)
 
     def reset_stats(self):
         self.stats_return_codes = {}
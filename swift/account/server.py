@@ -23,7 +23,8 @@ from eventlet import Timeout
 import swift.common.db
 from swift.account.backend import AccountBroker, DATADIR
 from swift.account.utils import account_listing_response, get_response_headers
-from swift.common.db import DatabaseConnectionError, DatabaseAlreadyExists
+from swift.common.db import DatabaseConnectionError, \
+    DatabaseAlreadyExists, DBChangeLog
 from swift.common.request_helpers import get_param, get_listing_content_type, \
     split_and_validate_path
 from swift.common.utils import get_logger, hash_path, public, \
@@ -57,8 +58,13 @@ class AccountController(object):
                                             logger=self.logger)
         self.auto_create_account_prefix = \
             conf.get('auto_create_account_prefix') or '.'
+        self.change_log = DBChangeLog(('replicator',), self.logger)
         swift.common.db.DB_PREALLOCATION = \
             config_true_value(conf.get('db_preallocation', 'f'))
+        swift.common.db.DB_WAL_MODE = \
+            config_true_value(conf.get('db_wal_mode', 'f'))
+        swift.common.db.DB_CONNECTION_POOL_SIZE = \
+            int(conf.get('db_connection_pool_size', 0))
 
     def _get_account_broker(self, drive, part, account, **kwargs):
         hsh = hash_path(account)
@@ -94,6 +100,7 @@ class AccountController(object):
         if broker.is_deleted():
             return self._deleted_response(broker, req, HTTPNotFound)
         broker.delete_db(req_timestamp.internal)
+        self.change_log.record(broker.db_file)
         return self._deleted_response(broker, req, HTTPNoContent)
 
     @public
@@ -129,6 +136,7 @@ class AccountController(object):
                                  req.headers['x-object-count'],
                                  req.headers['x-bytes-used'],
                                  container_policy_index)
+            self.change_log.record(broker.db_file)
             if req.headers['x-delete-timestamp'] > \
                     req.headers['x-put-timestamp']:
                 return HTTPNoContent(request=req)
@@ -157,6 +165,7 @@ class AccountController(object):
                             if is_sys_or_user_meta('account', key))
             if metadata:
                 broker.update_metadata(metadata, validate_metadata=True)
+            self.change_log.record(broker.db_file)
             if created:
                 return HTTPCreated(request=req)
             else:
@@ -250,6 +259,7 @@ class AccountController(object):
                         if is_sys_or_user_meta('account', key))
         if metadata:
             broker.update_metadata(metadata, validate_metadata=True)
+            self.change_log.record(broker.db_file)
         return HTTPNoContent(request=req)
 
     def __call__(self, env, start_response):
@@ -13,11 +13,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import itertools
 import time
 from xml.sax import saxutils
 
 from swift.common.swob import HTTPOk, HTTPNoContent
-from swift.common.utils import json, Timestamp
+from swift.common.request_helpers import set_listing_body
+from swift.common.utils import json, Timestamp, reiterate
 from swift.common.storage_policy import POLICIES
 
 
@@ -37,6 +39,9 @@ class FakeAccountBroker(object):
     def list_containers_iter(self, *_, **__):
         return []
 
+    def stream_containers(self, *_, **__):
+        return iter([])
+
     @property
     def metadata(self):
         return {}
@@ -76,39 +81,56 @@ def account_listing_response(account, req, response_content_type, broker=None,
 
     resp_headers = get_response_headers(broker)
 
-    account_list = broker.list_containers_iter(limit, marker, end_marker,
-                                               prefix, delimiter)
+    # read the first entries before committing to a response
+    account_list = reiterate(broker.stream_containers(
+        limit, marker, end_marker, prefix, delimiter))
     if response_content_type == 'application/json':
-        data = []
-        for (name, object_count, bytes_used, is_subdir) in account_list:
-            if is_subdir:
-                data.append({'subdir': name})
-            else:
-                data.append({'name': name, 'count': object_count,
-                             'bytes': bytes_used})
-        account_list = json.dumps(data)
+        body_iter = _json_listing_iter(account_list)
     elif response_content_type.endswith('/xml'):
-        output_list = ['<?xml version="1.0" encoding="UTF-8"?>',
-                       '<account name=%s>' % saxutils.quoteattr(account)]
-        for (name, object_count, bytes_used, is_subdir) in account_list:
-            if is_subdir:
-                output_list.append(
-                    '<subdir name=%s />' % saxutils.quoteattr(name))
-            else:
-                item = '<container><name>%s</name><count>%s</count>' \
-                       '<bytes>%s</bytes></container>' % \
-                       (saxutils.escape(name), object_count, bytes_used)
-                output_list.append(item)
-        output_list.append('</account>')
-        account_list = '\n'.join(output_list)
+        body_iter = _xml_listing_iter(account, account_list)
     else:
         if not account_list:
             resp = HTTPNoContent(request=req, headers=resp_headers)
             resp.content_type = response_content_type
             resp.charset = 'utf-8'
             return resp
-        account_list = '\n'.join(r[0] for r in account_list) + '\n'
-    ret = HTTPOk(body=account_list, request=req, headers=resp_headers)
+        body_iter = (r[0] + '\n' for r in account_list)
+    ret = HTTPOk(request=req, headers=resp_headers)
+    set_listing_body(ret, body_iter)
     ret.content_type = response_content_type
     ret.charset = 'utf-8'
     return ret
+
+
+def _json_listing_iter(account_list):
+    yield '['
+    separator = ''
+    account_list = iter(account_list)
+    while True:
+        # dumps is much quicker on a few hundred records than on one
+        data = []
+        for (name, object_count, bytes_used, is_subdir) in \
+                itertools.islice(account_list, 500):
+            if is_subdir:
+                data.append({'subdir': name})
+            else:
+                data.append({'name': name, 'count': object_count,
+                             'bytes': bytes_used})
+        if not data:
+            break
+        yield separator + json.dumps(data)[1:-1]
+        separator = ', '
+    yield ']'
+
+
+def _xml_listing_iter(account, account_list):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield '<account name=%s>' % saxutils.quoteattr(account)
+    for (name, object_count, bytes_used, is_subdir) in account_list:
+        if is_subdir:
+            yield '\n<subdir name=%s />' % saxutils.quoteattr(name)
+        else:
+            yield '\n<container><name>%s</name><count>%s</count>' \
+                '<bytes>%s</bytes></container>' % \
+                (saxutils.escape(name), object_count, bytes_used)
+    yield '\n</account>'
@@ -435,6 +435,7 @@ class SwiftRecon(object):
             set([('127.0.0.1', 6020), ('127.0.0.2', 6030)])
         """
         stats = {}
+        ages = []
         recon = Scout("replication", self.verbose, self.suppress_errors,
                       self.timeout)
         print("[%s] Checking on replication" % self._ptime())
@@ -445,6 +446,8 @@ class SwiftRecon(object):
         for url, response, status in self.pool.imap(recon.scout, hosts):
             if status == 200:
                 stats[url] = response['object_replication_time']
+                ages.append(response.get(
+                    'object_replication_oldest_partition_age'))
                 last = response.get('object_replication_last', 0)
                 if last < least_recent_time:
                     least_recent_time = last
@@ -461,6 +464,9 @@ class SwiftRecon(object):
                 print("[replication_time] - No hosts returned valid data.")
         else:
             print("[replication_time] - No hosts returned valid data.")
+        computed = self._gen_stats(ages, 'oldest_partition_age')
+        if computed['reported'] > 0:
+            self._print_stats(computed)
         if least_recent_url is not None:
             host = urlparse(least_recent_url).netloc
             if not least_recent_time:
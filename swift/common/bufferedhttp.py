@@ -27,12 +27,97 @@ BufferedHTTPResponse.
 """
 
 from swift import gettext_ as _
+from collections import defaultdict
 from urllib import quote
 import logging
+import socket
 import time
 
-from eventlet.green.httplib import CONTINUE, HTTPConnection, HTTPMessage, \
-    HTTPResponse, HTTPSConnection, _UNKNOWN
+from eventlet.green.httplib import BadStatusLine, CONTINUE, HTTPConnection, \
+    HTTPMessage, HTTPResponse, HTTPSConnection, _UNKNOWN
+from eventlet.patcher import original
+
+#: Idle keep-alive connections kept per backend (ip, port); 0 disables pooling
+CONNECTION_POOL_SIZE = 0
+#: Seconds an idle connection may sit in the pool before it is closed
+CONNECTION_POOL_IDLE_TIMEOUT = 10.0
+#: Logger given the pool's reuse and eviction metrics, if any
+CONNECTION_POOL_LOGGER = None
+
+_select = original('select').select
+
+
+def _close_socket(sock):
+    try:
+        sock.fd._sock.close()
+    except Exception:
+        pass
+    sock.close()
+
+
+class ConnectionPool(object):
+    """
+    Keeps idle keep-alive sockets to backend servers, so that later requests
+    to the same (ip, port) can skip connection setup. At most
+    CONNECTION_POOL_SIZE sockets are kept for each server, and the most
+    recently used is handed out first.
+
+    A socket is only handed out again while it has been idle for less than
+    CONNECTION_POOL_IDLE_TIMEOUT seconds and the server hasn't closed it or
+    sent anything on it in the meantime.
+    """
+
+    def __init__(self):
+        self.idle = defaultdict(list)
+
+    def _increment(self, metric):
+        if CONNECTION_POOL_LOGGER:
+            CONNECTION_POOL_LOGGER.increment('backend_pool.%s' % metric)
+
+    def _evict(self, sock):
+        _close_socket(sock)
+        self._increment('evictions')
+
+    def get(self, key):
+        """
+        :returns: an idle socket connected to key, or None
+        """
+        idle = self.idle.get(key)
+        expired = time.time() - CONNECTION_POOL_IDLE_TIMEOUT
+        while idle:
+            put_time, sock = idle.pop()
+            if put_time > expired:
+                try:
+                    readable = _select([sock], [], [], 0)[0]
+                except (socket.error, ValueError):
+                    readable = True
+                if not readable:
+                    self._increment('reuses')
+                    return sock
+            self._evict(sock)
+        return None
+
+    def put(self, key, sock):
+        """
+        :returns: True if the pool took the socket
+        """
+        if CONNECTION_POOL_SIZE <= 0:
+            return False
+        idle = self.idle[key]
+        expired = time.time() - CONNECTION_POOL_IDLE_TIMEOUT
+        while idle and (len(idle) >= CONNECTION_POOL_SIZE or
+                        idle[0][0] <= expired):
+            self._evict(idle.pop(0)[1])
+        idle.append((time.time(), sock))
+        return True
+
+    def clear(self):
+        while self.idle:
+            for put_time, sock in self.idle.popitem()[1]:
+                _close_socket(sock)
+
+
+_connection_pool = ConnectionPool()
 
 
 class BufferedHTTPResponse(HTTPResponse):
@@ -46,6 +131,9 @@ class BufferedHTTPResponse(HTTPResponse):
         # sock.fd._sock is a socket._socket object, which is what we want.
         self._real_socket = sock.fd._sock
         self.fp = sock.makefile('rb')
+        # set by BufferedHTTPConnection.getresponse when the socket may go
+        # back to the pool once this response has been read
+        self._connection = None
         self.debuglevel = debuglevel
         self.strict = strict
         self._method = method
@@ -85,7 +173,14 @@ class BufferedHTTPResponse(HTTPResponse):
         Closes the underlying socket regardless of whether or not anyone else
         has references to it. Use this when you are certain that nobody else
         you care about has a reference to this socket.
+
+        A socket whose response has been read to the end is returned to the
+        connection pool instead, if it came from there.
         """
+        if not self._reusable():
+            self._connection = None
+        elif self._connection:
+            self._real_socket = None
         if self._real_socket:
             # this is idempotent; see sock_close in Modules/socketmodule.c in
             # the Python source for details.
@@ -93,8 +188,22 @@ class BufferedHTTPResponse(HTTPResponse):
         self._real_socket = None
         self.close()
 
+    def _reusable(self):
+        """
+        Indicates whether or not both this response and the request it
+        answers have been sent in full, leaving the socket ready for the next
+        request.
+        """
+        return bool(self._connection and self._connection._request_done and
+                    self.fp and not self.will_close and
+                    not self.chunked and self.length == 0)
+
     def close(self):
+        connection = self._connection if self._reusable() else None
+        self._connection = None
         HTTPResponse.close(self)
+        if connection:
+            connection.release()
         self.sock = None
         self._real_socket = None
 
@@ -102,25 +211,107 @@ class BufferedHTTPResponse(HTTPResponse):
 class BufferedHTTPConnection(HTTPConnection):
     """HTTPConnection class that uses BufferedHTTPResponse"""
     response_class = BufferedHTTPResponse
+    #: (ip, port) of the pool this connection's socket goes back to, if any
+    _pool_key = None
+    _reused = False
 
     def connect(self):
         self._connected_time = time.time()
-        return HTTPConnection.connect(self)
+        HTTPConnection.connect(self)
+        if self._pool_key:
+            # a request's headers and body go out in separate writes, which
+            # would otherwise wait on delayed ACKs once the connection is
+            # reused
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
     def putrequest(self, method, url, skip_host=0, skip_accept_encoding=0):
         self._method = method
         self._path = url
+        self._request = (method, url, skip_host, skip_accept_encoding)
+        self._request_headers = []
+        self._request_sent = False
+        self._request_done = self._bodiless = False
+        self._chunked_request = False
+        self._body_left = 0
         return HTTPConnection.putrequest(self, method, url, skip_host,
                                          skip_accept_encoding)
 
+    def putheader(self, header, *values):
+        name = header.lower()
+        if name == 'content-length':
+            self._body_left = int(values[0])
+        elif name == 'transfer-encoding' and 'chunked' in values[0].lower():
+            self._chunked_request = True
+        self._request_headers.append((header, values))
+        return HTTPConnection.putheader(self, header, *values)
+
+    def endheaders(self, message_body=None):
+        try:
+            HTTPConnection.endheaders(self, message_body)
+        except socket.error:
+            if not self._reused:
+                raise
+            self._replay(message_body)
+            return
+        self._request_sent = True
+        self._bodiless = not (self._chunked_request or self._body_left)
+        self._request_done = self._bodiless
+
+    def send(self, data):
+        HTTPConnection.send(self, data)
+        if not self._request_sent:
+            return
+        # the request body is complete once Content-Length bytes or the
+        # last chunk have gone out
+        if self._chunked_request:
+            self._request_done = data == '0\r\n\r\n'
+        else:
+            self._body_left -= len(data)
+            self._request_done = self._body_left <= 0
+
+    def release(self):
+        """
+        Hand this connection's socket back to the connection pool, once the
+        response to its request has been read in full.
+        """
+        sock, self.sock = self.sock, None
+        # anything else sent through this object would need a new connection
+        self.auto_open = 0
+        if sock and not _connection_pool.put(self._pool_key, sock):
+            _close_socket(sock)
+
     def getexpect(self):
         response = BufferedHTTPResponse(self.sock, strict=self.strict,
                                         method=self._method)
         response.expect_response()
         return response
 
+    def _replay(self, message_body=None):
+        """
+        Send the request again on a new connection, after a pooled
+        connection turned out to have been closed by the server.
+        """
+        headers = self._request_headers
+        self.close()
+        self._reused = False
+        self.connect()
+        self.putrequest(*self._request)
+        for header, values in headers:
+            self.putheader(header, *values)
+        self.endheaders(message_body)
+
     def getresponse(self):
-        response = HTTPConnection.getresponse(self)
+        try:
+            response = HTTPConnection.getresponse(self)
+        except (BadStatusLine, socket.error):
+            # the server may close an idle connection just as it is reused;
+            # only requests without a body can safely be sent again
+            if not (self._reused and self._bodiless):
+                raise
+            self._replay()
+            response = HTTPConnection.getresponse(self)
+        if self._pool_key:
+            response._connection = self
         logging.debug("HTTP PERF: %(time).5f seconds to %(method)s "
                       "%(host)s:%(port)s %(path)s)",
                       {'time': time.time() - self._connected_time,
@@ -175,16 +366,27 @@ def http_connect_raw(ipaddr, port, method, path, headers=None,
     """
     if not port:
         port = 443 if ssl else 80
+    pool_key = None
     if ssl:
         conn = HTTPSConnection('%s:%s' % (ipaddr, port))
     else:
         conn = BufferedHTTPConnection('%s:%s' % (ipaddr, port))
+        if CONNECTION_POOL_SIZE > 0:
+            pool_key = (ipaddr, port)
+            conn._pool_key = pool_key
+            conn.sock = _connection_pool.get(pool_key)
+            if conn.sock:
+                conn._reused = True
+                conn._connected_time = time.time()
     if query_string:
         path += '?' + query_string
     conn.path = path
     conn.putrequest(method, path, skip_host=(headers and 'Host' in headers))
     if headers:
         for header, value in headers.iteritems():
+            if pool_key and header.lower() == 'connection':
+                # HTTP/1.1 connections persist unless told otherwise
+                continue
             conn.putheader(header, str(value))
     conn.endheaders()
     return conn
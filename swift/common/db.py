@@ -15,6 +15,7 @@
 
 """ Database code for Swift """
 
+from collections import OrderedDict
 from contextlib import contextmanager, closing
 import hashlib
 import logging
@@ -23,6 +24,7 @@ from uuid import uuid4
 import sys
 import time
 import errno
+import struct
 import cPickle as pickle
 from swift import gettext_ as _
 from tempfile import mkstemp
@@ -39,12 +41,30 @@ from swift.common.swob import HTTPBadRequest
 
 #: Whether calls will be made to preallocate disk space for database files.
 DB_PREALLOCATION = False
+#: Whether DBs use a write-ahead log rather than a rollback journal.
+DB_WAL_MODE = False
+#: Max number of idle DB connections each process keeps open for reuse.
+DB_CONNECTION_POOL_SIZE = 0
 #: Timeout for trying to connect to a DB
 BROKER_TIMEOUT = 25
 #: Pickle protocol to use
 PICKLE_PROTOCOL = 2
 #: Max number of pending entries
 PENDING_CAP = 131072
+#: Max number of pending entries to merge into the DB in one transaction
+PENDING_COMMIT_BATCH = 1000
+#: Bytes read from a .pending file at a time
+PENDING_CHUNK_SIZE = 65536
+#: Starts a binary pending entry; not used by the legacy base64 entries
+PENDING_RECORD_MARKER = '\x00'
+#: Big-endian length of the pickle following a PENDING_RECORD_MARKER
+PENDING_LENGTH = struct.Struct('!I')
+#: Max number of rows read by each query of a streamed listing
+LISTING_BATCH_SIZE = 1000
+#: Max number of DBs a DBChangeLog remembers having recorded
+CHANGE_LOG_CACHE_SIZE = 10000
+#: Length of the token line at the start of each change log
+CHANGE_LOG_TOKEN_LENGTH = 33
 
 
 def utf8encode(*args):
@@ -103,6 +123,7 @@ class GreenDBConnection(sqlite3.Connection):
             timeout = BROKER_TIMEOUT
         self.timeout = timeout
         self.db_file = database
+        self.ident = None
         super(GreenDBConnection, self).__init__(database, 0, *args, **kwargs)
 
     def cursor(self, cls=None):
@@ -156,6 +177,62 @@ def chexor(old, name, timestamp):
     return '%032x' % (int(old, 16) ^ int(new, 16))
 
 
+def _file_ident(path):
+    stat = os.stat(path)
+    return stat.st_dev, stat.st_ino
+
+
+class DBConnectionPool(object):
+    """
+    Keeps idle connections to recently used DBs open, so that brokers for
+    the same DB in later requests can skip connection setup. Each DB has at
+    most one idle connection, and at most DB_CONNECTION_POOL_SIZE are kept
+    in all; the least recently used are closed first.
+
+    A connection is only handed out again while its path still names the
+    file it was opened on, so DBs that have since been replaced by
+    replication or quarantined aren't reused.
+    """
+
+    def __init__(self):
+        self.idle = OrderedDict()
+
+    def get(self, path):
+        """
+        :returns: an idle connection to the DB at path, or None
+        """
+        conn = self.idle.pop(path, None)
+        if conn is None:
+            return None
+        try:
+            current = _file_ident(path)
+        except OSError:
+            current = None
+        if current != conn.ident:
+            conn.close()
+            return None
+        return conn
+
+    def put(self, path, conn):
+        """
+        :returns: True if the pool took the connection
+        """
+        if DB_CONNECTION_POOL_SIZE <= 0 or path in self.idle or \
+                getattr(conn, 'ident', None) is None:
+            return False
+        self.idle[path] = conn
+        while len(self.idle) > DB_CONNECTION_POOL_SIZE:
+            self.idle.popitem(last=False)[1].close()
+        return True
+
+    def clear(self):
+        while self.idle:
+            self.idle.popitem()[1].close()
+
+
+_connection_pool = DBConnectionPool()
+
+
 def get_db_connection(path, timeout=30, okay_to_create=False):
     """
     Returns a properly configured SQLite database connection.
@@ -169,10 +246,12 @@ def get_db_connection(path, timeout=30, okay_to_create=False):
         connect_time = time.time()
         conn = sqlite3.connect(path, check_same_thread=False,
                                factory=GreenDBConnection, timeout=timeout)
-        if path != ':memory:' and not okay_to_create:
-            # attempt to detect and fail when connect creates the db file
+        if path != ':memory:':
             stat = os.stat(path)
-            if stat.st_size == 0 and stat.st_ctime >= connect_time:
+            conn.ident = stat.st_dev, stat.st_ino
+            # attempt to detect and fail when connect creates the db file
+            if not okay_to_create and stat.st_size == 0 and \
+                    stat.st_ctime >= connect_time:
                 os.unlink(path)
                 raise DatabaseConnectionError(path,
                                               'DB file created by connect?')
@@ -182,7 +261,14 @@ def get_db_connection(path, timeout=30, okay_to_create=False):
             cur.execute('PRAGMA synchronous = NORMAL')
             cur.execute('PRAGMA count_changes = OFF')
             cur.execute('PRAGMA temp_store = MEMORY')
-            cur.execute('PRAGMA journal_mode = DELETE')
+            try:
+                # A DB can only change journal mode while nothing else has
+                # it open; until then it's used in the mode it's in.
+                sqlite3.Cursor.execute(cur, 'PRAGMA journal_mode = %s' % (
+                    'WAL' if DB_WAL_MODE else 'DELETE'))
+            except sqlite3.OperationalError as err:
+                if 'locked' not in str(err):
+                    raise
         conn.create_function('chexor', 3, chexor)
     except sqlite3.DatabaseError:
         import traceback
@@ -191,6 +277,113 @@ def get_db_connection(path, timeout=30, okay_to_create=False):
     return conn
 
 
+def change_log_path(datadir, reader):
+    """
+    Get the path of a reader's change log for a datadir. It sits beside the
+    datadir, in the root of the device.
+
+    :param datadir: path of the datadir, e.g. /srv/node/sda/containers
+    :param reader: name of the daemon reading the log, e.g. replicator
+    """
+    return '%s.%s.changes' % (datadir, reader)
+
+
+class DBChangeLog(object):
+    """
+    Records changed DBs in per-device change logs, so that the daemons that
+    would otherwise visit every DB on a device can visit the changed ones.
+
+    Each reader has its own log, which it starts with pop_db_changes; DBs
+    are only recorded in logs that exist, so nothing piles up for readers
+    that don't use them. Each log starts with a token line, by which a DB
+    is recorded in it at most once.
+
+    :param readers: names of the daemons reading the logs
+    :param logger: a logger for errors
+    """
+
+    def __init__(self, readers, logger):
+        self.readers = readers
+        self.logger = logger
+        #: maps (db_file, reader) to the token of the log it's recorded in
+        self.recorded = {}
+
+    def record(self, db_file):
+        """
+        Record a change to a DB in its device's change logs.
+
+        :param db_file: path of the DB, in its datadir's hash dir
+        """
+        hash_dir = os.path.dirname(db_file)
+        datadir = os.path.dirname(os.path.dirname(os.path.dirname(hash_dir)))
+        entry = os.path.relpath(hash_dir, datadir) + '\n'
+        for reader in self.readers:
+            path = change_log_path(datadir, reader)
+            try:
+                fd = os.open(path, os.O_RDWR | os.O_APPEND)
+                try:
+                    token = os.read(fd, CHANGE_LOG_TOKEN_LENGTH)
+                    if self.recorded.get((db_file, reader)) == token:
+                        continue
+                    os.write(fd, entry)
+                finally:
+                    os.close(fd)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    self.logger.error(
+                        _('ERROR recording change to %(db)s in %(log)s: '
+                          '%(err)s'), {'db': db_file, 'log': path, 'err': err})
+                continue
+            if len(self.recorded) >= CHANGE_LOG_CACHE_SIZE:
+                self.recorded.clear()
+            self.recorded[db_file, reader] = token
+
+
+def pop_db_changes(datadir, reader):
+    """
+    Start a reader's new change log for a datadir, and get the DBs recorded
+    in its previous one.
+
+    :param datadir: path of the datadir
+    :param reader: name of the daemon reading the log
+    :returns: a list of (partition, db_file) for the DBs that changed, or
+              None if there was no previous log, so changes are unknown
+    """
+    path = change_log_path(datadir, reader)
+    fd, new_path = mkstemp(dir=os.path.dirname(path),
+                           prefix=os.path.basename(path) + '.')
+    try:
+        os.write(fd, uuid4().hex + '\n')
+    finally:
+        os.close(fd)
+    old_path = path + '.old'
+    try:
+        os.rename(path, old_path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        old_path = None
+    os.rename(new_path, path)
+    if old_path is None:
+        return None
+    changes = []
+    seen = set()
+    with open(old_path) as fp:
+        fp.readline()
+        for line in fp:
+            entry = line.strip()
+            if not entry or entry in seen:
+                continue
+            seen.add(entry)
+            hash_dir = os.path.join(datadir, entry)
+            db_file = os.path.join(hash_dir,
+                                   os.path.basename(hash_dir) + '.db')
+            if os.path.exists(db_file):
+                changes.append((entry.split(os.sep)[0], db_file))
+    os.unlink(old_path)
+    return changes
+
+
 class DatabaseBroker(object):
     """Encapsulates working with a database."""
 
@@ -349,13 +542,24 @@ class DatabaseBroker(object):
         self.logger.error(detail)
         raise sqlite3.DatabaseError(detail)
 
+    def _connect(self):
+        conn = _connection_pool.get(self.db_file)
+        if conn is None:
+            return get_db_connection(self.db_file, self.timeout)
+        conn.timeout = self.timeout
+        return conn
+
+    def _release(self, conn):
+        if not _connection_pool.put(self.db_file, conn):
+            self.conn = conn
+
     @contextmanager
     def get(self):
         """Use with the "with" statement; returns a database connection."""
         if not self.conn:
             if self.db_file != ':memory:' and os.path.exists(self.db_file):
                 try:
-                    self.conn = get_db_connection(self.db_file, self.timeout)
+                    self.conn = self._connect()
                 except (sqlite3.DatabaseError, DatabaseConnectionError):
                     self.possibly_quarantine(*sys.exc_info())
             else:
@@ -365,7 +569,7 @@ class DatabaseBroker(object):
         try:
             yield conn
             conn.rollback()
-            self.conn = conn
+            self._release(conn)
         except sqlite3.DatabaseError:
             try:
                 conn.close()
@@ -381,7 +585,7 @@ class DatabaseBroker(object):
         """Use with the "with" statement; locks a database."""
         if not self.conn:
             if self.db_file != ':memory:' and os.path.exists(self.db_file):
-                self.conn = get_db_connection(self.db_file, self.timeout)
+                self.conn = self._connect()
             else:
                 raise DatabaseConnectionError(self.db_file, "DB doesn't exist")
         conn = self.conn
@@ -396,12 +600,41 @@ class DatabaseBroker(object):
         try:
             conn.execute('ROLLBACK')
             conn.isolation_level = orig_isolation_level
-            self.conn = conn
+            self._release(conn)
         except (Exception, Timeout):
             logging.exception(
                 _('Broker error trying to rollback locked connection'))
             conn.close()
 
+    def checkpoint(self):
+        """
+        Copy the commits in a WAL-mode DB's write-ahead log into the DB
+        file, so that the DB file can be copied on its own.
+
+        :returns: True if the DB file holds every commit
+        """
+        if self.db_file == ':memory:' or \
+                not os.path.exists(self.db_file + '-wal'):
+            return True
+        with self.get() as conn:
+            busy, log, checkpointed = conn.execute(
+                'PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+        return log == checkpointed
+
+    def leave_wal_mode(self):
+        """
+        Switch a WAL-mode DB back to a rollback journal, which folds its
+        write-ahead log into the DB file and removes it, so that the DB file
+        can be renamed into place on its own. This waits for every other
+        connection to the DB to close, so it's meant for DBs nothing else
+        uses, like those rsynced into a device's tmp dir.
+        """
+        if self.db_file == ':memory:' or \
+                not os.path.exists(self.db_file + '-wal'):
+            return
+        with self.get() as conn:
+            conn.execute('PRAGMA journal_mode = DELETE')
+
     def newid(self, remote_id):
         """
         Re-id the database.  This should be called after an rsync.
@@ -554,8 +787,18 @@ class DatabaseBroker(object):
             return curs.fetchone()
 
     def put_record(self, record):
+        self.put_records([record])
+
+    def put_records(self, records):
+        """
+        Append records to the .pending file under a single lock, or merge
+        them into the DB along with the rest of the .pending file once that
+        has grown past PENDING_CAP.
+
+        :param records: a list of record dicts
+        """
         if self.db_file == ':memory:':
-            self.merge_items([record])
+            self.merge_items(records)
             return
         if not os.path.exists(self.db_file):
             raise DatabaseConnectionError(self.db_file, "DB doesn't exist")
@@ -567,22 +810,87 @@ class DatabaseBroker(object):
                 if err.errno != errno.ENOENT:
                     raise
             if pending_size > PENDING_CAP:
-                self._commit_puts([record])
+                self._commit_puts(list(records))
             else:
+                entries = []
+                for record in records:
+                    entry = pickle.dumps(self.make_tuple_for_pickle(record),
+                                         protocol=PICKLE_PROTOCOL)
+                    entries.append(PENDING_RECORD_MARKER +
+                                   PENDING_LENGTH.pack(len(entry)) + entry)
                 with open(self.pending_file, 'a+b') as fp:
-                    # Colons aren't used in base64 encoding; so they are our
-                    # delimiter
-                    fp.write(':')
-                    fp.write(pickle.dumps(
-                        self.make_tuple_for_pickle(record),
-                        protocol=PICKLE_PROTOCOL).encode('base64'))
+                    # one write for all the entries, so a torn append can
+                    # only lose the tail of the file
+                    fp.write(''.join(entries))
                     fp.flush()
 
+    def _iter_pending(self, fp):
+        """
+        Read the entries of a .pending file without loading it all into
+        memory.
+
+        Entries are either a PENDING_RECORD_MARKER followed by the length
+        and the pickle itself, or, as written by older versions, a base64
+        encoded pickle preceded by a colon. Both kinds may appear in the same
+        file.
+
+        :param fp: file object positioned at the start of the .pending file
+        :returns: an iterator of (entry, encoded) tuples, where encoded is
+                  True for a legacy base64 entry
+        """
+        buf = ''
+        pos = 0
+        eof = False
+        while True:
+            if pos >= len(buf):
+                if eof:
+                    return
+                buf = fp.read(PENDING_CHUNK_SIZE)
+                pos = 0
+                if not buf:
+                    return
+                continue
+            if buf[pos] == PENDING_RECORD_MARKER:
+                start = pos + 1 + PENDING_LENGTH.size
+                end = None
+                if start <= len(buf):
+                    end = start + PENDING_LENGTH.unpack_from(buf, pos + 1)[0]
+                if end is None or end > len(buf):
+                    if eof:
+                        self.logger.error(
+                            _('Truncated pending entry in %s'),
+                            self.pending_file)
+                        return
+                    chunk = fp.read(max(PENDING_CHUNK_SIZE,
+                                        (end or start) - len(buf)))
+                    eof = not chunk
+                    buf = buf[pos:] + chunk
+                    pos = 0
+                    continue
+                yield buf[start:end], False
+                pos = end
+            elif buf[pos] == ':':
+                pos += 1
+            else:
+                end = len(buf)
+                for delimiter in (':', PENDING_RECORD_MARKER):
+                    index = buf.find(delimiter, pos, end)
+                    if index >= 0:
+                        end = index
+                if end == len(buf) and not eof:
+                    chunk = fp.read(PENDING_CHUNK_SIZE)
+                    eof = not chunk
+                    buf = buf[pos:] + chunk
+                    pos = 0
+                    continue
+                yield buf[pos:end], True
+                pos = end
+
     def _commit_puts(self, item_list=None):
         """
         Scan for .pending files and commit the found records by feeding them
-        to merge_items(). Assume that lock_parent_directory has already been
-        called.
+        to merge_items() in batches of PENDING_COMMIT_BATCH. Assume that
+        lock_parent_directory has already been called.
 
         :param item_list: A list of items to commit in addition to .pending
         """
@@ -596,14 +904,18 @@ class DatabaseBroker(object):
                 self.merge_items(item_list)
             return
         with open(self.pending_file, 'r+b') as fp:
-            for entry in fp.read().split(':'):
-                if entry:
-                    try:
-                        self._commit_puts_load(item_list, entry)
-                    except Exception:
-                        self.logger.exception(
-                            _('Invalid pending entry %(file)s: %(entry)s'),
-                            {'file': self.pending_file, 'entry': entry})
+            for entry, encoded in self._iter_pending(fp):
+                try:
+                    self._commit_puts_load(
+                        item_list,
+                        entry.decode('base64') if encoded else entry)
+                except Exception:
+                    self.logger.exception(
+                        _('Invalid pending entry %(file)s: %(entry)s'),
+                        {'file': self.pending_file, 'entry': entry})
+                if len(item_list) >= PENDING_COMMIT_BATCH:
+                    self.merge_items(item_list)
+                    item_list = []
             if item_list:
                 self.merge_items(item_list)
             try:
@@ -629,7 +941,7 @@ class DatabaseBroker(object):
 
     def _commit_puts_load(self, item_list, entry):
         """
-        Unmarshall the :param:entry and append it to :param:item_list.
+        Unpickle the :param:entry and append it to :param:item_list.
         This is implemented by a particular broker to be compatible
         with its :func:`merge_items`.
         """
@@ -642,6 +954,28 @@ class DatabaseBroker(object):
         """
         raise NotImplementedError
 
+    def _stream_listing(self, list_func, limit, marker, *args, **kwargs):
+        """
+        Yield the entries of a listing a batch of LISTING_BATCH_SIZE at a
+        time, each batch read by its own query starting after the last
+        entry of the one before, so that the DB isn't held open while they
+        are consumed.
+
+        :param list_func: a listing method such as list_objects_iter, called
+                          as list_func(limit, marker, *args, **kwargs)
+        :param limit: maximum number of entries to yield
+        :param marker: marker query
+        """
+        while limit > 0:
+            batch_limit = min(limit, LISTING_BATCH_SIZE)
+            batch = list_func(batch_limit, marker, *args, **kwargs)
+            for entry in batch:
+                yield entry
+            if len(batch) < batch_limit:
+                return
+            limit -= len(batch)
+            marker = batch[-1][0]
+
     def merge_syncs(self, sync_points, incoming=True):
         """
         Merge a list of sync points with the incoming sync table.
@@ -788,7 +1122,8 @@ class DatabaseBroker(object):
                          (json.dumps(md),))
             conn.commit()
 
-    def reclaim(self, age_timestamp, sync_timestamp):
+    def reclaim(self, age_timestamp, sync_timestamp, marker='',
+                batch_size=None, max_batches=None):
         """
         Delete rows from the db_contains_type table that are marked deleted
         and whose created_at timestamp is < age_timestamp.  Also deletes rows
@@ -797,18 +1132,41 @@ class DatabaseBroker(object):
 
         In addition, this calls the DatabaseBroker's :func:`_reclaim` method.
 
+        Given a batch_size, deleted rows are removed in name order, that many
+        at a time, each batch in its own transaction with a yield between
+        them, so that other writers aren't locked out for long.
+
         :param age_timestamp: max created_at timestamp of object rows to delete
         :param sync_timestamp: max update_at timestamp of sync rows to delete
+        :param marker: only delete rows with names greater than marker, to
+                       carry on from a previous call
+        :param batch_size: max number of rows to delete per transaction, or
+                           None to delete them all in one
+        :param max_batches: max number of batches to delete, or None for no
+                            limit
+        :returns: a tuple of (marker, lock_time); marker is the name to pass
+                  to the next call to carry on, or '' if there were no more
+                  rows to delete, and lock_time the seconds the DB was
+                  locked for deleting rows
         """
         if self.db_file != ':memory:' and os.path.exists(self.pending_file):
             with lock_parent_directory(self.pending_file,
                                        self.pending_timeout):
                 self._commit_puts()
+        lock_time = 0
+        batches = 0
+        while True:
+            if batches and max_batches and batches >= max_batches:
+                break
+            if batches:
+                sleep()
+            batches += 1
+            marker, batch_lock_time = self._reclaim_rows(
+                age_timestamp, marker, batch_size)
+            lock_time += batch_lock_time
+            if not marker:
+                break
         with self.get() as conn:
-            conn.execute('''
-                DELETE FROM %s WHERE deleted = 1 AND %s < ?
-            ''' % (self.db_contains_type, self.db_reclaim_timestamp),
-                (age_timestamp,))
             try:
                 conn.execute('''
                     DELETE FROM outgoing_sync WHERE updated_at < ?
@@ -822,6 +1180,36 @@ class DatabaseBroker(object):
                     raise
             DatabaseBroker._reclaim(self, conn, age_timestamp)
             conn.commit()
+        return marker, lock_time
+
+    def _reclaim_rows(self, age_timestamp, marker, batch_size):
+        """
+        Delete a batch of deleted rows older than age_timestamp.
+
+        :returns: a tuple of (marker, lock_time), as for reclaim
+        """
+        query = '''
+            DELETE FROM %s WHERE deleted = 1 AND %s < ? AND name > ?
+        ''' % (self.db_contains_type, self.db_reclaim_timestamp)
+        args = [age_timestamp, marker]
+        with self.get() as conn:
+            if batch_size:
+                names = [row[0] for row in conn.execute('''
+                    SELECT name FROM %s WHERE deleted = 1 AND name > ?
+                    AND %s < ? ORDER BY name LIMIT ?
+                ''' % (self.db_contains_type, self.db_reclaim_timestamp),
+                    (marker, age_timestamp, batch_size))]
+                if not names:
+                    return '', 0
+                query += ' AND name <= ?'
+                args.append(names[-1])
+                marker = names[-1] if len(names) >= batch_size else ''
+            else:
+                marker = ''
+            start = time.time()
+            conn.execute(query, args)
+            conn.commit()
+            return marker, time.time() - start
 
     def _reclaim(self, conn, timestamp):
         """
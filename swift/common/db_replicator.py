@@ -28,10 +28,12 @@ from eventlet import GreenPool, sleep, Timeout
 from eventlet.green import subprocess
 
 import swift.common.db
+from swift.common.db import DBChangeLog, pop_db_changes
 from swift.common.direct_client import quote
 from swift.common.utils import get_logger, whataremyips, storage_directory, \
     renamer, mkdirs, lock_parent_directory, config_true_value, \
-    unlink_older_than, dump_recon_cache, rsync_ip, ismount, json, Timestamp
+    unlink_older_than, dump_recon_cache, rsync_ip, ismount, json, Timestamp, \
+    walk_dir_tree
 from swift.common import ring
 from swift.common.http import HTTP_NOT_FOUND, HTTP_INSUFFICIENT_STORAGE
 from swift.common.bufferedhttp import BufferedHTTPConnection
@@ -78,25 +80,13 @@ def roundrobin_datadirs(datadirs):
     """
 
     def walk_datadir(datadir, node_id):
-        partitions = os.listdir(datadir)
-        random.shuffle(partitions)
-        for partition in partitions:
-            part_dir = os.path.join(datadir, partition)
-            if not os.path.isdir(part_dir):
+        for hash_dir, (partition, _suffix, hsh), is_dir in \
+                walk_dir_tree(datadir, 3, shuffle_top=True):
+            if is_dir is False:
                 continue
-            suffixes = os.listdir(part_dir)
-            for suffix in suffixes:
-                suff_dir = os.path.join(part_dir, suffix)
-                if not os.path.isdir(suff_dir):
-                    continue
-                hashes = os.listdir(suff_dir)
-                for hsh in hashes:
-                    hash_dir = os.path.join(suff_dir, hsh)
-                    if not os.path.isdir(hash_dir):
-                        continue
-                    object_file = os.path.join(hash_dir, hsh + '.db')
-                    if os.path.exists(object_file):
-                        yield (partition, object_file, node_id)
+            object_file = os.path.join(hash_dir, hsh + '.db')
+            if os.path.exists(object_file):
+                yield (partition, object_file, node_id)
 
     its = [walk_datadir(datadir, node_id) for datadir, node_id in datadirs]
     while its:
@@ -165,8 +155,17 @@ class Replicator(Daemon):
         self.node_timeout = int(conf.get('node_timeout', 10))
         self.conn_timeout = float(conf.get('conn_timeout', 0.5))
         self.reclaim_age = float(conf.get('reclaim_age', 86400 * 7))
+        self.reclaim_batch_size = int(conf.get('reclaim_batch_size', 1000))
+        self.reclaim_max_batches = int(conf.get('reclaim_max_batches', 100))
+        #: maps DB paths to the marker their next reclaim carries on from
+        self._reclaim_markers = {}
+        self.full_sweep_interval = float(conf.get('full_sweep_interval', 0))
+        self._last_full_sweep = 0
+        self.change_log = DBChangeLog(('replicator',), self.logger)
         swift.common.db.DB_PREALLOCATION = \
             config_true_value(conf.get('db_preallocation', 'f'))
+        swift.common.db.DB_WAL_MODE = \
+            config_true_value(conf.get('db_wal_mode', 'f'))
         self._zero_stats()
         self.recon_cache_path = conf.get('recon_cache_path',
                                          '/var/cache/swift')
@@ -249,14 +248,19 @@ class Replicator(Daemon):
         else:
             remote_file = '%s::%s/%s/tmp/%s' % (
                 device_ip, self.server_type, device['device'], local_id)
+        # a WAL-mode DB's latest commits may only be in its write-ahead log
+        broker.checkpoint()
         mtime = os.path.getmtime(broker.db_file)
         if not self._rsync_file(broker.db_file, remote_file):
             return False
         # perform block-level sync if the db was modified during the first sync
         if os.path.exists(broker.db_file + '-journal') or \
+                os.path.exists(broker.db_file + '-wal') or \
                 os.path.getmtime(broker.db_file) > mtime:
             # grab a lock so nobody else can modify it
             with broker.lock():
+                if not broker.checkpoint():
+                    return False
                 if not self._rsync_file(broker.db_file, remote_file, False):
                     return False
         with Timeout(replicate_timeout or self.node_timeout):
@@ -402,6 +406,23 @@ class Replicator(Daemon):
             return self._usync_db(max(rinfo['point'], local_sync),
                                   broker, http, rinfo['id'], info['id'])
 
+    def _reclaim(self, broker, now):
+        """
+        Reclaim a batch of the DB's old deleted rows, carrying on from where
+        the last pass left off.
+
+        :param broker: DB broker object
+        :param now: the time replication of the DB started
+        """
+        marker, lock_time = broker.reclaim(
+            now - self.reclaim_age, now - (self.reclaim_age * 2),
+            marker=self._reclaim_markers.pop(broker.db_file, ''),
+            batch_size=self.reclaim_batch_size or None,
+            max_batches=self.reclaim_max_batches or None)
+        if marker:
+            self._reclaim_markers[broker.db_file] = marker
+        self.logger.timing('reclaim_timing', lock_time * 1000)
+
     def _post_replicate_hook(self, broker, info, responses):
         """
         :param broker: the container that just replicated
@@ -418,6 +439,8 @@ class Replicator(Daemon):
         :param partition: partition to be replicated to
         :param object_file: DB file name to be replicated
         :param node_id: node id of the node to be replicated to
+        :returns: False if the DB couldn't be read or didn't replicate to
+                  every node it was sent to, True otherwise
         """
         start_time = now = time.time()
         self.logger.debug('Replicating db %s', object_file)
@@ -426,8 +449,7 @@ class Replicator(Daemon):
         shouldbehere = True
         try:
             broker = self.brokerclass(object_file, pending_timeout=30)
-            broker.reclaim(now - self.reclaim_age,
-                           now - (self.reclaim_age * 2))
+            self._reclaim(broker, now)
             info = broker.get_replication_info()
             bpart = self.ring.get_part(
                 info['account'], info.get('container'))
@@ -450,7 +472,7 @@ class Replicator(Daemon):
                 self.logger.exception(_('ERROR reading db %s'), object_file)
             self.stats['failure'] += 1
             self.logger.increment('failures')
-            return
+            return False
         # The db is considered deleted if the delete_timestamp value is greater
         # than the put_timestamp, and there are no objects.
         delete_timestamp = Timestamp(info.get('delete_timestamp') or 0)
@@ -461,7 +483,7 @@ class Replicator(Daemon):
             if self.report_up_to_date(info):
                 self.delete_db(object_file)
             self.logger.timing_since('timing', start_time)
-            return
+            return True
         responses = []
         nodes = self.ring.get_part_nodes(int(partition))
         if shouldbehere:
@@ -496,6 +518,15 @@ class Replicator(Daemon):
             # synced to all of its peers, it can be removed.
             self.delete_db(broker)
         self.logger.timing_since('timing', start_time)
+        return all(responses)
+
+    def _replicate_or_record(self, partition, object_file, node_id):
+        """
+        Replicate a DB, recording it in the change log again if it doesn't
+        fully replicate so that the next pass retries it.
+        """
+        if not self._replicate_object(partition, object_file, node_id):
+            self.change_log.record(object_file)
 
     def delete_db(self, broker):
         object_file = broker.db_file
@@ -528,14 +559,19 @@ class Replicator(Daemon):
     def report_up_to_date(self, full_info):
         return True
 
-    def run_once(self, *args, **kwargs):
-        """Run a replication pass once."""
-        self._zero_stats()
+    def _get_local_datadirs(self):
+        """
+        Find the datadirs of the mounted local devices in the ring, noting
+        their ids in _local_device_ids.
+
+        :returns: a list of (datadir, node_id), or None if this node's IPs
+                  can't be found
+        """
         dirs = []
         ips = whataremyips()
         if not ips:
             self.logger.error(_('ERROR Failed to get my own IPs?'))
-            return
+            return None
         self._local_device_ids = set()
         for node in self.ring.devs:
             if (node and node['replication_ip'] in ips and
@@ -552,10 +588,52 @@ class Replicator(Daemon):
                 if os.path.isdir(datadir):
                     self._local_device_ids.add(node['id'])
                     dirs.append((datadir, node['id']))
+        return dirs
+
+    def _changed_dbs(self, dirs):
+        """
+        Get the DBs recorded in the change logs of the local devices.
+
+        :param dirs: a list of (datadir, node_id)
+        :returns: a list of (partition, db_file, node_id), or None if the
+                  changes of some device aren't known
+        """
+        if not self.full_sweep_interval:
+            return None
+        changed = []
+        known = True
+        for datadir, node_id in dirs:
+            changes = pop_db_changes(datadir, 'replicator')
+            if changes is None:
+                known = False
+                continue
+            changed.extend((part, db_file, node_id)
+                           for part, db_file in changes)
+        return changed if known else None
+
+    def run_once(self, *args, **kwargs):
+        """Run a replication pass once."""
+        self._zero_stats()
+        dirs = self._get_local_datadirs()
+        if dirs is None:
+            return
         self.logger.info(_('Beginning replication run'))
-        for part, object_file, node_id in roundrobin_datadirs(dirs):
-            self.cpool.spawn_n(
-                self._replicate_object, part, object_file, node_id)
+        changed = self._changed_dbs(dirs)
+        if changed:
+            self.logger.info(_('Replicating %d changed dbs'), len(changed))
+            for part, object_file, node_id in changed:
+                self.cpool.spawn_n(
+                    self._replicate_or_record, part, object_file, node_id)
+        begin = time.time()
+        if changed is None or \
+                begin - self._last_full_sweep >= self.full_sweep_interval:
+            replicated = set(db_file for _part, db_file, _id in changed or [])
+            for part, object_file, node_id in roundrobin_datadirs(dirs):
+                if object_file not in replicated:
+                    self.cpool.spawn_n(
+                        self._replicate_or_record, part, object_file,
+                        node_id)
+            self._last_full_sweep = begin
         self.cpool.waitall()
         self.logger.info(_('Replication run OVER'))
         self._report_stats()
@@ -710,6 +788,7 @@ class ReplicatorRpc(object):
             return HTTPNotFound()
         broker = self.broker_class(old_filename)
         broker.newid(args[0])
+        broker.leave_wal_mode()
         renamer(old_filename, db_file)
         return HTTPNoContent()
 
@@ -719,6 +798,8 @@ class ReplicatorRpc(object):
             return HTTPNotFound()
         new_broker = self.broker_class(old_filename)
         existing_broker = self.broker_class(db_file)
+        if swift.common.db.DB_WAL_MODE:
+            return self._merge_rsynced_db(new_broker, existing_broker, args)
         point = -1
         objects = existing_broker.get_items_since(point, 1000)
         while len(objects):
@@ -730,6 +811,24 @@ class ReplicatorRpc(object):
         renamer(old_filename, db_file)
         return HTTPNoContent()
 
+    def _merge_rsynced_db(self, new_broker, existing_broker, args):
+        """
+        Merge the rows of an rsynced DB into the existing DB, for when the
+        existing DB can't be replaced. Closing a connection to a WAL-mode DB
+        removes its write-ahead log by name, so renaming over a DB that other
+        processes may still have open would cost the new DB its log.
+        """
+        point = -1
+        objects = new_broker.get_items_since(point, 1000)
+        while len(objects):
+            existing_broker.merge_items(objects, args[0])
+            point = objects[-1]['ROWID']
+            objects = new_broker.get_items_since(point, 1000)
+            sleep()
+        new_broker.leave_wal_mode()
+        os.unlink(new_broker.db_file)
+        return HTTPNoContent()
+
 # Footnote [1]:
 #   This orders the nodes so that, given nodes a b c, a will contact b then c,
 # b will contact c then a, and c will contact a then b -- in other words, each
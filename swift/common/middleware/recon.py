@@ -22,6 +22,7 @@ from swift.common.swob import Request, Response
 from swift.common.utils import get_logger, config_true_value, json, \
     SWIFT_CONF_FILE
 from swift.common.constraints import check_mount
+from swift.common.node_stats import NODE_STATS_FILE, read_node_stats
 from resource import getpagesize
 from hashlib import md5
 
@@ -53,6 +54,8 @@ class ReconMiddleware(object):
                                                   'container.recon')
         self.account_recon_cache = os.path.join(self.recon_cache_path,
                                                 'account.recon')
+        self.node_stats_path = os.path.join(self.recon_cache_path,
+                                            NODE_STATS_FILE)
         self.account_ring_path = os.path.join(swift_dir, 'account.ring.gz')
         self.container_ring_path = os.path.join(swift_dir, 'container.ring.gz')
         self.rings = [self.account_ring_path, self.container_ring_path]
@@ -137,9 +140,12 @@ class ReconMiddleware(object):
                                            'replication_last'],
                                           self.container_recon_cache)
         elif recon_type == 'object':
-            return self._from_recon_cache(['object_replication_time',
-                                           'object_replication_last'],
-                                          self.object_recon_cache)
+            return self._from_recon_cache(
+                ['object_replication_time',
+                 'object_replication_last',
+                 'object_replication_oldest_partition_age',
+                 'object_replication_partition_ages'],
+                self.object_recon_cache)
         else:
             return None
 
@@ -308,6 +314,16 @@ class ReconMiddleware(object):
                 raise
         return sockstat
 
+    def get_node_stats(self):
+        """get latency and error stats the proxy keeps of backend devices"""
+        try:
+            return read_node_stats(self.node_stats_path)
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                self.logger.exception(_('Error reading node stats'))
+                return None
+        return {}
+
     def GET(self, req):
         root, rcheck, rtype = req.split_path(1, 3, True)
         all_rtypes = ['account', 'container', 'object']
@@ -346,6 +362,8 @@ class ReconMiddleware(object):
             content = self.get_socket_info()
         elif rcheck == "version":
             content = self.get_version()
+        elif rcheck == "nodestats":
+            content = self.get_node_stats()
         else:
             content = "Invalid path: %s" % req.path
             return Response(request=req, status="404 Not Found",
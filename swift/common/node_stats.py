@@ -0,0 +1,224 @@
+# Copyright (c) 2010-2012 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Response time and error statistics for backend devices, kept in a table
+that all proxy server workers on a host share through a memory-mapped file.
+
+Each device has a slot holding an exponentially weighted moving average of
+its response times and a count of its recent errors that halves every
+error_half_life seconds. Slots are claimed under a file lock and never
+freed; their values are updated without locking, as the statistics are only
+hints for ordering nodes.
+"""
+
+from contextlib import contextmanager
+import fcntl
+import mmap
+import os
+import struct
+import time
+import zlib
+
+#: Name of the shared table's file in the recon cache directory
+NODE_STATS_FILE = 'proxy_node_stats'
+#: Number of devices the table has room for
+NODE_STATS_SLOTS = 4096
+#: Weight of a device's latest response time in its moving average
+LATENCY_ALPHA = 0.2
+
+_MAGIC = 'SWNSTAT1'
+# magic, slot count, error half-life
+_HEADER = struct.Struct('<8sI4xd')
+_KEY = struct.Struct('<96s')
+# latency, errors, time of last response, time of last error
+_VALUES = struct.Struct('<dddd')
+_SLOT_SIZE = _KEY.size + _VALUES.size
+
+
+def node_stats_key(node):
+    return '%(ip)s:%(port)s/%(device)s' % node
+
+
+def _sane(value):
+    # values are written without locking, so don't trust them blindly
+    return value if 0 <= value < float('inf') else 0.0
+
+
+def _decayed_errors(errors, error_at, half_life, now):
+    if half_life <= 0:
+        return 0.0
+    return _sane(errors) * 0.5 ** (max(now - _sane(error_at), 0) / half_life)
+
+
+def _dump_stats(buf):
+    magic, slots, half_life = _HEADER.unpack_from(buf, 0)
+    if magic != _MAGIC or len(buf) < _HEADER.size + slots * _SLOT_SIZE:
+        return {}
+    now = time.time()
+    stats = {}
+    for offset in xrange(_HEADER.size, _HEADER.size + slots * _SLOT_SIZE,
+                         _SLOT_SIZE):
+        key = _KEY.unpack_from(buf, offset)[0].rstrip('\0')
+        if not key:
+            continue
+        latency, errors, updated_at, error_at = _VALUES.unpack_from(
+            buf, offset + _KEY.size)
+        stats[key] = {
+            'latency': _sane(latency),
+            'errors': _decayed_errors(errors, error_at, half_life, now),
+            'updated_at': _sane(updated_at),
+            'error_at': _sane(error_at)}
+    return stats
+
+
+def read_node_stats(path):
+    """
+    Read the shared table without changing it.
+
+    :param path: path to the table's file
+    :returns: dict mapping "<ip>:<port>/<device>" to a dict of the device's
+              latency, decayed error count, and times of its last response
+              and error
+    """
+    with open(path, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size < _HEADER.size:
+            return {}
+        buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return _dump_stats(buf)
+        finally:
+            buf.close()
+
+
+class NodeStats(object):
+    """
+    Table of response time and error statistics for backend devices.
+
+    :param path: path to a file shared with other processes; if None, the
+                 table is private to this process
+    :param error_half_life: seconds for a device's error count to halve
+    :param slots: number of devices the table has room for
+    """
+
+    def __init__(self, path=None, error_half_life=60,
+                 slots=NODE_STATS_SLOTS):
+        self.error_half_life = error_half_life
+        self.slots = slots
+        self._offsets = {}
+        self._fd = None
+        size = _HEADER.size + slots * _SLOT_SIZE
+        if path is None:
+            self._map = mmap.mmap(-1, size)
+            _HEADER.pack_into(self._map, 0, _MAGIC, slots, error_half_life)
+            return
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self._lock():
+            if os.fstat(self._fd).st_size != size:
+                os.ftruncate(self._fd, size)
+            self._map = mmap.mmap(self._fd, size)
+            magic, count, half_life = _HEADER.unpack_from(self._map, 0)
+            if (magic, count) != (_MAGIC, slots):
+                # new, or left behind by a different layout
+                self._map[:] = '\0' * size
+            _HEADER.pack_into(self._map, 0, _MAGIC, slots, error_half_life)
+
+    @contextmanager
+    def _lock(self):
+        if self._fd is None:
+            yield
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _find(self, key, create=False):
+        """
+        :returns: offset of key's slot, or None if it has none
+        """
+        offset = self._offsets.get(key)
+        if offset is not None:
+            return offset
+        packed = _KEY.pack(key)
+        start = zlib.crc32(key) % self.slots
+        for probe in xrange(self.slots):
+            offset = _HEADER.size + \
+                ((start + probe) % self.slots) * _SLOT_SIZE
+            slot_key = self._map[offset:offset + _KEY.size]
+            if slot_key[0] == '\0':
+                if not create:
+                    return None
+                with self._lock():
+                    slot_key = self._map[offset:offset + _KEY.size]
+                    if slot_key[0] == '\0':
+                        self._map[offset:offset + _KEY.size] = packed
+                        slot_key = packed
+            if slot_key == packed:
+                self._offsets[key] = offset
+                return offset
+        return None
+
+    def _update(self, key, update):
+        offset = self._find(key, create=True)
+        if offset is None:
+            return
+        values = _VALUES.unpack_from(self._map, offset + _KEY.size)
+        _VALUES.pack_into(self._map, offset + _KEY.size,
+                          *update(*[_sane(value) for value in values]))
+
+    def record_latency(self, key, seconds):
+        """
+        Add a response time to a device's moving average.
+        """
+        def update(latency, errors, updated_at, error_at):
+            if updated_at:
+                latency += LATENCY_ALPHA * (seconds - latency)
+            else:
+                latency = seconds
+            return latency, errors, time.time(), error_at
+        self._update(key, update)
+
+    def record_error(self, key):
+        """
+        Count an error against a device.
+        """
+        def update(latency, errors, updated_at, error_at):
+            now = time.time()
+            errors = _decayed_errors(errors, error_at,
+                                     self.error_half_life, now)
+            return latency, errors + 1, updated_at, now
+        self._update(key, update)
+
+    def get(self, key):
+        """
+        :returns: a tuple of a device's average response time and its
+                  decayed error count; (0.0, 0.0) if it has no statistics
+        """
+        offset = self._find(key)
+        if offset is None:
+            return 0.0, 0.0
+        latency, errors, updated_at, error_at = _VALUES.unpack_from(
+            self._map, offset + _KEY.size)
+        return _sane(latency), _decayed_errors(
+            errors, error_at, self.error_half_life, time.time())
+
+    def dump(self):
+        """
+        :returns: the statistics of all devices in the table, as returned by
+                  :func:`read_node_stats`
+        """
+        return _dump_stats(self._map)
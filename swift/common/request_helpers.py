@@ -21,6 +21,7 @@ from swob in here without creating circular imports.
 """
 
 import hashlib
+import itertools
 import sys
 import time
 from contextlib import contextmanager
@@ -29,10 +30,15 @@ from swift.common.constraints import FORMAT2CONTENT_TYPE
 from swift.common.exceptions import ListingIterError, SegmentError
 from swift.common.http import is_success, HTTP_SERVICE_UNAVAILABLE
 from swift.common.swob import HTTPBadRequest, HTTPNotAcceptable
-from swift.common.utils import split_path, validate_device_partition
+from swift.common.utils import split_path, validate_device_partition, \
+    join_chunks
 from swift.common.wsgi import make_subrequest
 
 
+#: Size of the chunks in which long listings are streamed
+LISTING_CHUNK_SIZE = 65536
+
+
 def get_param(req, name, default=None):
     """
     Get parameters from an HTTP request ensuring proper handling UTF-8
@@ -78,6 +84,24 @@ def get_listing_content_type(req):
     return out_content_type
 
 
+def set_listing_body(resp, body_iter):
+    """
+    Set the body of a listing response from an iterator of strings. A body
+    that fits in one LISTING_CHUNK_SIZE chunk is sent with a Content-Length;
+    a longer one is streamed as it is generated.
+
+    :param resp: the swob.Response
+    :param body_iter: an iterator of strings making up the body
+    """
+    chunks = join_chunks(body_iter, LISTING_CHUNK_SIZE)
+    first = next(chunks, '')
+    second = next(chunks, None)
+    if second is None:
+        resp.body = first
+    else:
+        resp.app_iter = itertools.chain([first, second], chunks)
+
+
 def get_name_and_placement(request, minsegs=1, maxsegs=None,
                            rest_with_last=False):
     """
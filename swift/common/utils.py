@@ -46,6 +46,12 @@ try:
     import simplejson as json
 except ImportError:
     import json
+try:
+    # Provides the file type of directory entries, which saves a stat per
+    # entry when walking devices; os.listdir is used when it's not installed.
+    from scandir import scandir
+except ImportError:
+    scandir = None
 import cPickle as pickle
 import glob
 from urlparse import urlparse as stdlib_urlparse, ParseResult
@@ -59,6 +65,7 @@ from eventlet import GreenPool, sleep, Timeout, tpool, greenthread, \
     greenio, event
 from eventlet.green import socket, threading
 import eventlet.queue
+from eventlet.support.greenlets import GreenletExit
 import netifaces
 import codecs
 utf8_decoder = codecs.getdecoder('utf-8')
@@ -902,6 +909,52 @@ class GreenthreadSafeIterator(object):
             return self.unsafe_iter.next()
 
 
+class ReadAheadIterator(object):
+    """
+    Wrap an iterator, pulling up to depth items from it in a separate
+    greenthread ahead of the caller, so that producing the next items
+    overlaps with whatever the caller does with the previous ones.
+
+    An exception raised by the wrapped iterator is re-raised to the caller
+    once it has taken the items produced before it. Closing this iterator
+    stops the greenthread and closes the wrapped iterator.
+    """
+    def __init__(self, iterable, depth):
+        self.iterable = iter(iterable)
+        self.queue = eventlet.queue.Queue(depth)
+        self.finished = False
+        self.reader = eventlet.spawn(self._read)
+
+    def _read(self):
+        try:
+            for item in self.iterable:
+                self.queue.put((item, None))
+            self.queue.put((None, (StopIteration, StopIteration(), None)))
+        except GreenletExit:
+            raise
+        except BaseException:
+            self.queue.put((None, sys.exc_info()))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.finished:
+            raise StopIteration()
+        item, err = self.queue.get()
+        if err:
+            self.finished = True
+            raise err[0], err[1], err[2]
+        return item
+
+    def close(self):
+        self.finished = True
+        self.reader.kill()
+        close = getattr(self.iterable, 'close', None)
+        if close:
+            close()
+
+
 class NullLogger(object):
     """A no-op logger for eventlet wsgi."""
 
@@ -1938,6 +1991,92 @@ def remove_file(path):
         pass
 
 
+def _list_dir_entries(path):
+    """
+    Returns a sorted list of (name, is_dir) for the entries of a directory,
+    where is_dir is True or False if the type of the entry is known from the
+    directory entry itself and None if it is not. Returns an empty list if
+    the directory does not exist.
+    """
+    if scandir is None:
+        return sorted((name, None) for name in listdir(path))
+    try:
+        return sorted((entry.name, entry.is_dir()) for entry in scandir(path))
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+    return []
+
+
+def walk_dir_tree(path, depth, resume_after=None, shuffle_top=False):
+    """
+    Walks the directory tree below path, yielding (entry_path, names, is_dir)
+    for every entry depth levels down, where names is the tuple of the entry
+    names leading from path to the entry and is_dir is as returned by
+    _list_dir_entries. For example, walking a datadir with depth 3 yields
+    the hash directories, with names being (partition, suffix, hash).
+
+    Entries below path are listed lazily, one directory at a time, and only
+    entries that are directories or might be (when the file type isn't
+    known) are descended into; an entry that turns out not to be a directory
+    is skipped. No entry is stat'ed when the scandir module is available.
+
+    path itself is listed before this returns, so any error doing so
+    (other than path not existing) is raised to the caller; errors other
+    than ENOTDIR listing the directories below are raised while iterating.
+
+    :param path: the top of the tree to walk
+    :param depth: how many levels below path to yield entries from
+    :param resume_after: names previously yielded by a walk of the same tree;
+                         the walk continues with the entry that follows it.
+                         Names of fewer than depth levels skip everything
+                         below them. The entries of each directory are walked
+                         in sorted order, so a position remains valid as
+                         entries are added and removed.
+    :param shuffle_top: walk the entries of path itself in random order, so a
+                        restarted walk doesn't always begin with the same
+                        ones; can't be combined with resume_after
+    :returns: a generator of (entry_path, names, is_dir) tuples
+    """
+    if resume_after and shuffle_top:
+        raise ValueError('resume_after can not be used with shuffle_top')
+    entries = _list_dir_entries(path)
+    if shuffle_top:
+        shuffle(entries)
+    return _walk_dir_entries(path, entries, (), depth,
+                             tuple(resume_after or ()))
+
+
+def _walk_dir_entries(path, entries, names, depth, resume_after):
+    for name, is_dir in entries:
+        child_resume_after = ()
+        if resume_after:
+            if name < resume_after[0]:
+                continue
+            if name == resume_after[0]:
+                child_resume_after = resume_after[1:]
+                if depth == 1 or not child_resume_after:
+                    resume_after = ()
+                    continue
+            resume_after = ()
+        entry_path = os.path.join(path, name)
+        if depth == 1:
+            yield entry_path, names + (name,), is_dir
+            continue
+        if is_dir is False:
+            continue
+        try:
+            child_entries = _list_dir_entries(entry_path)
+        except OSError as err:
+            if err.errno != errno.ENOTDIR:
+                raise
+            continue
+        for item in _walk_dir_entries(entry_path, child_entries,
+                                      names + (name,), depth - 1,
+                                      child_resume_after):
+            yield item
+
+
 def audit_location_generator(devices, datadir, suffix='',
                              mount_check=True, logger=None):
     '''
@@ -1964,40 +2103,25 @@ def audit_location_generator(devices, datadir, suffix='',
             continue
         datadir_path = os.path.join(devices, device, datadir)
         try:
-            partitions = listdir(datadir_path)
+            hash_dirs = walk_dir_tree(datadir_path, 3)
         except OSError as e:
             if logger:
                 logger.warning('Skipping %s because %s', datadir_path, e)
             continue
-        for partition in partitions:
-            part_path = os.path.join(datadir_path, partition)
+        for hash_path, (partition, _suffix, _hash), is_dir in hash_dirs:
+            if is_dir is False:
+                continue
             try:
-                suffixes = listdir(part_path)
+                files = sorted(listdir(hash_path), reverse=True)
             except OSError as e:
                 if e.errno != errno.ENOTDIR:
                     raise
                 continue
-            for asuffix in suffixes:
-                suff_path = os.path.join(part_path, asuffix)
-                try:
-                    hashes = listdir(suff_path)
-                except OSError as e:
-                    if e.errno != errno.ENOTDIR:
-                        raise
+            for fname in files:
+                if suffix and not fname.endswith(suffix):
                     continue
-                for hsh in hashes:
-                    hash_path = os.path.join(suff_path, hsh)
-                    try:
-                        files = sorted(listdir(hash_path), reverse=True)
-                    except OSError as e:
-                        if e.errno != errno.ENOTDIR:
-                            raise
-                        continue
-                    for fname in files:
-                        if suffix and not fname.endswith(suffix):
-                            continue
-                        path = os.path.join(hash_path, fname)
-                        yield path, device, partition
+                path = os.path.join(hash_path, fname)
+                yield path, device, partition
 
 
 def ratelimit_sleep(running_time, max_rate, incr_by=1, rate_buffer=5):
@@ -2093,22 +2217,36 @@ class GreenAsyncPile(object):
         self._inflight += 1
         self._pool.spawn(self._run_func, func, args, kwargs)
 
-    def waitall(self, timeout):
-        """
-        Wait timeout seconds for any results to come in.
-
-        :param timeout: seconds to wait for results
-        :returns: list of results accrued in that time
-        """
+    def _wait(self, timeout, first_n=None):
         results = []
         try:
             with GreenAsyncPileWaitallTimeout(timeout):
                 while True:
                     results.append(self.next())
+                    if first_n and len(results) >= first_n:
+                        break
         except (GreenAsyncPileWaitallTimeout, StopIteration):
             pass
         return results
 
+    def waitall(self, timeout):
+        """
+        Wait timeout seconds for any results to come in.
+
+        :param timeout: seconds to wait for results
+        :returns: list of results accrued in that time
+        """
+        return self._wait(timeout)
+
+    def waitfirst(self, timeout):
+        """
+        Wait up to timeout seconds for the first result to come in.
+
+        :param timeout: seconds to wait for results
+        :returns: list holding the first result, or empty if none came in
+        """
+        return self._wait(timeout, first_n=1)
+
     def __iter__(self):
         return self
 
@@ -2559,6 +2697,27 @@ class CloseableChain(object):
                 close_method()
 
 
+def join_chunks(iterable, chunk_size=65536):
+    """
+    Join the strings from an iterator into chunks of at least chunk_size
+    bytes, the last one possibly shorter.
+
+    :param iterable: an iterable of strings
+    :param chunk_size: minimum size of the chunks to yield
+    """
+    pieces = []
+    size = 0
+    for piece in iterable:
+        pieces.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(pieces)
+            pieces = []
+            size = 0
+    if pieces:
+        yield ''.join(pieces)
+
+
 def reiterate(iterable):
     """
     Consume the first item from an iterator, then re-chain it to the rest of
@@ -3277,3 +3436,92 @@ def system_has_splice():
         return True
     except AttributeError:
         return False
+
+
+#: Shard containers of a root container in account "a" are kept in the
+#: hidden account ".shards_a".
+SHARDS_ACCOUNT_PREFIX = '.shards_'
+
+
+def shards_account(account):
+    """
+    Returns the name of the hidden account holding the shard containers of
+    the given account's containers.
+    """
+    return SHARDS_ACCOUNT_PREFIX + account
+
+
+class ShardRange(object):
+    """
+    The range of object names held by a shard container of a root container,
+    with the shard's usage as last reported to the root.
+
+    A shard holds the object names greater than lower and less than or
+    equal to upper; an empty lower or upper leaves that end of the range
+    unbounded.
+
+    :param name: the name of the shard container, in the root container's
+                 shards account
+    :param created_at: the timestamp of the range's bounds
+    :param lower: the lower bound (exclusive) of the range
+    :param upper: the upper bound (inclusive) of the range
+    :param object_count: the number of objects in the shard
+    :param bytes_used: the number of bytes used by objects in the shard
+    :param stats_at: the timestamp of object_count and bytes_used
+    :param deleted: 1 if the range is no longer in use
+    """
+
+    fields = ('name', 'created_at', 'lower', 'upper', 'object_count',
+              'bytes_used', 'stats_at', 'deleted')
+
+    def __init__(self, name, created_at, lower='', upper='', object_count=0,
+                 bytes_used=0, stats_at='0', deleted=0):
+        self.name = name
+        self.created_at = created_at
+        self.lower = lower
+        self.upper = upper
+        self.object_count = object_count
+        self.bytes_used = bytes_used
+        self.stats_at = stats_at
+        self.deleted = deleted
+
+    @classmethod
+    def create(cls, account, container, lower, upper, created_at):
+        """
+        Returns a new range of the given root container, named after the
+        root container and the range's bounds.
+        """
+        name = '%s-%s' % (container[:150], md5('/'.join((
+            account, container, lower, upper, created_at))).hexdigest())
+        return cls(name, created_at, lower, upper)
+
+    def __contains__(self, name):
+        return (not self.lower or name > self.lower) and \
+            (not self.upper or name <= self.upper)
+
+    def __eq__(self, other):
+        try:
+            return self.as_dict() == other.as_dict()
+        except AttributeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'ShardRange(%r, %r, lower=%r, upper=%r)' % (
+            self.name, self.created_at, self.lower, self.upper)
+
+    def as_dict(self):
+        return dict((field, getattr(self, field)) for field in self.fields)
+
+    @classmethod
+    def from_dict(cls, data):
+        kwargs = {}
+        for field in cls.fields:
+            if field in data:
+                value = data[field]
+                if isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                kwargs[field] = value
+        return cls(**kwargs)
@@ -43,6 +43,8 @@ class ContainerAuditor(Daemon):
             float(conf.get('containers_per_second', 200))
         swift.common.db.DB_PREALLOCATION = \
             config_true_value(conf.get('db_preallocation', 'f'))
+        swift.common.db.DB_WAL_MODE = \
+            config_true_value(conf.get('db_wal_mode', 'f'))
         self.recon_cache_path = conf.get('recon_cache_path',
                                          '/var/cache/swift')
         self.rcache = os.path.join(self.recon_cache_path, "container.recon")
@@ -20,10 +20,11 @@ import os
 from uuid import uuid4
 import time
 import cPickle as pickle
+from hashlib import md5
 
 import sqlite3
 
-from swift.common.utils import Timestamp
+from swift.common.utils import Timestamp, ShardRange
 from swift.common.db import DatabaseBroker, utf8encode
 
 
@@ -31,6 +32,54 @@ SQLITE_ARG_LIMIT = 999
 
 DATADIR = 'containers'
 
+#: Number of rows under a pseudo-directory read past by a delimiter listing
+#: before it seeks past the rest with a new query
+LISTING_SKIP_ROWS = 32
+
+SHARD_RANGE_TABLE_CREATE = '''
+    CREATE TABLE shard_range (
+        name TEXT PRIMARY KEY,
+        created_at TEXT,
+        lower TEXT,
+        upper TEXT,
+        object_count INTEGER DEFAULT 0,
+        bytes_used INTEGER DEFAULT 0,
+        stats_at TEXT DEFAULT '0',
+        deleted INTEGER DEFAULT 0
+    );
+'''
+
+# The usage of the object rows a sharded container DB still holds in each of
+# its shard ranges, as last counted by the sharder. Local to each DB.
+UNCLEAVED_USAGE_TABLE_CREATE = '''
+    CREATE TABLE uncleaved_usage (
+        name TEXT PRIMARY KEY,
+        object_count INTEGER DEFAULT 0,
+        bytes_used INTEGER DEFAULT 0
+    );
+'''
+
+# Covers the lookups merge_items makes for each incoming row; DBs with it
+# are at version 2.
+OBJECT_MERGE_INDEX_CREATE = '''
+    CREATE INDEX IF NOT EXISTS ix_object_name_policy
+    ON object (name, storage_policy_index, deleted, created_at);
+'''
+
+# Incoming rows are staged here by merge_items to be merged in bulk.
+MERGE_ITEM_TABLE_CREATE = '''
+    CREATE TEMP TABLE IF NOT EXISTS merge_item (
+        name TEXT,
+        created_at TEXT,
+        size INTEGER,
+        content_type TEXT,
+        etag TEXT,
+        deleted INTEGER,
+        storage_policy_index INTEGER,
+        remote_rowid INTEGER
+    );
+'''
+
 POLICY_STAT_TABLE_CREATE = '''
     CREATE TABLE policy_stat (
         storage_policy_index INTEGER PRIMARY KEY,
@@ -183,7 +232,7 @@ class ContainerBroker(DatabaseBroker):
             );
 
             CREATE INDEX ix_object_deleted_name ON object (deleted, name);
-
+        """ + OBJECT_MERGE_INDEX_CREATE + """
             CREATE TRIGGER object_update BEFORE UPDATE ON object
             BEGIN
                 SELECT RAISE(FAIL, 'UPDATE not allowed; DELETE and INSERT');
@@ -246,12 +295,35 @@ class ContainerBroker(DatabaseBroker):
     def get_db_version(self, conn):
         if self._db_version == -1:
             self._db_version = 0
-            for row in conn.execute('''
+            indexes = set(row[0] for row in conn.execute('''
                     SELECT name FROM sqlite_master
-                    WHERE name = 'ix_object_deleted_name' '''):
+                    WHERE name IN ('ix_object_deleted_name',
+                                   'ix_object_name_policy') '''))
+            if 'ix_object_deleted_name' in indexes:
                 self._db_version = 1
+                if 'ix_object_name_policy' in indexes:
+                    self._db_version = 2
         return self._db_version
 
+    def add_merge_index(self):
+        """
+        Migrate a version 1 DB to version 2 by adding the index that lets
+        merge_items merge in bulk. Building the index reads the whole object
+        table, so it's left to the replicator rather than done on the way to
+        merging items.
+        """
+        with self.get() as conn:
+            if self.get_db_version(conn) != 1:
+                return
+            try:
+                conn.executescript(OBJECT_MERGE_INDEX_CREATE)
+            except sqlite3.OperationalError as err:
+                if 'no such column: storage_policy_index' not in str(err):
+                    raise
+                self._migrate_add_storage_policy(conn)
+                conn.executescript(OBJECT_MERGE_INDEX_CREATE)
+            self._db_version = -1
+
     def _newid(self, conn):
         conn.execute('''
             UPDATE container_stat
@@ -274,7 +346,7 @@ class ContainerBroker(DatabaseBroker):
 
     def _commit_puts_load(self, item_list, entry):
         """See :func:`swift.common.db.DatabaseBroker._commit_puts_load`"""
-        data = pickle.loads(entry.decode('base64'))
+        data = pickle.loads(entry)
         (name, timestamp, size, content_type, etag, deleted) = data[:6]
         if len(data) > 6:
             storage_policy_index = data[6]
@@ -306,7 +378,9 @@ class ContainerBroker(DatabaseBroker):
                     raise
                 row = conn.execute(
                     'SELECT object_count from container_stat').fetchone()
-            return (row[0] == 0)
+            return row[0] == 0 and not any(
+                shard_range.object_count
+                for shard_range in self._get_shard_ranges(conn))
 
     def delete_object(self, name, timestamp, storage_policy_index=0):
         """
@@ -423,6 +497,25 @@ class ContainerBroker(DatabaseBroker):
                     else:
                         raise
             data = dict(data)
+            # The objects of a sharded container are mostly in its shards.
+            # Until this DB has been cleaved, the rows in a shard's range
+            # may also be counted by the shard, so each range counts
+            # whichever of the two has more, going by the usage the sharder
+            # last recorded for the range. A range it hasn't yet recorded is
+            # counted by this DB's rows alone.
+            uncleaved = data['object_count']
+            usage = {}
+            if uncleaved:
+                usage = self._get_uncleaved_usage(conn)
+            for shard_range in self._get_shard_ranges(conn):
+                if uncleaved and shard_range.name not in usage:
+                    continue
+                object_count, bytes_used = usage.get(shard_range.name,
+                                                     (0, 0))
+                data['object_count'] += max(
+                    0, shard_range.object_count - object_count)
+                data['bytes_used'] += max(
+                    0, shard_range.bytes_used - bytes_used)
             # populate instance cache
             self._storage_policy_index = data['storage_policy_index']
             self.account = data['account']
@@ -583,50 +676,60 @@ class ContainerBroker(DatabaseBroker):
             prefix = ''
         orig_marker = marker
         with self.get() as conn:
+            # The listing may take one query per pseudo-directory; build each
+            # query's text just once so sqlite's statement cache can reuse it.
+            if self.get_db_version(conn) < 1:
+                deleted_clause = ' +deleted = 0'
+            else:
+                deleted_clause = ' deleted = 0'
+            queries = {}
+            with_policy = [True]
+
+            def execute(lower_op, lower, remaining):
+                key = (lower_op, with_policy[0])
+                if key not in queries:
+                    query = '''SELECT name, created_at, size, content_type, etag
+                               FROM object WHERE'''
+                    if end_marker:
+                        query += ' name < ? AND'
+                    if lower_op:
+                        query += ' name %s ? AND' % lower_op
+                    query += deleted_clause
+                    if with_policy[0]:
+                        query += ' AND storage_policy_index = ?'
+                    queries[key] = query + ' ORDER BY name LIMIT ?'
+                args = [end_marker] if end_marker else []
+                if lower_op:
+                    args.append(lower)
+                if with_policy[0]:
+                    args.append(storage_policy_index)
+                args.append(remaining)
+                return conn.execute(queries[key], args)
+
             results = []
             while len(results) < limit:
-                query = '''SELECT name, created_at, size, content_type, etag
-                           FROM object WHERE'''
-                query_args = []
-                if end_marker:
-                    query += ' name < ? AND'
-                    query_args.append(end_marker)
+                lower_op = lower = None
                 if delim_force_gte:
-                    query += ' name >= ? AND'
-                    query_args.append(marker)
+                    lower_op, lower = '>=', marker
                     # Always set back to False
                     delim_force_gte = False
                 elif marker and marker >= prefix:
-                    query += ' name > ? AND'
-                    query_args.append(marker)
+                    lower_op, lower = '>', marker
                 elif prefix:
-                    query += ' name >= ? AND'
-                    query_args.append(prefix)
-                if self.get_db_version(conn) < 1:
-                    query += ' +deleted = 0'
+                    lower_op, lower = '>=', prefix
+                if prefix is not None and delimiter:
+                    # rows under pseudo-directories are read past, so
+                    # don't let them use up the limit
+                    remaining = -1
                 else:
-                    query += ' deleted = 0'
-                orig_tail_query = '''
-                    ORDER BY name LIMIT ?
-                '''
-                orig_tail_args = [limit - len(results)]
-                # storage policy filter
-                policy_tail_query = '''
-                    AND storage_policy_index = ?
-                ''' + orig_tail_query
-                policy_tail_args = [storage_policy_index] + orig_tail_args
-                tail_query, tail_args = \
-                    policy_tail_query, policy_tail_args
+                    remaining = limit - len(results)
                 try:
-                    curs = conn.execute(query + tail_query,
-                                        tuple(query_args + tail_args))
+                    curs = execute(lower_op, lower, remaining)
                 except sqlite3.OperationalError as err:
                     if 'no such column: storage_policy_index' not in str(err):
                         raise
-                    tail_query, tail_args = \
-                        orig_tail_query, orig_tail_args
-                    curs = conn.execute(query + tail_query,
-                                        tuple(query_args + tail_args))
+                    with_policy[0] = False
+                    curs = execute(lower_op, lower, remaining)
                 curs.row_factory = None
 
                 if prefix is None:
@@ -643,11 +746,24 @@ class ContainerBroker(DatabaseBroker):
                         return [r for r in curs if r[0].startswith(prefix)]
 
                 # We have a delimiter and a prefix (possibly empty string) to
-                # handle
-                rowcount = 0
+                # handle. Rows under a pseudo-directory are read past until
+                # there have been LISTING_SKIP_ROWS of them; it's only then
+                # worth a new query to seek past the rest on the name index.
+                dir_name = None
+                skipped = 0
                 for row in curs:
-                    rowcount += 1
-                    marker = name = row[0]
+                    name = row[0]
+                    if dir_name is not None:
+                        if name.startswith(dir_name):
+                            skipped += 1
+                            if skipped < LISTING_SKIP_ROWS:
+                                continue
+                            marker = dir_name[:-1] + chr(ord(delimiter) + 1)
+                            # we want result to be inclusive of delim+1
+                            delim_force_gte = path is None
+                            curs.close()
+                            break
+                        dir_name = None
                     if len(results) >= limit or not name.startswith(prefix):
                         curs.close()
                         return results
@@ -656,23 +772,34 @@ class ContainerBroker(DatabaseBroker):
                         if name == path:
                             continue
                         if end >= 0 and len(name) > end + len(delimiter):
-                            marker = name[:end] + chr(ord(delimiter) + 1)
-                            curs.close()
-                            break
+                            dir_name = name[:end + 1]
+                            skipped = 0
+                            continue
                     elif end > 0:
-                        marker = name[:end] + chr(ord(delimiter) + 1)
-                        # we want result to be inclusive of delim+1
-                        delim_force_gte = True
                         dir_name = name[:end + 1]
+                        skipped = 0
                         if dir_name != orig_marker:
                             results.append([dir_name, '0', 0, None, ''])
-                        curs.close()
-                        break
+                        continue
                     results.append(row)
-                if not rowcount:
+                else:
+                    # no more rows
                     break
             return results
 
+    def stream_objects(self, limit, marker, end_marker, prefix, delimiter,
+                       path=None, storage_policy_index=0):
+        """
+        Generate the same entries as :func:`list_objects_iter`, reading them
+        from the DB in batches.
+
+        :returns: iterator of tuples of (name, created_at, size,
+                  content_type, etag)
+        """
+        return self._stream_listing(
+            self.list_objects_iter, limit, marker, end_marker, prefix,
+            delimiter, path=path, storage_policy_index=storage_policy_index)
+
     def merge_items(self, item_list, source=None):
         """
         Merge items into the object table.
@@ -686,7 +813,73 @@ class ContainerBroker(DatabaseBroker):
             if isinstance(item['name'], unicode):
                 item['name'] = item['name'].encode('utf-8')
 
+        def _update_incoming_sync(curs, max_rowid):
+            curs.execute('''
+                UPDATE incoming_sync SET
+                sync_point=max(?, sync_point) WHERE remote_id=?
+            ''', (max_rowid, source))
+            if curs.rowcount < 1:
+                curs.execute('''
+                    INSERT INTO incoming_sync (sync_point, remote_id)
+                    VALUES (?, ?)
+                ''', (max_rowid, source))
+
+        def _bulk_merge_items(conn):
+            # Keep just the newest of any duplicate entries in item_list.
+            to_merge = {}
+            for item in item_list:
+                item.setdefault('storage_policy_index', 0)  # legacy
+                item_ident = (item['name'], item['storage_policy_index'])
+                if item_ident not in to_merge or \
+                        to_merge[item_ident]['created_at'] <= \
+                        item['created_at']:
+                    to_merge[item_ident] = item
+            curs = conn.cursor()
+            curs.execute('BEGIN IMMEDIATE')
+            curs.execute(MERGE_ITEM_TABLE_CREATE)
+            curs.execute('DELETE FROM merge_item')
+            curs.executemany(
+                'INSERT INTO merge_item VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                ((rec['name'], rec['created_at'], rec['size'],
+                  rec['content_type'], rec['etag'], rec['deleted'],
+                  rec['storage_policy_index'], rec.get('ROWID'))
+                 for rec in to_merge.itervalues()))
+            # Drop the items that are no newer than the rows they'd replace,
+            # then replace the rest; the object_update trigger only allows a
+            # DELETE and INSERT.
+            curs.execute('''
+                DELETE FROM merge_item WHERE EXISTS (
+                    SELECT 1 FROM object
+                    WHERE object.name = merge_item.name
+                    AND object.storage_policy_index =
+                        merge_item.storage_policy_index
+                    AND object.created_at >= merge_item.created_at)
+            ''')
+            curs.execute('''
+                DELETE FROM object WHERE ROWID IN (
+                    SELECT object.ROWID FROM merge_item JOIN object
+                    ON object.name = merge_item.name
+                    AND object.storage_policy_index =
+                        merge_item.storage_policy_index)
+            ''')
+            curs.execute('''
+                INSERT INTO object (name, created_at, size, content_type,
+                                    etag, deleted, storage_policy_index)
+                SELECT name, created_at, size, content_type, etag, deleted,
+                       storage_policy_index
+                FROM merge_item
+            ''')
+            if source and curs.rowcount > 0:
+                max_rowid = curs.execute(
+                    'SELECT max(remote_rowid) FROM merge_item').fetchone()[0]
+                if max_rowid is not None:
+                    _update_incoming_sync(curs, max_rowid)
+            curs.execute('DELETE FROM merge_item')
+            conn.commit()
+
         def _really_merge_items(conn):
+            if self.get_db_version(conn) >= 2:
+                return _bulk_merge_items(conn)
             curs = conn.cursor()
             if self.get_db_version(conn) >= 1:
                 query_mod = ' deleted IN (0, 1) AND '
@@ -737,15 +930,7 @@ class ContainerBroker(DatabaseBroker):
                 if source:
                     max_rowid = max(rec['ROWID']
                                     for rec in to_add.itervalues())
-                    curs.execute('''
-                        UPDATE incoming_sync SET
-                        sync_point=max(?, sync_point) WHERE remote_id=?
-                    ''', (max_rowid, source))
-                    if curs.rowcount < 1:
-                        curs.execute('''
-                            INSERT INTO incoming_sync (sync_point, remote_id)
-                            VALUES (?, ?)
-                        ''', (max_rowid, source))
+                    _update_incoming_sync(curs, max_rowid)
             conn.commit()
 
         with self.get() as conn:
@@ -757,6 +942,296 @@ class ContainerBroker(DatabaseBroker):
                 self._migrate_add_storage_policy(conn)
                 return _really_merge_items(conn)
 
+    def _get_shard_ranges(self, conn, include_deleted=False):
+        query = 'SELECT %s FROM shard_range' % ', '.join(ShardRange.fields)
+        if not include_deleted:
+            query += ' WHERE deleted = 0'
+        try:
+            rows = conn.execute(
+                query + " ORDER BY upper = '', upper").fetchall()
+        except sqlite3.OperationalError as err:
+            if 'no such table: shard_range' not in str(err):
+                raise
+            return []
+        return [ShardRange(*row) for row in rows]
+
+    def _get_range_usage(self, conn, lower, upper, storage_policy_index):
+        query = '''
+            SELECT COUNT(*), SUM(size) FROM object
+            WHERE deleted = 0 AND name > ?'''
+        args = [lower]
+        if upper:
+            query += ' AND name <= ?'
+            args.append(upper)
+        query += ' AND storage_policy_index = ?'
+        args.append(storage_policy_index)
+        object_count, bytes_used = conn.execute(query, args).fetchone()
+        return object_count, bytes_used or 0
+
+    def _get_uncleaved_usage(self, conn):
+        try:
+            rows = conn.execute(
+                'SELECT name, object_count, bytes_used FROM uncleaved_usage'
+            ).fetchall()
+        except sqlite3.OperationalError as err:
+            if 'no such table: uncleaved_usage' not in str(err):
+                raise
+            return {}
+        return dict((name, (object_count, bytes_used))
+                    for name, object_count, bytes_used in rows)
+
+    def update_uncleaved_usage(self):
+        """
+        Count the object rows this DB still holds in each of its shard
+        ranges, and record them for get_info to weigh against the usage the
+        shards report. Called by the sharder as it cleaves, so that
+        get_info needn't count the rows itself.
+        """
+        policy_index = self.storage_policy_index
+
+        def _really_update(conn):
+            usage = [
+                (shard_range.name,) + self._get_range_usage(
+                    conn, shard_range.lower, shard_range.upper,
+                    policy_index)
+                for shard_range in self._get_shard_ranges(conn)]
+            conn.execute('DELETE FROM uncleaved_usage')
+            conn.executemany(
+                'INSERT INTO uncleaved_usage '
+                '(name, object_count, bytes_used) VALUES (?, ?, ?)', usage)
+            conn.commit()
+
+        with self.get() as conn:
+            try:
+                return _really_update(conn)
+            except sqlite3.OperationalError as err:
+                if 'no such table: uncleaved_usage' not in str(err):
+                    raise
+                conn.executescript(UNCLEAVED_USAGE_TABLE_CREATE)
+                return _really_update(conn)
+
+    def get_uncleaved_object_count(self):
+        """
+        Get the number of objects listed by this DB itself rather than by
+        its shards: all of them until the container is sharded, then those
+        the sharder hasn't yet moved into the shards.
+
+        :returns: the number of object rows in this DB that aren't deleted
+        """
+        self._commit_puts_stale_ok()
+        with self.get() as conn:
+            return conn.execute(
+                'SELECT object_count FROM container_stat').fetchone()[0]
+
+    def get_shard_ranges(self, include_deleted=False):
+        """
+        Get the shard ranges of a sharded container, in order of their
+        bounds.
+
+        :param include_deleted: include the ranges no longer in use
+        :returns: a list of :class:`ShardRange`; empty if the container
+                  isn't sharded
+        """
+        with self.get() as conn:
+            return self._get_shard_ranges(conn, include_deleted)
+
+    def is_sharded(self):
+        """
+        :returns: True if object names are kept in shard containers
+        """
+        with self.get() as conn:
+            return bool(self._get_shard_ranges(conn))
+
+    def merge_shard_ranges(self, shard_ranges):
+        """
+        Merge shard ranges into the shard_range table. The bounds and
+        deleted status of a range are taken from whichever copy has the
+        newest created_at, and its usage from whichever copy has the newest
+        stats_at.
+
+        :param shard_ranges: a list of :class:`ShardRange`
+        """
+        def _really_merge(conn):
+            curs = conn.cursor()
+            curs.execute('BEGIN IMMEDIATE')
+            for shard_range in shard_ranges:
+                row = curs.execute(
+                    'SELECT %s FROM shard_range WHERE name = ?' %
+                    ', '.join(ShardRange.fields),
+                    (shard_range.name,)).fetchone()
+                merged = shard_range
+                if row:
+                    existing = ShardRange(*row)
+                    merged = ShardRange.from_dict(existing.as_dict())
+                    if shard_range.created_at > existing.created_at:
+                        for field in ('created_at', 'lower', 'upper',
+                                      'deleted'):
+                            setattr(merged, field,
+                                    getattr(shard_range, field))
+                    if shard_range.stats_at > existing.stats_at:
+                        for field in ('object_count', 'bytes_used',
+                                      'stats_at'):
+                            setattr(merged, field,
+                                    getattr(shard_range, field))
+                    if merged == existing:
+                        continue
+                curs.execute(
+                    'INSERT OR REPLACE INTO shard_range (%s) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)' %
+                    ', '.join(ShardRange.fields),
+                    [getattr(merged, field) for field in ShardRange.fields])
+            conn.commit()
+
+        with self.get() as conn:
+            try:
+                return _really_merge(conn)
+            except sqlite3.OperationalError as err:
+                if 'no such table: shard_range' not in str(err):
+                    raise
+                conn.executescript(SHARD_RANGE_TABLE_CREATE)
+                return _really_merge(conn)
+
+    def get_objects_in_range(self, lower, upper, limit, marker=None):
+        """
+        Get the object rows, including deleted ones, whose names are within
+        a shard range, in name order.
+
+        :param lower: the lower bound (exclusive) of the range, or '' if
+                      unbounded
+        :param upper: the upper bound (inclusive) of the range, or '' if
+                      unbounded
+        :param limit: the maximum number of rows to return
+        :param marker: only return rows with names greater than marker
+        :returns: a list of dicts with the same keys as get_items_since
+        """
+        self._commit_puts_stale_ok()
+        query = '''
+            SELECT ROWID, name, created_at, size, content_type, etag, deleted,
+                   storage_policy_index
+            FROM object WHERE name > ?'''
+        args = [max(lower, marker or '')]
+        if upper:
+            query += ' AND name <= ?'
+            args.append(upper)
+        query += ' ORDER BY name LIMIT ?'
+        args.append(limit)
+        with self.get() as conn:
+            curs = conn.execute(query, args)
+            return [dict(row) for row in curs]
+
+    def _range_clause(self, lower, upper):
+        clause = 'name > ?'
+        args = [lower]
+        if upper:
+            clause += ' AND name <= ?'
+            args.append(upper)
+        return clause, args
+
+    def get_range_digests(self, ranges):
+        """
+        Get digests of the object rows, including deleted ones, in each of
+        a list of name ranges. A range's digest XORs together the same row
+        hashes that make up the DB's hash, so replicas holding the same rows
+        in a range have the same digest for it.
+
+        :param ranges: a list of (lower, upper) bounds, as for
+                       get_objects_in_range
+        :returns: a list of (row count, hex digest) tuples, one per range
+        """
+        self._commit_puts_stale_ok()
+        digests = []
+        with self.get() as conn:
+            for lower, upper in ranges:
+                clause, args = self._range_clause(lower, upper)
+                count = digest = 0
+                for name, created_at in conn.execute(
+                        'SELECT name, created_at FROM object WHERE ' + clause,
+                        args):
+                    count += 1
+                    digest ^= int(md5('%s-%s' % (name, created_at))
+                                  .hexdigest(), 16)
+                digests.append((count, '%032x' % digest))
+        return digests
+
+    def split_range(self, lower, upper, parts):
+        """
+        Split a name range into ranges holding about the same number of
+        object rows, including deleted ones.
+
+        :param lower: the lower bound (exclusive) of the range, or ''
+        :param upper: the upper bound (inclusive) of the range, or ''
+        :param parts: the number of ranges to split it into
+        :returns: a list of (lower, upper) bounds, in order, covering the
+                  range
+        """
+        self._commit_puts_stale_ok()
+        clause, args = self._range_clause(lower, upper)
+        with self.get() as conn:
+            count = conn.execute(
+                'SELECT COUNT(*) FROM object WHERE ' + clause,
+                args).fetchone()[0]
+            step = max(1, -(-count // parts))
+            uppers = []
+            for _junk in range(parts - 1):
+                clause, args = self._range_clause(
+                    uppers[-1] if uppers else lower, upper)
+                row = conn.execute(
+                    'SELECT name FROM object WHERE %s ORDER BY name '
+                    'LIMIT 1 OFFSET ?' % clause, args + [step - 1]).fetchone()
+                if not row or row[0] == upper:
+                    break
+                uppers.append(row[0])
+        lowers = [lower] + uppers
+        return zip(lowers, uppers + [upper])
+
+    def remove_objects(self, item_list):
+        """
+        Remove object rows once they have been moved to a shard container.
+        A row is only removed if it hasn't been replaced since it was read.
+
+        :param item_list: a list of rows as returned by get_objects_in_range
+        """
+        with self.get() as conn:
+            conn.executemany(
+                'DELETE FROM object WHERE name = ? AND created_at = ? '
+                'AND storage_policy_index = ?',
+                ((item['name'], item['created_at'],
+                  item['storage_policy_index']) for item in item_list))
+            conn.commit()
+
+    def find_shard_bounds(self, rows_per_shard):
+        """
+        Find the upper bounds splitting the container's objects into ranges
+        of rows_per_shard objects; the last range, which holds what's left,
+        is unbounded.
+
+        :param rows_per_shard: the number of objects in each range
+        :returns: a list of (lower, upper) bounds, in order
+        """
+        self._commit_puts_stale_ok()
+        uppers = []
+        with self.get() as conn:
+            while True:
+                row = conn.execute('''
+                    SELECT name FROM object WHERE deleted = 0 AND name > ?
+                    ORDER BY name LIMIT 1 OFFSET ?
+                ''', (uppers[-1] if uppers else '',
+                      rows_per_shard - 1)).fetchone()
+                if not row:
+                    break
+                uppers.append(row[0])
+        if uppers:
+            # don't leave an empty last range behind
+            row = None
+            with self.get() as conn:
+                row = conn.execute('''
+                    SELECT name FROM object WHERE deleted = 0 AND name > ?
+                    LIMIT 1''', (uppers[-1],)).fetchone()
+            if not row:
+                uppers.pop()
+        lowers = [''] + uppers
+        return zip(lowers, uppers + [''])
+
     def get_reconciler_sync(self):
         with self.get() as conn:
             try:
@@ -19,6 +19,7 @@ import time
 from collections import defaultdict
 from eventlet import Timeout
 
+from swift import gettext_ as _
 from swift.container.backend import ContainerBroker, DATADIR
 from swift.container.reconciler import (
     MISPLACED_OBJECTS_ACCOUNT, incorrect_policy_index,
@@ -27,9 +28,10 @@ from swift.common import db_replicator
 from swift.common.storage_policy import POLICIES
 from swift.common.exceptions import DeviceUnavailable
 from swift.common.http import is_success
+from swift.common.swob import HTTPAccepted, Response
 from swift.common.db import DatabaseAlreadyExists
 from swift.common.utils import (json, Timestamp, hash_path,
-                                storage_directory, quorum_size)
+                                storage_directory, quorum_size, ShardRange)
 
 
 class ContainerReplicator(db_replicator.Replicator):
@@ -38,6 +40,14 @@ class ContainerReplicator(db_replicator.Replicator):
     datadir = DATADIR
     default_port = 6001
 
+    def __init__(self, conf, logger=None):
+        super(ContainerReplicator, self).__init__(conf, logger=logger)
+        self.digest_sync_fanout = int(conf.get('digest_sync_fanout', 0))
+
+    def _zero_stats(self):
+        super(ContainerReplicator, self)._zero_stats()
+        self.stats['digest_sync'] = 0
+
     def report_up_to_date(self, full_info):
         for key in ('put_timestamp', 'delete_timestamp', 'object_count',
                     'bytes_used'):
@@ -68,10 +78,115 @@ class ContainerReplicator(db_replicator.Replicator):
             if any(info[key] != remote_info[key] for key in sync_timestamps):
                 broker.merge_timestamps(*(remote_info[key] for key in
                                           sync_timestamps))
+            shard_ranges = broker.get_shard_ranges(include_deleted=True)
+            if shard_ranges:
+                # shard ranges aren't rows, so they don't travel with
+                # usync; push them along with every successful sync
+                http.replicate('merge_shard_ranges',
+                               [shard_range.as_dict()
+                                for shard_range in shard_ranges])
         rv = parent._handle_sync_response(
             node, response, info, broker, http)
         return rv
 
+    def _usync_db(self, point, broker, http, remote_id, local_id):
+        """
+        Sync a db by sending the records since the last sync or, when there
+        are too many of those to send, by comparing range digests.
+        """
+        if self.digest_sync_fanout and \
+                broker.get_max_row() - point > self.max_diffs * self.per_diff:
+            rv = self._digest_sync_db(broker, http, remote_id)
+            if rv is not None:
+                return rv
+        return super(ContainerReplicator, self)._usync_db(
+            point, broker, http, remote_id, local_id)
+
+    def _digest_sync_db(self, broker, http, remote_id):
+        """
+        Sync a db by comparing digests of name ranges of the object table
+        with the remote replica's, splitting the differing ranges into
+        digest_sync_fanout smaller ones until they hold no more than
+        digest_sync_fanout rows, and sending the rows of those. The first
+        ranges hold about max_diffs * per_diff rows each, which bounds the
+        rows the remote server digests for each request.
+
+        :param broker: database broker object
+        :param http: ReplConnection object for the remote server
+        :param remote_id: database id for the remote replica
+
+        :returns: boolean indicating completion and success, or None if the
+                  remote server doesn't compare range digests
+        """
+        self.stats['digest_sync'] += 1
+        self.logger.increment('digest_syncs')
+        self.logger.debug('Syncing range digests with %s', http.host)
+        max_row = broker.get_max_row()
+        sync_table = broker.get_syncs()
+        parts = broker.get_info()['object_count'] // (
+            self.max_diffs * self.per_diff) + 1
+        # each request compares one group of ranges
+        groups = [[bounds] for bounds in broker.split_range(
+            '', '', max(parts, self.digest_sync_fanout))]
+        rows = []
+        first = True
+        while groups:
+            ranges = groups.pop(0)
+            with Timeout(self.node_timeout):
+                response = http.replicate('range_digests', ranges)
+            if not response or not is_success(response.status):
+                return None if first else False
+            first = False
+            for bounds, local, remote in zip(
+                    ranges, broker.get_range_digests(ranges),
+                    json.loads(response.data)):
+                if local[0] == 0 or list(local) == remote:
+                    continue
+                sub_ranges = []
+                if local[0] > self.digest_sync_fanout:
+                    sub_ranges = broker.split_range(
+                        bounds[0], bounds[1], self.digest_sync_fanout)
+                if len(sub_ranges) > 1:
+                    groups.append(sub_ranges)
+                    continue
+                marker = None
+                while True:
+                    items = broker.get_objects_in_range(
+                        bounds[0], bounds[1], self.per_diff, marker=marker)
+                    if not items:
+                        break
+                    rows.extend(items)
+                    marker = items[-1]['name']
+                    while len(rows) >= self.per_diff:
+                        if not self._send_digest_sync_rows(
+                                http, rows[:self.per_diff]):
+                            return False
+                        del rows[:self.per_diff]
+        if rows and not self._send_digest_sync_rows(http, rows):
+            return False
+        with Timeout(self.node_timeout):
+            response = http.replicate('merge_syncs', sync_table)
+        if not response or not is_success(response.status):
+            return False
+        broker.merge_syncs([{'remote_id': remote_id, 'sync_point': max_row}],
+                           incoming=False)
+        return True
+
+    def _send_digest_sync_rows(self, http, rows):
+        # rows go out of ROWID order, so they mustn't move the remote's
+        # incoming sync point
+        with Timeout(self.node_timeout):
+            response = http.replicate('merge_items', rows, None)
+        if not response or not is_success(response.status):
+            if response:
+                self.logger.error(_('ERROR Bad response %(status)s from '
+                                    '%(host)s'),
+                                  {'status': response.status,
+                                   'host': http.host})
+            return False
+        self.logger.update_stats('digest_sync_rows', len(rows))
+        return True
+
     def find_local_handoff_for_part(self, part):
         """
         Look through devices in the ring for the first handoff device that was
@@ -180,6 +295,8 @@ class ContainerReplicator(db_replicator.Replicator):
         return low_sync
 
     def _post_replicate_hook(self, broker, info, responses):
+        # the replicator, not a request, pays for building the index
+        broker.add_merge_index()
         if info['account'] == MISPLACED_OBJECTS_ACCOUNT:
             return
         point = broker.get_reconciler_sync()
@@ -265,3 +382,11 @@ class ContainerReplicatorRpc(db_replicator.ReplicatorRpc):
                 timestamp=status_changed_at)
             info = broker.get_replication_info()
         return info
+
+    def range_digests(self, broker, args):
+        return Response(json.dumps(broker.get_range_digests(args[0])))
+
+    def merge_shard_ranges(self, broker, args):
+        broker.merge_shard_ranges([ShardRange.from_dict(data)
+                                   for data in args[0]])
+        return HTTPAccepted()
@@ -13,34 +13,38 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
+import itertools
 import os
+import signal
 import time
 import traceback
 from swift import gettext_ as _
 from xml.etree.cElementTree import Element, SubElement, tostring
 
-from eventlet import Timeout
+from eventlet import Timeout, sleep, spawn
 
 import swift.common.db
 from swift.container.backend import ContainerBroker, DATADIR
 from swift.container.replicator import ContainerReplicatorRpc
-from swift.common.db import DatabaseAlreadyExists
+from swift.common.db import DatabaseAlreadyExists, DBChangeLog
 from swift.common.container_sync_realms import ContainerSyncRealms
 from swift.common.request_helpers import get_param, get_listing_content_type, \
-    split_and_validate_path, is_sys_or_user_meta
+    split_and_validate_path, is_sys_or_user_meta, set_listing_body
 from swift.common.utils import get_logger, hash_path, public, \
     Timestamp, storage_directory, validate_sync_to, \
     config_true_value, json, timing_stats, replication, \
-    override_bytes_from_content_type, get_log_line
+    override_bytes_from_content_type, get_log_line, ShardRange, \
+    reiterate
 from swift.common.constraints import check_mount, valid_timestamp, check_utf8
 from swift.common import constraints
 from swift.common.bufferedhttp import http_connect
-from swift.common.exceptions import ConnectionTimeout
+from swift.common.exceptions import ConnectionTimeout, LockTimeout
 from swift.common.http import HTTP_NOT_FOUND, is_success
 from swift.common.storage_policy import POLICIES
 from swift.common.swob import HTTPAccepted, HTTPBadRequest, HTTPConflict, \
     HTTPCreated, HTTPInternalServerError, HTTPNoContent, HTTPNotFound, \
-    HTTPPreconditionFailed, HTTPMethodNotAllowed, Request, Response, \
+    HTTPOk, HTTPPreconditionFailed, HTTPMethodNotAllowed, Request, Response, \
     HTTPInsufficientStorage, HTTPException, HeaderKeyDict
 
 
@@ -71,6 +75,146 @@ def gen_resp_headers(info, is_deleted=False):
     return headers
 
 
+class UpdateBuffer(object):
+    """
+    Per-worker, in-memory buffer of the object rows headed for container DBs.
+
+    The rows buffered for a DB are written to its .pending file together
+    when there are ``max_rows`` of them, when the oldest has waited
+    ``interval`` seconds, when the worker reads that DB, at exit, and when
+    the worker is told to stop with SIGTERM or SIGHUP (see
+    :meth:`exit_on_signal`). Once ``max_total_rows`` are buffered across
+    all DBs everything is flushed, and rows that still can't be buffered
+    are written straight through.
+
+    Reads only flush the buffer of the worker serving them, so an update
+    is visible to the worker that accepted it straight away, but to other
+    workers only once it has been written.
+
+    :param logger: a logger for errors and flush metrics
+    :param max_rows: rows to buffer for one DB before flushing it
+    :param interval: seconds a row may wait in the buffer
+    :param max_total_rows: rows to buffer across all DBs
+    :param change_log: a DBChangeLog to record flushed DBs in
+    """
+
+    def __init__(self, logger, max_rows=100, interval=0.5,
+                 max_total_rows=10000, change_log=None):
+        self.logger = logger
+        self.change_log = change_log
+        self.max_rows = max_rows
+        self.interval = interval
+        self.max_total_rows = max_total_rows
+        #: maps db_file to [broker, rows, time the first row was buffered]
+        self.buffers = {}
+        self.total_rows = 0
+        self.flusher = None
+        #: the entries being written by flushes that haven't finished,
+        #: by id
+        self.flushing = {}
+
+    def put(self, broker, record):
+        """
+        Buffer a row for a container DB.
+
+        :param broker: the ContainerBroker for the DB
+        :param record: the object row, as passed to put_record
+        """
+        if self.total_rows >= self.max_total_rows:
+            self.flush_all()
+            if self.total_rows >= self.max_total_rows:
+                broker.put_record(record)
+                return
+        entry = self._add(broker, [record], time.time())
+        if len(entry[1]) >= self.max_rows:
+            self.flush(broker.db_file)
+        elif self.flusher is None:
+            self.flusher = spawn(self._run)
+
+    def _add(self, broker, records, buffered_at):
+        entry = self.buffers.get(broker.db_file)
+        if entry is None:
+            entry = self.buffers[broker.db_file] = [broker, [], buffered_at]
+        entry[1].extend(records)
+        entry[2] = min(entry[2], buffered_at)
+        self.total_rows += len(records)
+        return entry
+
+    def flush(self, db_file):
+        """
+        Write the rows buffered for a DB to its .pending file.
+
+        :param db_file: path of the DB
+        """
+        entry = self.buffers.pop(db_file, None)
+        if entry is None:
+            return
+        broker, records, buffered_at = entry
+        self.total_rows -= len(records)
+        start = time.time()
+        self.flushing[id(entry)] = entry
+        try:
+            broker.put_records(records)
+        except LockTimeout:
+            # keep them for the next flush
+            self._add(broker, records, buffered_at)
+            self.logger.increment('update_buffer.flush.errors')
+        except (Exception, Timeout):
+            self.logger.exception(
+                _('ERROR flushing %(count)d buffered updates to %(file)s'),
+                {'count': len(records), 'file': db_file})
+            self.logger.increment('update_buffer.flush.errors')
+        else:
+            self.logger.timing_since('update_buffer.flush.timing', start)
+            self.logger.timing_since('update_buffer.flush.delay',
+                                     buffered_at)
+            self.logger.update_stats('update_buffer.flush.rows',
+                                     len(records))
+            if self.change_log:
+                self.change_log.record(db_file)
+        finally:
+            self.flushing.pop(id(entry), None)
+
+    def flush_all(self):
+        """Write all the buffered rows to their .pending files."""
+        for db_file in self.buffers.keys():
+            self.flush(db_file)
+
+    def close(self):
+        """
+        Write all the buffered rows to their .pending files as the worker
+        exits, including those of flushes that were still waiting for the
+        lock on a .pending file when it was told to exit.
+        """
+        for broker, records, buffered_at in self.flushing.values():
+            self._add(broker, records, buffered_at)
+        self.flushing.clear()
+        self.flush_all()
+
+    def exit_on_signal(self, signum, frame):
+        """
+        SIGTERM and SIGHUP handler for a worker that buffers updates, which
+        would otherwise be killed with its buffered rows. Writes them out
+        and exits straight away, without draining in-flight requests.
+        """
+        try:
+            self.close()
+        finally:
+            os._exit(0)
+
+    def _run(self):
+        try:
+            while self.buffers:
+                oldest = min(entry[2] for entry in self.buffers.values())
+                sleep(max(0, oldest + self.interval - time.time()))
+                now = time.time()
+                for db_file, entry in self.buffers.items():
+                    if entry[2] + self.interval <= now:
+                        self.flush(db_file)
+        finally:
+            self.flusher = None
+
+
 class ContainerController(object):
     """WSGI Controller for the container server."""
 
@@ -110,6 +254,23 @@ class ContainerController(object):
             self.save_headers.append('x-versions-location')
         swift.common.db.DB_PREALLOCATION = \
             config_true_value(conf.get('db_preallocation', 'f'))
+        swift.common.db.DB_WAL_MODE = \
+            config_true_value(conf.get('db_wal_mode', 'f'))
+        swift.common.db.DB_CONNECTION_POOL_SIZE = \
+            int(conf.get('db_connection_pool_size', 0))
+        self.change_log = DBChangeLog(('replicator', 'updater'), self.logger)
+        self.update_buffer = None
+        if config_true_value(conf.get('buffer_updates', 'f')):
+            self.update_buffer = UpdateBuffer(
+                self.logger,
+                max_rows=int(conf.get('buffer_updates_rows', 100)),
+                interval=float(conf.get('buffer_updates_interval', 0.5)),
+                max_total_rows=int(
+                    conf.get('buffer_updates_max_rows', 10000)),
+                change_log=self.change_log)
+            atexit.register(self.update_buffer.close)
+            signal.signal(signal.SIGTERM, self.update_buffer.exit_on_signal)
+            signal.signal(signal.SIGHUP, self.update_buffer.exit_on_signal)
 
     def _get_container_broker(self, drive, part, account, container, **kwargs):
         """
@@ -129,6 +290,30 @@ class ContainerController(object):
         kwargs.setdefault('logger', self.logger)
         return ContainerBroker(db_path, **kwargs)
 
+    def _flush_updates(self, db_file):
+        """
+        Write any object updates this worker has buffered for a container
+        DB, so that requests reading the DB see them.
+        """
+        if self.update_buffer:
+            self.update_buffer.flush(db_file)
+
+    def _put_object(self, broker, name, timestamp, size, content_type, etag,
+                    deleted, storage_policy_index):
+        """
+        Record an object update in a container DB, through the update
+        buffer if there is one.
+        """
+        if not self.update_buffer:
+            broker.put_object(name, timestamp, size, content_type, etag,
+                              deleted, storage_policy_index)
+            self.change_log.record(broker.db_file)
+            return
+        self.update_buffer.put(broker, {
+            'name': name, 'created_at': timestamp, 'size': size,
+            'content_type': content_type, 'etag': etag, 'deleted': deleted,
+            'storage_policy_index': storage_policy_index})
+
     def get_and_validate_policy_index(self, req):
         """
         Validate that the index supplied maps to a policy.
@@ -260,16 +445,19 @@ class ContainerController(object):
         if not os.path.exists(broker.db_file):
             return HTTPNotFound()
         if obj:     # delete object
-            broker.delete_object(obj, req.headers.get('x-timestamp'),
-                                 obj_policy_index)
+            self._put_object(broker, obj, req.headers.get('x-timestamp'), 0,
+                             'application/deleted', 'noetag', 1,
+                             obj_policy_index)
             return HTTPNoContent(request=req)
         else:
             # delete container
+            self._flush_updates(broker.db_file)
             if not broker.empty():
                 return HTTPConflict(request=req)
             existed = Timestamp(broker.get_info()['put_timestamp']) and \
                 not broker.is_deleted()
             broker.delete_db(req_timestamp.internal)
+            self.change_log.record(broker.db_file)
             if not broker.is_deleted():
                 return HTTPConflict(request=req)
             resp = self.account_update(req, account, container, broker)
@@ -334,6 +522,9 @@ class ContainerController(object):
             return HTTPInsufficientStorage(drive=drive, request=req)
         requested_policy_index = self.get_and_validate_policy_index(req)
         broker = self._get_container_broker(drive, part, account, container)
+        record_type = req.headers.get('X-Backend-Record-Type', '').lower()
+        if not obj and record_type == 'shard':
+            return self._put_shard_ranges(req, broker)
         if obj:     # put container object
             # obj put expects the policy_index header, default is for
             # legacy support during upgrade.
@@ -346,13 +537,13 @@ class ContainerController(object):
                     pass
             if not os.path.exists(broker.db_file):
                 return HTTPNotFound()
-            broker.put_object(obj, req_timestamp.internal,
-                              int(req.headers['x-size']),
-                              req.headers['x-content-type'],
-                              req.headers['x-etag'], 0,
-                              obj_policy_index)
+            self._put_object(broker, obj, req_timestamp.internal,
+                             int(req.headers['x-size']),
+                             req.headers['x-content-type'],
+                             req.headers['x-etag'], 0, obj_policy_index)
             return HTTPCreated(request=req)
         else:   # put container
+            self._flush_updates(broker.db_file)
             if requested_policy_index is None:
                 # use the default index sent by the proxy if available
                 new_container_policy = req.headers.get(
@@ -375,6 +566,7 @@ class ContainerController(object):
                         broker.metadata['X-Container-Sync-To'][0]:
                     broker.set_x_container_sync_points(-1, -1)
             broker.update_metadata(metadata, validate_metadata=True)
+            self.change_log.record(broker.db_file)
             resp = self.account_update(req, account, container, broker)
             if resp:
                 return resp
@@ -383,6 +575,23 @@ class ContainerController(object):
             else:
                 return HTTPAccepted(request=req)
 
+    def _put_shard_ranges(self, req, broker):
+        """
+        Merge the shard ranges in the body of a PUT request, sent when a
+        container is sharded and by shards reporting their usage.
+        """
+        try:
+            shard_ranges = [ShardRange.from_dict(data)
+                            for data in json.loads(req.body)]
+        except (ValueError, TypeError, AttributeError):
+            return HTTPBadRequest(request=req, content_type='text/plain',
+                                  body='Invalid shard ranges')
+        if not os.path.exists(broker.db_file) or broker.is_deleted():
+            return HTTPNotFound(request=req)
+        broker.merge_shard_ranges(shard_ranges)
+        self.change_log.record(broker.db_file)
+        return HTTPAccepted(request=req)
+
     @public
     @timing_stats(sample_rate=0.1)
     def HEAD(self, req):
@@ -395,6 +604,7 @@ class ContainerController(object):
         broker = self._get_container_broker(drive, part, account, container,
                                             pending_timeout=0.1,
                                             stale_reads_ok=True)
+        self._flush_updates(broker.db_file)
         info, is_deleted = broker.get_info_is_deleted()
         headers = gen_resp_headers(info, is_deleted=is_deleted)
         if is_deleted:
@@ -404,6 +614,8 @@ class ContainerController(object):
             for key, (value, timestamp) in broker.metadata.iteritems()
             if value != '' and (key.lower() in self.save_headers or
                                 is_sys_or_user_meta('container', key)))
+        if broker.is_sharded():
+            headers['X-Backend-Sharded'] = 'true'
         headers['Content-Type'] = out_content_type
         return HTTPNoContent(request=req, headers=headers, charset='utf-8')
 
@@ -456,53 +668,103 @@ class ContainerController(object):
         broker = self._get_container_broker(drive, part, account, container,
                                             pending_timeout=0.1,
                                             stale_reads_ok=True)
+        self._flush_updates(broker.db_file)
         info, is_deleted = broker.get_info_is_deleted()
         resp_headers = gen_resp_headers(info, is_deleted=is_deleted)
         if is_deleted:
             return HTTPNotFound(request=req, headers=resp_headers)
-        container_list = broker.list_objects_iter(
+        record_type = req.headers.get('X-Backend-Record-Type', '').lower()
+        shard_ranges = broker.get_shard_ranges()
+        if shard_ranges:
+            resp_headers['X-Backend-Sharded'] = 'true'
+        if record_type == 'shard' or (record_type == 'auto' and shard_ranges):
+            # The proxy lists the objects of a sharded container from its
+            # shards, and from the root too while it has rows that are yet
+            # to be moved to the shards.
+            resp_headers['X-Backend-Record-Type'] = 'shard'
+            resp_headers['X-Backend-Uncleaved-Objects'] = \
+                broker.get_uncleaved_object_count()
+            return self.create_shard_listing(req, resp_headers,
+                                             broker.metadata, shard_ranges)
+        container_list = broker.stream_objects(
             limit, marker, end_marker, prefix, delimiter, path,
             storage_policy_index=info['storage_policy_index'])
         return self.create_listing(req, out_content_type, info, resp_headers,
                                    broker.metadata, container_list, container)
 
+    def create_shard_listing(self, req, resp_headers, metadata,
+                             shard_ranges):
+        for key, (value, timestamp) in metadata.iteritems():
+            if value and (key.lower() in self.save_headers or
+                          is_sys_or_user_meta('container', key)):
+                resp_headers[key] = value
+        return HTTPOk(request=req, headers=resp_headers,
+                      content_type='application/json', charset='utf-8',
+                      body=json.dumps([shard_range.as_dict()
+                                       for shard_range in shard_ranges]))
+
     def create_listing(self, req, out_content_type, info, resp_headers,
                        metadata, container_list, container):
         for key, (value, timestamp) in metadata.iteritems():
             if value and (key.lower() in self.save_headers or
                           is_sys_or_user_meta('container', key)):
                 resp_headers[key] = value
-        ret = Response(request=req, headers=resp_headers,
-                       content_type=out_content_type, charset='utf-8')
+        # read the first entries before committing to a response
+        container_list = reiterate(container_list)
         if out_content_type == 'application/json':
-            ret.body = json.dumps([self.update_data_record(record)
-                                   for record in container_list])
+            body_iter = self._json_listing_iter(container_list)
         elif out_content_type.endswith('/xml'):
-            doc = Element('container', name=container.decode('utf-8'))
-            for obj in container_list:
-                record = self.update_data_record(obj)
-                if 'subdir' in record:
-                    name = record['subdir'].decode('utf-8')
-                    sub = SubElement(doc, 'subdir', name=name)
-                    SubElement(sub, 'name').text = name
-                else:
-                    obj_element = SubElement(doc, 'object')
-                    for field in ["name", "hash", "bytes", "content_type",
-                                  "last_modified"]:
-                        SubElement(obj_element, field).text = str(
-                            record.pop(field)).decode('utf-8')
-                    for field in sorted(record):
-                        SubElement(obj_element, field).text = str(
-                            record[field]).decode('utf-8')
-            ret.body = tostring(doc, encoding='UTF-8').replace(
-                "<?xml version='1.0' encoding='UTF-8'?>",
-                '<?xml version="1.0" encoding="UTF-8"?>', 1)
+            body_iter = self._xml_listing_iter(container_list, container)
         else:
             if not container_list:
                 return HTTPNoContent(request=req, headers=resp_headers)
-            ret.body = '\n'.join(rec[0] for rec in container_list) + '\n'
+            body_iter = (rec[0] + '\n' for rec in container_list)
+        ret = Response(request=req, headers=resp_headers,
+                       content_type=out_content_type, charset='utf-8')
+        set_listing_body(ret, body_iter)
         return ret
 
+    def _json_listing_iter(self, container_list):
+        yield '['
+        separator = ''
+        container_list = iter(container_list)
+        while True:
+            # dumps is much quicker on a few hundred records than on one
+            records = [self.update_data_record(record) for record in
+                       itertools.islice(container_list, 500)]
+            if not records:
+                break
+            yield separator + json.dumps(records)[1:-1]
+            separator = ', '
+        yield ']'
+
+    def _xml_listing_iter(self, container_list, container):
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+        doc = tostring(Element('container', name=container.decode('utf-8')),
+                       encoding='utf-8')
+        if not container_list:
+            yield doc
+            return
+        # doc is an empty element, '<container name="..." />'
+        yield doc[:-len(' />')] + '>'
+        for obj in container_list:
+            record = self.update_data_record(obj)
+            if 'subdir' in record:
+                name = record['subdir'].decode('utf-8')
+                element = Element('subdir', name=name)
+                SubElement(element, 'name').text = name
+            else:
+                element = Element('object')
+                for field in ["name", "hash", "bytes", "content_type",
+                              "last_modified"]:
+                    SubElement(element, field).text = str(
+                        record.pop(field)).decode('utf-8')
+                for field in sorted(record):
+                    SubElement(element, field).text = str(
+                        record[field]).decode('utf-8')
+            yield tostring(element, encoding='utf-8')
+        yield '</container>'
+
     @public
     @replication
     @timing_stats(sample_rate=0.01)
@@ -518,6 +780,9 @@ class ContainerController(object):
             args = json.load(req.environ['wsgi.input'])
         except ValueError as err:
             return HTTPBadRequest(body=str(err), content_type='text/plain')
+        self._flush_updates(os.path.join(
+            self.root, drive, storage_directory(DATADIR, partition, hash),
+            hash + '.db'))
         ret = self.replicator_rpc.dispatch(post_args, args)
         ret.request = req
         return ret
@@ -537,6 +802,7 @@ class ContainerController(object):
         if self.mount_check and not check_mount(self.root, drive):
             return HTTPInsufficientStorage(drive=drive, request=req)
         broker = self._get_container_broker(drive, part, account, container)
+        self._flush_updates(broker.db_file)
         if broker.is_deleted():
             return HTTPNotFound(request=req)
         metadata = {}
@@ -552,6 +818,7 @@ class ContainerController(object):
                         broker.metadata['X-Container-Sync-To'][0]:
                     broker.set_x_container_sync_points(-1, -1)
             broker.update_metadata(metadata, validate_metadata=True)
+            self.change_log.record(broker.db_file)
         return HTTPNoContent(request=req)
 
     def __call__(self, env, start_response):
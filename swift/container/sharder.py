@@ -0,0 +1,295 @@
+# Copyright (c) 2010-2014 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+from swift import gettext_ as _
+
+from eventlet import GreenPile, Timeout
+
+from swift.container.backend import ContainerBroker, DATADIR
+from swift.container.replicator import ContainerReplicator
+from swift.common.bufferedhttp import http_connect
+from swift.common.db import DatabaseAlreadyExists
+from swift.common.exceptions import DeviceUnavailable, DriveNotMounted
+from swift.common.http import is_success
+from swift.common.utils import get_logger, json, hash_path, \
+    storage_directory, quorum_size, split_path, Timestamp, ShardRange, \
+    SHARDS_ACCOUNT_PREFIX, shards_account
+from swift.common.db_replicator import roundrobin_datadirs
+
+#: Sysmeta recording which root container a shard container belongs to
+SHARD_ROOT_HEADER = 'X-Container-Sysmeta-Shard-Root'
+#: Sysmeta recording the bounds of a shard container's range
+SHARD_LOWER_HEADER = 'X-Container-Sysmeta-Shard-Lower'
+SHARD_UPPER_HEADER = 'X-Container-Sysmeta-Shard-Upper'
+SHARD_CREATED_AT_HEADER = 'X-Container-Sysmeta-Shard-Created-At'
+
+
+class ContainerSharder(ContainerReplicator):
+    """
+    Splits container databases with more than shard_container_size objects
+    into shard containers, each holding a range of the object names.
+
+    The first primary node of a root container chooses the ranges and sends
+    them to the other primaries. Every node then moves the object rows of
+    its copy of the root into shard containers created on local devices,
+    replicating those out to the shards' primary nodes, and only removes
+    the rows from the root once a quorum of a shard's primaries has them.
+    The first
+    primary node of each shard reports the shard's usage to its root.
+    """
+
+    def __init__(self, conf, logger=None):
+        logger = logger or get_logger(conf, log_route='container-sharder')
+        super(ContainerSharder, self).__init__(conf, logger=logger)
+        self.shard_container_size = int(
+            conf.get('shard_container_size', 10000000))
+        self.cleave_batch_size = int(conf.get('cleave_batch_size', 10000))
+        self.user_agent = 'container-sharder %s' % os.getpid()
+
+    def _zero_shard_stats(self):
+        self.shard_stats = {'sharded': 0, 'cleaved': 0, 'reported': 0,
+                            'errors': 0}
+
+    def _is_leader(self, part, node_id):
+        nodes = self.ring.get_part_nodes(int(part))
+        return bool(nodes) and nodes[0]['id'] == node_id
+
+    def _send_shard_ranges(self, account, container, shard_ranges):
+        """
+        PUT shard ranges to the primary nodes of a root container.
+
+        :returns: True if a quorum of the nodes accepted them
+        """
+        part, nodes = self.ring.get_nodes(account, container)
+        body = json.dumps([shard_range.as_dict()
+                           for shard_range in shard_ranges])
+        headers = {'X-Backend-Record-Type': 'shard',
+                   'X-Timestamp': Timestamp(time.time()).internal,
+                   'Content-Type': 'application/json',
+                   'Content-Length': str(len(body)),
+                   'user-agent': self.user_agent}
+        path = '/%s/%s' % (account, container)
+        pile = GreenPile(len(nodes))
+        for node in nodes:
+            pile.spawn(self._send_shard_ranges_to_node, node, part, path,
+                       headers, body)
+        successes = sum(1 for success in pile if success)
+        return successes >= quorum_size(len(nodes))
+
+    def _send_shard_ranges_to_node(self, node, part, path, headers, body):
+        try:
+            with Timeout(self.conn_timeout):
+                conn = http_connect(node['ip'], node['port'], node['device'],
+                                    part, 'PUT', path, headers=headers)
+            with Timeout(self.node_timeout):
+                conn.send(body)
+                resp = conn.getresponse()
+                resp.read()
+                return is_success(resp.status)
+        except (Exception, Timeout):
+            self.logger.exception(_(
+                'ERROR sending shard ranges to '
+                '%(ip)s:%(port)s/%(device)s'), node)
+            return False
+
+    def _replicate_shard(self, part, broker, node_id):
+        """
+        Replicate a shard container DB to the shard's primary nodes.
+
+        :returns: True if a quorum of the primary nodes, including this one
+                  if it is a primary, have the DB's rows
+        """
+        info = broker.get_replication_info()
+        nodes = self.ring.get_part_nodes(int(part))
+        pile = GreenPile(len(nodes))
+        for node in nodes:
+            if node['id'] != node_id:
+                pile.spawn(self._replicate_shard_to_node, node, broker, part,
+                           info)
+        successes = sum(1 for success in pile if success)
+        if any(node['id'] == node_id for node in nodes):
+            successes += 1
+        return successes >= quorum_size(len(nodes))
+
+    def _replicate_shard_to_node(self, node, broker, part, info):
+        try:
+            return self._repl_to_node(node, broker, part, info)
+        except DriveNotMounted:
+            self.logger.error(_('ERROR Remote drive not mounted %s'), node)
+        except (Exception, Timeout):
+            self.logger.exception(_('ERROR syncing %(file)s with node'
+                                    ' %(node)s'),
+                                  {'file': broker.db_file, 'node': node})
+        return False
+
+    def _get_shard_broker(self, root_info, shard_range):
+        """
+        Get a local broker for a shard container, creating it on the first
+        local device available to its partition.
+
+        :returns: a tuple of (partition, broker, node_id)
+        :raises DeviceUnavailable: if no local device is available
+        """
+        account = shards_account(root_info['account'])
+        part = self.ring.get_part(account, shard_range.name)
+        node = self.find_local_handoff_for_part(part)
+        if not node:
+            raise DeviceUnavailable(
+                'No mounted devices found suitable for shard container %s '
+                'in partition %s' % (shard_range.name, part))
+        hsh = hash_path(account, shard_range.name)
+        db_dir = storage_directory(DATADIR, part, hsh)
+        db_path = os.path.join(self.root, node['device'], db_dir, hsh + '.db')
+        broker = ContainerBroker(db_path, account=account,
+                                 container=shard_range.name,
+                                 logger=self.logger)
+        if not os.path.exists(broker.db_file):
+            try:
+                broker.initialize(shard_range.created_at,
+                                  root_info['storage_policy_index'])
+            except DatabaseAlreadyExists:
+                pass
+            timestamp = shard_range.created_at
+            broker.update_metadata({
+                SHARD_ROOT_HEADER: (
+                    '%s/%s' % (root_info['account'],
+                               root_info['container']), timestamp),
+                SHARD_LOWER_HEADER: (shard_range.lower, timestamp),
+                SHARD_UPPER_HEADER: (shard_range.upper, timestamp),
+                SHARD_CREATED_AT_HEADER: (shard_range.created_at, timestamp)})
+        return part, broker, node['id']
+
+    def _shard(self, broker, info):
+        """
+        Choose the shard ranges of a root container, and send them to its
+        primary nodes.
+        """
+        created_at = Timestamp(time.time()).internal
+        shard_ranges = [
+            ShardRange.create(info['account'], info['container'],
+                              lower, upper, created_at)
+            for lower, upper in broker.find_shard_bounds(
+                max(1, self.shard_container_size // 2))]
+        if len(shard_ranges) < 2:
+            return
+        self.logger.info(_('Sharding %(path)s into %(count)d containers'),
+                         {'path': '/%s/%s' % (info['account'],
+                                              info['container']),
+                          'count': len(shard_ranges)})
+        broker.merge_shard_ranges(shard_ranges)
+        if not self._send_shard_ranges(info['account'], info['container'],
+                                       shard_ranges):
+            # the replicator carries the ranges the rest of the way
+            self.logger.warning(_('Failed to send shard ranges of %s to a '
+                                  'quorum of nodes'), broker.db_file)
+        self.shard_stats['sharded'] += 1
+
+    def _cleave(self, broker, info, shard_ranges):
+        """
+        Move object rows of a sharded root container into its shards. Each
+        batch of rows is replicated to a quorum of a shard's primary nodes
+        before it is removed from the root; if it can't be, the rest of the
+        range is left for the next pass.
+        """
+        for shard_range in shard_ranges:
+            items = broker.get_objects_in_range(
+                shard_range.lower, shard_range.upper, self.cleave_batch_size)
+            if not items:
+                continue
+            try:
+                part, shard_broker, node_id = self._get_shard_broker(
+                    info, shard_range)
+            except DeviceUnavailable as err:
+                self.logger.warning('DeviceUnavailable: %s', err)
+                self.shard_stats['errors'] += 1
+                continue
+            while items:
+                shard_broker.merge_items(items)
+                if not self._replicate_shard(part, shard_broker, node_id):
+                    self.logger.warning(_(
+                        'Failed to replicate %s to a quorum of nodes; '
+                        'leaving its rows in the root'), shard_broker.db_file)
+                    self.shard_stats['errors'] += 1
+                    break
+                broker.remove_objects(items)
+                self.shard_stats['cleaved'] += len(items)
+                items = broker.get_objects_in_range(
+                    shard_range.lower, shard_range.upper,
+                    self.cleave_batch_size, marker=items[-1]['name'])
+        broker.update_uncleaved_usage()
+
+    def _report(self, broker, info):
+        """
+        Report the usage of a shard container to its root container.
+        """
+        metadata = broker.metadata
+        try:
+            root_account, root_container = split_path(
+                '/' + metadata[SHARD_ROOT_HEADER][0], 2, 2)
+        except (KeyError, ValueError):
+            return
+        shard_range = ShardRange(
+            info['container'], metadata[SHARD_CREATED_AT_HEADER][0],
+            metadata[SHARD_LOWER_HEADER][0], metadata[SHARD_UPPER_HEADER][0],
+            info['object_count'], info['bytes_used'],
+            Timestamp(time.time()).internal)
+        if self._send_shard_ranges(root_account, root_container,
+                                   [shard_range]):
+            self.shard_stats['reported'] += 1
+        else:
+            self.shard_stats['errors'] += 1
+
+    def _process_broker(self, part, db_file, node_id):
+        broker = ContainerBroker(db_file, logger=self.logger)
+        try:
+            if broker.is_deleted():
+                return
+            info = broker.get_info()
+            if info['account'].startswith(SHARDS_ACCOUNT_PREFIX):
+                if self._is_leader(part, node_id):
+                    self._report(broker, info)
+                return
+            shard_ranges = broker.get_shard_ranges()
+            if not shard_ranges:
+                if info['object_count'] <= self.shard_container_size or \
+                        not self._is_leader(part, node_id):
+                    return
+                self._shard(broker, info)
+                shard_ranges = broker.get_shard_ranges()
+            self._cleave(broker, info, shard_ranges)
+        except (Exception, Timeout):
+            self.logger.exception(_('ERROR sharding %s'), db_file)
+            self.shard_stats['errors'] += 1
+
+    def run_once(self, *args, **kwargs):
+        """Run a sharding pass once."""
+        self._zero_stats()
+        self._zero_shard_stats()
+        self.reconciler_containers = self.reconciler_cleanups = None
+        dirs = self._get_local_datadirs()
+        if dirs is None:
+            return
+        begin = time.time()
+        self.logger.info(_('Beginning container sharding run'))
+        for part, db_file, node_id in roundrobin_datadirs(dirs):
+            self._process_broker(part, db_file, node_id)
+        self.cpool.waitall()
+        self.logger.info(_(
+            'Container sharding run completed in %(time).2fs: %(sharded)d '
+            'containers sharded, %(cleaved)d objects cleaved, %(reported)d '
+            'shards reported, %(errors)d errors'),
+            dict(self.shard_stats, time=time.time() - begin))
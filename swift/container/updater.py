@@ -25,6 +25,7 @@ from tempfile import mkstemp
 from eventlet import spawn, patcher, Timeout
 
 import swift.common.db
+from swift.common.db import DBChangeLog, pop_db_changes
 from swift.container.backend import ContainerBroker, DATADIR
 from swift.common.bufferedhttp import http_connect
 from swift.common.exceptions import ConnectionTimeout
@@ -57,8 +58,13 @@ class ContainerUpdater(Daemon):
         self.account_suppression_time = \
             float(conf.get('account_suppression_time', 60))
         self.new_account_suppressions = None
+        self.full_sweep_interval = float(conf.get('full_sweep_interval', 0))
+        self._last_full_sweep = 0
+        self.change_log = DBChangeLog(('updater',), self.logger)
         swift.common.db.DB_PREALLOCATION = \
             config_true_value(conf.get('db_preallocation', 'f'))
+        swift.common.db.DB_WAL_MODE = \
+            config_true_value(conf.get('db_wal_mode', 'f'))
         self.recon_cache_path = conf.get('recon_cache_path',
                                          '/var/cache/swift')
         self.rcache = os.path.join(self.recon_cache_path, "container.recon")
@@ -82,9 +88,16 @@ class ContainerUpdater(Daemon):
         """
         Get paths to all of the partitions on each drive to be processed.
 
+        With a full_sweep_interval, only the partitions of the containers
+        recorded in the drives' change logs are processed between full
+        sweeps, and they come first in full sweeps.
+
         :returns: a list of paths
         """
-        paths = []
+        begin = time.time()
+        full_sweep = begin - self._last_full_sweep >= self.full_sweep_interval
+        changed = set()
+        con_paths = []
         for device in self._listdir(self.devices):
             dev_path = os.path.join(self.devices, device)
             if self.mount_check and not ismount(dev_path):
@@ -93,10 +106,23 @@ class ContainerUpdater(Daemon):
             con_path = os.path.join(dev_path, DATADIR)
             if not os.path.exists(con_path):
                 continue
+            con_paths.append(con_path)
+            if self.full_sweep_interval:
+                changes = pop_db_changes(con_path, 'updater')
+                if changes is None:
+                    full_sweep = True
+                else:
+                    changed.update(os.path.join(con_path, partition)
+                                   for partition, _db_file in changes)
+        if not full_sweep:
+            return list(changed)
+        self._last_full_sweep = begin
+        paths = []
+        for con_path in con_paths:
             for partition in self._listdir(con_path):
                 paths.append(os.path.join(con_path, partition))
         shuffle(paths)
-        return paths
+        return list(changed) + [path for path in paths if path not in changed]
 
     def _load_suppressions(self, filename):
         try:
@@ -220,6 +246,8 @@ class ContainerUpdater(Daemon):
         if Timestamp(info['put_timestamp']) <= 0:
             return
         if self.account_suppressions.get(info['account'], 0) > time.time():
+            # retry once the suppression is over
+            self.change_log.record(dbfile)
             return
         if info['put_timestamp'] > info['reported_put_timestamp'] or \
                 info['delete_timestamp'] > info['reported_delete_timestamp'] \
@@ -256,6 +284,7 @@ class ContainerUpdater(Daemon):
                 if self.new_account_suppressions:
                     print >>self.new_account_suppressions, \
                         info['account'], until
+                self.change_log.record(dbfile)
             # Only track timing data for attempted updates:
             self.logger.timing_since('timing', start_time)
         else:
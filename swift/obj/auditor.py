@@ -13,6 +13,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import cPickle as pickle
+import errno
 import os
 import sys
 import time
@@ -24,11 +26,96 @@ from eventlet import Timeout
 
 from swift.obj import diskfile
 from swift.common.utils import get_logger, ratelimit_sleep, dump_recon_cache, \
-    list_from_csv, json, listdir
+    list_from_csv, json, listdir, config_true_value, write_pickle
 from swift.common.exceptions import DiskFileQuarantined, DiskFileNotExist
 from swift.common.daemon import Daemon
 
 SLEEP_BETWEEN_AUDITS = 30
+AUDIT_RECORD_FILE = 'object-auditor.verified'
+
+
+class AuditRecord(object):
+    """
+    Records when the objects of each suffix directory of a device were
+    verified, so that an incremental audit can skip objects that were
+    verified recently and haven't changed since.
+
+    Two times are kept per suffix: the last time every object in the suffix
+    was read and verified, and the last time the suffix was visited, by
+    which all objects that existed then had been verified at least once. An
+    object whose hash directory hasn't been modified since the last visit
+    only needs to be audited again when the last full verification of its
+    suffix gets too old.
+
+    The record is kept in a pickle at the root of the device, keyed by the
+    path of the suffix relative to the device (e.g. "objects/123/abc").
+
+    :param dev_path: path to the device
+    :param logger: logger to use for errors reading or writing the record
+    """
+
+    def __init__(self, dev_path, logger):
+        self.path = os.path.join(dev_path, AUDIT_RECORD_FILE)
+        self.logger = logger
+        self.suffixes = {}
+        self.visited = set()
+        try:
+            with open(self.path, 'rb') as fp:
+                self.suffixes = pickle.load(fp)
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                self.logger.exception(_('ERROR reading %s'), self.path)
+        except Exception:
+            self.logger.warning(_('Ignoring invalid audit record %s'),
+                                self.path)
+
+    def is_verified(self, suffix_key, hash_mtime, now, reaudit_age):
+        """
+        Returns True if an object can be skipped because it was verified
+        recently and hasn't been modified since.
+
+        :param suffix_key: the suffix path relative to the device
+        :param hash_mtime: the modification time of the object's hash dir
+        :param now: the current time
+        :param reaudit_age: how long a verification remains valid
+        """
+        try:
+            full_time, visit_time = self.suffixes[suffix_key]
+        except KeyError:
+            return False
+        return hash_mtime < visit_time and now - full_time < reaudit_age
+
+    def update(self, suffix_key, visit_time, complete):
+        """
+        Records a visit of a suffix in which every object was audited or
+        skipped as verified.
+
+        :param suffix_key: the suffix path relative to the device
+        :param visit_time: the time the visit of the suffix started
+        :param complete: True if every object in the suffix was audited
+        """
+        self.visited.add(suffix_key)
+        full_time = visit_time
+        if not complete and suffix_key in self.suffixes:
+            full_time = self.suffixes[suffix_key][0]
+        self.suffixes[suffix_key] = (full_time, visit_time)
+
+    def save(self, prune=False):
+        """
+        Writes the record to the device.
+
+        :param prune: forget the suffixes not visited since the record was
+                      loaded, which must only be done after visiting all of
+                      the device's suffixes
+        """
+        if prune:
+            for suffix_key in set(self.suffixes) - self.visited:
+                del self.suffixes[suffix_key]
+        try:
+            write_pickle(self.suffixes, self.path,
+                         pickle_protocol=diskfile.PICKLE_PROTOCOL)
+        except (OSError, IOError):
+            self.logger.exception(_('ERROR writing %s'), self.path)
 
 
 class AuditorWorker(object):
@@ -62,6 +149,12 @@ class AuditorWorker(object):
             [int(s) for s in list_from_csv(conf.get('object_size_stats'))])
         self.stats_buckets = dict(
             [(s, 0) for s in self.stats_sizes + ['OVER']])
+        self.incremental = self.auditor_type == 'ALL' and \
+            config_true_value(conf.get('incremental', 'no'))
+        self.reaudit_age = int(conf.get('reaudit_age', 2592000))
+        self.skips = 0
+        self.audit_records = {}
+        self.current_suffix = None
 
     def create_recon_nested_dict(self, top_level_key, device_list, item):
         if device_list:
@@ -90,6 +183,9 @@ class AuditorWorker(object):
             device_dirs=device_dirs)
         for location in all_locs:
             loop_time = time.time()
+            if self.incremental and \
+                    self.skip_verified_object(location, loop_time):
+                continue
             self.failsafe_object_audit(location)
             self.logger.timing_since('timing', loop_time)
             self.files_running_time = ratelimit_sleep(
@@ -120,6 +216,8 @@ class AuditorWorker(object):
                      'bytes_processed': self.bytes_processed,
                      'start_time': reported, 'audit_time': time_auditing})
                 dump_recon_cache(cache_entry, self.rcache, self.logger)
+                for record in self.audit_records.values():
+                    record.save()
                 reported = now
                 total_quarantines += self.quarantines
                 total_errors += self.errors
@@ -129,6 +227,15 @@ class AuditorWorker(object):
                 self.bytes_processed = 0
                 self.last_logged = now
             time_auditing += (now - loop_time)
+        if self.incremental:
+            self.finish_suffix()
+            for record in self.audit_records.values():
+                record.save(prune=True)
+            self.logger.info(
+                _('Object audit (%(type)s) skipped %(skips)d objects '
+                  'verified in the last %(age)ds') %
+                {'type': '%s%s' % (self.auditor_type, description),
+                 'skips': self.skips, 'age': self.reaudit_age})
         # Avoid divide by zero during very short runs
         elapsed = (time.time() - begin) or 0.000001
         self.logger.info(_(
@@ -148,6 +255,51 @@ class AuditorWorker(object):
             self.logger.info(
                 _('Object audit stats: %s') % json.dumps(self.stats_buckets))
 
+    def skip_verified_object(self, location, now):
+        """
+        Used in incremental mode to decide whether an object needs to be
+        audited, keeping track of the suffix being audited as it goes.
+
+        :param location: an audit location
+        :param now: the current time
+        :returns: True if the object was verified recently and hasn't been
+                  modified since, so needn't be audited
+        """
+        suffix_path = os.path.dirname(location.path)
+        if not self.current_suffix or \
+                self.current_suffix['path'] != suffix_path:
+            self.finish_suffix()
+            record = self.audit_records.get(location.device)
+            if record is None:
+                record = self.audit_records[location.device] = AuditRecord(
+                    os.path.join(self.devices, location.device), self.logger)
+            self.current_suffix = {
+                'path': suffix_path, 'record': record,
+                'key': '/'.join(suffix_path.rsplit(os.path.sep, 3)[1:]),
+                'visit_time': now, 'skipped': False, 'failed': False}
+        suffix = self.current_suffix
+        try:
+            hash_mtime = os.stat(location.path).st_mtime
+        except OSError:
+            return False  # let the audit deal with it
+        if suffix['record'].is_verified(suffix['key'], hash_mtime, now,
+                                        self.reaudit_age):
+            suffix['skipped'] = True
+            self.skips += 1
+            self.logger.increment('skips')
+            return True
+        return False
+
+    def finish_suffix(self):
+        """
+        Records the visit of the suffix being audited in incremental mode,
+        unless auditing any of its objects failed.
+        """
+        suffix, self.current_suffix = self.current_suffix, None
+        if suffix and not suffix['failed']:
+            suffix['record'].update(suffix['key'], suffix['visit_time'],
+                                    not suffix['skipped'])
+
     def record_stats(self, obj_size):
         """
         Based on config's object_size_stats will keep track of how many objects
@@ -174,6 +326,8 @@ class AuditorWorker(object):
         except (Exception, Timeout):
             self.logger.increment('errors')
             self.errors += 1
+            if self.current_suffix:
+                self.current_suffix['failed'] = True
             self.logger.exception(_('ERROR Trying to audit %s'), location)
 
     def object_audit(self, location):
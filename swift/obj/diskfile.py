@@ -57,7 +57,7 @@ from swift.common.utils import mkdirs, Timestamp, \
     fdatasync, drop_buffer_cache, ThreadPool, lock_path, write_pickle, \
     config_true_value, listdir, split_path, ismount, remove_file, \
     get_md5_socket, system_has_splice, splice, tee, SPLICE_F_MORE, \
-    F_SETPIPE_SZ
+    F_SETPIPE_SZ, walk_dir_tree
 from swift.common.exceptions import DiskFileQuarantined, DiskFileNotExist, \
     DiskFileCollision, DiskFileNoSpace, DiskFileDeviceUnavailable, \
     DiskFileDeleted, DiskFileError, DiskFileNotOpen, PathNotDir, \
@@ -75,6 +75,8 @@ DROP_CACHE_WINDOW = 1024 * 1024
 # These are system-set metadata keys that cannot be changed with a POST.
 # They should be lowercase.
 DATAFILE_SYSTEM_META = set('content-length content-type deleted etag'.split())
+# ioctl sharing one file's data extents with another (linux/fs.h)
+FICLONE = 0x40049409
 DATADIR_BASE = 'objects'
 ASYNCDIR_BASE = 'async_pending'
 TMP_BASE = 'tmp'
@@ -481,26 +483,11 @@ def object_audit_location_generator(devices, mount_check=True, logger=None,
                 if logger:
                     logger.warn(_('Directory %s does not map to a '
                                   'valid policy') % dir)
-            partitions = listdir(datadir_path)
-            for partition in partitions:
-                part_path = os.path.join(datadir_path, partition)
-                try:
-                    suffixes = listdir(part_path)
-                except OSError as e:
-                    if e.errno != errno.ENOTDIR:
-                        raise
-                    continue
-                for asuffix in suffixes:
-                    suff_path = os.path.join(part_path, asuffix)
-                    try:
-                        hashes = listdir(suff_path)
-                    except OSError as e:
-                        if e.errno != errno.ENOTDIR:
-                            raise
-                        continue
-                    for hsh in hashes:
-                        hsh_path = os.path.join(suff_path, hsh)
-                        yield AuditLocation(hsh_path, device, partition)
+            # hash entries are yielded whatever their type; a hash that
+            # isn't a directory is quarantined when it's audited
+            for hsh_path, (partition, _suffix, _hsh), _is_dir in \
+                    walk_dir_tree(datadir_path, 3):
+                yield AuditLocation(hsh_path, device, partition)
 
 
 class DiskFileManager(object):
@@ -838,6 +825,28 @@ class DiskFileWriter(object):
 
         return self._upload_size
 
+    def clone_from(self, reader):
+        """
+        Make the data of the file being written a copy-on-write clone of the
+        data of an object opened for reading, if the filesystem can.
+        Metadata is not cloned. Must be called before any data is written.
+
+        :param reader: a :class:`swift.obj.diskfile.DiskFileReader` for
+                       the object on the same device
+        :returns: True if the data was cloned, False if it must be written
+                  instead
+        """
+        try:
+            self._threadpool.run_in_thread(
+                fcntl.ioctl, self._fd, FICLONE, reader._fp.fileno())
+        except (IOError, OSError) as err:
+            if err.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                             errno.EXDEV, errno.ENOSYS):
+                return False
+            raise
+        self._upload_size = reader._obj_size
+        return True
+
     def _finalize_put(self, metadata, target_path):
         # Write the metadata before calling fsync() so that both data and
         # metadata are flushed to disk.
@@ -975,13 +984,15 @@ class DiskFileReader(object):
     def can_zero_copy_send(self):
         return self._use_splice
 
-    def zero_copy_send(self, wsockfd):
+    def zero_copy_send(self, wsockfd, timeout=None):
         """
         Does some magic with splice() and tee() to move stuff from disk to
         network without ever touching userspace.
 
         :param wsockfd: file descriptor (integer) of the socket out which to
                         send data
+        :param timeout: seconds to wait for the socket to become writable
+                        each time it would block; None waits forever
         """
         # Note: if we ever add support for zero-copy ranged GET responses,
         # we'll have to make this conditional.
@@ -1049,7 +1060,7 @@ class DiskFileReader(object):
                     sent = splice(client_rpipe, 0, wsockfd, 0,
                                   bytes_in_pipe, 0)
                     if sent is None:  # would have blocked
-                        trampoline(wsockfd, write=True)
+                        trampoline(wsockfd, write=True, timeout=timeout)
                     else:
                         bytes_in_pipe -= sent
 
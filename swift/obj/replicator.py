@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import errno
 import os
 from os.path import isdir, isfile, join
 import random
@@ -42,6 +43,137 @@ from swift.common.storage_policy import POLICIES
 
 hubs.use_hub(get_hub())
 
+REPLICATION_PROGRESS_FILE = 'object-replicator.progress'
+
+
+class ReplicationProgress(object):
+    """
+    Records which partitions of a device have been replicated during the
+    current pass, so that a restarted replicator can resume the pass rather
+    than starting over.
+
+    Progress is kept in a file at the root of the device. Its first line is
+    the time the pass started and each following line is the policy index,
+    partition and completion time of one replicated partition; lines are
+    only ever appended during a pass. When a pass completes its completion
+    times are merged into a file with a .last suffix, which keeps the latest
+    completion time of every partition from the passes so far around to
+    compute the age of partitions not yet replicated in the current one.
+
+    :param dev_path: path to the device
+    :param logger: logger to use for errors reading or writing the file
+    """
+
+    def __init__(self, dev_path, logger):
+        self.path = join(dev_path, REPLICATION_PROGRESS_FILE)
+        self.last_path = self.path + '.last'
+        self.logger = logger
+        self.pass_start, self.completed = self._load(self.path)
+        self.last_pass_start, self.last_completed = \
+            self._load(self.last_path)
+
+    def _load(self, path):
+        pass_start = None
+        completed = {}
+        try:
+            with open(path) as fp:
+                pass_start = float(fp.readline())
+                for line in fp:
+                    try:
+                        policy_idx, partition, done = line.split()
+                        completed[(int(policy_idx), partition)] = float(done)
+                    except ValueError:
+                        continue  # most likely a torn final line
+        except IOError as err:
+            if err.errno != errno.ENOENT:
+                self.logger.exception(_('ERROR reading %s'), path)
+        except ValueError:
+            self.logger.warning(_('Ignoring invalid progress file %s'), path)
+            pass_start = None
+            completed = {}
+        return pass_start, completed
+
+    def start_pass(self, now):
+        """
+        Starts a new pass unless one is already in progress.
+
+        :returns: True if a previous pass is being resumed
+        """
+        if self.pass_start is not None:
+            try:
+                with open(self.path, 'rb+') as fp:
+                    fp.seek(-1, os.SEEK_END)
+                    if fp.read(1) != '\n':
+                        # don't let the next record extend a torn line
+                        fp.write('\n')
+            except IOError:
+                self.logger.exception(_('ERROR writing %s'), self.path)
+            return True
+        self.pass_start = now
+        self.completed = {}
+        try:
+            with open(self.path, 'w') as fp:
+                fp.write('%.5f\n' % now)
+        except IOError:
+            self.logger.exception(_('ERROR writing %s'), self.path)
+        return False
+
+    def is_done(self, policy_idx, partition):
+        return (int(policy_idx), partition) in self.completed
+
+    def mark_done(self, policy_idx, partition, now):
+        self.completed[(int(policy_idx), partition)] = now
+        try:
+            with open(self.path, 'a') as fp:
+                fp.write('%d %s %.5f\n' % (int(policy_idx), partition, now))
+        except IOError:
+            self.logger.exception(_('ERROR writing %s'), self.path)
+
+    def finish_pass(self):
+        """
+        Marks the current pass as complete, so the next call to
+        start_pass starts a new one. Partitions that weren't replicated
+        in the pass keep their completion times from earlier passes.
+        """
+        if self.last_pass_start is not None:
+            self.last_pass_start = min(self.last_pass_start, self.pass_start)
+        else:
+            self.last_pass_start = self.pass_start
+        self.last_completed.update(self.completed)
+        tmp_path = self.last_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as fp:
+                fp.write('%.5f\n' % self.last_pass_start)
+                for (policy_idx, partition), done in sorted(
+                        self.last_completed.items()):
+                    fp.write('%d %s %.5f\n' % (policy_idx, partition, done))
+            os.rename(tmp_path, self.last_path)
+        except (IOError, OSError):
+            self.logger.exception(_('ERROR writing %s'), self.last_path)
+        try:
+            os.unlink(self.path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                self.logger.exception(_('ERROR removing %s'), self.path)
+        self.pass_start = None
+        self.completed = {}
+
+    def oldest_age(self, keys, now):
+        """
+        Returns how many seconds it has been since the least recently
+        replicated of the given (policy_idx, partition) keys was last
+        replicated, or 0 if there are no keys.
+
+        Partitions that haven't been replicated in any pass we know of are
+        counted from the start of the earliest one.
+        """
+        default = self.last_pass_start or self.pass_start or now
+        oldest = now
+        for key in keys:
+            oldest = min(oldest, self.completed.get(
+                key, self.last_completed.get(key, default)))
+        return max(now - oldest, 0)
+
 
 class ObjectReplicator(Daemon):
     """
@@ -83,6 +215,8 @@ class ObjectReplicator(Daemon):
         self.node_timeout = float(conf.get('node_timeout', 10))
         self.sync_method = getattr(self, conf.get('sync_method') or 'rsync')
         self.network_chunk_size = int(conf.get('network_chunk_size', 65536))
+        self.ssync_compact_missing_check = config_true_value(
+            conf.get('ssync_compact_missing_check', 'no'))
         self.headers = {
             'Content-Length': '0',
             'user-agent': 'object-replicator %s' % os.getpid()}
@@ -92,6 +226,9 @@ class ObjectReplicator(Daemon):
                                                          False))
         self.handoff_delete = config_auto_int_value(
             conf.get('handoff_delete', 'auto'), 0)
+        self.resume_passes = config_true_value(
+            conf.get('resume_passes', 'yes'))
+        self.progress = {}
         self._diskfile_mgr = DiskFileManager(conf, self.logger)
 
     def sync(self, node, job, suffixes):  # Just exists for doc anchor point
@@ -220,6 +357,8 @@ class ObjectReplicator(Daemon):
         belong on this node.
 
         :param job: a dict containing info about the partition to be replicated
+        :returns: True if the partition was synced to all of its primaries
+                  or removed, False otherwise
         """
 
         def tpool_get_suffixes(path):
@@ -229,6 +368,7 @@ class ObjectReplicator(Daemon):
         self.logger.increment('partition.delete.count.%s' % (job['device'],))
         self.headers['X-Backend-Storage-Policy-Index'] = job['policy_idx']
         begin = time.time()
+        success = False
         try:
             responses = []
             suffixes = tpool.execute(tpool_get_suffixes, job['path'])
@@ -255,22 +395,27 @@ class ObjectReplicator(Daemon):
             if not suffixes or delete_handoff:
                 self.logger.info(_("Removing partition: %s"), job['path'])
                 tpool.execute(shutil.rmtree, job['path'], ignore_errors=True)
+            success = not suffixes or delete_handoff
         except (Exception, Timeout):
             self.logger.exception(_("Error syncing handoff partition"))
         finally:
             self.partition_times.append(time.time() - begin)
             self.logger.timing_since('partition.delete.timing', begin)
+        return success
 
     def update(self, job):
         """
         High-level method that replicates a single partition.
 
         :param job: a dict containing info about the partition to be replicated
+        :returns: True if the partition was synced with every node it was
+                  compared against, False otherwise
         """
         self.replication_count += 1
         self.logger.increment('partition.update.count.%s' % (job['device'],))
         self.headers['X-Backend-Storage-Policy-Index'] = job['policy_idx']
         begin = time.time()
+        success = False
         try:
             hashed, local_hash = tpool_reraise(
                 get_hashes, job['path'],
@@ -279,6 +424,7 @@ class ObjectReplicator(Daemon):
             self.suffix_hash += hashed
             self.logger.update_stats('suffix.hashes', hashed)
             attempts_left = len(job['nodes'])
+            success = True
             nodes = itertools.chain(
                 job['nodes'],
                 job['object_ring'].get_more_nodes(int(job['partition'])))
@@ -302,6 +448,7 @@ class ObjectReplicator(Daemon):
                                                 "from %(ip)s"),
                                               {'resp': resp.status,
                                                'ip': node['replication_ip']})
+                            success = False
                             continue
                         remote_hash = pickle.loads(resp.read())
                         del resp
@@ -319,7 +466,8 @@ class ObjectReplicator(Daemon):
                     suffixes = [suffix for suffix in local_hash if
                                 local_hash[suffix] !=
                                 remote_hash.get(suffix, -1)]
-                    self.sync(node, job, suffixes)
+                    if not self.sync(node, job, suffixes):
+                        success = False
                     with Timeout(self.http_timeout):
                         conn = http_connect(
                             node['replication_ip'], node['replication_port'],
@@ -332,12 +480,15 @@ class ObjectReplicator(Daemon):
                 except (Exception, Timeout):
                     self.logger.exception(_("Error syncing with node: %s") %
                                           node)
+                    success = False
             self.suffix_count += len(local_hash)
         except (Exception, Timeout):
             self.logger.exception(_("Error syncing partition"))
+            success = False
         finally:
             self.partition_times.append(time.time() - begin)
             self.logger.timing_since('partition.update.timing', begin)
+        return success
 
     def stats_line(self):
         """
@@ -376,6 +527,39 @@ class ObjectReplicator(Daemon):
                 _("Nothing replicated for %s seconds."),
                 (time.time() - self.start))
 
+    def dump_progress_recon(self):
+        """
+        Writes to recon, per device and overall, how long ago the least
+        recently replicated partition was replicated.
+        """
+        if not self.progress:
+            return
+        now = time.time()
+        ages = {}
+        for device, (progress, keys) in self.progress.items():
+            ages[device] = progress.oldest_age(keys, now)
+        dump_recon_cache(
+            {'object_replication_oldest_partition_age': max(ages.values()),
+             'object_replication_partition_ages': ages},
+            self.rcache, self.logger)
+
+    def replicate_job(self, job, progress=None):
+        """
+        Replicates the job's partition and, if progress is given and the
+        partition replicated successfully, records that it has been
+        replicated during this pass.
+
+        :param job: a dict containing info about the partition to be replicated
+        :param progress: the :class:`ReplicationProgress` of the job's device
+        """
+        if job['delete']:
+            success = self.update_deleted(job)
+        else:
+            success = self.update(job)
+        if progress and success:
+            progress.mark_done(job['policy_idx'], job['partition'],
+                               time.time())
+
     def kill_coros(self):
         """Utility function that kills all coroutines currently running."""
         for coro in list(self.run_pool.coroutines_running):
@@ -392,6 +576,7 @@ class ObjectReplicator(Daemon):
         while True:
             eventlet.sleep(self.stats_interval)
             self.stats_line()
+            self.dump_progress_recon()
 
     def detect_lockups(self):
         """
@@ -486,6 +671,12 @@ class ObjectReplicator(Daemon):
             override_devices = []
         if override_partitions is None:
             override_partitions = []
+        # Only full passes are checkpointed; a run limited to some devices or
+        # partitions is neither resumed nor does it count toward a pass.
+        checkpoint = self.resume_passes and not (
+            override_devices or override_partitions)
+        self.progress = {}
+        completed = False
 
         stats = eventlet.spawn(self.heartbeat)
         lockup_detector = eventlet.spawn(self.detect_lockups)
@@ -494,6 +685,8 @@ class ObjectReplicator(Daemon):
         try:
             self.run_pool = GreenPool(size=self.concurrency)
             jobs = self.collect_jobs()
+            if checkpoint:
+                self.load_progress(jobs)
             for job in jobs:
                 if override_devices and job['device'] not in override_devices:
                     continue
@@ -508,12 +701,15 @@ class ObjectReplicator(Daemon):
                     self.logger.info(_("Ring change detected. Aborting "
                                        "current replication pass."))
                     return
-                if job['delete']:
-                    self.run_pool.spawn(self.update_deleted, job)
-                else:
-                    self.run_pool.spawn(self.update, job)
+                progress = None
+                if checkpoint:
+                    progress = self.progress[job['device']][0]
+                    if progress.is_done(job['policy_idx'], job['partition']):
+                        continue
+                self.run_pool.spawn(self.replicate_job, job, progress)
             with Timeout(self.lockup_timeout):
                 self.run_pool.waitall()
+            completed = True
         except (Exception, Timeout):
             self.logger.exception(_("Exception in top-level replication loop"))
             self.kill_coros()
@@ -521,6 +717,33 @@ class ObjectReplicator(Daemon):
             stats.kill()
             lockup_detector.kill()
             self.stats_line()
+            if completed:
+                for progress, keys in self.progress.values():
+                    progress.finish_pass()
+            self.dump_progress_recon()
+
+    def load_progress(self, jobs):
+        """
+        Loads the :class:`ReplicationProgress` of every device with jobs,
+        starting a new pass on those that have no pass in progress.
+
+        :param jobs: the jobs of this replication pass
+        """
+        now = time.time()
+        for job in jobs:
+            if job['device'] not in self.progress:
+                progress = ReplicationProgress(
+                    join(self.devices_dir, job['device']), self.logger)
+                if progress.start_pass(now):
+                    self.logger.info(
+                        _('Resuming replication pass of %(device)s started '
+                          'at %(start)s with %(done)d partitions done'),
+                        {'device': job['device'],
+                         'start': progress.pass_start,
+                         'done': len(progress.completed)})
+                self.progress[job['device']] = (progress, set())
+            self.progress[job['device']][1].add(
+                (int(job['policy_idx']), job['partition']))
 
     def run_once(self, *args, **kwargs):
         start = time.time()
@@ -23,6 +23,7 @@ import traceback
 import socket
 import math
 from swift import gettext_ as _
+from urllib import unquote
 from hashlib import md5
 
 from eventlet import sleep, wsgi, Timeout
@@ -30,7 +31,7 @@ from eventlet import sleep, wsgi, Timeout
 from swift.common.utils import public, get_logger, \
     config_true_value, timing_stats, replication, \
     normalize_delete_at_timestamp, get_log_line, Timestamp, \
-    get_expirer_container
+    get_expirer_container, split_path, list_from_csv
 from swift.common.bufferedhttp import http_connect
 from swift.common.constraints import check_object_creation, \
     valid_timestamp, check_utf8
@@ -47,7 +48,7 @@ from swift.common.swob import HTTPAccepted, HTTPBadRequest, HTTPCreated, \
     HTTPPreconditionFailed, HTTPRequestTimeout, HTTPUnprocessableEntity, \
     HTTPClientDisconnect, HTTPMethodNotAllowed, Request, Response, \
     HTTPInsufficientStorage, HTTPForbidden, HTTPException, HeaderKeyDict, \
-    HTTPConflict
+    HTTPConflict, HTTPServiceUnavailable
 from swift.obj.diskfile import DATAFILE_SYSTEM_META, DiskFileManager
 
 
@@ -154,6 +155,10 @@ class ObjectController(object):
             conf.get('replication_failure_threshold') or 100)
         self.replication_failure_ratio = float(
             conf.get('replication_failure_ratio') or 1.0)
+        self.replication_update_concurrency = int(
+            conf.get('replication_update_concurrency') or 1)
+        self.replication_update_buffer_size = int(
+            conf.get('replication_update_buffer_size') or 1048576)
 
     def get_diskfile(self, device, partition, account, container, obj,
                      policy_idx, **kwargs):
@@ -253,6 +258,18 @@ class ObjectController(object):
         else:
             updates = []
 
+        container_path = headers_in.get('X-Backend-Container-Path')
+        if container_path:
+            # the container is sharded; the proxy has found the nodes of
+            # the shard container holding this object's name
+            try:
+                account, container = split_path(
+                    '/' + unquote(container_path), 2, 2)
+            except ValueError:
+                self.logger.error(_('ERROR Container update failed: invalid '
+                                    'container path "%s"') % container_path)
+                return
+
         headers_out['x-trans-id'] = headers_in.get('x-trans-id', '-')
         headers_out['referer'] = request.as_referer()
         headers_out['X-Backend-Storage-Policy-Index'] = policy_idx
@@ -385,6 +402,81 @@ class ObjectController(object):
             return HTTPInsufficientStorage(drive=device, request=request)
         return HTTPAccepted(request=request)
 
+    def _get_copy_source(self, request, device):
+        """
+        Find the source of an object the proxy server has asked us to copy
+        with X-Backend-Copy-From-* headers: a copy of it on our own device,
+        or else a GET of it from one of the listed object servers.
+
+        :param request: the PUT request
+        :param device: the device the copy is being PUT to
+        :returns: a tuple of (chunks, size, source), where chunks iterates
+                  over the source's data, size is its length and source is
+                  what to close when done with it: chunks itself when it's a
+                  DiskFileReader of our copy of the source, or else the
+                  connection it's read from
+        :raises HTTPException: if the source can't be read
+        """
+        try:
+            partition, account, container, obj = split_path(
+                unquote(request.headers['X-Backend-Copy-From-Path']),
+                4, 4, True)
+            policy_idx = int(request.headers.get(
+                'X-Backend-Copy-From-Policy-Index', 0))
+            timestamp = Timestamp(
+                request.headers['X-Backend-Copy-From-Timestamp'])
+        except (KeyError, ValueError):
+            raise HTTPBadRequest(body='Invalid X-Backend-Copy-From headers',
+                                 request=request, content_type='text/plain')
+        if 'etag' not in request.headers:
+            raise HTTPBadRequest(body='ETag required to copy an object',
+                                 request=request, content_type='text/plain')
+        etag = request.headers['etag'].lower()
+        try:
+            disk_file = self.get_diskfile(
+                device, partition, account, container, obj,
+                policy_idx=policy_idx)
+            with disk_file.open():
+                metadata = disk_file.get_metadata()
+                if Timestamp(metadata['X-Timestamp']) == timestamp and \
+                        metadata['ETag'] == etag:
+                    reader = disk_file.reader()
+                    return reader, int(metadata['Content-Length']), reader
+        except (DiskFileNotExist, DiskFileQuarantined,
+                DiskFileDeviceUnavailable, DiskFileXattrNotSupported):
+            pass
+        headers = {'X-Backend-Storage-Policy-Index': str(policy_idx),
+                   'user-agent': 'object-server %s' % os.getpid()}
+        path = '/%s/%s/%s' % (account, container, obj)
+        for node in list_from_csv(
+                request.headers.get('X-Backend-Copy-From-Nodes')):
+            try:
+                addr, node_device = node.split('/', 1)
+                ip, port = addr.rsplit(':', 1)
+                with ConnectionTimeout(self.conn_timeout):
+                    conn = http_connect(ip, port, node_device, partition,
+                                        'GET', path, headers)
+                with Timeout(self.node_timeout):
+                    response = conn.getresponse()
+                if response.status == 200 and Timestamp(response.getheader(
+                        'X-Backend-Timestamp')) == timestamp:
+                    return (self._copy_chunks(response),
+                            int(response.getheader('Content-Length')), conn)
+                conn.close()
+            except (Exception, Timeout):
+                self.logger.exception(_(
+                    'ERROR reading copy source %(path)s from %(node)s'),
+                    {'path': path, 'node': node})
+        raise HTTPServiceUnavailable(request=request)
+
+    def _copy_chunks(self, response):
+        while True:
+            with ChunkReadTimeout(self.node_timeout):
+                chunk = response.read(self.network_chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
     @public
     @timing_stats()
     def PUT(self, request):
@@ -435,33 +527,53 @@ class ObjectController(object):
         upload_expiration = time.time() + self.max_upload_time
         etag = md5()
         elapsed_time = 0
+
+        def timeout_reader():
+            with ChunkReadTimeout(self.client_timeout):
+                return request.environ['wsgi.input'].read(
+                    self.network_chunk_size)
+
+        chunks = iter(timeout_reader, '')
+        copy_source = None
+        if 'X-Backend-Copy-From-Path' in request.headers:
+            try:
+                chunks, fsize, copy_source = self._get_copy_source(
+                    request, device)
+            except HTTPException as error_response:
+                return error_response
         try:
             with disk_file.create(size=fsize) as writer:
                 upload_size = 0
-
-                def timeout_reader():
-                    with ChunkReadTimeout(self.client_timeout):
-                        return request.environ['wsgi.input'].read(
-                            self.network_chunk_size)
-
+                # a copy of a source on our own device can share its data
+                cloned = copy_source is chunks and \
+                    hasattr(writer, 'clone_from') and \
+                    writer.clone_from(copy_source)
+                if cloned:
+                    # the clone's data is still read through the source's
+                    # reader, to hash it and so that the reader quarantines
+                    # a source that doesn't match its own ETag
+                    self.logger.increment('PUT.copy_clones')
                 try:
-                    for chunk in iter(lambda: timeout_reader(), ''):
+                    for chunk in chunks:
                         start_time = time.time()
                         if start_time > upload_expiration:
                             self.logger.increment('PUT.timeouts')
                             return HTTPRequestTimeout(request=request)
                         etag.update(chunk)
-                        upload_size = writer.write(chunk)
+                        if cloned:
+                            upload_size += len(chunk)
+                        else:
+                            upload_size = writer.write(chunk)
                         elapsed_time += time.time() - start_time
                 except ChunkReadTimeout:
                     return HTTPRequestTimeout(request=request)
-                if upload_size:
+                if upload_size and not cloned:
                     self.logger.transfer_rate(
                         'PUT.' + device + '.timing', elapsed_time,
                         upload_size)
+                etag = etag.hexdigest()
                 if fsize is not None and fsize != upload_size:
                     return HTTPClientDisconnect(request=request)
-                etag = etag.hexdigest()
                 if 'etag' in request.headers and \
                         request.headers['etag'].lower() != etag:
                     return HTTPUnprocessableEntity(request=request)
@@ -484,6 +596,9 @@ class ObjectController(object):
                 writer.put(metadata)
         except (DiskFileXattrNotSupported, DiskFileNoSpace):
             return HTTPInsufficientStorage(drive=device, request=request)
+        finally:
+            if copy_source is not None:
+                copy_source.close()
         if orig_delete_at != new_delete_at:
             if new_delete_at:
                 self.delete_at_update(
@@ -694,7 +809,8 @@ class ObjectController(object):
     @replication
     @timing_stats(sample_rate=0.1)
     def REPLICATION(self, request):
-        return Response(app_iter=ssync_receiver.Receiver(self, request)())
+        receiver = ssync_receiver.Receiver(self, request)
+        return Response(app_iter=receiver(), headers=receiver.headers)
 
     def __call__(self, env, start_response):
         """WSGI Application entry point for the Swift Object Server."""
@@ -13,7 +13,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import binascii
+import itertools
 import urllib
+import zlib
 
 import eventlet
 import eventlet.wsgi
@@ -24,6 +27,43 @@ from swift.common import exceptions
 from swift.common import http
 from swift.common import swob
 from swift.common import utils
+from swift.obj.ssync_sender import suffix_digest
+
+
+def decode_varint(data, pos):
+    """
+    Returns a tuple of (value, pos) for the base 128 varint starting at
+    data[pos], where the returned pos is just after the varint.
+
+    Raises IndexError if data ends before the varint does.
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def decode_missing(data, pos, prev_ticks):
+    """
+    Decodes the compact MISSING_CHECK record starting at data[pos], as
+    encoded by :py:func:`swift.obj.ssync_sender.encode_missing`.
+
+    Returns a tuple of (object_hash, ticks, offset, pos) where the
+    returned pos is just after the record. Raises IndexError if data
+    doesn't hold the whole record.
+    """
+    if len(data) < pos + 17:
+        raise IndexError('short record')
+    object_hash = binascii.hexlify(data[pos:pos + 16])
+    delta, pos = decode_varint(data, pos + 16)
+    offset, pos = decode_varint(data, pos)
+    delta = delta >> 1 if not delta & 1 else -((delta + 1) >> 1)
+    return object_hash, prev_ticks + delta, offset, pos
 
 
 class Receiver(object):
@@ -69,6 +109,13 @@ class Receiver(object):
         # raised during processing because otherwise the sender could send for
         # quite some time before realizing it was all in vain.
         self.disconnect = True
+        # The sender asks for the compact MISSING_CHECK format; echoing the
+        # header back in our response tells it we understand that format.
+        self.compact = utils.config_true_value(request.headers.get(
+            'X-Backend-Ssync-Compact-Missing-Check'))
+        self.headers = {}
+        if self.compact:
+            self.headers['X-Backend-Ssync-Compact-Missing-Check'] = 'true'
 
     def __call__(self):
         """
@@ -212,7 +259,14 @@ class Receiver(object):
         The collection and then response is so the sender doesn't
         have to read while it writes to ensure network buffers don't
         fill up and block everything.
+
+        If the sender negotiated the compact format, see
+        :py:meth:`compact_missing_check` instead.
         """
+        if self.compact:
+            for data in self.compact_missing_check():
+                yield data
+            return
         with exceptions.MessageTimeout(
                 self.app.client_timeout, 'missing_check start'):
             line = self.fp.readline(self.app.network_chunk_size)
@@ -227,21 +281,7 @@ class Receiver(object):
             if not line or line.strip() == ':MISSING_CHECK: END':
                 break
             object_hash, timestamp = [urllib.unquote(v) for v in line.split()]
-            want = False
-            try:
-                df = self.app._diskfile_mgr.get_diskfile_from_hash(
-                    self.device, self.partition, object_hash, self.policy_idx)
-            except exceptions.DiskFileNotExist:
-                want = True
-            else:
-                try:
-                    df.open()
-                except exceptions.DiskFileDeleted as err:
-                    want = err.timestamp < timestamp
-                except exceptions.DiskFileError as err:
-                    want = True
-                else:
-                    want = df.timestamp < timestamp
+            want = self._want(object_hash, timestamp)
             if want:
                 object_hashes.append(object_hash)
         yield ':MISSING_CHECK: START\r\n'
@@ -251,6 +291,148 @@ class Receiver(object):
         for data in self._ensure_flush():
             yield data
 
+    def _want(self, object_hash, timestamp):
+        """
+        Returns True if we don't have the object with the given hash, or
+        have an older timestamp for it.
+        """
+        try:
+            df = self.app._diskfile_mgr.get_diskfile_from_hash(
+                self.device, self.partition, object_hash, self.policy_idx)
+        except exceptions.DiskFileNotExist:
+            return True
+        try:
+            df.open()
+        except exceptions.DiskFileDeleted as err:
+            return err.timestamp < timestamp
+        except exceptions.DiskFileError:
+            return True
+        return df.timestamp < timestamp
+
+    def _read_compressed(self, decompressor):
+        """
+        Reads one `length` line and that many compressed bytes from the
+        sender and returns them decompressed, or None at the
+        terminating zero length.
+        """
+        with exceptions.MessageTimeout(
+                self.app.client_timeout, 'missing_check line'):
+            line = self.fp.readline(self.app.network_chunk_size)
+            size = int(line.strip(), 16)
+            if not size:
+                return None
+            data = self.fp.read(size)
+        if len(data) != size:
+            raise Exception('Early termination of compressed MISSING_CHECK')
+        return decompressor.decompress(data)
+
+    def compact_missing_check(self):
+        """
+        Handles the receiver-side of a compact MISSING_CHECK step, used
+        when the sender sends the X-Backend-Ssync-Compact-Missing-Check
+        header.
+
+        This is preceded by a RANGE_CHECK exchange:
+
+            1. Sender sends `:RANGE_CHECK: START`, a `suffix digest`
+               line for each suffix it has objects in and
+               `:RANGE_CHECK: END`. The digest covers the hashes and
+               timestamps of every object in the suffix.
+
+            2. Receiver responds with `:RANGE_CHECK: START`, the
+               suffixes whose digests don't match its own, one per line,
+               and `:RANGE_CHECK: END`.
+
+        The MISSING_CHECK itself then follows the same steps as
+        :py:meth:`missing_check` but only for the differing suffixes,
+        and with the lines between the START and END markers replaced
+        by zlib streams. Each stream is sent as a series of hex `length`
+        lines each followed by that many compressed bytes, and ends with
+        a zero length line.
+
+        The sender's stream holds, for each object, the 16 byte binary
+        hash, the timestamp as a zigzag varint delta of 10 microsecond
+        ticks from the previous object's, and the varint timestamp
+        offset. The receiver's stream is just the 16 byte binary hashes
+        it wants.
+        """
+        with exceptions.MessageTimeout(
+                self.app.client_timeout, 'range_check start'):
+            line = self.fp.readline(self.app.network_chunk_size)
+        if line.strip() != ':RANGE_CHECK: START':
+            raise Exception(
+                'Looking for :RANGE_CHECK: START got %r' % line[:1024])
+        their_digests = {}
+        while True:
+            with exceptions.MessageTimeout(
+                    self.app.client_timeout, 'range_check line'):
+                line = self.fp.readline(self.app.network_chunk_size)
+            if not line or line.strip() == ':RANGE_CHECK: END':
+                break
+            suffix, digest = line.split()
+            their_digests[suffix] = digest
+        our_digests = {}
+        hashes = self.app._diskfile_mgr.yield_hashes(
+            self.device, self.partition, self.policy_idx,
+            sorted(their_digests))
+        for suffix, entries in itertools.groupby(
+                hashes, lambda entry: entry[1][-3:]):
+            our_digests[suffix] = suffix_digest(
+                (object_hash, timestamp)
+                for path, object_hash, timestamp in entries)
+        yield ':RANGE_CHECK: START\r\n'
+        for suffix in sorted(their_digests):
+            if our_digests.get(suffix) != their_digests[suffix]:
+                yield suffix + '\r\n'
+        yield ':RANGE_CHECK: END\r\n'
+        for data in self._ensure_flush():
+            yield data
+
+        with exceptions.MessageTimeout(
+                self.app.client_timeout, 'missing_check start'):
+            line = self.fp.readline(self.app.network_chunk_size)
+        if line.strip() != ':MISSING_CHECK: START':
+            raise Exception(
+                'Looking for :MISSING_CHECK: START got %r' % line[:1024])
+        decompressor = zlib.decompressobj()
+        compressor = zlib.compressobj()
+        wanted = []
+        data = ''
+        ticks = 0
+        while True:
+            chunk = self._read_compressed(decompressor)
+            if chunk is None:
+                break
+            data += chunk
+            pos = 0
+            while pos < len(data):
+                try:
+                    object_hash, next_ticks, offset, pos = decode_missing(
+                        data, pos, ticks)
+                except IndexError:
+                    break  # need more data for this record
+                ticks = next_ticks
+                timestamp = utils.Timestamp(ticks / 100000.0, offset)
+                if self._want(object_hash, timestamp.internal):
+                    wanted.append(binascii.unhexlify(object_hash))
+            data = data[pos:]
+        if data:
+            raise Exception('Truncated compressed MISSING_CHECK record')
+        with exceptions.MessageTimeout(
+                self.app.client_timeout, 'missing_check end'):
+            line = self.fp.readline(self.app.network_chunk_size)
+        if line.strip() != ':MISSING_CHECK: END':
+            raise Exception(
+                'Looking for :MISSING_CHECK: END got %r' % line[:1024])
+        yield ':MISSING_CHECK: START\r\n'
+        if wanted:
+            data = compressor.compress(''.join(wanted)) + compressor.flush()
+            yield '%x\r\n%s' % (len(data), data)
+        yield '0\r\n'
+        yield ':MISSING_CHECK: END\r\n'
+        for data in self._ensure_flush():
+            yield data
+
     def updates(self):
         """
         Handles the UPDATES step of a REPLICATION request.
@@ -288,6 +470,11 @@ class Receiver(object):
         thresholds) so the sender knows the whole was not entirely a
         success. This is so the sender knows if it can remove an out
         of place partition, for example.
+
+        If replication_update_concurrency is greater than 1, subrequests
+        with bodies no larger than replication_update_buffer_size are
+        buffered and applied concurrently by a green pool of that size;
+        each subrequest still counts as its own success or failure.
         """
         with exceptions.MessageTimeout(
                 self.app.client_timeout, 'updates start'):
@@ -296,87 +483,63 @@ class Receiver(object):
             raise Exception('Looking for :UPDATES: START got %r' % line[:1024])
         successes = 0
         failures = 0
-        while True:
-            with exceptions.MessageTimeout(
-                    self.app.client_timeout, 'updates line'):
-                line = self.fp.readline(self.app.network_chunk_size)
-            if not line or line.strip() == ':UPDATES: END':
-                break
-            # Read first line METHOD PATH of subrequest.
-            method, path = line.strip().split(' ', 1)
-            subreq = swob.Request.blank(
-                '/%s/%s%s' % (self.device, self.partition, path),
-                environ={'REQUEST_METHOD': method})
-            # Read header lines.
-            content_length = None
-            replication_headers = []
+        # Subrequests whose bodies fit within replication_update_buffer_size
+        # are read off the wire and then applied by a bounded pool so that
+        # several objects can be written to disk at once while we keep
+        # reading from the sender. Larger subrequests stream straight through
+        # as before.
+        pool = None
+        results = []
+        if self.app.replication_update_concurrency > 1:
+            pool = eventlet.GreenPool(self.app.replication_update_concurrency)
+        try:
             while True:
-                with exceptions.MessageTimeout(self.app.client_timeout):
+                with exceptions.MessageTimeout(
+                        self.app.client_timeout, 'updates line'):
                     line = self.fp.readline(self.app.network_chunk_size)
-                if not line:
-                    raise Exception(
-                        'Got no headers for %s %s' % (method, path))
-                line = line.strip()
-                if not line:
+                if not line or line.strip() == ':UPDATES: END':
                     break
-                header, value = line.split(':', 1)
-                header = header.strip().lower()
-                value = value.strip()
-                subreq.headers[header] = value
-                replication_headers.append(header)
-                if header == 'content-length':
-                    content_length = int(value)
-            # Establish subrequest body, if needed.
-            if method == 'DELETE':
-                if content_length not in (None, 0):
-                    raise Exception(
-                        'DELETE subrequest with content-length %s' % path)
-            elif method == 'PUT':
-                if content_length is None:
+                subreq = self._read_subrequest(line)
+                content_length = subreq.content_length or 0
+                if pool and content_length <= \
+                        self.app.replication_update_buffer_size:
+                    if content_length:
+                        subreq.environ['wsgi.input'] = utils.FileLikeIter(
+                            [subreq.environ['wsgi.input'].read()])
+                    pool.spawn_n(self._apply_subrequest, subreq, results)
+                else:
+                    # Route subrequest and translate response.
+                    resp = subreq.get_response(self.app)
+                    results.append(
+                        http.is_success(resp.status_int) or
+                        resp.status_int == http.HTTP_NOT_FOUND)
+                    # The subreq may have failed, but we want to read the rest
+                    # of the body from the remote side so we can continue on
+                    # with the next subreq.
+                    for junk in subreq.environ['wsgi.input']:
+                        pass
+                while results:
+                    if results.pop():
+                        successes += 1
+                    else:
+                        failures += 1
+                if failures >= self.app.replication_failure_threshold and (
+                        not successes or
+                        float(failures) / successes >
+                        self.app.replication_failure_ratio):
                     raise Exception(
-                        'No content-length sent for %s %s' % (method, path))
-
-                def subreq_iter():
-                    left = content_length
-                    while left > 0:
-                        with exceptions.MessageTimeout(
-                                self.app.client_timeout,
-                                'updates content'):
-                            chunk = self.fp.read(
-                                min(left, self.app.network_chunk_size))
-                        if not chunk:
-                            raise Exception(
-                                'Early termination for %s %s' % (method, path))
-                        left -= len(chunk)
-                        yield chunk
-                subreq.environ['wsgi.input'] = utils.FileLikeIter(
-                    subreq_iter())
-            else:
-                raise Exception('Invalid subrequest method %s' % method)
-            subreq.headers['X-Backend-Storage-Policy-Index'] = self.policy_idx
-            subreq.headers['X-Backend-Replication'] = 'True'
-            if replication_headers:
-                subreq.headers['X-Backend-Replication-Headers'] = \
-                    ' '.join(replication_headers)
-            # Route subrequest and translate response.
-            resp = subreq.get_response(self.app)
-            if http.is_success(resp.status_int) or \
-                    resp.status_int == http.HTTP_NOT_FOUND:
+                        'Too many %d failures to %d successes' %
+                        (failures, successes))
+        finally:
+            # Never leave subrequests running once the replication lock is
+            # released.
+            if pool:
+                pool.waitall()
+        while results:
+            if results.pop():
                 successes += 1
             else:
                 failures += 1
-            if failures >= self.app.replication_failure_threshold and (
-                    not successes or
-                    float(failures) / successes >
-                    self.app.replication_failure_ratio):
-                raise Exception(
-                    'Too many %d failures to %d successes' %
-                    (failures, successes))
-            # The subreq may have failed, but we want to read the rest of the
-            # body from the remote side so we can continue on with the next
-            # subreq.
-            for junk in subreq.environ['wsgi.input']:
-                pass
         if failures:
             raise swob.HTTPInternalServerError(
                 'ERROR: With :UPDATES: %d failures to %d successes' %
@@ -385,3 +548,87 @@ class Receiver(object):
         yield ':UPDATES: END\r\n'
         for data in self._ensure_flush():
             yield data
+
+    def _read_subrequest(self, line):
+        """
+        Reads the headers of an UPDATES subrequest, given its first
+        `METHOD PATH` line, and returns a :class:`swob.Request` whose
+        wsgi.input will read the subrequest body from the sender.
+        """
+        # Read first line METHOD PATH of subrequest.
+        method, path = line.strip().split(' ', 1)
+        subreq = swob.Request.blank(
+            '/%s/%s%s' % (self.device, self.partition, path),
+            environ={'REQUEST_METHOD': method})
+        # Read header lines.
+        content_length = None
+        replication_headers = []
+        while True:
+            with exceptions.MessageTimeout(self.app.client_timeout):
+                line = self.fp.readline(self.app.network_chunk_size)
+            if not line:
+                raise Exception(
+                    'Got no headers for %s %s' % (method, path))
+            line = line.strip()
+            if not line:
+                break
+            header, value = line.split(':', 1)
+            header = header.strip().lower()
+            value = value.strip()
+            subreq.headers[header] = value
+            replication_headers.append(header)
+            if header == 'content-length':
+                content_length = int(value)
+        # Establish subrequest body, if needed.
+        if method == 'DELETE':
+            if content_length not in (None, 0):
+                raise Exception(
+                    'DELETE subrequest with content-length %s' % path)
+        elif method == 'PUT':
+            if content_length is None:
+                raise Exception(
+                    'No content-length sent for %s %s' % (method, path))
+
+            def subreq_iter():
+                left = content_length
+                while left > 0:
+                    with exceptions.MessageTimeout(
+                            self.app.client_timeout,
+                            'updates content'):
+                        chunk = self.fp.read(
+                            min(left, self.app.network_chunk_size))
+                    if not chunk:
+                        raise Exception(
+                            'Early termination for %s %s' % (method, path))
+                    left -= len(chunk)
+                    yield chunk
+            subreq.environ['wsgi.input'] = utils.FileLikeIter(
+                subreq_iter())
+        else:
+            raise Exception('Invalid subrequest method %s' % method)
+        subreq.headers['X-Backend-Storage-Policy-Index'] = self.policy_idx
+        subreq.headers['X-Backend-Replication'] = 'True'
+        if replication_headers:
+            subreq.headers['X-Backend-Replication-Headers'] = \
+                ' '.join(replication_headers)
+        return subreq
+
+    def _apply_subrequest(self, subreq, results):
+        """
+        Routes a fully buffered UPDATES subrequest to the object server
+        and appends whether it succeeded to `results`.
+
+        Runs in a green pool, so any exception is logged and counted
+        as a failure of just this subrequest.
+        """
+        try:
+            resp = subreq.get_response(self.app)
+            success = http.is_success(resp.status_int) or \
+                resp.status_int == http.HTTP_NOT_FOUND
+        except Exception:
+            self.app.logger.exception(
+                '%s/%s/%s EXCEPTION in replication.Receiver subrequest %s %s'
+                % (self.request.remote_addr, self.device, self.partition,
+                   subreq.method, subreq.path))
+            success = False
+        results.append(success)
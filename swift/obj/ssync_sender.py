@@ -13,10 +13,70 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import binascii
+import itertools
 import urllib
+import zlib
+from hashlib import md5
+
+from eventlet import Timeout
+
 from swift.common import bufferedhttp
 from swift.common import exceptions
 from swift.common import http
+from swift.common.utils import config_true_value, Timestamp
+
+
+def encode_varint(value):
+    """
+    Returns the unsigned integer value encoded in base 128, least
+    significant group first, with the high bit set on all but the last
+    byte.
+    """
+    data = []
+    while value > 0x7f:
+        data.append(chr(0x80 | (value & 0x7f)))
+        value >>= 7
+    data.append(chr(value))
+    return ''.join(data)
+
+
+def timestamp_ticks(timestamp):
+    """
+    Returns a tuple of (ticks, offset) for the timestamp, where ticks is
+    the whole number of 10 microsecond units of its normalized form.
+    """
+    timestamp = Timestamp(timestamp)
+    return int(round(timestamp.timestamp * 100000)), timestamp.offset
+
+
+def encode_missing(object_hash, timestamp, prev_ticks):
+    """
+    Returns a tuple of (record, ticks) where record is the compact
+    MISSING_CHECK encoding of the object hash and timestamp: the 16
+    byte binary hash, the zigzag varint delta of the timestamp's ticks
+    from prev_ticks and the varint timestamp offset.
+    """
+    ticks, offset = timestamp_ticks(timestamp)
+    delta = ticks - prev_ticks
+    delta = delta << 1 if delta >= 0 else ((-delta) << 1) - 1
+    return (binascii.unhexlify(object_hash) + encode_varint(delta) +
+            encode_varint(offset)), ticks
+
+
+def suffix_digest(hashes_and_timestamps):
+    """
+    Returns the hex md5 of an iterable of (object_hash, timestamp)
+    tuples for a suffix, independent of their order.
+
+    Both sides of a compact MISSING_CHECK compute this to skip suffixes
+    that are already identical.
+    """
+    digest = md5()
+    for object_hash, timestamp in sorted(
+            (h, Timestamp(t).internal) for h, t in hashes_and_timestamps):
+        digest.update('%s %s\n' % (object_hash, timestamp))
+    return digest.hexdigest()
 
 
 class Sender(object):
@@ -39,6 +99,7 @@ class Sender(object):
         self.response_chunk_left = 0
         self.send_list = None
         self.failures = 0
+        self.compact = False
 
     @property
     def policy_idx(self):
@@ -102,6 +163,9 @@ class Sender(object):
             self.connection.putheader('Transfer-Encoding', 'chunked')
             self.connection.putheader('X-Backend-Storage-Policy-Index',
                                       self.policy_idx)
+            if self.daemon.ssync_compact_missing_check:
+                self.connection.putheader(
+                    'X-Backend-Ssync-Compact-Missing-Check', 'true')
             self.connection.endheaders()
         with exceptions.MessageTimeout(
                 self.daemon.node_timeout, 'connect receive'):
@@ -110,6 +174,11 @@ class Sender(object):
                 raise exceptions.ReplicationException(
                     'Expected status %s; got %s' %
                     (http.HTTP_OK, self.response.status))
+            # Older receivers don't know the compact MISSING_CHECK format and
+            # won't echo the header back.
+            if self.daemon.ssync_compact_missing_check:
+                self.compact = config_true_value(self.response.getheader(
+                    'X-Backend-Ssync-Compact-Missing-Check'))
 
     def readline(self):
         """
@@ -156,6 +225,35 @@ class Sender(object):
             data += '\n'
         return data
 
+    def read(self, size):
+        """
+        Reads exactly size bytes from the REPLICATION response body.
+        """
+        data = ''
+        while len(data) < size:
+            line = self.readline()
+            if not line:
+                raise exceptions.ReplicationException('Early disconnect')
+            data += line
+        self.response_buffer = data[size:] + self.response_buffer
+        return data[:size]
+
+    def send_line(self, msg):
+        """
+        Sends msg as a chunk of the REPLICATION request body.
+        """
+        self.connection.send('%x\r\n%s\r\n' % (len(msg), msg))
+
+    def send_compressed(self, compressor, data):
+        """
+        Sends data compressed with compressor as a `length` line followed
+        by that many bytes, flushing the compressor so the receiver can
+        decode everything sent so far.
+        """
+        data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            self.send_line('%x\r\n%s' % (len(data), data))
+
     def missing_check(self):
         """
         Handles the sender-side of the MISSING_CHECK step of a
@@ -164,6 +262,8 @@ class Sender(object):
         Full documentation of this can be found at
         :py:meth:`.Receiver.missing_check`.
         """
+        if self.compact:
+            return self.compact_missing_check()
         # First, send our list.
         with exceptions.MessageTimeout(
                 self.daemon.node_timeout, 'missing_check start'):
@@ -210,6 +310,115 @@ class Sender(object):
             if line:
                 self.send_list.append(line)
 
+    def compact_missing_check(self):
+        """
+        Handles the sender-side of a compact MISSING_CHECK step,
+        preceded by a RANGE_CHECK of per-suffix digests.
+
+        Full documentation of this can be found at
+        :py:meth:`.Receiver.compact_missing_check`.
+        """
+        with exceptions.MessageTimeout(
+                self.daemon.node_timeout, 'range_check start'):
+            self.send_line(':RANGE_CHECK: START\r\n')
+        hashes = self.daemon._diskfile_mgr.yield_hashes(
+            self.job['device'], self.job['partition'], self.policy_idx,
+            self.suffixes)
+        # yield_hashes lists a suffix at a time, so only one suffix's worth
+        # of entries is held in memory here.
+        for suffix, entries in itertools.groupby(
+                hashes, lambda entry: entry[1][-3:]):
+            digest = suffix_digest((object_hash, timestamp)
+                                   for path, object_hash, timestamp in entries)
+            with exceptions.MessageTimeout(
+                    self.daemon.node_timeout, 'range_check send line'):
+                self.send_line('%s %s\r\n' % (suffix, digest))
+        with exceptions.MessageTimeout(
+                self.daemon.node_timeout, 'range_check end'):
+            self.send_line(':RANGE_CHECK: END\r\n')
+        differing = []
+        self.expect_line(':RANGE_CHECK: START', 'range_check start wait')
+        while True:
+            with exceptions.MessageTimeout(
+                    self.daemon.http_timeout, 'range_check line wait'):
+                line = self.readline()
+            if not line:
+                raise exceptions.ReplicationException('Early disconnect')
+            line = line.strip()
+            if line == ':RANGE_CHECK: END':
+                break
+            if line:
+                differing.append(line)
+        # Only the suffixes that differ are listed in full.
+        compressor = zlib.compressobj()
+        with exceptions.MessageTimeout(
+                self.daemon.node_timeout, 'missing_check start'):
+            self.send_line(':MISSING_CHECK: START\r\n')
+        prev_ticks = 0
+        records = []
+        records_size = 0
+        for path, object_hash, timestamp in \
+                self.daemon._diskfile_mgr.yield_hashes(
+                    self.job['device'], self.job['partition'],
+                    self.policy_idx, differing):
+            record, prev_ticks = encode_missing(
+                object_hash, timestamp, prev_ticks)
+            records.append(record)
+            records_size += len(record)
+            if records_size >= self.daemon.network_chunk_size:
+                with exceptions.MessageTimeout(
+                        self.daemon.node_timeout, 'missing_check send line'):
+                    self.send_compressed(compressor, ''.join(records))
+                records = []
+                records_size = 0
+        with exceptions.MessageTimeout(
+                self.daemon.node_timeout, 'missing_check end'):
+            self.send_compressed(compressor, ''.join(records))
+            self.send_line('0\r\n:MISSING_CHECK: END\r\n')
+        # Now, retrieve the list of what they want.
+        self.expect_line(':MISSING_CHECK: START', 'missing_check start wait')
+        decompressor = zlib.decompressobj()
+        wanted = ''
+        self.send_list = []
+        while True:
+            with exceptions.MessageTimeout(
+                    self.daemon.http_timeout, 'missing_check line wait'):
+                line = self.readline()
+                if not line:
+                    raise exceptions.ReplicationException('Early disconnect')
+                if not line.strip():
+                    continue
+                try:
+                    size = int(line.strip(), 16)
+                except ValueError:
+                    raise exceptions.ReplicationException(
+                        'Unexpected response: %r' % line[:1024])
+                if not size:
+                    break
+                wanted += decompressor.decompress(self.read(size))
+            while len(wanted) >= 16:
+                self.send_list.append(binascii.hexlify(wanted[:16]))
+                wanted = wanted[16:]
+        self.expect_line(':MISSING_CHECK: END', 'missing_check end wait')
+
+    def expect_line(self, expected, timeout_msg):
+        """
+        Reads lines from the REPLICATION response, skipping blank ones,
+        until one is found; it must be the expected line.
+        """
+        while True:
+            with exceptions.MessageTimeout(
+                    self.daemon.http_timeout, timeout_msg):
+                line = self.readline()
+            if not line:
+                raise exceptions.ReplicationException('Early disconnect')
+            line = line.strip()
+            if line == expected:
+                return
+            elif line:
+                raise exceptions.ReplicationException(
+                    'Unexpected response: %r' % line[:1024])
+
     def updates(self):
         """
         Handles the sender-side of the UPDATES step of a REPLICATION
@@ -284,6 +493,10 @@ class Sender(object):
         """
         Sends a PUT subrequest for the url_path using the source df
         (DiskFile) and content_length.
+
+        If the DiskFile's reader supports zero-copy sends (see the
+        object-replicator's splice setting) the body is sent as a single
+        chunk straight from disk to the socket.
         """
         msg = ['PUT ' + url_path, 'Content-Length: ' + str(df.content_length)]
         # Sorted to make it easier to test.
@@ -293,11 +506,42 @@ class Sender(object):
         msg = '\r\n'.join(msg) + '\r\n\r\n'
         with exceptions.MessageTimeout(self.daemon.node_timeout, 'send_put'):
             self.connection.send('%x\r\n%s\r\n' % (len(msg), msg))
-        for chunk in df.reader():
+        reader = df.reader()
+        checker = getattr(reader, 'can_zero_copy_send', None)
+        if df.content_length and checker and checker():
+            self.send_put_zero_copy(reader, df.content_length)
+            return
+        for chunk in reader:
             with exceptions.MessageTimeout(
                     self.daemon.node_timeout, 'send_put chunk'):
                 self.connection.send('%x\r\n%s\r\n' % (len(chunk), chunk))
 
+    def send_put_zero_copy(self, reader, content_length):
+        """
+        Sends a PUT subrequest body of content_length bytes as one chunk
+        using the reader's zero_copy_send.
+        """
+        with exceptions.MessageTimeout(
+                self.daemon.node_timeout, 'send_put chunk'):
+            self.connection.send('%x\r\n' % content_length)
+        try:
+            reader.zero_copy_send(
+                self.connection.sock.fileno(),
+                timeout=self.daemon.node_timeout)
+        except Timeout:
+            raise exceptions.ReplicationException(
+                'Timeout in send_put zero-copy chunk')
+        # A short read means the chunk we announced was never completed and
+        # the receiver would misparse the rest of the stream; give up on the
+        # whole request instead.
+        if reader._bytes_read != content_length:
+            raise exceptions.ReplicationException(
+                'Sent %d of %d bytes in send_put zero-copy chunk' %
+                (reader._bytes_read, content_length))
+        with exceptions.MessageTimeout(
+                self.daemon.node_timeout, 'send_put chunk'):
+            self.connection.send('\r\n')
+
     def disconnect(self):
         """
         Closes down the connection to the object server once done
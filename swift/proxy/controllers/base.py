@@ -26,20 +26,24 @@
 
 import os
 import time
+import copy
 import functools
 import inspect
+import itertools
 import operator
+from collections import OrderedDict
 from sys import exc_info
 from swift import gettext_ as _
 from urllib import quote
 
-from eventlet import sleep
+from eventlet import sleep, spawn_n
+from eventlet.event import Event
 from eventlet.timeout import Timeout
 
 from swift.common.wsgi import make_pre_authed_env
 from swift.common.utils import Timestamp, config_true_value, \
     public, split_path, list_from_csv, GreenthreadSafeIterator, \
-    quorum_size, GreenAsyncPile
+    quorum_size, GreenAsyncPile, ReadAheadIterator
 from swift.common.bufferedhttp import http_connect
 from swift.common.exceptions import ChunkReadTimeout, ChunkWriteTimeout, \
     ConnectionTimeout
@@ -53,6 +57,67 @@ from swift.common.request_helpers import strip_sys_meta_prefix, \
     strip_user_meta_prefix, is_user_meta, is_sys_meta, is_sys_or_user_meta
 from swift.common.storage_policy import POLICIES
 
+#: Number of account and container infos each process keeps in front of
+#: memcache; 0 disables the in-process cache
+INFO_CACHE_SIZE = 0
+#: Seconds an info may be served from the in-process cache
+INFO_CACHE_TTL = 1.0
+#: Logger given the in-process cache's hit and miss metrics, if any
+INFO_CACHE_LOGGER = None
+
+
+class InfoCache(object):
+    """
+    Process-local cache of account and container infos, consulted before
+    memcache. It keeps the INFO_CACHE_SIZE most recently used infos, each
+    for at most INFO_CACHE_TTL seconds; infos of accounts and containers
+    that were not found are cached the same way.
+
+    While an info is being fetched from the backend, other lookups of the
+    same info wait for that fetch rather than starting their own.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.fetches = {}
+
+    def increment(self, metric):
+        if INFO_CACHE_LOGGER:
+            INFO_CACHE_LOGGER.increment('info_cache.%s' % metric)
+
+    def get(self, key):
+        """
+        :returns: a copy of the cached info, including its meta and sysmeta
+                  dicts, or None if it isn't cached
+        """
+        if INFO_CACHE_SIZE <= 0:
+            return None
+        entry = self.entries.pop(key, None)
+        if entry is None or entry[0] < time.time():
+            self.increment('l1.misses')
+            return None
+        self.entries[key] = entry
+        self.increment('l1.hits')
+        return copy.deepcopy(entry[1])
+
+    def set(self, key, info):
+        if INFO_CACHE_SIZE <= 0:
+            return
+        self.entries.pop(key, None)
+        while len(self.entries) >= INFO_CACHE_SIZE:
+            self.entries.popitem(last=False)
+        self.entries[key] = (time.time() + INFO_CACHE_TTL,
+                             copy.deepcopy(info))
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+
+_info_cache = InfoCache()
+
 
 def update_headers(response, headers):
     """
@@ -166,6 +231,7 @@ def headers_to_container_info(headers, status_int=HTTP_OK):
         'versions': headers.get('x-versions-location'),
         'storage_policy': headers.get('X-Backend-Storage-Policy-Index'.lower(),
                                       '0'),
+        'sharded': config_true_value(headers.get('x-backend-sharded')),
         'cors': {
             'allow_origin': meta.get('access-control-allow-origin'),
             'expose_headers': meta.get('access-control-expose-headers'),
@@ -393,6 +459,7 @@ def _set_info_cache(app, env, account, container, resp):
     memcache = getattr(app, 'memcache', None) or env.get('swift.cache')
     if not cache_time:
         env.pop(env_key, None)
+        _info_cache.delete(cache_key)
         if memcache:
             memcache.delete(cache_key)
         return
@@ -403,6 +470,7 @@ def _set_info_cache(app, env, account, container, resp):
         info = headers_to_account_info(resp.headers, resp.status_int)
     if memcache:
         memcache.set(cache_key, info, time=cache_time)
+    _info_cache.set(cache_key, info)
     env[env_key] = info
 
 
@@ -447,7 +515,8 @@ def clear_info_cache(app, env, account, container=None):
 
 def _get_info_cache(app, env, account, container=None):
     """
-    Get the cached info from env or memcache (if used) in that order
+    Get the cached info from env, the in-process cache or memcache (if used)
+    in that order
     Used for both account and container info
     A private function used by get_info
 
@@ -459,13 +528,20 @@ def _get_info_cache(app, env, account, container=None):
     cache_key, env_key = _get_cache_key(account, container)
     if env_key in env:
         return env[env_key]
+    info = _info_cache.get(cache_key)
+    if info:
+        env[env_key] = info
+        return info
     memcache = getattr(app, 'memcache', None) or env.get('swift.cache')
     if memcache:
         info = memcache.get(cache_key)
+        if INFO_CACHE_SIZE > 0:
+            _info_cache.increment('l2.hits' if info else 'l2.misses')
         if info:
             for key in info:
                 if isinstance(info[key], unicode):
                     info[key] = info[key].encode("utf-8")
+            _info_cache.set(cache_key, info)
             env[env_key] = info
         return info
     return None
@@ -505,11 +581,35 @@ def get_info(app, env, account, container=None, ret_not_found=False,
     :returns: the cached info or None if cannot be retrieved
     """
     info = _get_info_cache(app, env, account, container)
-    if info:
-        if ret_not_found or is_success(info['status']):
-            return info
-        return None
-    # Not in cache, let's try the account servers
+    if not info:
+        cache_key, env_key = _get_cache_key(account, container)
+        fetch = _info_cache.fetches.get(cache_key)
+        if fetch:
+            # someone else is already asking the backend
+            _info_cache.increment('collapsed')
+            info = fetch.wait()
+            if info:
+                info = env[env_key] = copy.deepcopy(info)
+        else:
+            if INFO_CACHE_SIZE > 0:
+                fetch = _info_cache.fetches[cache_key] = Event()
+            try:
+                info = _fetch_info(app, env, account, container, swift_source)
+            finally:
+                if fetch:
+                    del _info_cache.fetches[cache_key]
+                    fetch.send(info)
+    if info and (ret_not_found or is_success(info['status'])):
+        return info
+    return None
+
+
+def _fetch_info(app, env, account, container, swift_source):
+    """
+    Get the info about accounts or containers from the backend
+
+    :returns: the info, or None if it cannot be retrieved
+    """
     path = '/v1/%s' % account
     if container:
         # Stop and check if we have an account?
@@ -528,8 +628,7 @@ def get_info(app, env, account, container=None, ret_not_found=False,
     try:
         info = resp.environ[env_key]
         env[env_key] = info
-        if ret_not_found or is_success(info['status']):
-            return info
+        return info
     except (KeyError, AttributeError):
         pass
     return None
@@ -585,7 +684,9 @@ def close_swift_conn(src):
         # Also, since calling the response's close() method might not
         # close the underlying socket but only decrement some
         # reference-counter, we have a special method here that really,
-        # really kills the underlying socket with a close() syscall.
+        # really kills the underlying socket with a close() syscall. Pooled
+        # keep-alive connections whose response was read in full go back to
+        # the pool instead.
         src.nuke_from_orbit()  # it's the only way to be sure
     except Exception:
         pass
@@ -659,19 +760,19 @@ class GetOrHeadHandler(object):
             return True
         return is_success(src.status) or is_redirection(src.status)
 
-    def _make_app_iter(self, req, node, source):
+    def _read_source(self, node, source):
         """
         Returns an iterator over the contents of the source (via its read
-        func).  There is also quite a bit of cleanup to ensure garbage
-        collection works and the underlying socket of the source is closed.
+        func). If an object server is too slow to send a chunk, the rest is
+        fetched from another node, starting where the source left off.
+        The underlying socket of the last source read is closed when
+        the iterator finishes or is closed.
 
-        :param req: incoming request object
         :param source: The httplib.Response object this iterator should read
                        from.
         :param node: The node the source is reading from, for logging purposes.
         """
         try:
-            nchunks = 0
             bytes_read_from_source = 0
             node_timeout = self.app.node_timeout
             if self.server_type == 'Object':
@@ -680,7 +781,6 @@ class GetOrHeadHandler(object):
                 try:
                     with ChunkReadTimeout(node_timeout):
                         chunk = source.read(self.app.object_chunk_size)
-                        nchunks += 1
                         bytes_read_from_source += len(chunk)
                 except ChunkReadTimeout:
                     exc_type, exc_value, exc_traceback = exc_info()
@@ -706,6 +806,37 @@ class GetOrHeadHandler(object):
                         raise exc_type, exc_value, exc_traceback
                 if not chunk:
                     break
+                yield chunk
+        except ChunkReadTimeout:
+            self.app.exception_occurred(node, _('Object'),
+                                        _('Trying to read during GET'))
+            raise
+        finally:
+            # Close-out the connection as best as possible.
+            if getattr(source, 'swift_conn', None):
+                close_swift_conn(source)
+
+    def _make_app_iter(self, req, node, source):
+        """
+        Returns an iterator over the contents of the source (via its read
+        func).  There is also quite a bit of cleanup to ensure garbage
+        collection works and the underlying socket of the source is closed.
+
+        If read_ahead_chunks is set, object data is read from the source in
+        a separate greenthread, up to that many chunks ahead of the client.
+
+        :param req: incoming request object
+        :param source: The httplib.Response object this iterator should read
+                       from.
+        :param node: The node the source is reading from, for logging purposes.
+        """
+        chunks = self._read_source(node, source)
+        if self.app.read_ahead_chunks > 0 and self.server_type == 'Object':
+            chunks = ReadAheadIterator(chunks, self.app.read_ahead_chunks)
+        try:
+            nchunks = 0
+            for chunk in chunks:
+                nchunks += 1
                 with ChunkWriteTimeout(self.app.client_timeout):
                     yield chunk
                 # This is for fairness; if the network is outpacing the CPU,
@@ -725,10 +856,6 @@ class GetOrHeadHandler(object):
                 if nchunks % 5 == 0:
                     sleep()
 
-        except ChunkReadTimeout:
-            self.app.exception_occurred(node, _('Object'),
-                                        _('Trying to read during GET'))
-            raise
         except ChunkWriteTimeout:
             self.app.logger.warn(
                 _('Client did not read from proxy within %ss') %
@@ -741,9 +868,145 @@ class GetOrHeadHandler(object):
             self.app.logger.exception(_('Trying to send to client'))
             raise
         finally:
-            # Close-out the connection as best as possible.
-            if getattr(source, 'swift_conn', None):
-                close_swift_conn(source)
+            chunks.close()
+
+    def _make_node_request(self, node, node_timeout):
+        """
+        Send the request to one node.
+
+        :returns: the node's response, or None if it couldn't be had
+        """
+        start_node_timing = time.time()
+        try:
+            with ConnectionTimeout(self.app.conn_timeout):
+                conn = http_connect(
+                    node['ip'], node['port'], node['device'],
+                    self.partition, self.req_method, self.path,
+                    headers=self.backend_headers,
+                    query_string=self.req_query_string)
+            self.app.set_node_timing(node, time.time() - start_node_timing)
+
+            with Timeout(node_timeout):
+                possible_source = conn.getresponse()
+                # See NOTE: swift_conn at top of file about this.
+                possible_source.swift_conn = conn
+        except (Exception, Timeout):
+            self.app.exception_occurred(
+                node, self.server_type,
+                _('Trying to %(method)s %(path)s') %
+                {'method': self.req_method, 'path': self.req_path})
+            return None
+        self.app.set_response_timing(node, self.server_type,
+                                     time.time() - start_node_timing)
+        return possible_source
+
+    def _add_source(self, possible_source, node, sources):
+        """
+        Record a node's response, and add it to sources if it is usable.
+
+        :returns: True if the response was added to sources
+        """
+        if self.is_good_source(possible_source):
+            # 404 if we know we don't have a synced copy
+            if not float(possible_source.getheader('X-PUT-Timestamp', 1)):
+                self.statuses.append(HTTP_NOT_FOUND)
+                self.reasons.append('')
+                self.bodies.append('')
+                self.source_headers.append('')
+                close_swift_conn(possible_source)
+                return False
+            if self.used_source_etag:
+                src_headers = dict(
+                    (k.lower(), v) for k, v in
+                    possible_source.getheaders())
+                if src_headers.get('etag', '').strip('"') != \
+                        self.used_source_etag:
+                    self.statuses.append(HTTP_NOT_FOUND)
+                    self.reasons.append('')
+                    self.bodies.append('')
+                    self.source_headers.append('')
+                    return False
+
+            self.statuses.append(possible_source.status)
+            self.reasons.append(possible_source.reason)
+            self.bodies.append('')
+            self.source_headers.append('')
+            sources.append((possible_source, node))
+            return True
+
+        self.statuses.append(possible_source.status)
+        self.reasons.append(possible_source.reason)
+        self.bodies.append(possible_source.read())
+        self.source_headers.append(possible_source.getheaders())
+        if possible_source.status == HTTP_INSUFFICIENT_STORAGE:
+            self.app.error_limit(node, _('ERROR Insufficient Storage'))
+        elif is_server_error(possible_source.status):
+            self.app.error_occurred(
+                node, _('ERROR %(status)d %(body)s '
+                        'From %(type)s Server') %
+                {'status': possible_source.status,
+                 'body': self.bodies[-1][:1024],
+                 'type': self.server_type})
+        return False
+
+    def _hedged_request(self, node, node_timeout, hedge):
+        return self._make_node_request(node, node_timeout), node, hedge
+
+    def _get_hedged_source(self, nodes, node_timeout, hedge_delay, sources):
+        """
+        Ask the nodes one at a time like _get_source_and_node, except that
+        the next node is also asked whenever no response has come in for
+        hedge_delay seconds. The first usable response wins; the others are
+        closed as they come in.
+        """
+        max_pending = len(self.ring.get_part_nodes(self.partition))
+        pile = GreenAsyncPile(max_pending)
+        pending = 0
+        hedging = True
+        node = next(nodes, None)
+        if node:
+            pile.spawn(self._hedged_request, node, node_timeout, False)
+            pending += 1
+        while pending:
+            if hedging and pending < max_pending:
+                results = pile.waitfirst(hedge_delay)
+            else:
+                results = [pile.next()]
+            if not results:
+                node = next(nodes, None)
+                if node is None:
+                    hedging = False
+                    continue
+                if not self.app.start_hedge():
+                    # keep the node to fail over to
+                    nodes = itertools.chain([node], nodes)
+                    hedging = False
+                    continue
+                self.app.logger.increment('hedges')
+                pile.spawn(self._hedged_request, node, node_timeout, True)
+                pending += 1
+                continue
+            possible_source, node, hedge = results[0]
+            pending -= 1
+            if possible_source and \
+                    self._add_source(possible_source, node, sources):
+                if hedge:
+                    self.app.logger.increment('hedge_wins')
+                if pending:
+                    spawn_n(self._close_hedged_sources, pile)
+                return
+            if not pending:
+                # no-one else was asked yet; fail over to the next node
+                node = next(nodes, None)
+                if node:
+                    pile.spawn(self._hedged_request, node, node_timeout,
+                               False)
+                    pending += 1
+
+    def _close_hedged_sources(self, pile):
+        for possible_source, node, hedge in pile:
+            if possible_source:
+                close_swift_conn(possible_source)
 
     def _get_source_and_node(self):
         self.statuses = []
@@ -755,71 +1018,21 @@ class GetOrHeadHandler(object):
         node_timeout = self.app.node_timeout
         if self.server_type == 'Object' and not self.newest:
             node_timeout = self.app.recoverable_node_timeout
-        for node in self.app.iter_nodes(self.ring, self.partition):
-            if node in self.used_nodes:
-                continue
-            start_node_timing = time.time()
-            try:
-                with ConnectionTimeout(self.app.conn_timeout):
-                    conn = http_connect(
-                        node['ip'], node['port'], node['device'],
-                        self.partition, self.req_method, self.path,
-                        headers=self.backend_headers,
-                        query_string=self.req_query_string)
-                self.app.set_node_timing(node, time.time() - start_node_timing)
-
-                with Timeout(node_timeout):
-                    possible_source = conn.getresponse()
-                    # See NOTE: swift_conn at top of file about this.
-                    possible_source.swift_conn = conn
-            except (Exception, Timeout):
-                self.app.exception_occurred(
-                    node, self.server_type,
-                    _('Trying to %(method)s %(path)s') %
-                    {'method': self.req_method, 'path': self.req_path})
-                continue
-            if self.is_good_source(possible_source):
-                # 404 if we know we don't have a synced copy
-                if not float(possible_source.getheader('X-PUT-Timestamp', 1)):
-                    self.statuses.append(HTTP_NOT_FOUND)
-                    self.reasons.append('')
-                    self.bodies.append('')
-                    self.source_headers.append('')
-                    close_swift_conn(possible_source)
-                else:
-                    if self.used_source_etag:
-                        src_headers = dict(
-                            (k.lower(), v) for k, v in
-                            possible_source.getheaders())
-                        if src_headers.get('etag', '').strip('"') != \
-                                self.used_source_etag:
-                            self.statuses.append(HTTP_NOT_FOUND)
-                            self.reasons.append('')
-                            self.bodies.append('')
-                            self.source_headers.append('')
-                            continue
-
-                    self.statuses.append(possible_source.status)
-                    self.reasons.append(possible_source.reason)
-                    self.bodies.append('')
-                    self.source_headers.append('')
-                    sources.append((possible_source, node))
-                    if not self.newest:  # one good source is enough
-                        break
-            else:
-                self.statuses.append(possible_source.status)
-                self.reasons.append(possible_source.reason)
-                self.bodies.append(possible_source.read())
-                self.source_headers.append(possible_source.getheaders())
-                if possible_source.status == HTTP_INSUFFICIENT_STORAGE:
-                    self.app.error_limit(node, _('ERROR Insufficient Storage'))
-                elif is_server_error(possible_source.status):
-                    self.app.error_occurred(
-                        node, _('ERROR %(status)d %(body)s '
-                                'From %(type)s Server') %
-                        {'status': possible_source.status,
-                         'body': self.bodies[-1][:1024],
-                         'type': self.server_type})
+        nodes = (node for node in self.app.iter_nodes(self.ring,
+                                                      self.partition)
+                 if node not in self.used_nodes)
+        hedge_delay = None
+        if not self.newest:
+            hedge_delay = self.app.get_hedge_delay(self.server_type)
+        if hedge_delay:
+            self._get_hedged_source(nodes, node_timeout, hedge_delay, sources)
+        else:
+            for node in nodes:
+                possible_source = self._make_node_request(node, node_timeout)
+                if possible_source and \
+                        self._add_source(possible_source, node, sources) and \
+                        not self.newest:  # one good source is enough
+                    break
 
         if sources:
             sources.sort(key=lambda s: source_key(s[0]))
@@ -829,7 +1042,7 @@ class GetOrHeadHandler(object):
             self.used_nodes.append(node)
             src_headers = dict(
                 (k.lower(), v) for k, v in
-                possible_source.getheaders())
+                source.getheaders())
             self.used_source_etag = src_headers.get('etag', '').strip('"')
             return source, node
         return None, None
@@ -844,6 +1057,9 @@ class GetOrHeadHandler(object):
                 res.app_iter = self._make_app_iter(req, node, source)
                 # See NOTE: swift_conn at top of file about this.
                 res.swift_conn = source.swift_conn
+                # lets a server-side copy close the source unread
+                res.swift_source = source
+                res.swift_node = node
             res.status = source.status
             update_headers(res, source.getheaders())
             if not res.environ:
@@ -1027,6 +1243,9 @@ class Controller(object):
                 self.app.set_node_timing(node, time.time() - start_node_timing)
                 with Timeout(self.app.node_timeout):
                     resp = conn.getresponse()
+                    self.app.set_response_timing(
+                        node, self.server_type,
+                        time.time() - start_node_timing)
                     if not is_informational(resp.status) and \
                             not is_server_error(resp.status):
                         return resp.status, resp.reason, resp.getheaders(), \
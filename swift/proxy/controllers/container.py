@@ -14,18 +14,21 @@
 # limitations under the License.
 
 from swift import gettext_ as _
-from urllib import unquote
+from urllib import unquote, quote
+from xml.etree.cElementTree import Element, SubElement, tostring
 import time
 
-from swift.common.utils import public, csv_append, Timestamp
+from swift.common.utils import public, csv_append, Timestamp, json, \
+    ShardRange, shards_account
 from swift.common.constraints import check_metadata
 from swift.common import constraints
 from swift.common.http import HTTP_ACCEPTED, is_success
+from swift.common.request_helpers import get_listing_content_type
 from swift.proxy.controllers.base import Controller, delay_denial, \
     cors_validation, clear_info_cache
 from swift.common.storage_policy import POLICIES
 from swift.common.swob import HTTPBadRequest, HTTPForbidden, \
-    HTTPNotFound
+    HTTPNotFound, HTTPServiceUnavailable
 
 
 class ContainerController(Controller):
@@ -81,12 +84,141 @@ class ContainerController(Controller):
                         return HTTPBadRequest(request=req, body=str(err))
         return None
 
+    def _get_listing(self, account, container, headers, params):
+        """
+        Get a page of a container's listing from one of its nodes.
+
+        :returns: a tuple of (status, listing); status is None if no node
+                  responded
+        """
+        part = self.app.container_ring.get_part(account, container)
+        resp = self._make_request(
+            self.app.iter_nodes(self.app.container_ring, part), part,
+            'GET', quote('/%s/%s' % (account, container)), headers,
+            '&'.join('%s=%s' % (quote(key), quote(value))
+                     for key, value in params.items()),
+            self.app.logger.thread_locals)
+        if not resp:
+            return None, []
+        if not is_success(resp[0]):
+            return resp[0], []
+        return resp[0], json.loads(resp[3] or '[]')
+
+    def _get_from_shards(self, req, resp):
+        """
+        Build the listing of a sharded container from the listings of the
+        shard containers whose ranges overlap the requested names, merged
+        with the objects the root hasn't yet moved to its shards.
+
+        :param req: the client's GET request
+        :param resp: the root container's response, listing its shard ranges
+        :returns: the listing response
+        """
+        shard_ranges = [ShardRange.from_dict(data)
+                        for data in json.loads(resp.body)]
+        params = dict(req.params)
+        limit = constraints.CONTAINER_LISTING_LIMIT
+        given_limit = params.get('limit')
+        if given_limit and given_limit.isdigit():
+            limit = min(int(given_limit), limit)
+        marker = params.get('marker', '')
+        end_marker = params.get('end_marker')
+        prefix = params.get('prefix')
+        params['format'] = 'json'
+        account = shards_account(self.account_name)
+        headers = self.generate_request_headers(req)
+        root_listing = []
+        if int(resp.headers.get('X-Backend-Uncleaved-Objects') or 0):
+            root_headers = dict(headers, **{'X-Backend-Record-Type': 'object'})
+            status, root_listing = self._get_listing(
+                self.account_name, self.container_name, root_headers,
+                dict(params, limit=str(limit)))
+            if not is_success(status):
+                return HTTPServiceUnavailable(request=req)
+        listing = []
+        for shard_range in shard_ranges:
+            if len(listing) >= limit:
+                break
+            if marker and shard_range.upper and shard_range.upper <= marker:
+                continue
+            if end_marker and shard_range.lower >= end_marker:
+                break
+            if prefix and shard_range.upper and shard_range.upper < prefix:
+                continue
+            if prefix and shard_range.lower > prefix and \
+                    not shard_range.lower.startswith(prefix):
+                break
+            params.update(marker=marker, limit=str(limit - len(listing)))
+            status, shard_listing = self._get_listing(
+                account, shard_range.name, headers, params)
+            if status == 404:
+                # not created yet; its objects are still in the root
+                continue
+            if not is_success(status):
+                return HTTPServiceUnavailable(request=req)
+            for item in shard_listing:
+                if 'subdir' in item:
+                    name = item['subdir'].encode('utf-8')
+                    if listing and listing[-1].get('subdir') == item['subdir']:
+                        # the same subdir can span several shards
+                        continue
+                else:
+                    name = item['name'].encode('utf-8')
+                listing.append(item)
+                marker = name
+        if root_listing:
+            # the root's copy of an object may be newer than the shard's
+            merged = {}
+            for item in listing + root_listing:
+                key = (item.get('name', item.get('subdir')).encode('utf-8'),
+                       'subdir' in item)
+                if key not in merged or item.get('last_modified') > \
+                        merged[key].get('last_modified'):
+                    merged[key] = item
+            listing = [merged[k] for k in sorted(merged)][:limit]
+        del resp.headers['X-Backend-Record-Type']
+        out_content_type = get_listing_content_type(req)
+        resp.content_type = out_content_type
+        resp.charset = 'utf-8'
+        if out_content_type == 'application/json':
+            resp.body = json.dumps(listing)
+        elif out_content_type.endswith('/xml'):
+            doc = Element('container',
+                          name=self.container_name.decode('utf-8'))
+            for item in listing:
+                if 'subdir' in item:
+                    sub = SubElement(doc, 'subdir', name=item['subdir'])
+                    SubElement(sub, 'name').text = item['subdir']
+                else:
+                    obj_element = SubElement(doc, 'object')
+                    for field in ["name", "hash", "bytes", "content_type",
+                                  "last_modified"]:
+                        SubElement(obj_element, field).text = unicode(
+                            item.pop(field))
+                    for field in sorted(item):
+                        SubElement(obj_element, field).text = unicode(
+                            item[field])
+            resp.body = tostring(doc, encoding='UTF-8').replace(
+                "<?xml version='1.0' encoding='UTF-8'?>",
+                '<?xml version="1.0" encoding="UTF-8"?>', 1)
+        elif listing:
+            resp.body = '\n'.join(
+                item.get('name', item.get('subdir')).encode('utf-8')
+                for item in listing) + '\n'
+        else:
+            resp.status = 204
+            resp.body = ''
+        return resp
+
     def GETorHEAD(self, req):
         """Handler for HTTP GET/HEAD requests."""
         if not self.account_info(self.account_name, req)[1]:
             return HTTPNotFound(request=req)
         part = self.app.container_ring.get_part(
             self.account_name, self.container_name)
+        if req.method == 'GET':
+            # a sharded container lists its shard ranges instead
+            req.headers['X-Backend-Record-Type'] = 'auto'
         resp = self.GETorHEAD_base(
             req, _('Container'), self.app.container_ring, part,
             req.swift_entity_path)
@@ -95,6 +227,9 @@ class ContainerController(Controller):
             aresp = req.environ['swift.authorize'](req)
             if aresp:
                 return aresp
+        if req.method == 'GET' and is_success(resp.status_int) and \
+                resp.headers.get('X-Backend-Record-Type') == 'shard':
+            resp = self._get_from_shards(req, resp)
         if not req.environ.get('swift_owner', False):
             for key in self.app.swift_owner_headers:
                 if key in resp.headers:
@@ -28,17 +28,19 @@ import itertools
 import mimetypes
 import time
 import math
+from collections import OrderedDict
 from swift import gettext_ as _
 from urllib import unquote, quote
 
-from eventlet import GreenPile
+from eventlet import GreenPile, spawn_n
 from eventlet.queue import Queue
 from eventlet.timeout import Timeout
 
 from swift.common.utils import (
     clean_content_type, config_true_value, ContextPool, csv_append,
     GreenAsyncPile, GreenthreadSafeIterator, json, Timestamp,
-    normalize_delete_at_timestamp, public, quorum_size, get_expirer_container)
+    normalize_delete_at_timestamp, public, quorum_size, get_expirer_container,
+    cache_from_env, ShardRange, shards_account)
 from swift.common.bufferedhttp import http_connect
 from swift.common.constraints import check_metadata, check_object_creation, \
     check_copy_from_header, check_destination_header, \
@@ -48,14 +50,14 @@ from swift.common.exceptions import ChunkReadTimeout, \
     ChunkWriteTimeout, ConnectionTimeout, ListingIterNotFound, \
     ListingIterNotAuthorized, ListingIterError
 from swift.common.http import is_success, is_client_error, HTTP_CONTINUE, \
-    HTTP_CREATED, HTTP_MULTIPLE_CHOICES, HTTP_NOT_FOUND, \
+    HTTP_OK, HTTP_CREATED, HTTP_MULTIPLE_CHOICES, HTTP_NOT_FOUND, \
     HTTP_INTERNAL_SERVER_ERROR, HTTP_SERVICE_UNAVAILABLE, \
     HTTP_INSUFFICIENT_STORAGE, HTTP_PRECONDITION_FAILED
 from swift.proxy.controllers.base import Controller, delay_denial, \
-    cors_validation
+    cors_validation, close_swift_conn
 from swift.common.swob import HTTPAccepted, HTTPBadRequest, HTTPNotFound, \
     HTTPPreconditionFailed, HTTPRequestEntityTooLarge, HTTPRequestTimeout, \
-    HTTPServerError, HTTPServiceUnavailable, Request, \
+    HTTPServerError, HTTPServiceUnavailable, Request, Response, \
     HTTPClientDisconnect
 from swift.common.request_helpers import is_sys_or_user_meta, is_sys_meta, \
     remove_items, copy_header_subset
@@ -83,6 +85,105 @@ def check_content_type(req):
     return None
 
 
+class ObjectCache(object):
+    """
+    Process-local cache of small objects, consulted by object GETs and
+    HEADs before the object servers.
+
+    It keeps the most recently used objects of up to max_object_size bytes,
+    up to size bytes of object data in all, each for at most ttl seconds.
+    A write of an object through this proxy server drops the object from
+    the cache, and for ttl seconds keeps responses from before the write
+    from being cached. Writes through other proxy servers may take up to
+    ttl seconds to be seen.
+
+    :param size: bytes of object data to cache
+    :param max_object_size: size in bytes of the largest object to cache
+    :param ttl: seconds to cache an object for
+    :param policy_indexes: indexes of the storage policies whose objects
+                           are cached, or None for every policy
+    :param logger: logger to count hits and misses with
+    """
+
+    def __init__(self, size, max_object_size, ttl, policy_indexes=None,
+                 logger=None):
+        self.size = size
+        self.max_object_size = max_object_size
+        self.ttl = ttl
+        self.policy_indexes = policy_indexes
+        self.logger = logger
+        self.entries = OrderedDict()
+        self.writes = OrderedDict()
+        self.bytes_used = 0
+
+    def increment(self, metric):
+        if self.logger:
+            self.logger.increment('object_cache.%s' % metric)
+
+    def key(self, policy_index, path):
+        """
+        :returns: the key of the object at path in the storage policy with
+                  index policy_index, or None if the policy isn't cached
+        """
+        policy_index = int(policy_index or 0)
+        if self.policy_indexes is not None and \
+                policy_index not in self.policy_indexes:
+            return None
+        return policy_index, path
+
+    def get(self, key):
+        """
+        :returns: a tuple of the cached object's headers and body, or None
+                  if it isn't cached
+        """
+        entry = self.entries.pop(key, None)
+        now = time.time()
+        if entry is not None:
+            expires, headers, body = entry
+            delete_at = headers.get('X-Delete-At')
+            if expires >= now and not (delete_at and int(delete_at) <= now):
+                self.entries[key] = entry
+                self.increment('hits')
+                return dict(headers), body
+            self.bytes_used -= len(body)
+        self.increment('misses')
+        return None
+
+    def set(self, key, headers, body):
+        if len(body) > min(self.max_object_size, self.size):
+            return
+        timestamp = Timestamp(headers.get('X-Backend-Timestamp') or
+                              headers.get('X-Timestamp') or 0)
+        write = self.writes.get(key)
+        if write and write[0] >= time.time() and write[1] > timestamp:
+            # fetched before a write through this proxy server
+            return
+        self.delete(key)
+        while self.entries and self.bytes_used + len(body) > self.size:
+            self.bytes_used -= len(self.entries.popitem(last=False)[1][2])
+        self.entries[key] = (time.time() + self.ttl, dict(headers), body)
+        self.bytes_used += len(body)
+
+    def delete(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes_used -= len(entry[2])
+
+    def invalidate(self, key, timestamp):
+        """
+        Drop an object being written from the cache.
+
+        :param key: the object's key
+        :param timestamp: the X-Timestamp of the write
+        """
+        self.delete(key)
+        now = time.time()
+        while self.writes and self.writes.itervalues().next()[0] < now:
+            self.writes.popitem(last=False)
+        self.writes.pop(key, None)
+        self.writes[key] = (now + self.ttl, Timestamp(timestamp))
+
+
 class ObjectController(Controller):
     """WSGI controller for object requests."""
     server_type = 'Object'
@@ -206,6 +307,17 @@ class ObjectController(Controller):
             aresp = req.environ['swift.authorize'](req)
             if aresp:
                 return aresp
+        object_cache = self.app.object_cache
+        cache_key = None
+        if object_cache and \
+                not config_true_value(req.headers.get('X-Newest', 'f')):
+            cache_key = object_cache.key(policy_index, req.swift_entity_path)
+        if cache_key:
+            cached = object_cache.get(cache_key)
+            if cached:
+                headers, body = cached
+                return Response(request=req, headers=headers, body=body,
+                                conditional_response=True)
         partition = obj_ring.get_part(
             self.account_name, self.container_name, self.object_name)
         resp = self.GETorHEAD_base(
@@ -215,8 +327,42 @@ class ObjectController(Controller):
         if ';' in resp.headers.get('content-type', ''):
             resp.content_type = clean_content_type(
                 resp.headers['content-type'])
+        if cache_key and req.method == 'GET' and \
+                resp.status_int == HTTP_OK and \
+                resp.content_length is not None and \
+                resp.content_length <= object_cache.max_object_size:
+            content_length = resp.content_length
+            resp.app_iter = self._cache_object_iter(
+                cache_key, dict(resp.headers), resp.app_iter)
+            resp.content_length = content_length
         return resp
 
+    def _cache_object_iter(self, cache_key, headers, app_iter):
+        """
+        Pass an object's data through to the client, caching the object if
+        all of it gets read.
+        """
+        chunks = []
+        try:
+            for chunk in app_iter:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            close = getattr(app_iter, 'close', None)
+            if close:
+                close()
+        body = ''.join(chunks)
+        if len(body) == int(headers['Content-Length']):
+            self.app.object_cache.set(cache_key, headers, body)
+
+    def _invalidate_cached_object(self, req, policy_index):
+        if self.app.object_cache:
+            cache_key = self.app.object_cache.key(policy_index,
+                                                  req.swift_entity_path)
+            if cache_key:
+                self.app.object_cache.invalidate(cache_key,
+                                                 req.headers['X-Timestamp'])
+
     @public
     @cors_validation
     @delay_denial
@@ -284,24 +430,85 @@ class ObjectController(Controller):
                 self.account_name, self.container_name, self.object_name)
 
             req.headers['X-Timestamp'] = Timestamp(time.time()).internal
+            self._invalidate_cached_object(req, policy_index)
 
+            container_partition, containers, container_path = \
+                self._get_update_target(req, container_info)
             headers = self._backend_requests(
                 req, len(nodes), container_partition, containers,
-                delete_at_container, delete_at_part, delete_at_nodes)
+                delete_at_container, delete_at_part, delete_at_nodes,
+                container_path=container_path)
 
             resp = self.make_requests(req, obj_ring, partition,
                                       'POST', req.swift_entity_path, headers)
             return resp
 
+    def _get_shard_ranges(self, req):
+        """
+        Get the shard ranges of the sharded container, from memcache if
+        they're there.
+
+        :returns: a list of :class:`~swift.common.utils.ShardRange`, or None
+                  if they couldn't be fetched
+        """
+        memcache = cache_from_env(req.environ, True)
+        cache_key = 'shard-ranges/%s/%s' % (self.account_name,
+                                            self.container_name)
+        data = memcache.get(cache_key) if memcache else None
+        if data is None:
+            part, nodes = self.app.container_ring.get_nodes(
+                self.account_name, self.container_name)
+            headers = self.generate_request_headers(
+                req, additional={'X-Backend-Record-Type': 'shard'})
+            path = quote('/%s/%s' % (self.account_name, self.container_name))
+            resp = self._make_request(
+                self.app.iter_nodes(self.app.container_ring, part), part,
+                'GET', path, headers, 'format=json',
+                self.app.logger.thread_locals)
+            if not resp or not is_success(resp[0]):
+                return None
+            try:
+                data = json.loads(resp[3])
+            except ValueError:
+                return None
+            if memcache:
+                memcache.set(cache_key, data,
+                             time=self.app.recheck_container_existence)
+        return [ShardRange.from_dict(shard_range) for shard_range in data]
+
+    def _get_update_target(self, req, container_info):
+        """
+        Find where container updates for the object should be sent: the
+        container itself or, if it's sharded, the shard container holding the
+        object's name.
+
+        :returns: a tuple of (container partition, container nodes,
+                  container path), where container path is None unless the
+                  updates go to a shard container
+        """
+        if not container_info.get('sharded'):
+            return container_info['partition'], container_info['nodes'], None
+        for shard_range in self._get_shard_ranges(req) or []:
+            if self.object_name in shard_range:
+                account = shards_account(self.account_name)
+                part, nodes = self.app.container_ring.get_nodes(
+                    account, shard_range.name)
+                return part, nodes, quote('%s/%s' % (account,
+                                                     shard_range.name))
+        # the sharder moves updates from the root into its shards anyway
+        return container_info['partition'], container_info['nodes'], None
+
     def _backend_requests(self, req, n_outgoing,
                           container_partition, containers,
                           delete_at_container=None, delete_at_partition=None,
-                          delete_at_nodes=None):
+                          delete_at_nodes=None, container_path=None):
         headers = [self.generate_request_headers(req, additional=req.headers)
                    for _junk in range(n_outgoing)]
 
         for header in headers:
             header['Connection'] = 'close'
+            if container_path:
+                header['X-Backend-Container-Path'] = container_path
 
         for i, container in enumerate(containers):
             i = i % len(headers)
@@ -347,6 +554,11 @@ class ObjectController(Controller):
                           logger_thread_locals):
         """Method for a file PUT connect"""
         self.app.logger.thread_locals = logger_thread_locals
+        expect_timeout = self.app.node_timeout
+        if 'X-Backend-Copy-From-Path' in headers:
+            # there's no 100 Continue for a server-side copy; the object
+            # server only responds once it has copied the object
+            expect_timeout = self.app.server_side_copy_timeout
         for node in nodes:
             try:
                 start_time = time.time()
@@ -355,7 +567,7 @@ class ObjectController(Controller):
                         node['ip'], node['port'], node['device'], part, 'PUT',
                         path, headers)
                 self.app.set_node_timing(node, time.time() - start_time)
-                with Timeout(self.app.node_timeout):
+                with Timeout(expect_timeout):
                     resp = conn.getexpect()
                 if resp.status == HTTP_CONTINUE:
                     conn.resp = None
@@ -377,7 +589,7 @@ class ObjectController(Controller):
                     node, _('Object'),
                     _('Expect: 100-continue on %s') % path)
 
-    def _get_put_responses(self, req, conns, nodes):
+    def _get_put_responses(self, req, conns, nodes, response_timeout=None):
         statuses = []
         reasons = []
         bodies = []
@@ -385,7 +597,7 @@ class ObjectController(Controller):
 
         def get_conn_response(conn):
             try:
-                with Timeout(self.app.node_timeout):
+                with Timeout(response_timeout or self.app.node_timeout):
                     if conn.resp:
                         return (conn, conn.resp)
                     else:
@@ -394,7 +606,7 @@ class ObjectController(Controller):
                 self.app.exception_occurred(
                     conn.node, _('Object'),
                     _('Trying to get final status of PUT to %s') % req.path)
-            return (None, None)
+            return (conn, None)
 
         pile = GreenAsyncPile(len(conns))
         for conn in conns:
@@ -420,11 +632,19 @@ class ObjectController(Controller):
                 if self.have_quorum(statuses, len(nodes)):
                     break
 
-        # give any pending requests *some* chance to finish
-        finished_quickly = pile.waitall(self.app.post_quorum_timeout)
-        for (conn, response) in finished_quickly:
-            if response:
-                _handle_response(conn, response)
+        if self.app.return_at_put_quorum and len(etags) == 1 and \
+                sum(1 for status in statuses if is_success(status)) >= \
+                quorum_size(len(nodes)):
+            # answer the client now; the rest finish in the background
+            self.app.logger.increment('put_quorum_returns')
+            spawn_n(self._finish_put_responses, req, pile,
+                    self.app.logger.thread_locals)
+        else:
+            # give any pending requests *some* chance to finish
+            finished_quickly = pile.waitall(self.app.post_quorum_timeout)
+            for (conn, response) in finished_quickly:
+                if response:
+                    _handle_response(conn, response)
 
         while len(statuses) < len(nodes):
             statuses.append(HTTP_SERVICE_UNAVAILABLE)
@@ -432,6 +652,62 @@ class ObjectController(Controller):
             bodies.append('')
         return statuses, reasons, bodies, etags
 
+    def _finish_put_responses(self, req, pile, logger_thread_locals):
+        """
+        Collect the final statuses of PUTs still outstanding after the client
+        was answered at quorum. Each is bounded by node_timeout; replicas
+        that fail are counted, and the object replicator copies the object
+        to them from the nodes that succeeded.
+        """
+        self.app.logger.thread_locals = logger_thread_locals
+        for (conn, response) in pile:
+            if response:
+                body = response.read()
+                if is_success(response.status):
+                    continue
+                if response.status >= HTTP_INTERNAL_SERVER_ERROR:
+                    self.app.error_occurred(
+                        conn.node,
+                        _('ERROR %(status)d %(body)s From Object Server '
+                          're: %(path)s') %
+                        {'status': response.status,
+                         'body': body[:1024], 'path': req.path})
+            self.app.logger.increment('put_late_failures')
+
+    def _copy_from_headers(self, source_req, source_resp):
+        """
+        Get the headers that have object servers copy the source of a COPY
+        themselves: from their own device if they hold it, or else from the
+        object server that answered the proxy's GET of it or one of the
+        source's other primary nodes.
+
+        :param source_req: the GET request for the source
+        :param source_resp: the response to source_req
+        :returns: a dict of headers, or None if the source can't be copied
+                  that way
+        """
+        source_node = getattr(source_resp, 'swift_node', None)
+        if not source_node or source_resp.status_int != HTTP_OK or \
+                'X-Backend-Timestamp' not in source_resp.headers:
+            return None
+        ver, account, container, obj = source_req.split_path(4, 4, True)
+        policy_index = source_req.headers.get(
+            'X-Backend-Storage-Policy-Index', '0')
+        partition, nodes = self.app.get_object_ring(policy_index).get_nodes(
+            account, container, obj)
+        node_names = []
+        for node in [source_node] + nodes:
+            node_name = '%(ip)s:%(port)s/%(device)s' % node
+            if node_name not in node_names:
+                node_names.append(node_name)
+        return {
+            'X-Backend-Copy-From-Path': quote('/%s/%s/%s/%s' % (
+                partition, account, container, obj)),
+            'X-Backend-Copy-From-Nodes': ','.join(node_names),
+            'X-Backend-Copy-From-Policy-Index': policy_index,
+            'X-Backend-Copy-From-Timestamp':
+            source_resp.headers['X-Backend-Timestamp']}
+
     def _config_obj_expiration(self, req):
         delete_at_container = None
         delete_at_part = None
@@ -535,6 +811,7 @@ class ObjectController(Controller):
             req.headers['X-Timestamp'] = req_timestamp.internal
         else:
             req.headers['X-Timestamp'] = Timestamp(time.time()).internal
+        self._invalidate_cached_object(req, policy_index)
 
         if object_versions and not req.environ.get('swift_versioned_copy'):
             if hresp.status_int != HTTP_NOT_FOUND:
@@ -571,6 +848,7 @@ class ObjectController(Controller):
         data_source = iter(lambda: reader(self.app.client_chunk_size), '')
         source_header = req.headers.get('X-Copy-From')
         source_resp = None
+        copy_from_headers = None
         if source_header:
             if req.environ.get('swift.orig_req_method', req.method) != 'POST':
                 req.environ.setdefault('swift.log_info', []).append(
@@ -599,6 +877,7 @@ class ObjectController(Controller):
             sink_req = Request.blank(req.path_info,
                                      environ=req.environ, headers=req.headers)
             source_resp = self.GET(source_req)
+            unhooked_resp = source_resp
 
             # This gives middlewares a way to change the source; for example,
             # this lets you COPY a SLO manifest and have the new object be the
@@ -614,7 +893,15 @@ class ObjectController(Controller):
             self.object_name = orig_obj_name
             self.container_name = orig_container_name
             self.account_name = orig_account_name
-            data_source = iter(source_resp.app_iter)
+            if self.app.server_side_copy and source_resp is unhooked_resp:
+                copy_from_headers = self._copy_from_headers(source_req,
+                                                            source_resp)
+            if copy_from_headers:
+                # the object servers fetch the data themselves
+                close_swift_conn(source_resp.swift_source)
+                data_source = iter([])
+            else:
+                data_source = iter(source_resp.app_iter)
             sink_req.content_length = source_resp.content_length
             if sink_req.content_length is None:
                 # This indicates a transfer-encoding: chunked source object,
@@ -659,15 +946,22 @@ class ObjectController(Controller):
             self.iter_nodes_local_first(obj_ring, partition))
         pile = GreenPile(len(nodes))
         te = req.headers.get('transfer-encoding', '')
-        chunked = ('chunked' in te)
+        chunked = ('chunked' in te) and not copy_from_headers
 
+        container_partition, containers, container_path = \
+            self._get_update_target(req, container_info)
         outgoing_headers = self._backend_requests(
             req, len(nodes), container_partition, containers,
-            delete_at_container, delete_at_part, delete_at_nodes)
+            delete_at_container, delete_at_part, delete_at_nodes,
+            container_path=container_path)
 
         for nheaders in outgoing_headers:
+            if copy_from_headers:
+                nheaders.update(copy_from_headers)
+                nheaders['Content-Length'] = '0'
+                nheaders.pop('Transfer-Encoding', None)
             # RFC2616:8.2.3 disallows 100-continue without a body
-            if (req.content_length > 0) or chunked:
+            elif (req.content_length > 0) or chunked:
                 nheaders['Expect'] = '100-continue'
             pile.spawn(self._connect_put_node, node_iter, partition,
                        req.swift_entity_path, nheaders,
@@ -698,25 +992,43 @@ class ObjectController(Controller):
                     conn.failed = False
                     conn.queue = Queue(self.app.put_queue_depth)
                     pool.spawn(self._send_file, conn, req.path)
+                # client reads are gathered into buffers of put_buffer_size
+                # bytes, each built once and queued to every connection
+                buffered = []
+                buffered_bytes = 0
                 while True:
                     with ChunkReadTimeout(self.app.client_timeout):
                         try:
                             chunk = next(data_source)
                         except StopIteration:
-                            if chunked:
-                                for conn in conns:
-                                    conn.queue.put('0\r\n\r\n')
-                            break
-                    bytes_transferred += len(chunk)
-                    if bytes_transferred > constraints.MAX_FILE_SIZE:
-                        return HTTPRequestEntityTooLarge(request=req)
+                            chunk = None
+                    if chunk is not None:
+                        bytes_transferred += len(chunk)
+                        if bytes_transferred > constraints.MAX_FILE_SIZE:
+                            return HTTPRequestEntityTooLarge(request=req)
+                        buffered.append(chunk)
+                        buffered_bytes += len(chunk)
+                        if buffered_bytes < self.app.put_buffer_size:
+                            continue
+                    if chunked and buffered:
+                        buffered.insert(0, '%x\r\n' % buffered_bytes)
+                        buffered.append('\r\n')
+                    data = [''.join(buffered)]
+                    if chunked and chunk is None:
+                        # sent on its own, so that the connection can tell
+                        # the request is complete and go back to the pool
+                        data.append('0\r\n\r\n')
+                    buffered = []
+                    buffered_bytes = 0
                     for conn in list(conns):
                         if not conn.failed:
-                            conn.queue.put(
-                                '%x\r\n%s\r\n' % (len(chunk), chunk)
-                                if chunked else chunk)
+                            for item in data:
+                                if item:
+                                    conn.queue.put(item)
                         else:
                             conns.remove(conn)
+                    if chunk is None:
+                        break
                     if len(conns) < min_conns:
                         self.app.logger.error(_(
                             'Object PUT exceptions during'
@@ -736,15 +1048,18 @@ class ObjectController(Controller):
             self.app.logger.exception(
                 _('ERROR Exception causing client disconnect'))
             return HTTPClientDisconnect(request=req)
-        if req.content_length and bytes_transferred < req.content_length:
+        if req.content_length and not copy_from_headers and \
+                bytes_transferred < req.content_length:
             req.client_disconnect = True
             self.app.logger.warn(
                 _('Client disconnected without sending enough data'))
             self.app.logger.increment('client_disconnects')
             return HTTPClientDisconnect(request=req)
 
-        statuses, reasons, bodies, etags = self._get_put_responses(req, conns,
-                                                                   nodes)
+        statuses, reasons, bodies, etags = self._get_put_responses(
+            req, conns, nodes, response_timeout=(
+                self.app.server_side_copy_timeout if copy_from_headers
+                else None))
 
         if len(etags) > 1:
             self.app.logger.error(
@@ -874,9 +1189,13 @@ class ObjectController(Controller):
             req.headers['X-Timestamp'] = req_timestamp.internal
         else:
             req.headers['X-Timestamp'] = Timestamp(time.time()).internal
+        self._invalidate_cached_object(req, policy_index)
 
+        container_partition, containers, container_path = \
+            self._get_update_target(req, container_info)
         headers = self._backend_requests(
-            req, len(nodes), container_partition, containers)
+            req, len(nodes), container_partition, containers,
+            container_path=container_path)
         # When deleting objects treat a 404 status as 204.
         status_overrides = {404: 204}
         resp = self.make_requests(req, obj_ring,
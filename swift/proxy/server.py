@@ -13,18 +13,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import math
 import mimetypes
 import os
 import socket
+from collections import defaultdict, deque
 from swift import gettext_ as _
 from random import shuffle
 from time import time
 import itertools
 
 from eventlet import Timeout
+from eventlet.event import Event
 
 from swift import __canonical_version__ as swift_version
-from swift.common import constraints
+from swift.common import bufferedhttp, constraints
+from swift.common.node_stats import NodeStats, NODE_STATS_FILE, \
+    node_stats_key
 from swift.common.storage_policy import POLICIES
 from swift.common.ring import Ring
 from swift.common.utils import cache_from_env, get_logger, \
@@ -32,11 +37,20 @@ from swift.common.utils import cache_from_env, get_logger, \
     affinity_key_function, affinity_locality_predicate, list_from_csv, \
     register_swift_info
 from swift.common.constraints import check_utf8
+from swift.common.http import is_success
 from swift.proxy.controllers import AccountController, ObjectController, \
     ContainerController, InfoController
+from swift.proxy.controllers import base
+from swift.proxy.controllers.obj import ObjectCache
 from swift.common.swob import HTTPBadRequest, HTTPForbidden, \
     HTTPMethodNotAllowed, HTTPNotFound, HTTPPreconditionFailed, \
-    HTTPServerError, HTTPException, Request
+    HTTPServerError, HTTPServiceUnavailable, HTTPException, Request
+
+
+#: Number of recent requests and response timings that hedging is based on
+HEDGE_TIMING_SAMPLES = 1000
+#: Responses between updates of a percentile hedge delay
+HEDGE_DELAY_UPDATE = 100
 
 
 # List of entry points for mandatory middlewares.
@@ -64,6 +78,108 @@ required_filters = [
         'catch_errors', 'gatekeeper', 'proxy_logging']}]
 
 
+class AdmissionControl(object):
+    """
+    Limits how many object requests a proxy server worker works on at once,
+    per storage policy and per device.
+
+    A request counts against its object's storage policy and each of the
+    object's primary devices from when it is admitted until its response is
+    ready to be sent. A request that would take any of them over its limit
+    waits up to queue_timeout seconds for others to finish. If queue_size
+    requests are already waiting, or the wait runs out, it is shed instead.
+
+    :param max_policy_requests: requests per storage policy; 0 for no limit
+    :param max_device_requests: requests per device; 0 for no limit
+    :param queue_size: requests that may wait at once
+    :param queue_timeout: seconds a request may wait
+    :param logger: logger to send metrics to
+    """
+
+    def __init__(self, max_policy_requests, max_device_requests, queue_size,
+                 queue_timeout, logger):
+        self.limits = {'policy': max_policy_requests,
+                       'device': max_device_requests}
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        # seconds shed requests are told to wait before retrying
+        self.retry_after = max(1, int(math.ceil(queue_timeout)))
+        self.logger = logger
+        self.in_flight = defaultdict(int)
+        self.queued = 0
+        self._waiters = []
+
+    def _keys(self, policy_index, devices):
+        keys = [('policy', policy_index)]
+        if self.limits['device']:
+            keys.extend(('device', device) for device in devices)
+        return keys
+
+    def _has_room(self, keys):
+        for key in keys:
+            limit = self.limits[key[0]]
+            if limit and self.in_flight[key] >= limit:
+                return False
+        return True
+
+    def _admit(self, policy_index, keys):
+        for key in keys:
+            self.in_flight[key] += 1
+        self.logger.timing('admission.%s.in_flight' % policy_index,
+                           self.in_flight[keys[0]])
+
+    def acquire(self, policy_index, devices):
+        """
+        Admit a request, waiting for room if need be.
+
+        :param policy_index: index of the storage policy of the object
+        :param devices: names of the object's primary devices
+        :returns: True if the request was admitted, False if it was shed;
+                  an admitted request must be passed to :meth:`release`
+        """
+        keys = self._keys(policy_index, devices)
+        if self._has_room(keys):
+            self._admit(policy_index, keys)
+            return True
+        if self.queued < self.queue_size:
+            self.queued += 1
+            self.logger.timing('admission.%s.queued' % policy_index,
+                               self.queued)
+            start = time()
+            try:
+                while True:
+                    remaining = start + self.queue_timeout - time()
+                    if remaining <= 0:
+                        break
+                    event = Event()
+                    self._waiters.append(event)
+                    with Timeout(remaining, False):
+                        event.wait()
+                    if self._has_room(keys):
+                        self.logger.timing_since(
+                            'admission.%s.queue.timing' % policy_index,
+                            start)
+                        self._admit(policy_index, keys)
+                        return True
+            finally:
+                self.queued -= 1
+        self.logger.increment('admission.%s.shed' % policy_index)
+        return False
+
+    def release(self, policy_index, devices):
+        """
+        Note that an admitted request is done, and let waiting ones retry.
+        """
+        for key in self._keys(policy_index, devices):
+            self.in_flight[key] -= 1
+            if self.in_flight[key] <= 0:
+                del self.in_flight[key]
+        waiters, self._waiters = self._waiters, []
+        for event in waiters:
+            if not event.ready():
+                event.send()
+
+
 class Application(object):
     """WSGI application for the proxy server."""
 
@@ -86,10 +202,19 @@ class Application(object):
         self.conn_timeout = float(conf.get('conn_timeout', 0.5))
         self.client_timeout = int(conf.get('client_timeout', 60))
         self.put_queue_depth = int(conf.get('put_queue_depth', 10))
+        self.put_buffer_size = int(conf.get('put_buffer_size', 262144))
         self.object_chunk_size = int(conf.get('object_chunk_size', 65536))
         self.client_chunk_size = int(conf.get('client_chunk_size', 65536))
+        self.read_ahead_chunks = int(conf.get('read_ahead_chunks', 0))
         self.trans_id_suffix = conf.get('trans_id_suffix', '')
         self.post_quorum_timeout = float(conf.get('post_quorum_timeout', 0.5))
+        self.return_at_put_quorum = config_true_value(
+            conf.get('return_at_put_quorum', 'false'))
+        bufferedhttp.CONNECTION_POOL_SIZE = \
+            int(conf.get('backend_pool_size', 0))
+        bufferedhttp.CONNECTION_POOL_IDLE_TIMEOUT = \
+            float(conf.get('backend_pool_idle_timeout', 10))
+        bufferedhttp.CONNECTION_POOL_LOGGER = self.logger
         self.error_suppression_interval = \
             int(conf.get('error_suppression_interval', 60))
         self.error_suppression_limit = \
@@ -98,10 +223,17 @@ class Application(object):
             int(conf.get('recheck_container_existence', 60))
         self.recheck_account_existence = \
             int(conf.get('recheck_account_existence', 60))
+        base.INFO_CACHE_SIZE = int(conf.get('info_cache_size', 0))
+        base.INFO_CACHE_TTL = float(conf.get('info_cache_ttl', 1))
+        base.INFO_CACHE_LOGGER = self.logger
         self.allow_account_management = \
             config_true_value(conf.get('allow_account_management', 'no'))
         self.object_post_as_copy = \
             config_true_value(conf.get('object_post_as_copy', 'true'))
+        self.server_side_copy = \
+            config_true_value(conf.get('server_side_copy', 'false'))
+        self.server_side_copy_timeout = \
+            float(conf.get('server_side_copy_timeout', 600))
         self.container_ring = container_ring or Ring(swift_dir,
                                                      ring_name='container')
         self.account_ring = account_ring or Ring(swift_dir,
@@ -109,6 +241,34 @@ class Application(object):
         # ensure rings are loaded for all configured storage policies
         for policy in POLICIES:
             policy.load_ring(swift_dir)
+        self.admission_control = None
+        max_policy_requests = int(conf.get('max_policy_requests', 0))
+        max_device_requests = int(conf.get('max_device_requests', 0))
+        if max_policy_requests > 0 or max_device_requests > 0:
+            self.admission_control = AdmissionControl(
+                max_policy_requests, max_device_requests,
+                int(conf.get('admission_queue_size', 100)),
+                float(conf.get('admission_queue_timeout', 1)), self.logger)
+        self.object_cache = None
+        object_cache_size = int(conf.get('object_cache_size', 0))
+        if object_cache_size > 0:
+            policy_indexes = None
+            policy_names = list_from_csv(conf.get('object_cache_policies'))
+            if policy_names:
+                policy_indexes = set()
+                for name in policy_names:
+                    policy = POLICIES.get_by_name(name)
+                    if not policy:
+                        raise ValueError(
+                            'Invalid object_cache_policies value: %r '
+                            '(no policy named %r)' % (
+                                conf['object_cache_policies'], name))
+                    policy_indexes.add(policy.idx)
+            self.object_cache = ObjectCache(
+                object_cache_size,
+                int(conf.get('object_cache_max_object_size', 65536)),
+                float(conf.get('object_cache_ttl', 1)),
+                policy_indexes=policy_indexes, logger=self.logger)
         self.memcache = memcache
         mimetypes.init(mimetypes.knownfiles +
                        [os.path.join(swift_dir, 'mime.types')])
@@ -139,6 +299,31 @@ class Application(object):
         self.node_timings = {}
         self.timing_expiry = int(conf.get('timing_expiry', 300))
         self.sorting_method = conf.get('sorting_method', 'shuffle').lower()
+        self.node_stats = None
+        if self.sorting_method == 'latency':
+            stats_path = os.path.join(
+                conf.get('recon_cache_path', '/var/cache/swift'),
+                NODE_STATS_FILE)
+            try:
+                self.node_stats = NodeStats(
+                    stats_path,
+                    error_half_life=self.error_suppression_interval)
+            except (IOError, OSError) as err:
+                self.logger.warning(
+                    _('Unable to share node stats through %(path)s, keeping '
+                      'them per worker: %(err)s'),
+                    {'path': stats_path, 'err': err})
+                self.node_stats = NodeStats(
+                    error_half_life=self.error_suppression_interval)
+        self.hedge_delay = float(conf.get('hedge_delay', 0))
+        self.hedge_delay_percentile = float(
+            conf.get('hedge_delay_percentile', 0))
+        self.hedge_ratio = float(conf.get('hedge_ratio', 0.05))
+        self.response_timings = defaultdict(
+            lambda: deque(maxlen=HEDGE_TIMING_SAMPLES))
+        self._hedge_delays = {}
+        self._timing_counts = defaultdict(int)
+        self._hedge_counts = [0, 0]
         self.max_large_object_get_time = float(
             conf.get('max_large_object_get_time', '86400'))
         value = conf.get('request_node_count', '2 * replicas').lower().split()
@@ -219,8 +404,10 @@ class Application(object):
         """
         Check the configuration for possible errors
         """
-        if self._read_affinity and self.sorting_method != 'affinity':
-            self.logger.warn("sorting_method is set to '%s', not 'affinity'; "
+        if self._read_affinity and \
+                self.sorting_method not in ('affinity', 'latency'):
+            self.logger.warn("sorting_method is set to '%s', not 'affinity' "
+                             "or 'latency'; "
                              "read_affinity setting will have no effect." %
                              self.sorting_method)
 
@@ -372,6 +559,15 @@ class Application(object):
             # gets mutated during handling.  This way logging can display the
             # method the client actually sent.
             req.environ['swift.orig_req_method'] = req.method
+            admission = self._get_admission(req, controller)
+            if admission:
+                if not self.admission_control.acquire(*admission):
+                    return HTTPServiceUnavailable(request=req, headers={
+                        'Retry-After': self.admission_control.retry_after})
+                try:
+                    return handler(req)
+                finally:
+                    self.admission_control.release(*admission)
             return handler(req)
         except HTTPException as error_response:
             return error_response
@@ -379,6 +575,27 @@ class Application(object):
             self.logger.exception(_('ERROR Unhandled exception in request'))
             return HTTPServerError(request=req)
 
+    def _get_admission(self, req, controller):
+        """
+        :returns: a tuple of the storage policy index and primary device
+                  names of the object a request is for, or None if the
+                  request isn't subject to admission control
+        """
+        if not self.admission_control or \
+                not isinstance(controller, ObjectController):
+            return None
+        container_info = base.get_container_info(req.environ, self)
+        if not is_success(container_info.get('status')):
+            return None
+        policy_index = req.headers.get('X-Backend-Storage-Policy-Index',
+                                       container_info['storage_policy'])
+        obj_ring = self.get_object_ring(policy_index)
+        partition, nodes = obj_ring.get_nodes(
+            controller.account_name, controller.container_name,
+            controller.object_name)
+        return (int(policy_index or 0),
+                [node_stats_key(node) for node in nodes])
+
     def sort_nodes(self, nodes):
         '''
         Sorts nodes in-place (and returns the sorted list) according to
@@ -399,8 +616,23 @@ class Application(object):
             nodes.sort(key=key_func)
         elif self.sorting_method == 'affinity':
             nodes.sort(key=self.read_affinity_sort_key)
+        elif self.sorting_method == 'latency':
+            nodes.sort(key=self._latency_sort_key)
         return nodes
 
+    def _latency_sort_key(self, node):
+        """
+        Nodes of devices with recent errors go last, and otherwise those
+        whose average response time is more than twice as fast go first; if
+        read_affinity is set, it takes precedence over both.
+        """
+        latency, errors = self.node_stats.get(node_stats_key(node))
+        key = (int(errors + 0.5),
+               int(math.log(latency * 1000, 2)) if latency > 0.001 else 0)
+        if self._read_affinity:
+            key = (self.read_affinity_sort_key(node),) + key
+        return key
+
     def set_node_timing(self, node, timing):
         if self.sorting_method != 'timing':
             return
@@ -408,6 +640,57 @@ class Application(object):
         timing = round(timing, 3)  # sort timings to the millisecond
         self.node_timings[node['ip']] = (timing, now + self.timing_expiry)
 
+    def get_hedge_delay(self, server_type):
+        """
+        Get how long a GET or HEAD should wait on a backend's response before
+        also asking the next node, and count the request towards the share
+        of requests allowed to hedge.
+
+        :param server_type: the type of backend server asked
+        :returns: seconds to wait, or None if the request shouldn't hedge
+        """
+        if self.hedge_delay <= 0 and self.hedge_delay_percentile <= 0:
+            return None
+        counts = self._hedge_counts
+        counts[0] += 1
+        if counts[0] > HEDGE_TIMING_SAMPLES:
+            # only recent requests count towards hedge_ratio
+            counts[0] /= 2.0
+            counts[1] /= 2.0
+        delay = self._hedge_delays.get(server_type, self.hedge_delay)
+        return delay if delay > 0 else None
+
+    def start_hedge(self):
+        """
+        Check and count one more hedged request against hedge_ratio.
+
+        :returns: True if the hedged request may be sent
+        """
+        requests, hedges = self._hedge_counts
+        if hedges + 1 > requests * self.hedge_ratio:
+            return False
+        self._hedge_counts[1] += 1
+        return True
+
+    def set_response_timing(self, node, server_type, timing):
+        """
+        Record how long a backend took to start responding, for latency
+        sorting and for hedge delays that follow the observed percentile.
+        """
+        if self.node_stats:
+            self.node_stats.record_latency(node_stats_key(node), timing)
+        if self.hedge_delay_percentile <= 0:
+            return
+        timings = self.response_timings[server_type]
+        timings.append(timing)
+        self._timing_counts[server_type] += 1
+        # the delay follows along every so many responses
+        if self._timing_counts[server_type] % HEDGE_DELAY_UPDATE == 0:
+            ordered = sorted(timings)
+            index = int(len(ordered) * self.hedge_delay_percentile / 100)
+            self._hedge_delays[server_type] = \
+                ordered[min(index, len(ordered) - 1)]
+
     def _error_limit_node_key(self, node):
         return "{ip}:{port}/{device}".format(**node)
 
@@ -447,6 +730,8 @@ class Application(object):
         node_key = self._error_limit_node_key(node)
         error_stats = self._error_limiting.setdefault(node_key, {})
         error_stats['errors'] = self.error_suppression_limit + 1
+        if self.node_stats:
+            self.node_stats.record_error(node_stats_key(node))
         error_stats['last_error'] = time()
         self.logger.error(_('%(msg)s %(ip)s:%(port)s/%(device)s'),
                           {'msg': msg, 'ip': node['ip'],
@@ -463,6 +748,8 @@ class Application(object):
         error_stats = self._error_limiting.setdefault(node_key, {})
         error_stats['errors'] = error_stats.get('errors', 0) + 1
         error_stats['last_error'] = time()
+        if self.node_stats:
+            self.node_stats.record_error(node_stats_key(node))
         self.logger.error(_('%(msg)s %(ip)s:%(port)s/%(device)s'),
                           {'msg': msg, 'ip': node['ip'],
                           'port': node['port'], 'device': node['device']})
@@ -531,6 +818,8 @@ class Application(object):
         :param typ: server type
         :param additional_info: additional information to log
         """
+        if self.node_stats:
+            self.node_stats.record_error(node_stats_key(node))
         self.logger.exception(
             _('ERROR with %(type)s server %(ip)s:%(port)s/%(device)s re: '
               '%(info)s'),
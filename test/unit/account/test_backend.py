@@ -30,6 +30,8 @@ import itertools
 from contextlib import contextmanager
 import random
 
+import mock
+
 from swift.account.backend import AccountBroker
 from swift.common.utils import Timestamp
 from test.unit import patch_policies, with_tempdir
@@ -483,6 +485,26 @@ class TestAccountBroker(unittest.TestCase):
         self.assertEqual([row[0] for row in listing],
                          ['3-0049-', '3-0049-0049'])
 
+    def test_stream_containers(self):
+        broker = AccountBroker(':memory:', account='a')
+        broker.initialize(Timestamp('1').internal)
+        for name in ('a', 'b-1', 'b-2', 'b-2-x', 'b0', 'c-1', 'c-2', 'd'):
+            broker.put_container(name, Timestamp(time()).internal, 0, 0, 0,
+                                 POLICIES.default.idx)
+        for args in ((100, '', None, None, None),
+                     (5, '', None, None, None),
+                     (100, 'a', 'd', None, None),
+                     (100, '', None, '', '-'),
+                     (3, '', None, '', '-'),
+                     (100, '', None, 'b-', '-')):
+            expected = broker.list_containers_iter(*args)
+            for batch_size in (1, 2, 1000):
+                with mock.patch('swift.common.db.LISTING_BATCH_SIZE',
+                                batch_size):
+                    listing = broker.stream_containers(*args)
+                    self.assertFalse(isinstance(listing, list))
+                    self.assertEqual(list(listing), expected)
+
     def test_double_check_trailing_delimiter(self):
         # Test AccountBroker.list_containers_iter for an
         # account that has an odd container with a trailing delimiter
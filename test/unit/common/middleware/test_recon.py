@@ -26,6 +26,7 @@ import mock
 from swift import __version__ as swiftver
 from swift.common.swob import Request
 from swift.common.middleware import recon
+from swift.common.node_stats import NodeStats
 
 
 def fake_check_mount(a, b):
@@ -553,17 +554,22 @@ class TestReconSuccess(TestCase):
             "replication_last": 1357969645.25})
 
     def test_get_replication_object(self):
-        from_cache_response = {"object_replication_time": 200.0,
-                               "object_replication_last": 1357962809.15}
+        from_cache_response = {
+            "object_replication_time": 200.0,
+            "object_replication_last": 1357962809.15,
+            "object_replication_oldest_partition_age": 3600.0,
+            "object_replication_partition_ages": {"sda": 3600.0,
+                                                  "sdb": 1800.0}}
         self.fakecache.fakeout_calls = []
         self.fakecache.fakeout = from_cache_response
         rv = self.app.get_replication_info('object')
         self.assertEquals(self.fakecache.fakeout_calls,
                           [((['object_replication_time',
-                              'object_replication_last'],
+                              'object_replication_last',
+                              'object_replication_oldest_partition_age',
+                              'object_replication_partition_ages'],
                               '/var/cache/swift/object.recon'), {})])
-        self.assertEquals(rv, {'object_replication_time': 200.0,
-                               'object_replication_last': 1357962809.15})
+        self.assertEquals(rv, from_cache_response)
 
     def test_get_updater_info_container(self):
         from_cache_response = {"container_updater_sweep": 18.476239919662476}
@@ -823,6 +829,17 @@ class TestReconSuccess(TestCase):
             (('/proc/net/sockstat', 'r'), {}),
             (('/proc/net/sockstat6', 'r'), {})])
 
+    def test_get_node_stats(self):
+        self.app.node_stats_path = os.path.join(self.tempdir, 'node_stats')
+        self.assertEqual(self.app.get_node_stats(), {})
+        stats = NodeStats(self.app.node_stats_path)
+        stats.record_latency('1.2.3.4:6000/sda', 0.5)
+        stats.record_error('1.2.3.4:6000/sdb')
+        rv = self.app.get_node_stats()
+        self.assertEqual(sorted(rv), ['1.2.3.4:6000/sda', '1.2.3.4:6000/sdb'])
+        self.assertEqual(rv['1.2.3.4:6000/sda']['latency'], 0.5)
+        self.assertAlmostEqual(rv['1.2.3.4:6000/sdb']['errors'], 1, 2)
+
 
 class TestReconMiddleware(unittest.TestCase):
 
@@ -15,9 +15,11 @@
 
 import unittest
 
-from eventlet import spawn, Timeout, listen
+import mock
+from eventlet import spawn, sleep, Timeout, listen
 
 from swift.common import bufferedhttp
+from test.unit import FakeLogger
 
 
 class TestBufferedHTTP(unittest.TestCase):
@@ -102,6 +104,87 @@ class TestBufferedHTTP(unittest.TestCase):
         finally:
             bufferedhttp.HTTPSConnection = origHTTPSConnection
 
+    def test_connection_pool(self):
+        bindsock = listen(('127.0.0.1', 0))
+        port = bindsock.getsockname()[1]
+        logger = FakeLogger()
+        requests = []
+
+        def read_request(fp):
+            line = fp.readline()
+            headers = {}
+            while line and line != '\r\n':
+                headers[line.split(':')[0].lower()] = line
+                line = fp.readline()
+            return headers
+
+        def accept():
+            try:
+                with Timeout(3):
+                    # two requests on the first connection, then it's closed
+                    sock, addr = bindsock.accept()
+                    fp = sock.makefile()
+                    for body in ('ONE', 'TWO'):
+                        requests.append(read_request(fp))
+                        fp.write('HTTP/1.1 200 OK\r\nContent-Length: 3\r\n'
+                                 '\r\n' + body)
+                        fp.flush()
+                    self.assertEqual(fp.read(3), 'abc')
+                    sock.close()
+                    fp.close()
+                    # the third request is sent again on a new connection,
+                    # and its partly read response leaves it closed
+                    sock, addr = bindsock.accept()
+                    fp = sock.makefile()
+                    requests.append(read_request(fp))
+                    fp.write('HTTP/1.1 200 OK\r\nContent-Length: 5\r\n'
+                             '\r\nTHREE')
+                    fp.flush()
+                    self.assertEqual(fp.read(), '')
+            except BaseException as err:
+                return err
+            return None
+
+        def request(method, headers):
+            return bufferedhttp.http_connect(
+                '127.0.0.1', port, 'dev', 1, method, '/path',
+                headers=dict(headers, Connection='close'))
+
+        event = spawn(accept)
+        with mock.patch.multiple(bufferedhttp, CONNECTION_POOL_SIZE=2,
+                                 CONNECTION_POOL_LOGGER=logger), \
+                mock.patch.object(bufferedhttp, '_connection_pool',
+                                  bufferedhttp.ConnectionPool()) as pool:
+            try:
+                with Timeout(3):
+                    resp = request('GET', {}).getresponse()
+                    self.assertEqual(resp.read(), 'ONE')
+                    self.assertEqual(len(pool.idle[('127.0.0.1', port)]), 1)
+                    conn = request('PUT', {'Content-Length': 3})
+                    # the response may come back before the request body is
+                    # sent, and then the connection can't be reused
+                    conn.send('abc')
+                    resp = conn.getresponse()
+                    self.assertEqual(resp.read(), 'TWO')
+                    resp.nuke_from_orbit()
+                    self.assertEqual(len(pool.idle[('127.0.0.1', port)]), 1)
+                    sleep(0.1)
+                    # the server closed the pooled connection
+                    resp = request('GET', {}).getresponse()
+                    self.assertEqual(resp.read(2), 'TH')
+                    resp.nuke_from_orbit()
+                    self.assertEqual(pool.idle[('127.0.0.1', port)], [])
+            finally:
+                err = event.wait()
+                if err:
+                    raise Exception(err)
+        self.assertEqual(len(requests), 3)
+        for headers in requests:
+            self.assertFalse('connection' in headers)
+        self.assertEqual(logger.get_increment_counts(),
+                         {'backend_pool.reuses': 1,
+                          'backend_pool.evictions': 1})
+
 
 if __name__ == '__main__':
     unittest.main()
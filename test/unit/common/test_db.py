@@ -21,6 +21,8 @@ from tempfile import mkdtemp
 from shutil import rmtree, copy
 from uuid import uuid4
 import cPickle as pickle
+from StringIO import StringIO
+import struct
 
 import simplejson
 import sqlite3
@@ -36,12 +38,13 @@ from swift.common.constraints import \
     MAX_META_VALUE_LENGTH, MAX_META_COUNT, MAX_META_OVERALL_SIZE
 from swift.common.db import chexor, dict_factory, get_db_connection, \
     DatabaseBroker, DatabaseConnectionError, DatabaseAlreadyExists, \
-    GreenDBConnection, PICKLE_PROTOCOL
+    GreenDBConnection, DBConnectionPool, DBChangeLog, pop_db_changes, \
+    PICKLE_PROTOCOL
 from swift.common.utils import normalize_timestamp, mkdirs, json, Timestamp
 from swift.common.exceptions import LockTimeout
 from swift.common.swob import HTTPException
 
-from test.unit import with_tempdir
+from test.unit import with_tempdir, FakeLogger
 
 
 class TestDatabaseConnectionError(unittest.TestCase):
@@ -179,6 +182,143 @@ class TestGetDBConnection(unittest.TestCase):
                              list((mock_db_cmd.call_args,) *
                                   mock_db_cmd.call_count))
 
+    @with_tempdir
+    def test_wal_mode(self, tempdir):
+        path = os.path.join(tempdir, 'test.db')
+        with patch('swift.common.db.DB_WAL_MODE', True):
+            conn = get_db_connection(path, okay_to_create=True)
+        self.assertEqual(
+            conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        conn.execute('CREATE TABLE test (one TEXT)')
+        conn.commit()
+        self.assertTrue(os.path.exists(path + '-wal'))
+        # while another connection has it open, it stays in WAL mode
+        conn2 = get_db_connection(path)
+        self.assertEqual(
+            conn2.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        conn2.close()
+        conn.close()
+        conn = get_db_connection(path)
+        self.assertEqual(
+            conn.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+        self.assertFalse(os.path.exists(path + '-wal'))
+
+
+class TestDBConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+        self.pool = DBConnectionPool()
+
+    def tearDown(self):
+        self.pool.clear()
+        rmtree(self.testdir, ignore_errors=1)
+
+    def _connect(self, name):
+        return get_db_connection(os.path.join(self.testdir, name),
+                                 okay_to_create=True)
+
+    def test_disabled(self):
+        conn = self._connect('a.db')
+        with patch('swift.common.db.DB_CONNECTION_POOL_SIZE', 0):
+            self.assertFalse(self.pool.put(conn.db_file, conn))
+        self.assertEqual(self.pool.get(conn.db_file), None)
+        # in-memory DBs are never pooled
+        with patch('swift.common.db.DB_CONNECTION_POOL_SIZE', 2):
+            self.assertFalse(self.pool.put(':memory:',
+                                           get_db_connection(':memory:')))
+
+    def test_reuse(self):
+        conns = [self._connect(name) for name in ('a.db', 'b.db', 'c.db')]
+        with patch('swift.common.db.DB_CONNECTION_POOL_SIZE', 2):
+            for conn in conns:
+                self.assertTrue(self.pool.put(conn.db_file, conn))
+            # one idle connection per DB
+            self.assertFalse(self.pool.put(conns[2].db_file,
+                                           self._connect('c.db')))
+        self.assertEqual(self.pool.get(conns[0].db_file), None)
+        # the least recently used was closed to make room
+        self.assertRaises(sqlite3.ProgrammingError, conns[0].execute,
+                          'SELECT 1')
+        self.assertTrue(self.pool.get(conns[1].db_file) is conns[1])
+        self.assertEqual(self.pool.get(conns[1].db_file), None)
+        self.assertTrue(self.pool.get(conns[2].db_file) is conns[2])
+
+    def test_replaced_db(self):
+        conn = self._connect('a.db')
+        replacement = self._connect('b.db')
+        replacement.close()
+        with patch('swift.common.db.DB_CONNECTION_POOL_SIZE', 2):
+            self.pool.put(conn.db_file, conn)
+        os.rename(replacement.db_file, conn.db_file)
+        self.assertEqual(self.pool.get(conn.db_file), None)
+        self.assertRaises(sqlite3.ProgrammingError, conn.execute, 'SELECT 1')
+
+        conn = self._connect('a.db')
+        with patch('swift.common.db.DB_CONNECTION_POOL_SIZE', 2):
+            self.pool.put(conn.db_file, conn)
+        os.unlink(conn.db_file)
+        self.assertEqual(self.pool.get(conn.db_file), None)
+
+
+class TestDBChangeLog(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+        self.datadir = os.path.join(self.testdir, 'sda', 'containers')
+        self.logger = FakeLogger()
+        self.change_log = DBChangeLog(('replicator', 'updater'), self.logger)
+
+    def tearDown(self):
+        rmtree(self.testdir, ignore_errors=1)
+
+    def _db_file(self, part, hsh):
+        hash_dir = os.path.join(self.datadir, part, hsh[-3:], hsh)
+        mkdirs(hash_dir)
+        db_file = os.path.join(hash_dir, hsh + '.db')
+        with open(db_file, 'w'):
+            pass
+        return db_file
+
+    def test_record_and_pop(self):
+        db1 = self._db_file('1', 'abcdef')
+        db2 = self._db_file('2', '123456')
+        # nothing is recorded until a reader starts its log
+        self.change_log.record(db1)
+        self.assertEqual(os.listdir(os.path.dirname(self.datadir)),
+                         ['containers'])
+        self.assertEqual(pop_db_changes(self.datadir, 'replicator'), None)
+        self.change_log.record(db1)
+        self.change_log.record(db2)
+        self.change_log.record(db1)
+        self.assertEqual(pop_db_changes(self.datadir, 'replicator'),
+                         [('1', db1), ('2', db2)])
+        self.assertEqual(pop_db_changes(self.datadir, 'replicator'), [])
+        # a DB recorded in a previous log is recorded in the new one
+        self.change_log.record(db1)
+        self.assertEqual(pop_db_changes(self.datadir, 'replicator'),
+                         [('1', db1)])
+        # DBs that have gone aren't returned
+        self.change_log.record(db2)
+        os.unlink(db2)
+        self.assertEqual(pop_db_changes(self.datadir, 'replicator'), [])
+        self.assertEqual(pop_db_changes(self.datadir, 'updater'), None)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.datadir))),
+                         ['containers', 'containers.replicator.changes',
+                          'containers.updater.changes'])
+        self.assertEqual(self.logger.get_lines_for_level('error'), [])
+
+    def test_record_error(self):
+        change_log = DBChangeLog(('replicator',), self.logger)
+        db_file = self._db_file('1', 'abcdef')
+        pop_db_changes(self.datadir, 'replicator')
+        with patch('os.open', side_effect=OSError(13, 'Permission denied')):
+            change_log.record(db_file)
+        self.assertEqual(len(self.logger.get_lines_for_level('error')), 1)
+        change_log.record(db_file)
+        self.assertEqual(pop_db_changes(self.datadir, 'replicator'),
+                         [('1', db_file)])
+
 
 class ExampleBroker(DatabaseBroker):
     """
@@ -239,7 +379,7 @@ class ExampleBroker(DatabaseBroker):
             conn.commit()
 
     def _commit_puts_load(self, item_list, entry):
-        (name, timestamp, deleted) = pickle.loads(entry.decode('base64'))
+        (name, timestamp, deleted) = pickle.loads(entry)
         item_list.append({
             'name': name,
             'created_at': timestamp,
@@ -574,6 +714,31 @@ class TestExampleBroker(unittest.TestCase):
         broker.get_info()
         self.assertEqual(1, broker.get_info()[count_key])
 
+    @with_tempdir
+    def test_commit_pending_in_batches(self, tempdir):
+        ts = (Timestamp(t).internal for t in
+              itertools.count(int(time.time())))
+        broker = self.broker_class(os.path.join(tempdir, 'test.db'),
+                                   account='a', container='c')
+        broker.initialize(ts.next(), storage_policy_index=int(self.policy))
+        for i in range(5):
+            self.put_item(broker, ts.next())
+        batches = []
+        orig_merge_items = broker.merge_items
+
+        def fake_merge_items(item_list, *args, **kwargs):
+            batches.append(len(item_list))
+            return orig_merge_items(item_list, *args, **kwargs)
+
+        with patch.object(broker, 'merge_items', fake_merge_items), \
+                patch('swift.common.db.PENDING_COMMIT_BATCH', 2), \
+                patch('swift.common.db.PENDING_CHUNK_SIZE', 7):
+            broker._commit_puts_stale_ok()
+        self.assertEqual(batches, [2, 2, 1])
+        self.assertEqual(0, os.path.getsize(broker.pending_file))
+        count_key = '%s_count' % broker.db_contains_type
+        self.assertEqual(1, broker.get_info()[count_key])
+
 
 class TestDatabaseBroker(unittest.TestCase):
 
@@ -591,6 +756,30 @@ class TestDatabaseBroker(unittest.TestCase):
         swift.common.db.DB_PREALLOCATION = True
         self.assertRaises(OSError, b._preallocate)
 
+    def test_iter_pending(self):
+        entries = [pickle.dumps(('o%d' % i, ':\x00' * i), protocol=2)
+                   for i in range(4)]
+        pending = ''.join((
+            ':' + entries[0].encode('base64'),
+            '\x00' + struct.pack('!I', len(entries[1])) + entries[1],
+            ':' + entries[2].encode('base64'),
+            '\x00' + struct.pack('!I', len(entries[3])) + entries[3]))
+        broker = DatabaseBroker(os.path.join(self.testdir, '1.db'))
+        for chunk_size in (1, 5, 65536):
+            with patch('swift.common.db.PENDING_CHUNK_SIZE', chunk_size):
+                found = list(broker._iter_pending(StringIO(pending)))
+            self.assertEqual(
+                [entry.decode('base64') if encoded else entry
+                 for entry, encoded in found], entries)
+            self.assertEqual([encoded for entry, encoded in found],
+                             [True, False, True, False])
+
+        # a torn append loses only the last entry
+        broker.logger = FakeLogger()
+        found = list(broker._iter_pending(StringIO(pending[:-1])))
+        self.assertEqual(len(found), 3)
+        self.assertEqual(len(broker.logger.get_lines_for_level('error')), 1)
+
     def test_memory_db_init(self):
         broker = DatabaseBroker(':memory:')
         self.assertEqual(broker.db_file, ':memory:')
@@ -768,6 +957,58 @@ class TestDatabaseBroker(unittest.TestCase):
                 'Quarantined %s to %s due to corrupted database' %
                 (dbpath, qpath))
 
+    def test_get_pooled_connection(self):
+        broker = DatabaseBroker(os.path.join(self.testdir, '1.db'))
+        broker._initialize = lambda *args, **kwargs: None
+        broker.initialize(normalize_timestamp('1'))
+        with patch('swift.common.db.DB_CONNECTION_POOL_SIZE', 1):
+            try:
+                with broker.get() as conn:
+                    pass
+                self.assertEqual(broker.conn, None)
+                broker2 = DatabaseBroker(broker.db_file, timeout=.5)
+                with broker2.get() as conn2:
+                    self.assertTrue(conn2 is conn)
+                    self.assertEqual(conn2.timeout, .5)
+                    # a pooled connection is only used by one broker at a time
+                    with broker.get() as conn3:
+                        self.assertFalse(conn3 is conn)
+                    self.assertEqual(broker.conn, None)
+                # the pool already has an idle connection to the DB
+                self.assertTrue(broker2.conn is conn2)
+                with broker.lock():
+                    pass
+                self.assertEqual(broker.conn, None)
+            finally:
+                swift.common.db._connection_pool.clear()
+
+    def test_checkpoint(self):
+        broker = DatabaseBroker(os.path.join(self.testdir, '1.db'))
+        broker._initialize = lambda *args, **kwargs: None
+        broker.initialize(normalize_timestamp('1'))
+        self.assertTrue(broker.checkpoint())
+        broker.leave_wal_mode()
+        with patch('swift.common.db.DB_WAL_MODE', True):
+            broker = DatabaseBroker(broker.db_file)
+            with broker.get() as conn:
+                conn.execute('CREATE TABLE test (one TEXT)')
+                conn.commit()
+        wal_file = broker.db_file + '-wal'
+        self.assertTrue(os.path.getsize(wal_file) > 0)
+        self.assertTrue(broker.checkpoint())
+        self.assertEqual(os.path.getsize(wal_file), 0)
+        # a copy of the DB file alone has the commit
+        copy(broker.db_file, os.path.join(self.testdir, '2.db'))
+        with DatabaseBroker(os.path.join(self.testdir, '2.db')).get() as conn:
+            conn.execute('SELECT * FROM test')
+        # everything is still in the DB file once it's out of WAL mode
+        broker.leave_wal_mode()
+        self.assertFalse(os.path.exists(wal_file))
+        with broker.get() as conn:
+            self.assertEqual(
+                conn.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+            conn.execute('SELECT * FROM test')
+
     def test_lock(self):
         broker = DatabaseBroker(os.path.join(self.testdir, '1.db'), timeout=.1)
         got_exc = False
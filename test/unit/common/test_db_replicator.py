@@ -26,7 +26,7 @@ from tempfile import mkdtemp, NamedTemporaryFile
 import mock
 import simplejson
 
-from swift.container.backend import DATADIR
+from swift.container.backend import ContainerBroker, DATADIR
 from swift.common import db_replicator
 from swift.common.utils import (normalize_timestamp, hash_path,
                                 storage_directory)
@@ -195,6 +195,12 @@ class FakeBroker(object):
         yield True
         self.locked = False
 
+    def checkpoint(self):
+        return True
+
+    def leave_wal_mode(self):
+        pass
+
     def get_sync(self, *args, **kwargs):
         return 5
 
@@ -229,8 +235,8 @@ class FakeBroker(object):
             info.update(self.stub_replication_info)
         return info
 
-    def reclaim(self, item_timestamp, sync_timestamp):
-        pass
+    def reclaim(self, item_timestamp, sync_timestamp, **kwargs):
+        return '', 0
 
     def newid(self, remote_d):
         pass
@@ -434,6 +440,27 @@ class TestDBReplicator(unittest.TestCase):
                 replicator._rsync_db(broker, fake_device, ReplHttp(), 'abcd')
                 self.assertEquals(2, replicator._rsync_file_call_count)
 
+    def test_rsync_db_checkpoint_failure(self):
+        class MyTestReplicator(TestReplicator):
+            def __init__(self):
+                super(MyTestReplicator, self).__init__({})
+                self._rsync_file_call_count = 0
+
+            def _rsync_file(self_, *args, **kwargs):
+                self_._rsync_file_call_count += 1
+                return True
+
+        broker = FakeBroker()
+        replicator = MyTestReplicator()
+        fake_device = {'ip': '127.0.0.1', 'replication_ip': '127.0.0.1',
+                       'device': 'sda1'}
+        with patch('os.path.exists', lambda path: path.endswith('-wal')), \
+                patch.object(broker, 'checkpoint', side_effect=[True, False]):
+            self.assertFalse(replicator._rsync_db(broker, fake_device,
+                                                  ReplHttp(), 'abcd'))
+        # the DB's write-ahead log couldn't be folded in under the lock
+        self.assertEqual(1, replicator._rsync_file_call_count)
+
     def test_in_sync(self):
         replicator = TestReplicator({})
         self.assertEquals(replicator._in_sync(
@@ -524,6 +551,63 @@ class TestDBReplicator(unittest.TestCase):
                              replicator.ring.devs[0]['device'],
                              replicator.datadir))
 
+    def test_run_once_changed_dbs(self):
+        replicator = TestReplicator({'full_sweep_interval': '3600'})
+        dirs = [('/srv/node/sda/containers', 1)]
+        changes = [None]
+        spawned = []
+        self._patch(patch.object, replicator, '_get_local_datadirs',
+                    lambda: dirs)
+        self._patch(patch.object, db_replicator, 'pop_db_changes',
+                    lambda *args: changes.pop(0))
+        self._patch(patch.object, db_replicator, 'roundrobin_datadirs',
+                    lambda *args: [('1', '/srv/node/sda/1.db', 1),
+                                   ('2', '/srv/node/sda/2.db', 1)])
+        self._patch(patch.object, replicator.cpool, 'spawn_n',
+                    lambda fn, *args: spawned.append(args))
+        # the first pass has no changes to go on
+        replicator.run_once()
+        self.assertEqual(spawned, [('1', '/srv/node/sda/1.db', 1),
+                                   ('2', '/srv/node/sda/2.db', 1)])
+        spawned[:] = []
+        changes.append([('2', '/srv/node/sda/2.db')])
+        replicator.run_once()
+        self.assertEqual(spawned, [('2', '/srv/node/sda/2.db', 1)])
+        # a full sweep doesn't visit the changed DBs twice
+        spawned[:] = []
+        changes.append([('2', '/srv/node/sda/2.db')])
+        replicator._last_full_sweep -= 3600
+        replicator.run_once()
+        self.assertEqual(spawned, [('2', '/srv/node/sda/2.db', 1),
+                                   ('1', '/srv/node/sda/1.db', 1)])
+        # unless the feature is disabled
+        spawned[:] = []
+        replicator.full_sweep_interval = 0
+        replicator.run_once()
+        self.assertEqual(spawned, [('1', '/srv/node/sda/1.db', 1),
+                                   ('2', '/srv/node/sda/2.db', 1)])
+
+    def test_reclaim_carries_on(self):
+        replicator = TestReplicator({'reclaim_batch_size': '10',
+                                     'reclaim_max_batches': '2'},
+                                    logger=unit.FakeLogger())
+        broker = FakeBroker()
+        markers = ['o_20', '', '']
+        with patch.object(broker, 'reclaim', side_effect=lambda *args, **kw:
+                          (markers.pop(0), 0.25)) as mock_reclaim:
+            replicator._reclaim(broker, 1000000)
+            replicator._reclaim(broker, 1000000)
+            replicator._reclaim(broker, 1000000)
+        self.assertEqual(
+            [call[1] for call in mock_reclaim.call_args_list],
+            [{'marker': '', 'batch_size': 10, 'max_batches': 2},
+             {'marker': 'o_20', 'batch_size': 10, 'max_batches': 2},
+             {'marker': '', 'batch_size': 10, 'max_batches': 2}])
+        self.assertEqual(replicator._reclaim_markers, {})
+        self.assertEqual(
+            [call[0] for call in replicator.logger.log_dict['timing']],
+            [('reclaim_timing', 250.0)] * 3)
+
     def test_usync(self):
         fake_http = ReplHttp()
         replicator = TestReplicator({})
@@ -552,9 +636,25 @@ class TestDBReplicator(unittest.TestCase):
         db_replicator.ring = FakeRingWithNodes()
         replicator = TestReplicator({})
         replicator.delete_db = self.stub_delete_db
-        replicator._replicate_object('0', '/path/to/file', 'node_id')
+        # none of the nodes can be reached
+        self.assertFalse(
+            replicator._replicate_object('0', '/path/to/file', 'node_id'))
         self.assertEquals([], self.delete_db_calls)
 
+    def test_replicate_or_record(self):
+        replicator = TestReplicator({})
+        results = [True, False]
+        self._patch(patch.object, replicator, '_replicate_object',
+                    lambda *args: results.pop(0))
+        self._patch(patch.object, replicator.change_log, 'record',
+                    lambda db_file: recorded.append(db_file))
+        recorded = []
+        replicator._replicate_or_record('0', '/path/to/file', 'node_id')
+        self.assertEqual(recorded, [])
+        # the next pass retries a DB that didn't fully replicate
+        replicator._replicate_or_record('0', '/path/to/file', 'node_id')
+        self.assertEqual(recorded, ['/path/to/file'])
+
     def test_replicate_object_quarantine(self):
         replicator = TestReplicator({})
         self._patch(patch.object, replicator.brokerclass, 'db_file',
@@ -606,7 +706,8 @@ class TestDBReplicator(unittest.TestCase):
         # Correct node_id, wrong part
         part = replicator.ring.get_part(TEST_ACCOUNT_NAME) + 1
         node_id = replicator.ring.get_part_nodes(part)[0]['id']
-        replicator._replicate_object(str(part), '/path/to/file', node_id)
+        self.assertTrue(replicator._replicate_object(
+            str(part), '/path/to/file', node_id))
         self.assertEqual(['/path/to/file'], self.delete_db_calls)
         error_msgs = replicator.logger.get_lines_for_level('error')
         expected = 'Found /path/to/file for /a%20c%20t when it should be ' \
@@ -942,6 +1043,33 @@ class TestDBReplicator(unittest.TestCase):
         rpc = db_replicator.ReplicatorRpc('/', '/', FakeBroker, False)
         rpc.rsync_then_merge('sda1', '/srv/swift/blah', ('a', 'b'))
 
+    @unit.with_tempdir
+    def test_rsync_then_merge_wal_mode(self, tempdir):
+        os.mkdir(os.path.join(tempdir, 'tmp'))
+        db_file = os.path.join(tempdir, 'db.db')
+        old_file = os.path.join(tempdir, 'tmp', 'remote_id')
+        rpc = db_replicator.ReplicatorRpc(tempdir, DATADIR, ContainerBroker,
+                                          False)
+        for path, names in ((db_file, 'a'), (old_file, 'bc')):
+            broker = ContainerBroker(path, account='a', container='c')
+            broker.initialize(normalize_timestamp(1), 0)
+            for name in names:
+                broker.put_object(name, normalize_timestamp(2), 0,
+                                  'text/plain', 'etag')
+            broker._commit_puts()
+        ident = os.stat(db_file).st_ino
+        with patch('swift.common.db.DB_WAL_MODE', True):
+            resp = rpc.rsync_then_merge('', db_file, ['remote_id'])
+        self.assertEquals(204, resp.status_int)
+        # merged into the existing DB rather than renamed over it
+        self.assertEqual(os.stat(db_file).st_ino, ident)
+        self.assertFalse(os.path.exists(old_file))
+        self.assertFalse(os.path.exists(old_file + '-wal'))
+        broker = ContainerBroker(db_file)
+        self.assertEqual([item['name'] for item in
+                          broker.get_items_since(-1, 10)], ['a', 'b', 'c'])
+        self.assertEqual(broker.get_sync('remote_id'), 2)
+
     def test_merge_items(self):
         rpc = db_replicator.ReplicatorRpc('/', '/', FakeBroker, False)
         fake_broker = FakeBroker()
@@ -986,7 +1114,6 @@ class TestDBReplicator(unittest.TestCase):
 
     def test_roundrobin_datadirs(self):
         listdir_calls = []
-        isdir_calls = []
         exists_calls = []
         shuffle_calls = []
 
@@ -997,147 +1124,103 @@ class TestDBReplicator(unittest.TestCase):
                 return []
             path = path[len('/srv/node/sdx/containers'):]
             if path == '':
-                return ['123', '456', '789']  # 456 will pretend to be a file
+                return ['789', '456', '123']  # 456 will pretend to be a file
             elif path == '/123':
                 return ['abc', 'def.db']  # def.db will pretend to be a file
             elif path == '/123/abc':
                 # 11111111111111111111111111111abc will pretend to be a file
                 return ['00000000000000000000000000000abc',
                         '11111111111111111111111111111abc']
-            elif path == '/123/abc/00000000000000000000000000000abc':
-                return ['00000000000000000000000000000abc.db',
-                        # This other.db isn't in the right place, so should be
-                        # ignored later.
-                        '000000000000000000000000000other.db',
-                        'weird1']  # weird1 will pretend to be a dir, if asked
             elif path == '/789':
                 return ['ghi', 'jkl']  # jkl will pretend to be a file
             elif path == '/789/ghi':
                 # 33333333333333333333333333333ghi will pretend to be a file
                 return ['22222222222222222222222222222ghi',
                         '33333333333333333333333333333ghi']
-            elif path == '/789/ghi/22222222222222222222222222222ghi':
-                return ['22222222222222222222222222222ghi.db',
-                        'weird2']  # weird2 will pretend to be a dir, if asked
-            return []
-
-        def _isdir(path):
-            isdir_calls.append(path)
-            if not path.startswith('/srv/node/sda/containers') and \
-                    not path.startswith('/srv/node/sdb/containers'):
-                return False
-            path = path[len('/srv/node/sdx/containers'):]
-            if path in ('/123', '/123/abc',
-                        '/123/abc/00000000000000000000000000000abc',
-                        '/123/abc/00000000000000000000000000000abc/weird1',
-                        '/789', '/789/ghi',
-                        '/789/ghi/22222222222222222222222222222ghi',
-                        '/789/ghi/22222222222222222222222222222ghi/weird2'):
-                return True
-            return False
+            raise OSError(errno.ENOTDIR, os.strerror(errno.ENOTDIR))
 
         def _exists(arg):
             exists_calls.append(arg)
-            return True
+            return arg.endswith(('00000000000000000000000000000abc.db',
+                                 '22222222222222222222222222222ghi.db'))
 
         def _shuffle(arg):
-            shuffle_calls.append(arg)
+            shuffle_calls.append([name for name, is_dir in arg])
 
-        orig_listdir = db_replicator.os.listdir
-        orig_isdir = db_replicator.os.path.isdir
-        orig_exists = db_replicator.os.path.exists
-        orig_shuffle = db_replicator.random.shuffle
-        try:
-            db_replicator.os.listdir = _listdir
-            db_replicator.os.path.isdir = _isdir
-            db_replicator.os.path.exists = _exists
-            db_replicator.random.shuffle = _shuffle
+        with mock.patch('os.listdir', _listdir), \
+                mock.patch('os.path.exists', _exists), \
+                mock.patch('os.path.isdir') as _isdir, \
+                mock.patch('swift.common.utils.shuffle', _shuffle), \
+                mock.patch('swift.common.utils.scandir', None):
             datadirs = [('/srv/node/sda/containers', 1),
                         ('/srv/node/sdb/containers', 2)]
             results = list(db_replicator.roundrobin_datadirs(datadirs))
-            # The results show that the .db files are returned, the devices
-            # interleaved.
-            self.assertEquals(results, [
-                ('123', '/srv/node/sda/containers/123/abc/'
-                        '00000000000000000000000000000abc/'
-                        '00000000000000000000000000000abc.db', 1),
-                ('123', '/srv/node/sdb/containers/123/abc/'
-                        '00000000000000000000000000000abc/'
-                        '00000000000000000000000000000abc.db', 2),
-                ('789', '/srv/node/sda/containers/789/ghi/'
-                        '22222222222222222222222222222ghi/'
-                        '22222222222222222222222222222ghi.db', 1),
-                ('789', '/srv/node/sdb/containers/789/ghi/'
-                        '22222222222222222222222222222ghi/'
-                        '22222222222222222222222222222ghi.db', 2)])
-            # The listdir calls show that we only listdir the dirs
-            self.assertEquals(listdir_calls, [
-                '/srv/node/sda/containers',
-                '/srv/node/sda/containers/123',
-                '/srv/node/sda/containers/123/abc',
-                '/srv/node/sdb/containers',
-                '/srv/node/sdb/containers/123',
-                '/srv/node/sdb/containers/123/abc',
-                '/srv/node/sda/containers/789',
-                '/srv/node/sda/containers/789/ghi',
-                '/srv/node/sdb/containers/789',
-                '/srv/node/sdb/containers/789/ghi'])
-            # The isdir calls show that we did ask about the things pretending
-            # to be files at various levels.
-            self.assertEquals(isdir_calls, [
-                '/srv/node/sda/containers/123',
-                '/srv/node/sda/containers/123/abc',
-                ('/srv/node/sda/containers/123/abc/'
-                 '00000000000000000000000000000abc'),
-                '/srv/node/sdb/containers/123',
-                '/srv/node/sdb/containers/123/abc',
-                ('/srv/node/sdb/containers/123/abc/'
-                 '00000000000000000000000000000abc'),
-                ('/srv/node/sda/containers/123/abc/'
-                 '11111111111111111111111111111abc'),
-                '/srv/node/sda/containers/123/def.db',
-                '/srv/node/sda/containers/456',
-                '/srv/node/sda/containers/789',
-                '/srv/node/sda/containers/789/ghi',
-                ('/srv/node/sda/containers/789/ghi/'
-                 '22222222222222222222222222222ghi'),
-                ('/srv/node/sdb/containers/123/abc/'
-                 '11111111111111111111111111111abc'),
-                '/srv/node/sdb/containers/123/def.db',
-                '/srv/node/sdb/containers/456',
-                '/srv/node/sdb/containers/789',
-                '/srv/node/sdb/containers/789/ghi',
-                ('/srv/node/sdb/containers/789/ghi/'
-                 '22222222222222222222222222222ghi'),
-                ('/srv/node/sda/containers/789/ghi/'
-                 '33333333333333333333333333333ghi'),
-                '/srv/node/sda/containers/789/jkl',
-                ('/srv/node/sdb/containers/789/ghi/'
-                 '33333333333333333333333333333ghi'),
-                '/srv/node/sdb/containers/789/jkl'])
-            # The exists calls are the .db files we looked for as we walked the
-            # structure.
-            self.assertEquals(exists_calls, [
-                ('/srv/node/sda/containers/123/abc/'
-                 '00000000000000000000000000000abc/'
-                 '00000000000000000000000000000abc.db'),
-                ('/srv/node/sdb/containers/123/abc/'
-                 '00000000000000000000000000000abc/'
-                 '00000000000000000000000000000abc.db'),
-                ('/srv/node/sda/containers/789/ghi/'
-                 '22222222222222222222222222222ghi/'
-                 '22222222222222222222222222222ghi.db'),
-                ('/srv/node/sdb/containers/789/ghi/'
-                 '22222222222222222222222222222ghi/'
-                 '22222222222222222222222222222ghi.db')])
-            # Shows that we called shuffle twice, once for each device.
-            self.assertEquals(
-                shuffle_calls, [['123', '456', '789'], ['123', '456', '789']])
-        finally:
-            db_replicator.os.listdir = orig_listdir
-            db_replicator.os.path.isdir = orig_isdir
-            db_replicator.os.path.exists = orig_exists
-            db_replicator.random.shuffle = orig_shuffle
+        # The results show that the .db files are returned, the devices
+        # interleaved.
+        self.assertEquals(results, [
+            ('123', '/srv/node/sda/containers/123/abc/'
+                    '00000000000000000000000000000abc/'
+                    '00000000000000000000000000000abc.db', 1),
+            ('123', '/srv/node/sdb/containers/123/abc/'
+                    '00000000000000000000000000000abc/'
+                    '00000000000000000000000000000abc.db', 2),
+            ('789', '/srv/node/sda/containers/789/ghi/'
+                    '22222222222222222222222222222ghi/'
+                    '22222222222222222222222222222ghi.db', 1),
+            ('789', '/srv/node/sdb/containers/789/ghi/'
+                    '22222222222222222222222222222ghi/'
+                    '22222222222222222222222222222ghi.db', 2)])
+        # Nothing is stat'ed to find out whether it's a directory; the
+        # things pretending to be files at the partition and suffix levels
+        # are simply found not to be directories when listed.
+        self.assertFalse(_isdir.called)
+        self.assertEquals(listdir_calls, [
+            '/srv/node/sda/containers',
+            '/srv/node/sda/containers/123',
+            '/srv/node/sda/containers/123/abc',
+            '/srv/node/sdb/containers',
+            '/srv/node/sdb/containers/123',
+            '/srv/node/sdb/containers/123/abc',
+            '/srv/node/sda/containers/123/def.db',
+            '/srv/node/sda/containers/456',
+            '/srv/node/sda/containers/789',
+            '/srv/node/sda/containers/789/ghi',
+            '/srv/node/sdb/containers/123/def.db',
+            '/srv/node/sdb/containers/456',
+            '/srv/node/sdb/containers/789',
+            '/srv/node/sdb/containers/789/ghi',
+            '/srv/node/sda/containers/789/jkl',
+            '/srv/node/sdb/containers/789/jkl'])
+        # The exists calls are the .db files we looked for as we walked the
+        # structure.
+        self.assertEquals(exists_calls, [
+            ('/srv/node/sda/containers/123/abc/'
+             '00000000000000000000000000000abc/'
+             '00000000000000000000000000000abc.db'),
+            ('/srv/node/sdb/containers/123/abc/'
+             '00000000000000000000000000000abc/'
+             '00000000000000000000000000000abc.db'),
+            ('/srv/node/sda/containers/123/abc/'
+             '11111111111111111111111111111abc/'
+             '11111111111111111111111111111abc.db'),
+            ('/srv/node/sda/containers/789/ghi/'
+             '22222222222222222222222222222ghi/'
+             '22222222222222222222222222222ghi.db'),
+            ('/srv/node/sdb/containers/123/abc/'
+             '11111111111111111111111111111abc/'
+             '11111111111111111111111111111abc.db'),
+            ('/srv/node/sdb/containers/789/ghi/'
+             '22222222222222222222222222222ghi/'
+             '22222222222222222222222222222ghi.db'),
+            ('/srv/node/sda/containers/789/ghi/'
+             '33333333333333333333333333333ghi/'
+             '33333333333333333333333333333ghi.db'),
+            ('/srv/node/sdb/containers/789/ghi/'
+             '33333333333333333333333333333ghi/'
+             '33333333333333333333333333333ghi.db')])
+        # Shows that we called shuffle twice, once for each device.
+        self.assertEquals(
+            shuffle_calls, [['123', '456', '789'], ['123', '456', '789']])
 
     @mock.patch("swift.common.db_replicator.ReplConnection", mock.Mock())
     def test_http_connect(self):
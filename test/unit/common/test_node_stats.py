@@ -0,0 +1,76 @@
+# Copyright (c) 2010-2012 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import mock
+
+from swift.common import node_stats
+
+
+class TestNodeStats(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+        self.path = os.path.join(self.testdir, node_stats.NODE_STATS_FILE)
+
+    def tearDown(self):
+        rmtree(self.testdir, ignore_errors=True)
+
+    def test_latency_average(self):
+        stats = node_stats.NodeStats()
+        self.assertEqual(stats.get('a'), (0.0, 0.0))
+        stats.record_latency('a', 1.0)
+        self.assertEqual(stats.get('a'), (1.0, 0.0))
+        stats.record_latency('a', 2.0)
+        self.assertEqual(stats.get('a'), (1.2, 0.0))
+        self.assertEqual(stats.get('b'), (0.0, 0.0))
+
+    def test_error_decay(self):
+        stats = node_stats.NodeStats(error_half_life=10)
+        with mock.patch('swift.common.node_stats.time.time',
+                        return_value=1000.0):
+            stats.record_error('a')
+            stats.record_error('a')
+            self.assertEqual(stats.get('a'), (0.0, 2.0))
+        with mock.patch('swift.common.node_stats.time.time',
+                        return_value=1010.0):
+            self.assertEqual(stats.get('a'), (0.0, 1.0))
+            stats.record_error('a')
+            self.assertEqual(stats.get('a'), (0.0, 2.0))
+
+    def test_shared(self):
+        # keys colliding in a small table probe on to the next slots
+        first = node_stats.NodeStats(self.path, slots=2)
+        second = node_stats.NodeStats(self.path, slots=2)
+        first.record_latency('a', 1.0)
+        second.record_error('b')
+        self.assertEqual(second.get('a'), (1.0, 0.0))
+        self.assertEqual(round(first.get('b')[1]), 1)
+        # a full table keeps no stats for further keys
+        first.record_latency('c', 1.0)
+        self.assertEqual(first.get('c'), (0.0, 0.0))
+        self.assertEqual(sorted(node_stats.read_node_stats(self.path)),
+                         ['a', 'b'])
+        # a table of another layout starts over
+        third = node_stats.NodeStats(self.path, slots=3)
+        self.assertEqual(third.dump(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
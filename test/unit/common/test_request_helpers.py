@@ -16,10 +16,11 @@
 """Tests for swift.common.request_helpers"""
 
 import unittest
-from swift.common.swob import Request
+import mock
+from swift.common.swob import Request, Response
 from swift.common.request_helpers import is_sys_meta, is_user_meta, \
     is_sys_or_user_meta, strip_sys_meta_prefix, strip_user_meta_prefix, \
-    remove_items, copy_header_subset
+    remove_items, copy_header_subset, set_listing_body
 
 server_types = ['account', 'container', 'object']
 
@@ -81,3 +82,21 @@ class TestRequestHelpers(unittest.TestCase):
         self.assertEqual(to_req.headers['A'], 'b')
         self.assertFalse('c' in to_req.headers)
         self.assertFalse('C' in to_req.headers)
+
+    def test_set_listing_body(self):
+        with mock.patch('swift.common.request_helpers.LISTING_CHUNK_SIZE', 4):
+            resp = Response()
+            set_listing_body(resp, iter(['ab', 'cd']))
+            self.assertEqual(resp.content_length, 4)
+            self.assertEqual(resp.body, 'abcd')
+
+            resp = Response()
+            set_listing_body(resp, iter([]))
+            self.assertEqual(resp.content_length, 0)
+
+            body_iter = iter(['ab', 'cd', 'ef', 'gh', 'ij', 'k'])
+            resp = Response()
+            set_listing_body(resp, body_iter)
+            self.assertEqual(resp.content_length, None)
+            # only the first two chunks have been read
+            self.assertEqual(list(body_iter), ['ij', 'k'])
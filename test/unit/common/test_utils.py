@@ -22,6 +22,7 @@ import errno
 import eventlet
 import eventlet.event
 import grp
+import itertools
 import logging
 import os
 import mock
@@ -2147,6 +2148,13 @@ cluster_dfw1 = http://dfw1.host/v1/
         self.assertFalse(utils.streq_const_time('a', 'aaaaa'))
         self.assertFalse(utils.streq_const_time('ABC123', 'abc123'))
 
+    def test_join_chunks(self):
+        self.assertEqual(list(utils.join_chunks([], 3)), [])
+        self.assertEqual(list(utils.join_chunks(['ab'], 3)), ['ab'])
+        self.assertEqual(
+            list(utils.join_chunks(iter(['a', 'bc', 'd', 'efgh', 'i']), 3)),
+            ['abc', 'defgh', 'i'])
+
     def test_quorum_size(self):
         expected_sizes = {1: 1,
                           2: 2,
@@ -3424,6 +3432,43 @@ class TestGreenthreadSafeIterator(unittest.TestCase):
             not unsafe_iterable.concurrent_call, 'concurrent call occurred')
 
 
+class TestReadAheadIterator(unittest.TestCase):
+
+    def test_reads_ahead(self):
+        produced = []
+
+        def produce():
+            for n in xrange(10):
+                produced.append(n)
+                yield n
+            raise ValueError('out of numbers')
+
+        iterable = utils.ReadAheadIterator(produce(), 3)
+        self.assertEqual(iterable.next(), 0)
+        eventlet.sleep(0.01)
+        # one handed out, three queued, one waiting to be queued
+        self.assertEqual(produced, range(5))
+        self.assertEqual(list(itertools.islice(iterable, 9)), range(1, 10))
+        self.assertRaises(ValueError, iterable.next)
+        self.assertRaises(StopIteration, iterable.next)
+
+    def test_close(self):
+        closed = []
+
+        def produce():
+            try:
+                for n in itertools.count():
+                    yield n
+            finally:
+                closed.append(True)
+
+        iterable = utils.ReadAheadIterator(produce(), 2)
+        self.assertEqual(iterable.next(), 0)
+        iterable.close()
+        self.assertEqual(closed, [True])
+        self.assertRaises(StopIteration, iterable.next)
+
+
 class TestStatsdLoggingDelegation(unittest.TestCase):
 
     def setUp(self):
@@ -4019,6 +4064,105 @@ class TestAuditLocationGenerator(unittest.TestCase):
                              [(obj_path, "drive", "partition2")])
 
 
+class TestWalkDirTree(unittest.TestCase):
+
+    def _make_tree(self, tmpdir):
+        for path in ('1/abc/hash1', '1/abc/hash2', '1/def/hash3',
+                     '2/ghi/hash4', '3'):
+            os.makedirs(os.path.join(tmpdir, path))
+        with open(os.path.join(tmpdir, '1', 'not_a_suffix'), 'w'):
+            pass
+        with open(os.path.join(tmpdir, '1', 'def', 'not_a_hash'), 'w'):
+            pass
+
+    def _walk(self, tmpdir, depth, **kwargs):
+        return [names for path, names, is_dir in
+                utils.walk_dir_tree(tmpdir, depth, **kwargs)]
+
+    def test_walk(self):
+        with temptree([]) as tmpdir:
+            self._make_tree(tmpdir)
+            self.assertEqual(self._walk(tmpdir, 1), [('1',), ('2',), ('3',)])
+            self.assertEqual(
+                self._walk(tmpdir, 3),
+                [('1', 'abc', 'hash1'), ('1', 'abc', 'hash2'),
+                 ('1', 'def', 'hash3'), ('1', 'def', 'not_a_hash'),
+                 ('2', 'ghi', 'hash4')])
+            path, names, is_dir = next(utils.walk_dir_tree(tmpdir, 3))
+            self.assertEqual(path, os.path.join(tmpdir, '1/abc/hash1'))
+            self.assertEqual(
+                list(utils.walk_dir_tree(os.path.join(tmpdir, 'nope'), 3)),
+                [])
+
+    def test_resume_after(self):
+        with temptree([]) as tmpdir:
+            self._make_tree(tmpdir)
+            self.assertEqual(
+                self._walk(tmpdir, 3, resume_after=('1', 'abc', 'hash1')),
+                [('1', 'abc', 'hash2'), ('1', 'def', 'hash3'),
+                 ('1', 'def', 'not_a_hash'), ('2', 'ghi', 'hash4')])
+            # positions don't need to exist any more
+            self.assertEqual(
+                self._walk(tmpdir, 3, resume_after=('1', 'bcd', 'hash0')),
+                [('1', 'def', 'hash3'), ('1', 'def', 'not_a_hash'),
+                 ('2', 'ghi', 'hash4')])
+            # a partial position skips everything below it
+            self.assertEqual(self._walk(tmpdir, 3, resume_after=('1',)),
+                             [('2', 'ghi', 'hash4')])
+            self.assertEqual(
+                self._walk(tmpdir, 3, resume_after=('2', 'ghi', 'hash4')),
+                [])
+            self.assertRaises(ValueError, utils.walk_dir_tree, tmpdir, 3,
+                              resume_after=('1',), shuffle_top=True)
+
+    def test_shuffle_top(self):
+        with temptree([]) as tmpdir:
+            self._make_tree(tmpdir)
+            with patch('swift.common.utils.shuffle',
+                       lambda entries: entries.reverse()):
+                self.assertEqual(
+                    self._walk(tmpdir, 2, shuffle_top=True),
+                    [('2', 'ghi'), ('1', 'abc'), ('1', 'def'),
+                     ('1', 'not_a_suffix')])
+
+    def test_top_errors_raised_before_iterating(self):
+        with temptree([]) as tmpdir:
+            self._make_tree(tmpdir)
+            with patch('os.listdir',
+                       side_effect=OSError(errno.EACCES, 'denied')):
+                self.assertRaises(OSError, utils.walk_dir_tree, tmpdir, 3)
+            self.assertRaises(OSError, utils.walk_dir_tree,
+                              os.path.join(tmpdir, '1', 'not_a_suffix'), 1)
+
+    def test_scandir_file_types(self):
+        listed = []
+
+        class FakeEntry(object):
+            def __init__(self, name, is_dir):
+                self.name = name
+                self._is_dir = is_dir
+
+            def is_dir(self):
+                return self._is_dir
+
+        tree = {'/top': [FakeEntry('b', True), FakeEntry('a', False)],
+                '/top/b': [FakeEntry('x', False)]}
+
+        def fake_scandir(path):
+            listed.append(path)
+            return iter(tree[path])
+
+        with patch('swift.common.utils.scandir', fake_scandir):
+            self.assertEqual(
+                list(utils.walk_dir_tree('/top', 2)),
+                [('/top/b/x', ('b', 'x'), False)])
+            self.assertEqual(
+                list(utils.walk_dir_tree('/top', 1)),
+                [('/top/a', ('a',), False), ('/top/b', ('b',), True)])
+        # the file was never listed
+        self.assertEqual(listed, ['/top', '/top/b', '/top'])
+
+
 class TestGreenAsyncPile(unittest.TestCase):
     def test_runs_everything(self):
         def run_test():
@@ -4079,6 +4223,19 @@ class TestGreenAsyncPile(unittest.TestCase):
         self.assertEqual(pile.waitall(0.5), [0.1, 0.1])
         self.assertEqual(completed[0], 2)
 
+    def test_waitfirst(self):
+        def run_test(sleep_duration, result):
+            eventlet.sleep(sleep_duration)
+            return result
+
+        pile = utils.GreenAsyncPile(3)
+        pile.spawn(run_test, 0.5, 'slow')
+        self.assertEqual(pile.waitfirst(0.05), [])
+        pile.spawn(run_test, 0.05, 'fast')
+        self.assertEqual(pile.waitfirst(1), ['fast'])
+        self.assertEqual(pile.waitfirst(1), ['slow'])
+        self.assertEqual(pile.waitfirst(1), [])
+
 
 class TestLRUCache(unittest.TestCase):
 
@@ -4347,5 +4504,40 @@ class TestPairs(unittest.TestCase):
                               (50, 60)]))
 
 
+class TestShardRange(unittest.TestCase):
+
+    def test_contains(self):
+        shard_range = utils.ShardRange('c-1', '1', 'b', 'd')
+        self.assertFalse('b' in shard_range)
+        self.assertTrue('b\x00' in shard_range)
+        self.assertTrue('d' in shard_range)
+        self.assertFalse('d\x00' in shard_range)
+        self.assertTrue('' in utils.ShardRange('c-1', '1'))
+        self.assertTrue('z' in utils.ShardRange('c-1', '1', 'b'))
+        self.assertTrue('a' in utils.ShardRange('c-1', '1', '', 'b'))
+
+    def test_create(self):
+        shard_range = utils.ShardRange.create('a', 'c', 'b', 'd', '1')
+        self.assertTrue(shard_range.name.startswith('c-'))
+        self.assertEqual(
+            (shard_range.lower, shard_range.upper, shard_range.created_at),
+            ('b', 'd', '1'))
+        self.assertNotEqual(
+            shard_range.name,
+            utils.ShardRange.create('a', 'c', 'd', '', '1').name)
+        self.assertEqual(
+            shard_range, utils.ShardRange.create('a', 'c', 'b', 'd', '1'))
+
+    def test_dict_round_trip(self):
+        shard_range = utils.ShardRange(
+            'c-1', '1', 'b', '\xe2\x98\x83', 3, 30, '2')
+        data = json.loads(json.dumps(shard_range.as_dict()))
+        copy = utils.ShardRange.from_dict(data)
+        self.assertEqual(copy, shard_range)
+        self.assertTrue(isinstance(copy.upper, str))
+        self.assertEqual(utils.shards_account('AUTH_test'),
+                         '.shards_AUTH_test')
+
+
 if __name__ == '__main__':
     unittest.main()
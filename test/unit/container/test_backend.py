@@ -29,7 +29,7 @@ import pickle
 import json
 
 from swift.container.backend import ContainerBroker
-from swift.common.utils import Timestamp
+from swift.common.utils import Timestamp, ShardRange
 from swift.common.storage_policy import POLICIES
 
 import mock
@@ -162,6 +162,39 @@ class TestContainerBroker(unittest.TestCase):
         broker.reclaim(Timestamp(time()).internal, time())
         broker.delete_db(Timestamp(time()).internal)
 
+    def test_reclaim_batches(self):
+        ts = (Timestamp(t).internal for t in itertools.count(int(time())))
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(ts.next(), 0)
+        for name in 'abcdefg':
+            broker.put_object(name, ts.next(), 0, 'text/plain', 'etag')
+            broker.delete_object(name, ts.next())
+        broker.put_object('h', ts.next(), 0, 'text/plain', 'etag')
+        # a newer tombstone isn't reclaimed
+        reclaim_age = ts.next()
+        broker.delete_object('i', ts.next())
+
+        def names():
+            with broker.get() as conn:
+                return [row[0] for row in conn.execute(
+                    'SELECT name FROM object ORDER BY name')]
+
+        with mock.patch('swift.common.db.sleep') as mock_sleep:
+            marker, lock_time = broker.reclaim(
+                reclaim_age, reclaim_age, batch_size=2, max_batches=2)
+        self.assertEqual(marker, 'd')
+        self.assertTrue(lock_time > 0)
+        self.assertEqual(mock_sleep.call_count, 1)
+        self.assertEqual(names(), ['e', 'f', 'g', 'h', 'i'])
+        marker, lock_time = broker.reclaim(
+            reclaim_age, reclaim_age, marker=marker, batch_size=2,
+            max_batches=2)
+        self.assertEqual(marker, '')
+        self.assertEqual(names(), ['h', 'i'])
+        self.assertEqual(
+            broker.reclaim(reclaim_age, reclaim_age, batch_size=2),
+            ('', 0))
+
     def test_get_info_is_deleted(self):
         start = int(time())
         ts = (Timestamp(t).internal for t in itertools.count(start))
@@ -968,6 +1001,66 @@ class TestContainerBroker(unittest.TestCase):
         self.assertEquals([row[0] for row in listing],
                           ['/pets/fish/a', '/pets/fish/b'])
 
+    def test_list_objects_iter_skip_scan(self):
+        # pseudo-directories are read past or sought past, with the same
+        # listing either way
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(Timestamp('1').internal, 0)
+        for i in range(4):
+            for j in range(i * 3):
+                broker.put_object(
+                    'd%d/o%d' % (i, j), Timestamp(0).internal, 0,
+                    'text/plain', 'd41d8cd98f00b204e9800998ecf8427e')
+            broker.put_object(
+                'd%d0' % i, Timestamp(0).internal, 0,
+                'text/plain', 'd41d8cd98f00b204e9800998ecf8427e')
+        broker.put_object(
+            'd2/o1/x', Timestamp(0).internal, 0,
+            'text/plain', 'd41d8cd98f00b204e9800998ecf8427e')
+
+        def listings():
+            return [
+                [row[0] for row in broker.list_objects_iter(
+                    100, None, None, '', '/')],
+                [row[0] for row in broker.list_objects_iter(
+                    3, 'd1/', None, '', '/')],
+                [row[0] for row in broker.list_objects_iter(
+                    100, None, None, 'd2/', '/')],
+                [row[0] for row in broker.list_objects_iter(
+                    100, None, None, None, None, 'd2')]]
+
+        expected = [
+            ['d00', 'd1/', 'd10', 'd2/', 'd20', 'd3/', 'd30'],
+            ['d10', 'd2/', 'd20'],
+            ['d2/o0', 'd2/o1', 'd2/o1/', 'd2/o2', 'd2/o3', 'd2/o4', 'd2/o5'],
+            ['d2/o0', 'd2/o1', 'd2/o2', 'd2/o3', 'd2/o4', 'd2/o5']]
+        for skip_rows in (1, 2, 100):
+            with mock.patch('swift.container.backend.LISTING_SKIP_ROWS',
+                            skip_rows):
+                self.assertEqual(listings(), expected)
+
+    def test_stream_objects(self):
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(Timestamp('1').internal, 0)
+        for name in ('a', 'b/1', 'b/2', 'b/2/x', 'b0', 'c/1', 'c/2', 'd'):
+            broker.put_object(
+                name, Timestamp(0).internal, 0,
+                'text/plain', 'd41d8cd98f00b204e9800998ecf8427e')
+        for args in ((100, '', None, None, None),
+                     (5, '', None, None, None),
+                     (100, 'a', 'd', None, None),
+                     (100, '', None, '', '/'),
+                     (3, '', None, '', '/'),
+                     (100, '', None, 'b/', '/'),
+                     (100, 'b/1', None, None, None, 'b')):
+            expected = broker.list_objects_iter(*args)
+            for batch_size in (1, 2, 1000):
+                with mock.patch('swift.common.db.LISTING_BATCH_SIZE',
+                                batch_size):
+                    listing = broker.stream_objects(*args)
+                    self.assertFalse(isinstance(listing, list))
+                    self.assertEqual(list(listing), expected)
+
     def test_double_check_trailing_delimiter(self):
         # Test ContainerBroker.list_objects_iter for a
         # container that has an odd file with a trailing delimiter
@@ -1203,6 +1296,45 @@ class TestContainerBroker(unittest.TestCase):
         self.assertEquals(['a', 'b', 'c'],
                           sorted([rec['name'] for rec in items]))
 
+    def test_merge_items_newest_wins(self):
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(Timestamp('1').internal, 0)
+        broker.put_object('a', Timestamp(2).internal, 1,
+                          'text/plain', 'etag-a')
+        broker.put_object('b', Timestamp(2).internal, 2,
+                          'text/plain', 'etag-b')
+
+        def item(name, t, size, deleted=0):
+            return {'name': name, 'created_at': Timestamp(t).internal,
+                    'size': size, 'content_type': 'text/plain',
+                    'etag': 'etag-%s-%s' % (name, t), 'deleted': deleted,
+                    'storage_policy_index': 0}
+
+        broker.merge_items([
+            item('a', 1, 10),  # stale
+            item('b', 3, 30), item('b', 4, 40), item('b', 3, 35),
+            item('c', 5, 50), item('c', 5, 55),  # tie goes to the later one
+            item('d', 6, 0, deleted=1)])
+        items = dict((rec['name'], rec)
+                     for rec in broker.get_items_since(-1, 1000))
+        self.assertEqual(sorted(items), ['a', 'b', 'c', 'd'])
+        self.assertEqual(items['a']['etag'], 'etag-a')
+        self.assertEqual(items['b']['size'], 40)
+        self.assertEqual(items['c']['size'], 55)
+        self.assertEqual(items['d']['deleted'], 1)
+        info = broker.get_info()
+        self.assertEqual(info['object_count'], 3)
+        self.assertEqual(info['bytes_used'], 1 + 40 + 55)
+
+        # the sync point follows the rows that were merged
+        rows = [dict(item('e', 7, 70), ROWID=12),
+                dict(item('a', 1, 10), ROWID=13)]
+        broker.merge_items(rows, 'remote-id')
+        self.assertEqual(broker.get_sync('remote-id'), 12)
+        # nothing new merged, the sync point stays put
+        broker.merge_items([dict(item('e', 7, 70), ROWID=20)], 'remote-id')
+        self.assertEqual(broker.get_sync('remote-id'), 12)
+
     def test_merge_items_overwrite_unicode(self):
         # test DatabaseBroker.merge_items
         snowman = u'\N{SNOWMAN}'.encode('utf-8')
@@ -1418,6 +1550,181 @@ class TestContainerBroker(unittest.TestCase):
         }
         self.assertEqual(broker.get_policy_stats(), expected)
 
+    def test_merge_shard_ranges(self):
+        ts = (Timestamp(t).internal for t in itertools.count(int(time())))
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(ts.next(), 0)
+        self.assertEqual(broker.get_shard_ranges(), [])
+        self.assertFalse(broker.is_sharded())
+        created_at = ts.next()
+        first = ShardRange('c-1', created_at, '', 'm')
+        second = ShardRange('c-2', created_at, 'm', '')
+        broker.merge_shard_ranges([second, first])
+        self.assertTrue(broker.is_sharded())
+        self.assertEqual(broker.get_shard_ranges(), [first, second])
+
+        # usage reports only update the stats
+        report = ShardRange('c-1', '0', 'x', 'y', 3, 30, ts.next())
+        broker.merge_shard_ranges([report])
+        shard_range = broker.get_shard_ranges()[0]
+        self.assertEqual((shard_range.lower, shard_range.upper), ('', 'm'))
+        self.assertEqual(shard_range.object_count, 3)
+        self.assertEqual(shard_range.bytes_used, 30)
+        stale = ShardRange('c-1', '0', '', 'm', 1, 10, '1')
+        broker.merge_shard_ranges([stale])
+        self.assertEqual(broker.get_shard_ranges()[0].object_count, 3)
+
+        # newer bounds win
+        deleted = ShardRange('c-2', ts.next(), 'm', '', deleted=1)
+        broker.merge_shard_ranges([deleted])
+        self.assertEqual(broker.get_shard_ranges(), [shard_range])
+        self.assertEqual(len(broker.get_shard_ranges(include_deleted=True)),
+                         2)
+
+    def test_shard_range_stats_in_info(self):
+        ts = (Timestamp(t).internal for t in itertools.count(int(time())))
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(ts.next(), 0)
+        broker.put_object('o', ts.next(), 5, 'text/plain', 'etag')
+        broker.merge_shard_ranges([
+            ShardRange('c-1', ts.next(), '', 'm', 0, 0, ts.next())])
+        info = broker.get_info()
+        self.assertEqual(info['object_count'], 1)
+        self.assertEqual(info['bytes_used'], 5)
+        broker.delete_object('o', ts.next())
+        self.assertTrue(broker.empty())
+        broker.merge_shard_ranges([
+            ShardRange('c-1', '0', '', 'm', 2, 20, ts.next())])
+        info = broker.get_info()
+        self.assertEqual(info['object_count'], 2)
+        self.assertEqual(info['bytes_used'], 20)
+        self.assertFalse(broker.empty())
+
+    def test_shard_range_stats_while_cleaving(self):
+        ts = (Timestamp(t).internal for t in itertools.count(int(time())))
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(ts.next(), 0)
+        for name in 'abcxyz':
+            broker.put_object(name, ts.next(), 10, 'text/plain', 'etag')
+        self.assertEqual(broker.get_uncleaved_object_count(), 6)
+        # another copy of the root has cleaved its rows into both shards,
+        # and the first shard got an update of its own
+        broker.merge_shard_ranges([
+            ShardRange('c-1', ts.next(), '', 'm', 4, 40, ts.next()),
+            ShardRange('c-2', ts.next(), 'm', '', 3, 30, ts.next())])
+        # until the sharder has counted this copy's rows in each range, only
+        # they are counted
+        info = broker.get_info()
+        self.assertEqual(info['object_count'], 6)
+        self.assertEqual(info['bytes_used'], 60)
+        broker.update_uncleaved_usage()
+        info = broker.get_info()
+        self.assertEqual(info['object_count'], 7)
+        self.assertEqual(info['bytes_used'], 70)
+        # this copy cleaves its rows from the first range
+        broker.remove_objects(broker.get_objects_in_range('', 'm', 10))
+        broker.update_uncleaved_usage()
+        self.assertEqual(broker.get_uncleaved_object_count(), 3)
+        info = broker.get_info()
+        self.assertEqual(info['object_count'], 7)
+        self.assertEqual(info['bytes_used'], 70)
+        # once every row is cleaved the shards' usage is all that counts
+        broker.remove_objects(broker.get_objects_in_range('m', '', 10))
+        info = broker.get_info()
+        self.assertEqual(info['object_count'], 7)
+        self.assertEqual(info['bytes_used'], 70)
+
+    def test_get_objects_in_range(self):
+        ts = (Timestamp(t).internal for t in itertools.count(int(time())))
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(ts.next(), 0)
+        for name in 'abcdef':
+            broker.put_object(name, ts.next(), 0, 'text/plain', 'etag')
+        broker.delete_object('c', ts.next())
+
+        def names(rows):
+            return [row['name'] for row in rows]
+
+        self.assertEqual(names(broker.get_objects_in_range('', 'c', 10)),
+                         ['a', 'b', 'c'])
+        self.assertEqual(names(broker.get_objects_in_range('c', '', 10)),
+                         ['d', 'e', 'f'])
+        self.assertEqual(names(broker.get_objects_in_range('a', 'e', 2)),
+                         ['b', 'c'])
+        self.assertEqual(
+            names(broker.get_objects_in_range('a', 'e', 2, marker='c')),
+            ['d', 'e'])
+
+        rows = broker.get_objects_in_range('', 'c', 10)
+        # an update made after the rows were read survives their removal
+        broker.put_object('b', ts.next(), 1, 'text/plain', 'etag')
+        broker._commit_puts_stale_ok()
+        broker.remove_objects(rows)
+        self.assertEqual(names(broker.get_objects_in_range('', '', 10)),
+                         ['b', 'd', 'e', 'f'])
+        self.assertEqual(broker.get_info()['object_count'], 4)
+
+    def test_find_shard_bounds(self):
+        ts = (Timestamp(t).internal for t in itertools.count(int(time())))
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(ts.next(), 0)
+        self.assertEqual(broker.find_shard_bounds(2), [('', '')])
+        for name in 'abcde':
+            broker.put_object(name, ts.next(), 0, 'text/plain', 'etag')
+        self.assertEqual(broker.find_shard_bounds(2),
+                         [('', 'b'), ('b', 'd'), ('d', '')])
+        broker.put_object('f', ts.next(), 0, 'text/plain', 'etag')
+        self.assertEqual(broker.find_shard_bounds(2),
+                         [('', 'b'), ('b', 'd'), ('d', '')])
+        self.assertEqual(broker.find_shard_bounds(3), [('', 'c'), ('c', '')])
+        self.assertEqual(broker.find_shard_bounds(6), [('', '')])
+
+    def test_get_range_digests(self):
+        ts = (Timestamp(t).internal for t in itertools.count(int(time())))
+        brokers = []
+        for i in range(2):
+            broker = ContainerBroker(':memory:', account='a', container='c')
+            broker.initialize(Timestamp(1).internal, 0)
+            brokers.append(broker)
+        for name in 'abcdef':
+            timestamp = ts.next()
+            for broker in brokers:
+                broker.put_object(name, timestamp, 0, 'text/plain', 'etag')
+        ranges = [('', 'b'), ('b', 'd'), ('d', '')]
+        digests = brokers[0].get_range_digests(ranges)
+        self.assertEqual([count for count, _digest in digests], [2, 2, 2])
+        self.assertEqual(brokers[1].get_range_digests(ranges), digests)
+        # the whole range's digest is the DB's hash
+        self.assertEqual(brokers[0].get_range_digests([('', '')]),
+                         [(6, brokers[0].get_replication_info()['hash'])])
+        # deleted rows count too
+        brokers[1].delete_object('c', ts.next())
+        other_digests = brokers[1].get_range_digests(ranges)
+        self.assertEqual(other_digests[0], digests[0])
+        self.assertNotEqual(other_digests[1], digests[1])
+        self.assertEqual(other_digests[1][0], 2)
+        self.assertEqual(other_digests[2], digests[2])
+        self.assertEqual(brokers[0].get_range_digests([('f', '')]),
+                         [(0, '0' * 32)])
+
+    def test_split_range(self):
+        ts = (Timestamp(t).internal for t in itertools.count(int(time())))
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(ts.next(), 0)
+        self.assertEqual(broker.split_range('', '', 4), [('', '')])
+        for name in 'abcdefgh':
+            broker.put_object(name, ts.next(), 0, 'text/plain', 'etag')
+        broker.delete_object('d', ts.next())
+        self.assertEqual(broker.split_range('', '', 4),
+                         [('', 'b'), ('b', 'd'), ('d', 'f'), ('f', '')])
+        self.assertEqual(broker.split_range('', '', 3),
+                         [('', 'c'), ('c', 'f'), ('f', '')])
+        self.assertEqual(broker.split_range('b', 'f', 2),
+                         [('b', 'd'), ('d', 'f')])
+        self.assertEqual(broker.split_range('b', 'd', 4),
+                         [('b', 'c'), ('c', 'd')])
+        self.assertEqual(broker.split_range('g', 'h', 4), [('g', 'h')])
+
 
 class TestCommonContainerBroker(TestExampleBroker):
 
@@ -1909,3 +2216,70 @@ class TestContainerBrokerBeforeSPI(ContainerBrokerMigrationMixin,
         info = broker.get_info()
         self.assertEqual(info['object_count'], 1)
         self.assertEqual(info['bytes_used'], 456)
+
+
+_imported_create_object_table = ContainerBroker.create_object_table
+
+
+def premergeindex_create_object_table(self, conn, *args, **kwargs):
+    _imported_create_object_table(self, conn, *args, **kwargs)
+    conn.execute('DROP INDEX ix_object_name_policy')
+
+
+class TestContainerBrokerBeforeMergeIndex(TestContainerBroker):
+    """
+    Tests for ContainerBroker against databases created
+    before the ix_object_name_policy index was added.
+    """
+
+    def setUp(self):
+        ContainerBroker.create_object_table = \
+            premergeindex_create_object_table
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(Timestamp('1').internal, 0)
+        with broker.get() as conn:
+            self.assertEqual(broker.get_db_version(conn), 1)
+
+    def tearDown(self):
+        ContainerBroker.create_object_table = _imported_create_object_table
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(Timestamp('1').internal, 0)
+        with broker.get() as conn:
+            self.assertEqual(broker.get_db_version(conn), 2)
+
+    @with_tempdir
+    def test_add_merge_index(self, tempdir):
+        db_path = os.path.join(tempdir, 'container.db')
+        broker = ContainerBroker(db_path, account='a', container='c')
+        broker.initialize(Timestamp('1').internal, 0)
+        broker.put_object('a', Timestamp(2).internal, 0,
+                          'text/plain', 'etag')
+        with broker.get() as conn:
+            self.assertEqual(broker.get_db_version(conn), 1)
+        broker.add_merge_index()
+        with broker.get() as conn:
+            self.assertEqual(broker.get_db_version(conn), 2)
+        # and it's safe to repeat
+        broker.add_merge_index()
+        broker = ContainerBroker(db_path, account='a', container='c')
+        with broker.get() as conn:
+            self.assertEqual(broker.get_db_version(conn), 2)
+        broker.merge_items([{'name': 'a', 'created_at': Timestamp(3).internal,
+                             'size': 3, 'content_type': 'text/plain',
+                             'etag': 'etag', 'deleted': 0,
+                             'storage_policy_index': 0}])
+        self.assertEqual(broker.get_info()['bytes_used'], 3)
+
+    @with_tempdir
+    def test_add_merge_index_before_spi(self, tempdir):
+        db_path = os.path.join(tempdir, 'container.db')
+        with TestContainerBrokerBeforeSPI.old_broker() as old_broker:
+            broker = old_broker(db_path, account='a', container='c')
+            broker.initialize(Timestamp('1').internal, 0)
+            with broker.get() as conn:
+                self.assertEqual(broker.get_db_version(conn), 1)
+        broker = ContainerBroker(db_path, account='a', container='c')
+        broker.add_merge_index()
+        with broker.get() as conn:
+            self.assertEqual(broker.get_db_version(conn), 2)
+            conn.execute('SELECT storage_policy_index FROM object')
@@ -26,8 +26,9 @@ from swift.common import db_replicator
 from swift.container import replicator, backend, server
 from swift.container.reconciler import (
     MISPLACED_OBJECTS_ACCOUNT, get_reconciler_container_name)
-from swift.common.utils import Timestamp
+from swift.common.utils import Timestamp, ShardRange
 from swift.common.storage_policy import POLICIES
+from swift.common.swob import HTTPServerError
 
 from test.unit.common import test_db_replicator
 from test.unit import patch_policies
@@ -307,6 +308,68 @@ class TestReplicatorSync(test_db_replicator.TestReplicatorSync):
                              "mismatch remote %s %r != %r" % (
                                  k, remote_info[k], v))
 
+    def _make_unsynced_replicas(self, container, missing):
+        ts = (Timestamp(t).internal for t in itertools.count(int(time.time())))
+        put_timestamp = ts.next()
+        broker = self._get_broker('a', container, node_index=0)
+        broker.initialize(put_timestamp, POLICIES.default.idx)
+        remote_broker = self._get_broker('a', container, node_index=1)
+        remote_broker.initialize(put_timestamp, POLICIES.default.idx)
+        # both replicas got the same rows, but never synced with each other
+        for i in range(40):
+            timestamp = ts.next()
+            for db in (broker, remote_broker):
+                db.put_object('o_%02d' % i, timestamp, 0, 'content-type',
+                              'etag', storage_policy_index=0)
+        # and a few rows didn't make it to the remote
+        for name in missing:
+            broker.put_object(name, ts.next(), 0, 'content-type', 'etag',
+                              storage_policy_index=0)
+        return broker, remote_broker
+
+    def test_sync_range_digests(self):
+        broker, remote_broker = self._make_unsynced_replicas(
+            'c', ('o_05', 'o_31x', 'o_32'))
+        calls = []
+
+        def capture(op, *args):
+            calls.append((op, args))
+        FakeReplConnection = test_db_replicator.attach_fake_replication_rpc(
+            self.rpc, replicate_hook=capture)
+        db_replicator.ReplConnection = FakeReplConnection
+        daemon = replicator.ContainerReplicator({
+            'per_diff': '4', 'max_diffs': '2', 'digest_sync_fanout': '4'})
+        part, node = self._get_broker_part_node(remote_broker)
+        info = broker.get_replication_info()
+        self.assertTrue(daemon._repl_to_node(node, broker, part, info))
+        self.assertEqual(1, daemon.stats['digest_sync'])
+        self.assertEqual(0, daemon.stats['diff_capped'])
+        # only the rows of the differing ranges were sent
+        sent = [item['name'] for op, args in calls if op == 'merge_items'
+                for item in args[0]]
+        self.assertEqual(sorted(sent), ['o_04', 'o_05', 'o_31x', 'o_32'])
+        self.assertEqual(remote_broker.get_info()['hash'], info['hash'])
+        # the replicas are in sync now
+        calls[:] = []
+        info = broker.get_replication_info()
+        self.assertTrue(daemon._repl_to_node(node, broker, part, info))
+        self.assertEqual(['sync'], [op for op, args in calls])
+        self.assertEqual(1, daemon.stats['no_change'])
+
+    def test_sync_range_digests_unsupported(self):
+        broker, remote_broker = self._make_unsynced_replicas('c', ('o_05',))
+        daemon = replicator.ContainerReplicator({
+            'per_diff': '4', 'max_diffs': '2', 'digest_sync_fanout': '4'})
+        part, node = self._get_broker_part_node(remote_broker)
+        info = broker.get_replication_info()
+        with mock.patch.object(self.rpc, 'range_digests',
+                               return_value=HTTPServerError()):
+            self.assertFalse(daemon._repl_to_node(node, broker, part, info))
+        # fell back to sending rows since the last sync point
+        self.assertEqual(1, daemon.stats['digest_sync'])
+        self.assertEqual(1, daemon.stats['diff'])
+        self.assertEqual(1, daemon.stats['diff_capped'])
+
     def test_sync_status_change(self):
         # setup a local container
         broker = self._get_broker('a', 'c', node_index=0)
@@ -398,6 +461,27 @@ class TestReplicatorSync(test_db_replicator.TestReplicatorSync):
         self.assertEqual(remote_put_timestamp,
                          remote_broker.get_info()['put_timestamp'])
 
+    def test_sync_shard_ranges(self):
+        ts = (Timestamp(t).internal for t in
+              itertools.count(int(time.time())))
+        broker = self._get_broker('a', 'c', node_index=0)
+        broker.initialize(ts.next(), POLICIES.default.idx)
+        remote_broker = self._get_broker('a', 'c', node_index=1)
+        remote_broker.initialize(ts.next(), POLICIES.default.idx)
+        daemon = replicator.ContainerReplicator({})
+        part, node = self._get_broker_part_node(remote_broker)
+        info = broker.get_replication_info()
+        self.assertTrue(daemon._repl_to_node(node, broker, part, info))
+        self.assertEqual(remote_broker.get_shard_ranges(), [])
+
+        created_at = ts.next()
+        shard_ranges = [ShardRange('c-1', created_at, '', 'm'),
+                        ShardRange('c-2', created_at, 'm', '')]
+        broker.merge_shard_ranges(shard_ranges)
+        info = broker.get_replication_info()
+        self.assertTrue(daemon._repl_to_node(node, broker, part, info))
+        self.assertEqual(remote_broker.get_shard_ranges(), shard_ranges)
+
     def test_sync_bogus_db_quarantines(self):
         ts = (Timestamp(t).internal for t in
               itertools.count(int(time.time())))
@@ -943,6 +1027,15 @@ class TestReplicatorSync(test_db_replicator.TestReplicatorSync):
             daemon._post_replicate_hook(broker, info, [])
         self.assertEqual(0, len(calls))
 
+    def test_post_replicate_hook_adds_merge_index(self):
+        broker = self._get_broker('a', 'c', node_index=0)
+        broker.initialize(Timestamp(1).internal, 0)
+        info = broker.get_replication_info()
+        daemon = replicator.ContainerReplicator({})
+        with mock.patch.object(broker, 'add_merge_index') as mock_add:
+            daemon._post_replicate_hook(broker, info, [])
+        mock_add.assert_called_once_with()
+
 
 if __name__ == '__main__':
     unittest.main()
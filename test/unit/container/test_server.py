@@ -15,6 +15,7 @@
 
 import operator
 import os
+import signal
 import mock
 import unittest
 import itertools
@@ -28,7 +29,8 @@ from xml.dom import minidom
 import time
 import random
 
-from eventlet import spawn, Timeout, listen
+from eventlet import spawn, sleep, Timeout, listen
+from eventlet.event import Event
 import simplejson
 
 from swift.common.swob import Request, HeaderKeyDict
@@ -36,9 +38,11 @@ import swift.container
 from swift.container import server as container_server
 from swift.common import constraints
 from swift.common.utils import (Timestamp, mkdirs, public, replication,
-                                lock_parent_directory, json)
+                                lock_parent_directory, json, ShardRange)
 from test.unit import fake_http_connect
 from swift.common.storage_policy import (POLICIES, StoragePolicy)
+from swift.common.db import pop_db_changes
+from swift.common.exceptions import LockTimeout
 from swift.common.request_helpers import get_sys_meta_prefix
 
 from test.unit import patch_policies
@@ -1348,6 +1352,87 @@ class TestContainerController(unittest.TestCase):
         resp = req.get_response(self.controller)
         self.assertEquals(resp.status_int, 404)
 
+    def test_buffered_object_updates(self):
+        with mock.patch('swift.container.server.atexit') as mock_atexit, \
+                mock.patch('signal.signal') as mock_signal:
+            self.controller = container_server.ContainerController(
+                {'devices': self.testdir, 'mount_check': 'false',
+                 'buffer_updates': 'true', 'buffer_updates_rows': '3'},
+                logger=FakeLogger())
+        update_buffer = self.controller.update_buffer
+        mock_atexit.register.assert_called_once_with(update_buffer.close)
+        self.assertEqual(mock_signal.call_args_list, [
+            mock.call(signal.SIGTERM, update_buffer.exit_on_signal),
+            mock.call(signal.SIGHUP, update_buffer.exit_on_signal)])
+        ts = (Timestamp(t).internal for t in itertools.count(1))
+        req = Request.blank('/sda1/p/a/c', method='PUT', headers={
+            'X-Timestamp': ts.next()})
+        self.assertEqual(req.get_response(self.controller).status_int, 201)
+        broker = self.controller._get_container_broker('sda1', 'p', 'a', 'c')
+
+        def put_object(name):
+            req = Request.blank(
+                '/sda1/p/a/c/%s' % name, method='PUT', headers={
+                    'X-Timestamp': ts.next(), 'X-Size': 1,
+                    'X-Content-Type': 'text/plain', 'X-Etag': 'x'})
+            self._update_object_put_headers(req)
+            self.assertEqual(req.get_response(self.controller).status_int,
+                             201)
+
+        with mock.patch('swift.container.server.spawn') as mock_spawn:
+            put_object('o1')
+            put_object('o2')
+            self.assertFalse(os.path.exists(broker.pending_file))
+            self.assertEqual(update_buffer.total_rows, 2)
+            self.assertEqual(mock_spawn.call_count, 1)
+            # reads see this worker's writes
+            req = Request.blank('/sda1/p/a/c', method='HEAD')
+            resp = req.get_response(self.controller)
+            self.assertEqual(resp.headers['X-Container-Object-Count'], '2')
+            self.assertEqual(update_buffer.total_rows, 0)
+            # a full buffer is flushed
+            for name in ('o3', 'o4', 'o5'):
+                put_object(name)
+        self.assertEqual(update_buffer.total_rows, 0)
+        self.assertEqual(broker.get_info()['object_count'], 5)
+        logger = self.controller.logger
+        self.assertEqual(
+            logger.get_increment_counts(), {})
+        self.assertEqual(
+            [call[0][:2] for call in logger.log_dict['update_stats']],
+            [('update_buffer.flush.rows', 2),
+             ('update_buffer.flush.rows', 3)])
+        self.assertEqual(
+            sorted(set(call[0][0] for call in logger.log_dict['timing_since']
+                       if call[0][0].startswith('update_buffer'))),
+            ['update_buffer.flush.delay', 'update_buffer.flush.timing'])
+
+    def test_change_log(self):
+        datadir = os.path.join(self.testdir, 'sda1', container_server.DATADIR)
+        mkdirs(datadir)
+        # only started logs are recorded in
+        self.assertEqual(pop_db_changes(datadir, 'replicator'), None)
+        ts = (Timestamp(t).internal for t in itertools.count(1))
+        req = Request.blank('/sda1/p/a/c', method='PUT', headers={
+            'X-Timestamp': ts.next()})
+        self.assertEqual(req.get_response(self.controller).status_int, 201)
+        broker = self.controller._get_container_broker('sda1', 'p', 'a', 'c')
+        self.assertEqual(pop_db_changes(datadir, 'replicator'),
+                         [('p', broker.db_file)])
+        self.assertEqual(pop_db_changes(datadir, 'updater'), None)
+        req = Request.blank('/sda1/p/a/c/o', method='PUT', headers={
+            'X-Timestamp': ts.next(), 'X-Size': 1,
+            'X-Content-Type': 'text/plain', 'X-Etag': 'x'})
+        self._update_object_put_headers(req)
+        self.assertEqual(req.get_response(self.controller).status_int, 201)
+        for reader in ('replicator', 'updater'):
+            self.assertEqual(pop_db_changes(datadir, reader),
+                             [('p', broker.db_file)])
+        # reads aren't changes
+        req = Request.blank('/sda1/p/a/c', method='GET')
+        self.assertEqual(req.get_response(self.controller).status_int, 200)
+        self.assertEqual(pop_db_changes(datadir, 'replicator'), [])
+
     def test_object_update_with_offset(self):
         ts = (Timestamp(t).internal for t in
               itertools.count(int(time.time())))
@@ -1594,6 +1679,114 @@ class TestContainerController(unittest.TestCase):
         resp = req.get_response(self.controller)
         self.assertEquals(resp.status_int, 412)
 
+    def test_PUT_GET_shard_ranges(self):
+        req = Request.blank(
+            '/sda1/p/a/c', environ={'REQUEST_METHOD': 'PUT',
+                                    'HTTP_X_TIMESTAMP': '0'})
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 201)
+        req = Request.blank(
+            '/sda1/p/a/c/o', environ={
+                'REQUEST_METHOD': 'PUT', 'HTTP_X_TIMESTAMP': '1',
+                'HTTP_X_CONTENT_TYPE': 'text/plain', 'HTTP_X_ETAG': 'x',
+                'HTTP_X_SIZE': 0})
+        self._update_object_put_headers(req)
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 201)
+
+        # not sharded: auto lists objects
+        req = Request.blank(
+            '/sda1/p/a/c?format=json', environ={'REQUEST_METHOD': 'GET'},
+            headers={'X-Backend-Record-Type': 'auto'})
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals([item['name'] for item in
+                           simplejson.loads(resp.body)], ['o'])
+        self.assertFalse('X-Backend-Record-Type' in resp.headers)
+        self.assertFalse('X-Backend-Sharded' in resp.headers)
+
+        shard_ranges = [ShardRange('c-1', '2', '', 'm', 3, 30, '2'),
+                        ShardRange('c-2', '2', 'm', '')]
+        for body in ('garbage', '[{"lower": "m"}]'):
+            req = Request.blank(
+                '/sda1/p/a/c', environ={'REQUEST_METHOD': 'PUT'},
+                headers={'X-Timestamp': '3', 'X-Backend-Record-Type': 'shard'},
+                body=body)
+            resp = req.get_response(self.controller)
+            self.assertEquals(resp.status_int, 400)
+        req = Request.blank(
+            '/sda1/p/a/c', environ={'REQUEST_METHOD': 'PUT'},
+            headers={'X-Timestamp': '3', 'X-Backend-Record-Type': 'shard'},
+            body=simplejson.dumps([shard_range.as_dict()
+                                   for shard_range in shard_ranges]))
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 202)
+        req = Request.blank(
+            '/sda1/p/a/missing', environ={'REQUEST_METHOD': 'PUT'},
+            headers={'X-Timestamp': '3', 'X-Backend-Record-Type': 'shard'},
+            body='[]')
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 404)
+
+        req = Request.blank('/sda1/p/a/c', environ={'REQUEST_METHOD': 'HEAD'})
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.headers['X-Backend-Sharded'], 'true')
+        # the shards' usage counts once the sharder has counted the rows
+        # the root still holds in their ranges
+        self.assertEquals(resp.headers['X-Container-Object-Count'], '1')
+        self.controller._get_container_broker(
+            'sda1', 'p', 'a', 'c').update_uncleaved_usage()
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.headers['X-Container-Object-Count'], '4')
+
+        for record_type in ('auto', 'shard'):
+            req = Request.blank(
+                '/sda1/p/a/c', environ={'REQUEST_METHOD': 'GET'},
+                headers={'X-Backend-Record-Type': record_type})
+            resp = req.get_response(self.controller)
+            self.assertEquals(resp.status_int, 200)
+            self.assertEquals(resp.content_type, 'application/json')
+            self.assertEquals(resp.headers['X-Backend-Record-Type'], 'shard')
+            self.assertEquals(
+                resp.headers['X-Backend-Uncleaved-Objects'], '1')
+            self.assertEquals(
+                [ShardRange.from_dict(data)
+                 for data in simplejson.loads(resp.body)], shard_ranges)
+        # without the header, the objects still in the root are listed
+        req = Request.blank('/sda1/p/a/c', environ={'REQUEST_METHOD': 'GET'})
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.body, 'o\n')
+        self.assertEquals(resp.headers['X-Backend-Sharded'], 'true')
+
+    def test_GET_streamed(self):
+        req = Request.blank(
+            '/sda1/p/a/c', method='PUT', headers={'X-Timestamp': '0'})
+        self.assertEqual(req.get_response(self.controller).status_int, 201)
+        for name in ('a', 'b/1', 'b/2', 'c'):
+            req = Request.blank(
+                '/sda1/p/a/c/%s' % name, method='PUT', headers={
+                    'X-Timestamp': '1', 'X-Content-Type': 'text/plain',
+                    'X-Etag': 'x', 'X-Size': 0})
+            self._update_object_put_headers(req)
+            self.assertEqual(req.get_response(self.controller).status_int,
+                             201)
+        for query in ('', '?delimiter=/', '?prefix=b/'):
+            for fmt in ('plain', 'json', 'xml'):
+                path = '/sda1/p/a/c%s' % (query or '?') + '&format=' + fmt
+                expected = Request.blank(path).get_response(
+                    self.controller).body
+                self.assertTrue(expected)
+                with mock.patch('swift.common.db.LISTING_BATCH_SIZE', 1), \
+                        mock.patch('swift.common.request_helpers.'
+                                   'LISTING_CHUNK_SIZE', 1):
+                    resp = Request.blank(path).get_response(self.controller)
+                    self.assertEqual(resp.content_length, None)
+                    self.assertEqual(resp.body, expected)
+        resp = Request.blank('/sda1/p/a/c?prefix=b/&format=json').get_response(
+            self.controller)
+        self.assertEqual([obj['name'] for obj in json.loads(resp.body)],
+                         ['b/1', 'b/2'])
+
     def test_GET_json(self):
         # make a container
         req = Request.blank(
@@ -2551,6 +2744,101 @@ class TestContainerController(unittest.TestCase):
              '404 - "-" "-" "-" 2.0000 "-" 1234',), {})])
 
 
+class TestUpdateBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = FakeLogger()
+        self.update_buffer = container_server.UpdateBuffer(
+            self.logger, max_rows=10, interval=0.01, max_total_rows=4)
+
+    def _broker(self, db_file):
+        return mock.MagicMock(db_file=db_file)
+
+    def _lock_timeout(self, *args):
+        err = LockTimeout(0.1, args[0])
+        # only raised here, never scheduled
+        err.cancel()
+        raise err
+
+    def test_flushed_after_interval(self):
+        broker = self._broker('1.db')
+        self.update_buffer.put(broker, {'name': 'o1'})
+        self.update_buffer.put(broker, {'name': 'o2'})
+        self.assertFalse(broker.put_records.called)
+        self.update_buffer.flusher.wait()
+        broker.put_records.assert_called_once_with(
+            [{'name': 'o1'}, {'name': 'o2'}])
+        self.assertEqual(self.update_buffer.buffers, {})
+        self.assertEqual(self.update_buffer.flusher, None)
+
+    def test_lock_timeout_keeps_rows(self):
+        broker = self._broker('1.db')
+        broker.put_records.side_effect = self._lock_timeout
+        self.update_buffer.put(broker, {'name': 'o1'})
+        self.update_buffer.flush('1.db')
+        self.assertEqual(self.update_buffer.total_rows, 1)
+        self.assertEqual(self.logger.get_increment_counts(),
+                         {'update_buffer.flush.errors': 1})
+        broker.put_records.side_effect = None
+        self.update_buffer.put(broker, {'name': 'o2'})
+        self.update_buffer.flush_all()
+        self.assertEqual(broker.put_records.call_args[0][0],
+                         [{'name': 'o1'}, {'name': 'o2'}])
+        self.assertEqual(self.update_buffer.total_rows, 0)
+
+    def test_close_writes_interrupted_flushes(self):
+        broker = self._broker('1.db')
+        other_broker = self._broker('2.db')
+        locked = Event()
+        broker.put_records.side_effect = lambda records: locked.wait()
+        self.update_buffer.put(broker, {'name': 'o1'})
+        self.update_buffer.put(other_broker, {'name': 'o2'})
+        # the worker is told to exit while a flush waits for the lock
+        flush = spawn(self.update_buffer.flush, '1.db')
+        sleep()
+        self.assertEqual(self.update_buffer.buffers.keys(), ['2.db'])
+        broker.put_records.side_effect = None
+        self.update_buffer.close()
+        self.assertEqual(broker.put_records.call_args_list,
+                         [mock.call([{'name': 'o1'}])] * 2)
+        other_broker.put_records.assert_called_once_with([{'name': 'o2'}])
+        self.assertEqual(self.update_buffer.flushing, {})
+        self.assertEqual(self.update_buffer.total_rows, 0)
+        flush.kill()
+        self.update_buffer.flusher.kill()
+
+    def test_exit_on_signal(self):
+        broker = self._broker('1.db')
+        self.update_buffer.put(broker, {'name': 'o1'})
+        with mock.patch('os._exit') as mock_exit:
+            self.update_buffer.exit_on_signal(signal.SIGTERM, None)
+        broker.put_records.assert_called_once_with([{'name': 'o1'}])
+        mock_exit.assert_called_once_with(0)
+
+        # the worker exits even if the rows can't be written
+        broker.put_records.side_effect = Exception('oops')
+        self.update_buffer.put(broker, {'name': 'o2'})
+        with mock.patch('os._exit') as mock_exit, \
+                mock.patch.object(self.update_buffer, 'flush_all',
+                                  side_effect=Exception('oops')):
+            self.assertRaises(Exception, self.update_buffer.exit_on_signal,
+                              signal.SIGTERM, None)
+        mock_exit.assert_called_once_with(0)
+        self.update_buffer.flusher.kill()
+
+    def test_max_total_rows(self):
+        brokers = [self._broker('%d.db' % i) for i in range(5)]
+        for broker in brokers[:4]:
+            broker.put_records.side_effect = self._lock_timeout
+            self.update_buffer.put(broker, {'name': 'o'})
+        # buffers that can't be flushed don't grow any further
+        self.update_buffer.put(brokers[4], {'name': 'o'})
+        brokers[4].put_record.assert_called_once_with({'name': 'o'})
+        self.assertEqual(self.update_buffer.total_rows, 4)
+        self.assertFalse('4.db' in self.update_buffer.buffers)
+        self.update_buffer.flusher.kill()
+
+
 @patch_policies([
     StoragePolicy(0, 'legacy'),
     StoragePolicy(1, 'one'),
@@ -0,0 +1,186 @@
+# Copyright (c) 2010-2014 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import itertools
+import unittest
+
+import mock
+
+from swift.container import backend, server, sharder
+from swift.common.utils import Timestamp, ShardRange, json, shards_account
+from swift.common.storage_policy import POLICIES
+from test.unit.common import test_db_replicator
+
+
+class TestSharder(test_db_replicator.TestReplicatorSync):
+
+    backend = backend.ContainerBroker
+    datadir = server.DATADIR
+    replicator_daemon = sharder.ContainerSharder
+    replicator_rpc = server.ContainerReplicatorRpc
+
+    def setUp(self):
+        super(TestSharder, self).setUp()
+        self.ts = (Timestamp(t).internal for t in
+                   itertools.count(int(time.time())))
+        self.sent = []
+
+    def _fake_send(self, node, part, path, headers, body):
+        # stand in for the container server on node
+        self.sent.append((node['device'], path, json.loads(body)))
+        account, container = path.split('/')[1:]
+        broker = self._get_broker(account, container, node_index=node['id'])
+        if not os.path.exists(broker.db_file):
+            return False
+        broker.merge_shard_ranges([ShardRange.from_dict(data)
+                                   for data in json.loads(body)])
+        return True
+
+    def _patch_send(self):
+        return mock.patch.object(sharder.ContainerSharder,
+                                 '_send_shard_ranges_to_node',
+                                 self._fake_send)
+
+    def _run_once(self, node, conf_updates=None, daemon=None):
+        with self._patch_send():
+            return super(TestSharder, self)._run_once(
+                node, conf_updates=conf_updates, daemon=daemon)
+
+    def _make_root(self, names):
+        brokers = []
+        for node_index in range(3):
+            broker = self._get_broker('a', 'c', node_index=node_index)
+            broker.initialize('1', POLICIES.default.idx)
+            for name in names:
+                broker.put_object(name, self.ts.next(), 1, 'text/plain',
+                                  'etag')
+            brokers.append(broker)
+        return brokers
+
+    def _shard_brokers(self, shard_range, node_index):
+        return self._get_broker(shards_account('a'), shard_range.name,
+                                node_index=node_index)
+
+    def test_small_container_not_sharded(self):
+        brokers = self._make_root('abcde')
+        daemon = self._run_once(self._ring.devs[0],
+                                {'shard_container_size': '5'})
+        self.assertFalse(brokers[0].is_sharded())
+        self.assertEqual(daemon.shard_stats['sharded'], 0)
+        self.assertEqual(self.sent, [])
+
+    def test_shard_and_cleave(self):
+        brokers = self._make_root('abcde')
+        # only the leader chooses the shard ranges
+        daemon = self._run_once(self._ring.devs[1],
+                                {'shard_container_size': '4'})
+        self.assertEqual(daemon.shard_stats['sharded'], 0)
+        self.assertFalse(brokers[1].is_sharded())
+
+        daemon = self._run_once(self._ring.devs[0],
+                                {'shard_container_size': '4'})
+        self.assertEqual(daemon.shard_stats['sharded'], 1)
+        self.assertEqual(daemon.shard_stats['cleaved'], 5)
+        shard_ranges = brokers[0].get_shard_ranges()
+        self.assertEqual([(sr.lower, sr.upper) for sr in shard_ranges],
+                         [('', 'b'), ('b', 'd'), ('d', '')])
+        for broker in brokers:
+            self.assertEqual(broker.get_shard_ranges(), shard_ranges)
+        # the leader's copy of the root has been cleaved...
+        self.assertEqual(brokers[0].get_objects_in_range('', '', 10), [])
+        # ...into shards replicated out to their primary nodes
+        for node_index in range(3):
+            for shard_range, names in zip(shard_ranges,
+                                          (['a', 'b'], ['c', 'd'], ['e'])):
+                shard_broker = self._shard_brokers(shard_range, node_index)
+                self.assertEqual(
+                    [row['name'] for row in
+                     shard_broker.get_objects_in_range('', '', 10)], names)
+                metadata = shard_broker.metadata
+                self.assertEqual(metadata[sharder.SHARD_ROOT_HEADER][0],
+                                 'a/c')
+                self.assertEqual(metadata[sharder.SHARD_UPPER_HEADER][0],
+                                 shard_range.upper)
+
+        # the other nodes cleave their own copies
+        daemon = self._run_once(self._ring.devs[1],
+                                {'shard_container_size': '4'})
+        self.assertEqual(daemon.shard_stats['cleaved'], 5)
+        self.assertEqual(brokers[1].get_objects_in_range('', '', 10), [])
+
+    def test_cleave_needs_quorum(self):
+        brokers = self._make_root('abcde')
+        with mock.patch.object(sharder.ContainerSharder, '_repl_to_node',
+                               return_value=False):
+            daemon = self._run_once(self._ring.devs[0],
+                                    {'shard_container_size': '4'})
+        self.assertEqual(daemon.shard_stats['sharded'], 1)
+        self.assertEqual(daemon.shard_stats['cleaved'], 0)
+        self.assertEqual(daemon.shard_stats['errors'], 3)
+        # the rows stay in the root until its shards have them
+        self.assertEqual(
+            [row['name'] for row in
+             brokers[0].get_objects_in_range('', '', 10)], list('abcde'))
+        self.assertEqual(brokers[0].get_info()['object_count'], 5)
+
+        # one other primary is enough
+        def fake_repl_to_node(daemon, node, *args):
+            return node['id'] == 1
+
+        with mock.patch.object(sharder.ContainerSharder, '_repl_to_node',
+                               fake_repl_to_node):
+            daemon = self._run_once(self._ring.devs[0],
+                                    {'shard_container_size': '4'})
+        self.assertEqual(daemon.shard_stats['cleaved'], 5)
+        self.assertEqual(daemon.shard_stats['errors'], 0)
+        self.assertEqual(brokers[0].get_objects_in_range('', '', 10), [])
+
+    def test_report(self):
+        brokers = self._make_root('abcde')
+        daemon = self._run_once(self._ring.devs[0],
+                                {'shard_container_size': '4'})
+        shard_ranges = brokers[0].get_shard_ranges()
+        self.sent = []
+        daemon._zero_shard_stats()
+        with self._patch_send():
+            for shard_range in shard_ranges:
+                shard_broker = self._shard_brokers(shard_range, 0)
+                daemon._process_broker('0', shard_broker.db_file, 0)
+        self.assertEqual(daemon.shard_stats['reported'], 3)
+        self.assertEqual(len(self.sent), 9)
+        self.assertEqual(
+            [(sr.object_count, sr.bytes_used)
+             for sr in brokers[1].get_shard_ranges()],
+            [(2, 2), (2, 2), (1, 1)])
+        info = brokers[1].get_info()
+        # nothing cleaved from this copy of the root yet, and its rows
+        # aren't counted twice
+        self.assertEqual(info['object_count'], 5)
+        info = brokers[0].get_info()
+        self.assertEqual(info['object_count'], 5)
+        self.assertEqual(info['bytes_used'], 5)
+
+        # only a shard's leader reports
+        self.sent = []
+        shard_broker = self._shard_brokers(shard_ranges[0], 1)
+        with self._patch_send():
+            daemon._process_broker('0', shard_broker.db_file, 1)
+        self.assertEqual(self.sent, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
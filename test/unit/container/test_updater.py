@@ -28,6 +28,7 @@ from eventlet import spawn, Timeout, listen
 from swift.common import utils
 from swift.container import updater as container_updater
 from swift.container.backend import ContainerBroker, DATADIR
+from swift.common.db import DBChangeLog
 from swift.common.ring import RingData
 from swift.common.utils import normalize_timestamp
 
@@ -74,6 +75,46 @@ class TestContainerUpdater(unittest.TestCase):
         self.assertEquals(cu.node_timeout, 5)
         self.assert_(cu.get_account_ring() is not None)
 
+    def test_get_paths_changed(self):
+        cu = container_updater.ContainerUpdater({
+            'devices': self.devices_dir,
+            'mount_check': 'false',
+            'swift_dir': self.testdir,
+            'full_sweep_interval': '3600',
+        })
+        containers_dir = os.path.join(self.sda1, DATADIR)
+        brokers = []
+        for part in ('1', '2'):
+            cb = ContainerBroker(
+                os.path.join(containers_dir, part, 'ash', 'hash' + part,
+                             'hash%s.db' % part), account='a',
+                container='c' + part)
+            cb.initialize(normalize_timestamp(1), 0)
+            brokers.append(cb)
+        change_log = DBChangeLog(('updater',), FakeLogger())
+        self.assertEqual(sorted(cu.get_paths()),
+                         [os.path.join(containers_dir, '1'),
+                          os.path.join(containers_dir, '2')])
+        self.assertEqual(cu.get_paths(), [])
+        change_log.record(brokers[1].db_file)
+        self.assertEqual(cu.get_paths(), [os.path.join(containers_dir, '2')])
+        # a full sweep visits the changed partitions first
+        change_log.record(brokers[1].db_file)
+        cu._last_full_sweep -= 3600
+        self.assertEqual(cu.get_paths(),
+                         [os.path.join(containers_dir, '2'),
+                          os.path.join(containers_dir, '1')])
+        # a container whose update fails is visited again
+        with mock.patch.object(cu, 'container_report', return_value=500):
+            cu.process_container(brokers[0].db_file)
+        self.assertEqual(cu.failures, 1)
+        self.assertEqual(cu.get_paths(), [os.path.join(containers_dir, '1')])
+        # as is one skipped while its account's updates are suppressed
+        cu.process_container(brokers[0].db_file)
+        self.assertEqual(cu.failures, 1)
+        self.assertEqual(cu.get_paths(), [os.path.join(containers_dir, '1')])
+        self.assertEqual(cu.get_paths(), [])
+
     def test_run_once(self):
         cu = container_updater.ContainerUpdater({
             'devices': self.devices_dir,
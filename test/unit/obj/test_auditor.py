@@ -307,6 +307,128 @@ class TestAuditor(unittest.TestCase):
         self.assertEquals(auditor_worker.stats_buckets[10240], 0)
         self.assertEquals(auditor_worker.stats_buckets['OVER'], 1)
 
+    def test_object_run_incremental(self):
+        self.conf['incremental'] = 'yes'
+        self.conf['reaudit_age'] = '1000'
+        timestamp = str(normalize_timestamp(time.time()))
+        data = '0' * 1024
+
+        def write_file(df):
+            with df.create() as writer:
+                writer.write(data)
+                metadata = {
+                    'ETag': md5(data).hexdigest(),
+                    'X-Timestamp': timestamp,
+                    'Content-Length': str(len(data)),
+                }
+                writer.put(metadata)
+
+        def audited(now):
+            auditor_worker = auditor.AuditorWorker(self.conf, self.logger,
+                                                   self.rcache, self.devices)
+            auditor_worker.log_time = float('inf')
+            audited = []
+            real_audit = auditor_worker.object_audit
+
+            def fake_audit(location):
+                audited.append(location.path)
+                real_audit(location)
+
+            with mock.patch.object(auditor_worker, 'object_audit',
+                                   fake_audit), \
+                    mock.patch('swift.obj.auditor.time.time',
+                               return_value=now):
+                auditor_worker.audit_all_objects()
+            self.assertEqual(len(audited),
+                             auditor_worker.total_files_processed)
+            return audited
+
+        write_file(self.disk_file)
+        write_file(self.disk_file_p1)
+        now = time.time() + 10
+        self.assertEqual(len(audited(now)), 2)
+        record = auditor.AuditRecord(os.path.join(self.devices, 'sda'),
+                                     self.logger)
+        suffix_key = os.path.relpath(
+            os.path.dirname(self.disk_file._datadir),
+            os.path.join(self.devices, 'sda'))
+        self.assertEqual(record.suffixes[suffix_key], (now, now))
+
+        # nothing changed and nothing is too old
+        self.assertEqual(audited(now + 10), [])
+        record = auditor.AuditRecord(os.path.join(self.devices, 'sda'),
+                                     self.logger)
+        self.assertEqual(record.suffixes[suffix_key], (now, now + 10))
+
+        # a new object in a suffix verified recently is audited
+        other_df = self.df_mgr.get_diskfile('sda', '0', 'a', 'c', 'o2', 0)
+        write_file(other_df)
+        os.utime(other_df._datadir, (now + 15, now + 15))
+        self.assertEqual(audited(now + 20), [other_df._datadir])
+
+        # as is an old object rewritten since it was verified
+        os.utime(self.disk_file._datadir, (now + 25, now + 25))
+        self.assertEqual(audited(now + 30), [self.disk_file._datadir])
+
+        # objects are audited again when their suffix's last full
+        # verification gets too old
+        self.assertEqual(audited(now + 1000), [self.disk_file_p1._datadir])
+        self.assertEqual(sorted(audited(now + 1030)),
+                         sorted([self.disk_file._datadir, other_df._datadir]))
+        self.assertEqual(audited(now + 1040), [])
+
+        # the ZBF auditor isn't incremental
+        auditor_worker = auditor.AuditorWorker(self.conf, self.logger,
+                                               self.rcache, self.devices,
+                                               zero_byte_only_at_fps=50)
+        self.assertFalse(auditor_worker.incremental)
+
+    def test_object_run_incremental_errors(self):
+        self.conf['incremental'] = 'yes'
+        auditor_worker = auditor.AuditorWorker(self.conf, self.logger,
+                                               self.rcache, self.devices)
+        auditor_worker.log_time = float('inf')
+        with self.disk_file.create() as writer:
+            writer.put({'X-Timestamp': normalize_timestamp(time.time()),
+                        'Content-Length': '0'})
+        with mock.patch.object(auditor_worker, 'object_audit',
+                               side_effect=Exception('boom')):
+            auditor_worker.audit_all_objects()
+        self.assertEqual(auditor_worker.errors, 1)
+        # the suffix must be audited again
+        record = auditor.AuditRecord(os.path.join(self.devices, 'sda'),
+                                     self.logger)
+        self.assertEqual(record.suffixes, {})
+
+    def test_audit_record_prune(self):
+        dev_path = os.path.join(self.devices, 'sda')
+        record = auditor.AuditRecord(dev_path, self.logger)
+        record.update('objects/0/abc', 100.0, True)
+        record.update('objects/0/def', 100.0, True)
+        record.save()
+        record = auditor.AuditRecord(dev_path, self.logger)
+        self.assertEqual(sorted(record.suffixes),
+                         ['objects/0/abc', 'objects/0/def'])
+        # an incomplete visit doesn't move the full verification time
+        record.update('objects/0/abc', 200.0, False)
+        self.assertEqual(record.suffixes['objects/0/abc'], (100.0, 200.0))
+        self.assertTrue(record.is_verified('objects/0/abc', 150.0, 250.0,
+                                           200))
+        self.assertFalse(record.is_verified('objects/0/abc', 200.0, 250.0,
+                                            200))
+        self.assertFalse(record.is_verified('objects/0/abc', 150.0, 300.0,
+                                            200))
+        self.assertFalse(record.is_verified('objects/0/xyz', 0.0, 0.0, 200))
+        record.save(prune=True)
+        record = auditor.AuditRecord(dev_path, self.logger)
+        self.assertEqual(record.suffixes.keys(), ['objects/0/abc'])
+        # a corrupt record is ignored
+        with open(record.path, 'w') as fp:
+            fp.write('garbage')
+        record = auditor.AuditRecord(dev_path, self.logger)
+        self.assertEqual(record.suffixes, {})
+        self.assertEqual(len(self.logger.get_lines_for_level('warning')), 1)
+
     def test_object_run_logging(self):
         logger = FakeLogger()
         auditor_worker = auditor.AuditorWorker(self.conf, logger,
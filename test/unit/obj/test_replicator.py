@@ -15,6 +15,7 @@
 
 import unittest
 import os
+import json
 import mock
 from gzip import GzipFile
 from shutil import rmtree
@@ -671,6 +672,135 @@ class TestObjectReplicator(unittest.TestCase):
                             mock_http_connect(200)):
                 self.replicator.replicate()
 
+    def test_replicate_resumes_pass(self):
+        self.replicator.rcache = os.path.join(self.testdir, 'object.recon')
+        dev_path = os.path.join(self.devices, 'sda')
+        # a previous replicator got through some partitions before it died
+        progress = object_replicator.ReplicationProgress(
+            dev_path, self.replicator.logger)
+        progress.start_pass(time.time() - 60)
+        progress.mark_done(0, '0', time.time() - 50)
+        progress.mark_done(1, '2', time.time() - 40)
+
+        replicated = []
+
+        def fake_update(job):
+            replicated.append((int(job['policy_idx']), job['partition']))
+            return True
+
+        with mock.patch.object(self.replicator, 'update', fake_update), \
+                mock.patch.object(self.replicator, 'update_deleted',
+                                  fake_update):
+            self.replicator.replicate()
+        all_parts = set((p, part) for p in (0, 1)
+                        for part in ('0', '1', '2', '3'))
+        self.assertEqual(sorted(replicated),
+                         sorted(all_parts - set([(0, '0'), (1, '2')])))
+        self.assertFalse(os.path.exists(progress.path))
+        self.assertTrue(os.path.exists(progress.last_path))
+        with open(self.replicator.rcache) as f:
+            recon = json.load(f)
+        self.assertTrue(
+            50 <= recon['object_replication_oldest_partition_age'] < 60)
+        self.assertEqual(recon['object_replication_partition_ages'].keys(),
+                         ['sda'])
+
+        # the next pass starts from scratch
+        del replicated[:]
+        with mock.patch.object(self.replicator, 'update', fake_update), \
+                mock.patch.object(self.replicator, 'update_deleted',
+                                  fake_update):
+            self.replicator.replicate()
+        self.assertEqual(sorted(replicated), sorted(all_parts))
+
+    def test_replicate_job_failure_not_checkpointed(self):
+        progress = object_replicator.ReplicationProgress(
+            os.path.join(self.devices, 'sda'), self.replicator.logger)
+        progress.start_pass(time.time())
+        jobs = [{'delete': delete, 'policy_idx': 0, 'partition': part}
+                for delete in (False, True) for part in ('1', '2')]
+
+        def fake_update(job):
+            return job['partition'] == '1'
+
+        with mock.patch.object(self.replicator, 'update', fake_update), \
+                mock.patch.object(self.replicator, 'update_deleted',
+                                  fake_update):
+            for job in jobs[:2]:
+                self.replicator.replicate_job(job, progress)
+            self.assertTrue(progress.is_done(0, '1'))
+            self.assertFalse(progress.is_done(0, '2'))
+            progress.completed.clear()
+            for job in jobs[2:]:
+                self.replicator.replicate_job(job, progress)
+            self.assertTrue(progress.is_done(0, '1'))
+            self.assertFalse(progress.is_done(0, '2'))
+
+    def test_replicate_interrupted_pass_not_finished(self):
+        with mock.patch.object(self.replicator, 'update'), \
+                mock.patch.object(self.replicator, 'update_deleted'), \
+                mock.patch.object(self.replicator, 'check_ring',
+                                  side_effect=[True, True, False]):
+            self.replicator.replicate()
+        progress = object_replicator.ReplicationProgress(
+            os.path.join(self.devices, 'sda'), self.replicator.logger)
+        self.assertFalse(os.path.exists(progress.last_path))
+        self.assertTrue(progress.start_pass(time.time()))
+        self.assertTrue(len(progress.completed) <= 2)
+
+    def test_replicate_override_not_checkpointed(self):
+        with mock.patch.object(self.replicator, 'update'), \
+                mock.patch.object(self.replicator, 'update_deleted'):
+            self.replicator.replicate(override_devices=['sda'])
+        self.assertFalse(os.path.exists(os.path.join(
+            self.devices, 'sda', object_replicator.REPLICATION_PROGRESS_FILE)))
+        self.assertFalse(os.path.exists(os.path.join(
+            self.devices, 'sda',
+            object_replicator.REPLICATION_PROGRESS_FILE + '.last')))
+
+    def test_replication_progress(self):
+        dev_path = os.path.join(self.devices, 'sda')
+        progress = object_replicator.ReplicationProgress(
+            dev_path, self.replicator.logger)
+        self.assertFalse(progress.start_pass(100.0))
+        progress.mark_done(0, '1', 110.0)
+        progress.mark_done(1, '1', 120.0)
+        # a torn last line is ignored
+        with open(progress.path, 'a') as f:
+            f.write('0 2')
+
+        progress = object_replicator.ReplicationProgress(
+            dev_path, self.replicator.logger)
+        self.assertTrue(progress.start_pass(200.0))
+        self.assertEqual(progress.pass_start, 100.0)
+        self.assertTrue(progress.is_done(0, '1'))
+        self.assertTrue(progress.is_done('1', '1'))
+        self.assertFalse(progress.is_done(0, '2'))
+        keys = [(0, '1'), (1, '1'), (0, '2')]
+        # partition 2 has never been replicated; count from the pass start
+        self.assertEqual(progress.oldest_age(keys, 300.0), 200.0)
+        progress.mark_done(0, '2', 250.0)
+        progress.finish_pass()
+        self.assertFalse(os.path.exists(progress.path))
+
+        progress = object_replicator.ReplicationProgress(
+            dev_path, self.replicator.logger)
+        self.assertFalse(progress.start_pass(400.0))
+        self.assertEqual(progress.oldest_age(keys, 500.0), 390.0)
+        progress.mark_done(0, '1', 450.0)
+        self.assertEqual(progress.oldest_age(keys, 500.0), 380.0)
+        self.assertEqual(progress.oldest_age([], 500.0), 0)
+        # partitions not replicated in a pass keep their earlier times
+        progress.finish_pass()
+        progress = object_replicator.ReplicationProgress(
+            dev_path, self.replicator.logger)
+        self.assertEqual(progress.last_completed, {
+            (0, '1'): 450.0, (1, '1'): 120.0, (0, '2'): 250.0})
+        self.assertFalse(progress.start_pass(600.0))
+        self.assertEqual(progress.oldest_age(keys, 700.0), 580.0)
+        # and ones never replicated count from the first pass
+        self.assertEqual(progress.oldest_age([(0, '3')], 700.0), 600.0)
+
     def test_sync_just_calls_sync_method(self):
         self.replicator.sync_method = mock.MagicMock()
         self.replicator.sync('node', 'job', 'suffixes')
@@ -707,7 +837,7 @@ class TestObjectReplicator(unittest.TestCase):
             set_default(self)
             ring = self.replicator.get_object_ring(job['policy_idx'])
             self.headers['X-Backend-Storage-Policy-Index'] = job['policy_idx']
-            self.replicator.update(job)
+            self.assertFalse(self.replicator.update(job))
             self.assertTrue(error in mock_logger.error.call_args[0][0])
             self.assertTrue(expect in mock_logger.exception.call_args[0][0])
             self.assertEquals(len(self.replicator.partition_times), 1)
@@ -728,7 +858,7 @@ class TestObjectReplicator(unittest.TestCase):
         error = 'Invalid response %(resp)s from %(ip)s'
         for job in jobs:
             set_default(self)
-            self.replicator.update(job)
+            self.assertFalse(self.replicator.update(job))
             self.assertTrue(error in mock_logger.error.call_args[0][0])
             self.assertEquals(len(self.replicator.partition_times), 1)
             mock_logger.reset_mock()
@@ -739,7 +869,7 @@ class TestObjectReplicator(unittest.TestCase):
         expect = 'Error syncing with node:'
         for job in jobs:
             set_default(self)
-            self.replicator.update(job)
+            self.assertFalse(self.replicator.update(job))
             self.assertTrue(expect in mock_logger.exception.call_args[0][0])
             self.assertEquals(len(self.replicator.partition_times), 1)
             mock_logger.reset_mock()
@@ -755,7 +885,7 @@ class TestObjectReplicator(unittest.TestCase):
             if job['partition'] == '0' and job['policy_idx'] == 0:
                 local_job = job.copy()
                 continue
-            self.replicator.update(job)
+            self.assertTrue(self.replicator.update(job))
             self.assertEquals(mock_logger.exception.call_count, 0)
             self.assertEquals(mock_logger.error.call_count, 0)
             self.assertEquals(len(self.replicator.partition_times), 1)
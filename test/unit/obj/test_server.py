@@ -770,6 +770,127 @@ class TestObjectController(unittest.TestCase):
             resp = req.get_response(self.object_controller)
             self.assertEquals(resp.status_int, 408)
 
+    def _copy_put(self, timestamp, source_timestamp,
+                  etag='0b4c12d7e0a73840c1c4f148fda3b037'):
+        return Request.blank(
+            '/sda1/p/a/c/o2', environ={'REQUEST_METHOD': 'PUT'},
+            headers={'X-Timestamp': timestamp,
+                     'Content-Type': 'text/plain',
+                     'Content-Length': '0',
+                     'ETag': etag,
+                     'X-Backend-Copy-From-Path': '/p/a/c/o',
+                     'X-Backend-Copy-From-Nodes':
+                     '10.0.0.1:6000/sdb1,10.0.0.2:6000/sdc1',
+                     'X-Backend-Copy-From-Policy-Index': '0',
+                     'X-Backend-Copy-From-Timestamp': source_timestamp})
+
+    def _copied_file(self, timestamp):
+        return os.path.join(
+            self.testdir, 'sda1',
+            storage_directory(diskfile.get_data_dir(0), 'p',
+                              hash_path('a', 'c', 'o2')),
+            utils.Timestamp(timestamp).internal + '.data')
+
+    def test_PUT_copy_from_local_source(self):
+        source_timestamp = normalize_timestamp(time())
+        req = Request.blank(
+            '/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
+            headers={'X-Timestamp': source_timestamp,
+                     'Content-Type': 'text/plain',
+                     'Content-Length': '6'})
+        req.body = 'VERIFY'
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 201)
+
+        # no remote GETs when the source is on this device
+        timestamp = normalize_timestamp(float(source_timestamp) + 1)
+        with mocked_http_conn() as fake_conn:
+            resp = self._copy_put(timestamp, source_timestamp).get_response(
+                self.object_controller)
+            self.assertRaises(StopIteration, fake_conn.code_iter.next)
+        self.assertEquals(resp.status_int, 201)
+        objfile = self._copied_file(timestamp)
+        self.assertEquals(open(objfile).read(), 'VERIFY')
+        metadata = diskfile.read_metadata(objfile)
+        self.assertEquals(metadata['Content-Length'], '6')
+        self.assertEquals(metadata['ETag'],
+                          '0b4c12d7e0a73840c1c4f148fda3b037')
+        self.assertEquals(metadata['name'], '/a/c/o2')
+
+        # where the filesystem can, the data is cloned rather than read
+        def fake_ioctl(fd, op, source_fd):
+            self.assertEquals(op, diskfile.FICLONE)
+            # like FICLONE, leave the source's offset alone
+            offset = os.lseek(source_fd, 0, os.SEEK_CUR)
+            os.write(fd, os.read(source_fd, 1024))
+            os.lseek(source_fd, offset, os.SEEK_SET)
+
+        timestamp = normalize_timestamp(float(source_timestamp) + 2)
+        with mock.patch('swift.obj.diskfile.fcntl.ioctl', fake_ioctl):
+            resp = self._copy_put(timestamp, source_timestamp).get_response(
+                self.object_controller)
+        self.assertEquals(resp.status_int, 201)
+        self.assertEquals(open(self._copied_file(timestamp)).read(),
+                          'VERIFY')
+        self.assertEquals(self.object_controller.logger.get_increment_counts(),
+                          {'PUT.copy_clones': 1})
+
+        # a clone's data is still checked against the ETag, and a source
+        # that doesn't match its own is quarantined
+        source_file = os.path.join(
+            self.testdir, 'sda1',
+            storage_directory(diskfile.get_data_dir(0), 'p',
+                              hash_path('a', 'c', 'o')),
+            utils.Timestamp(source_timestamp).internal + '.data')
+        with open(source_file, 'r+') as fp:
+            fp.write('XXXXXX')
+        timestamp = normalize_timestamp(float(source_timestamp) + 3)
+        with mock.patch('swift.obj.diskfile.fcntl.ioctl', fake_ioctl):
+            resp = self._copy_put(timestamp, source_timestamp).get_response(
+                self.object_controller)
+        self.assertEquals(resp.status_int, 422)
+        self.assertFalse(os.path.exists(self._copied_file(timestamp)))
+        self.assertFalse(os.path.exists(source_file))
+
+    def test_PUT_copy_from_remote_source(self):
+        source_timestamp = normalize_timestamp(time())
+        timestamp = normalize_timestamp(float(source_timestamp) + 1)
+        connects = []
+
+        def capture_connect(ip, port, method, path, headers=None,
+                            *args, **kwargs):
+            connects.append((ip, port, method, path,
+                             headers['X-Backend-Storage-Policy-Index']))
+
+        source_ts = utils.Timestamp(source_timestamp).internal
+        with mocked_http_conn(404, 200, body='VERIFY',
+                              timestamps=[source_ts, source_ts],
+                              give_connect=capture_connect):
+            resp = self._copy_put(timestamp, source_timestamp).get_response(
+                self.object_controller)
+        self.assertEquals(resp.status_int, 201)
+        self.assertEquals(connects, [
+            ('10.0.0.1', '6000', 'GET', '/sdb1/p/a/c/o', '0'),
+            ('10.0.0.2', '6000', 'GET', '/sdc1/p/a/c/o', '0')])
+        self.assertEquals(open(self._copied_file(timestamp)).read(),
+                          'VERIFY')
+
+        # a source that isn't the one the proxy copied isn't used
+        timestamp = normalize_timestamp(float(source_timestamp) + 2)
+        with mocked_http_conn(200, 200, body='VERIFY',
+                              timestamps=['1', '1']):
+            resp = self._copy_put(timestamp, source_timestamp).get_response(
+                self.object_controller)
+        self.assertEquals(resp.status_int, 503)
+        self.assertFalse(os.path.exists(self._copied_file(timestamp)))
+
+        # nor one with the wrong data
+        with mocked_http_conn(200, body='VERIFY', timestamps=[source_ts]):
+            resp = self._copy_put(timestamp, source_timestamp,
+                                  etag='badbadbad').get_response(
+                self.object_controller)
+        self.assertEquals(resp.status_int, 422)
+
     def test_PUT_system_metadata(self):
         # check that sysmeta is stored in diskfile
         timestamp = normalize_timestamp(time())
@@ -3075,6 +3196,44 @@ class TestObjectController(unittest.TestCase):
             'container': 'c',
             'op': 'PUT'})
 
+    def test_container_update_to_shard(self):
+        given_args = []
+
+        def fake_async_update(*args):
+            given_args.append(args)
+
+        headers = {'X-Timestamp': 1,
+                   'X-Trans-Id': '123',
+                   'X-Container-Host': 'chost:cport',
+                   'X-Container-Partition': 'cpartition',
+                   'X-Container-Device': 'cdevice',
+                   'X-Backend-Container-Path': '.shards_a/c-%E2%98%83'}
+        req = Request.blank(
+            '/v1/a/c/o', environ={'REQUEST_METHOD': 'PUT'}, headers=headers)
+        update_headers = {
+            'x-size': '0', 'x-etag': 'd41d8cd98f00b204e9800998ecf8427e',
+            'x-content-type': 'text/plain', 'x-timestamp': '1'}
+        with mock.patch.object(self.object_controller, 'async_update',
+                               fake_async_update):
+            self.object_controller.container_update(
+                'PUT', 'a', 'c', 'o', req, dict(update_headers), 'sda1', 0)
+        self.assertEqual(len(given_args), 1)
+        self.assertEqual(given_args[0][:7], (
+            'PUT', '.shards_a', 'c-\xe2\x98\x83', 'o', 'chost:cport',
+            'cpartition', 'cdevice'))
+
+        given_args = []
+        headers['X-Backend-Container-Path'] = 'bad'
+        req = Request.blank(
+            '/v1/a/c/o', environ={'REQUEST_METHOD': 'PUT'}, headers=headers)
+        with mock.patch.object(self.object_controller, 'async_update',
+                               fake_async_update):
+            self.object_controller.container_update(
+                'PUT', 'a', 'c', 'o', req, dict(update_headers), 'sda1', 0)
+        self.assertEqual(given_args, [])
+        errors = self.object_controller.logger.get_lines_for_level('error')
+        self.assertTrue('invalid container path "bad"' in errors[-1])
+
     def test_container_update_bad_args(self):
         given_args = []
 
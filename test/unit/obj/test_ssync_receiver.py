@@ -19,6 +19,7 @@ import shutil
 import StringIO
 import tempfile
 import unittest
+import zlib
 
 import eventlet
 import mock
@@ -30,6 +31,7 @@ from swift.common import utils
 from swift.obj import diskfile
 from swift.obj import server
 from swift.obj import ssync_receiver
+from swift.obj import ssync_sender
 
 from test import unit
 
@@ -615,6 +617,124 @@ class TestReceiver(unittest.TestCase):
         self.assertFalse(self.controller.logger.error.called)
         self.assertFalse(self.controller.logger.exception.called)
 
+    def _compact_missing(self, entries):
+        records = []
+        ticks = 0
+        for object_hash, timestamp in entries:
+            record, ticks = ssync_sender.encode_missing(
+                object_hash, timestamp, ticks)
+            records.append(record)
+        data = zlib.compress(''.join(records))
+        return '%x\r\n%s0\r\n' % (len(data), data)
+
+    def _decompress_wanted(self, body):
+        body = body.split(':MISSING_CHECK: START\r\n', 1)[1]
+        size, body = body.split('\r\n', 1)
+        size = int(size, 16)
+        wanted = zlib.decompress(body[:size])
+        return sorted(wanted[i:i + 16].encode('hex')
+                      for i in xrange(0, len(wanted), 16))
+
+    def test_compact_MISSING_CHECK(self):
+        object_dir = utils.storage_directory(
+            os.path.join(self.testdir, 'sda1', diskfile.get_data_dir(0)),
+            '1', self.hash1)
+        utils.mkdirs(object_dir)
+        older_ts1 = utils.normalize_timestamp(float(self.ts1) - 1)
+        self.metadata1['X-Timestamp'] = older_ts1
+        fp = open(os.path.join(object_dir, older_ts1 + '.data'), 'w+')
+        fp.write('1')
+        fp.flush()
+        self.metadata1['Content-Length'] = '1'
+        diskfile.write_metadata(fp, self.metadata1)
+
+        entries = [(self.hash1, self.ts1), (self.hash2, self.ts2)]
+        self.controller.logger = mock.MagicMock()
+        req = swob.Request.blank(
+            '/sda1/1',
+            environ={'REQUEST_METHOD': 'REPLICATION'},
+            headers={'X-Backend-Ssync-Compact-Missing-Check': 'true'},
+            body=':RANGE_CHECK: START\r\n' +
+                 ''.join('%s %s\r\n' % (
+                     h[-3:], ssync_sender.suffix_digest([(h, t)]))
+                     for h, t in sorted(entries)) +
+                 ':RANGE_CHECK: END\r\n'
+                 ':MISSING_CHECK: START\r\n' +
+                 self._compact_missing(entries) +
+                 ':MISSING_CHECK: END\r\n'
+                 ':UPDATES: START\r\n:UPDATES: END\r\n')
+        resp = req.get_response(self.controller)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(
+            resp.headers['X-Backend-Ssync-Compact-Missing-Check'], 'true')
+        self.assertFalse(self.controller.logger.error.called)
+        self.assertFalse(self.controller.logger.exception.called)
+        body = resp.body
+        self.assertTrue(':RANGE_CHECK: START\r\n%s\r\n%s\r\n'
+                        ':RANGE_CHECK: END\r\n' % tuple(
+                            sorted([self.hash1[-3:], self.hash2[-3:]]))
+                        in body)
+        self.assertEqual(self._decompress_wanted(body),
+                         sorted([self.hash1, self.hash2]))
+        self.assertTrue(':MISSING_CHECK: END\r\n' in body)
+        self.assertTrue(body.rstrip().endswith(
+            ':UPDATES: START\r\n:UPDATES: END'))
+
+    def test_compact_MISSING_CHECK_identical_suffix_skipped(self):
+        object_dir = utils.storage_directory(
+            os.path.join(self.testdir, 'sda1', diskfile.get_data_dir(0)),
+            '1', self.hash1)
+        utils.mkdirs(object_dir)
+        fp = open(os.path.join(object_dir, self.ts1 + '.data'), 'w+')
+        fp.write('1')
+        fp.flush()
+        self.metadata1['Content-Length'] = '1'
+        diskfile.write_metadata(fp, self.metadata1)
+
+        self.controller.logger = mock.MagicMock()
+        req = swob.Request.blank(
+            '/sda1/1',
+            environ={'REQUEST_METHOD': 'REPLICATION'},
+            headers={'X-Backend-Ssync-Compact-Missing-Check': 'true'},
+            body=':RANGE_CHECK: START\r\n' +
+                 '%s %s\r\n' % (self.hash1[-3:], ssync_sender.suffix_digest(
+                     [(self.hash1, self.ts1)])) +
+                 ':RANGE_CHECK: END\r\n'
+                 ':MISSING_CHECK: START\r\n0\r\n'
+                 ':MISSING_CHECK: END\r\n'
+                 ':UPDATES: START\r\n:UPDATES: END\r\n')
+        resp = req.get_response(self.controller)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(
+            self.body_lines(resp.body),
+            [':RANGE_CHECK: START', ':RANGE_CHECK: END',
+             ':MISSING_CHECK: START', '0', ':MISSING_CHECK: END',
+             ':UPDATES: START', ':UPDATES: END'])
+        self.assertFalse(self.controller.logger.exception.called)
+
+    def test_decode_missing(self):
+        ts = utils.Timestamp(1372800001.00001, offset=3).internal
+        records = []
+        ticks = 0
+        for timestamp in (self.ts2, self.ts1, ts):
+            record, ticks = ssync_sender.encode_missing(
+                self.hash1, timestamp, ticks)
+            records.append(record)
+        data = ''.join(records)
+        pos = 0
+        ticks = 0
+        decoded = []
+        while pos < len(data):
+            object_hash, ticks, offset, pos = ssync_receiver.decode_missing(
+                data, pos, ticks)
+            decoded.append((object_hash,
+                            utils.Timestamp(ticks / 100000.0, offset)))
+        self.assertEqual(decoded, [(self.hash1, utils.Timestamp(self.ts2)),
+                                   (self.hash1, utils.Timestamp(self.ts1)),
+                                   (self.hash1, utils.Timestamp(ts))])
+        self.assertRaises(IndexError, ssync_receiver.decode_missing,
+                          data[:-1], len(records[0]) + len(records[1]), 0)
+
     def test_UPDATES_timeout(self):
 
         class _Wrapper(StringIO.StringIO):
@@ -1316,6 +1436,97 @@ class TestReceiver(unittest.TestCase):
                 'X-Backend-Replication-Headers': 'x-timestamp'})
             self.assertEqual(_requests, [])
 
+    def test_UPDATES_concurrent(self):
+        _requests = []
+
+        @server.public
+        def _PUT(request):
+            request.read_body = request.environ['wsgi.input'].read()
+            # Give other subrequests a chance to run.
+            eventlet.sleep(0)
+            _requests.append(request)
+            return swob.HTTPOk()
+
+        @server.public
+        def _DELETE(request):
+            eventlet.sleep(0)
+            _requests.append(request)
+            if request.path == '/device/partition/a/c/o4':
+                return swob.HTTPInternalServerError()
+            return swob.HTTPOk()
+
+        with contextlib.nested(
+                mock.patch.object(self.controller, 'PUT', _PUT),
+                mock.patch.object(self.controller, 'DELETE', _DELETE)):
+            self.controller.replication_update_concurrency = 3
+            self.controller.replication_update_buffer_size = 3
+            self.controller.logger = mock.MagicMock()
+            req = swob.Request.blank(
+                '/device/partition',
+                environ={'REQUEST_METHOD': 'REPLICATION'},
+                body=':MISSING_CHECK: START\r\n:MISSING_CHECK: END\r\n'
+                     ':UPDATES: START\r\n'
+                     'PUT /a/c/o1\r\n'
+                     'Content-Length: 3\r\n'
+                     'X-Timestamp: 1364456113.00001\r\n'
+                     '\r\n'
+                     '123'
+                     'DELETE /a/c/o2\r\n'
+                     'X-Timestamp: 1364456113.00002\r\n'
+                     '\r\n'
+                     'PUT /a/c/o3\r\n'
+                     'Content-Length: 4\r\n'
+                     'X-Timestamp: 1364456113.00003\r\n'
+                     '\r\n'
+                     '1234'
+                     'DELETE /a/c/o4\r\n'
+                     'X-Timestamp: 1364456113.00004\r\n'
+                     '\r\n'
+                     ':UPDATES: END\r\n')
+            resp = req.get_response(self.controller)
+            self.assertEqual(
+                self.body_lines(resp.body),
+                [':MISSING_CHECK: START', ':MISSING_CHECK: END',
+                 ":ERROR: 500 'ERROR: With :UPDATES: 1 failures to 3 "
+                 "successes'"])
+            self.assertEqual(resp.status_int, 200)
+            self.assertFalse(self.controller.logger.exception.called)
+            self.assertFalse(self.controller.logger.error.called)
+        self.assertEqual(
+            sorted(r.path for r in _requests),
+            ['/device/partition/a/c/o1', '/device/partition/a/c/o2',
+             '/device/partition/a/c/o3', '/device/partition/a/c/o4'])
+        bodies = dict((r.path, getattr(r, 'read_body', None))
+                      for r in _requests)
+        self.assertEqual(bodies['/device/partition/a/c/o1'], '123')
+        self.assertEqual(bodies['/device/partition/a/c/o3'], '1234')
+
+    def test_UPDATES_concurrent_subreq_exception(self):
+
+        @server.public
+        def _DELETE(request):
+            raise Exception('boom')
+
+        with mock.patch.object(self.controller, 'DELETE', _DELETE):
+            self.controller.replication_update_concurrency = 2
+            self.controller.logger = mock.MagicMock()
+            req = swob.Request.blank(
+                '/device/partition',
+                environ={'REQUEST_METHOD': 'REPLICATION'},
+                body=':MISSING_CHECK: START\r\n:MISSING_CHECK: END\r\n'
+                     ':UPDATES: START\r\n'
+                     'DELETE /a/c/o\r\n'
+                     'X-Timestamp: 1364456113.00001\r\n'
+                     '\r\n'
+                     ':UPDATES: END\r\n')
+            resp = req.get_response(self.controller)
+            self.assertEqual(
+                self.body_lines(resp.body),
+                [':MISSING_CHECK: START', ':MISSING_CHECK: END',
+                 ":ERROR: 500 'ERROR: With :UPDATES: 1 failures to 0 "
+                 "successes'"])
+            self.assertEqual(resp.status_int, 200)
+
     def test_UPDATES_subreq_does_not_read_all(self):
         # This tests that if a REPLICATION subrequest fails and doesn't read
         # all the subrequest body that it will read and throw away the rest of
@@ -20,12 +20,13 @@ import StringIO
 import tempfile
 import time
 import unittest
+import zlib
 
 import eventlet
 import mock
 
 from swift.common import exceptions, utils
-from swift.obj import ssync_sender, diskfile
+from swift.obj import ssync_receiver, ssync_sender, diskfile
 
 from test.unit import DebugLogger, patch_policies
 
@@ -39,6 +40,7 @@ class FakeReplicator(object):
         self.http_timeout = 3
         self.network_chunk_size = 65536
         self.disk_chunk_size = 4096
+        self.ssync_compact_missing_check = False
         conf = {
             'devices': testdir,
             'mount_check': 'false',
@@ -69,6 +71,7 @@ class FakeResponse(object):
     def __init__(self, chunk_body=''):
         self.status = 200
         self.close_called = False
+        self.headers = {}
         if chunk_body:
             self.fp = StringIO.StringIO(
                 '%x\r\n%s\r\n0\r\n\r\n' % (len(chunk_body), chunk_body))
@@ -76,6 +79,9 @@ class FakeResponse(object):
     def close(self):
         self.close_called = True
 
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
 
 class FakeConnection(object):
 
@@ -891,6 +897,132 @@ class TestSender(unittest.TestCase):
             '%(chunk_size)s\r\n'
             '%(body)s\r\n' % expected)
 
+    def test_send_put_zero_copy(self):
+        body = 'test'
+        df = self._make_open_diskfile(body=body)
+        expected = dict(df.get_metadata())
+        self.sender.connection = FakeConnection()
+        self.sender.connection.sock = mock.MagicMock()
+        self.sender.connection.sock.fileno.return_value = 123
+        zero_copy_calls = []
+
+        def fake_zero_copy_send(reader, wsockfd, timeout=None):
+            zero_copy_calls.append((wsockfd, timeout))
+            self.sender.connection.sent.append(body)
+            reader._bytes_read = len(body)
+
+        with mock.patch.object(diskfile.DiskFileReader, 'can_zero_copy_send',
+                               lambda r: True), \
+                mock.patch.object(diskfile.DiskFileReader, 'zero_copy_send',
+                                  fake_zero_copy_send):
+            self.sender.send_put('/a/c/o', df)
+        self.assertEqual(zero_copy_calls, [(123, 2)])
+        self.assertEqual(
+            ''.join(self.sender.connection.sent),
+            '68\r\n'
+            'PUT /a/c/o\r\n'
+            'Content-Length: %(Content-Length)s\r\n'
+            'ETag: %(ETag)s\r\n'
+            'X-Timestamp: %(X-Timestamp)s\r\n'
+            '\r\n'
+            '\r\n'
+            '4\r\n'
+            'test\r\n' % expected)
+
+    def test_send_put_zero_copy_short_read(self):
+        df = self._make_open_diskfile(body='test')
+        self.sender.connection = FakeConnection()
+        self.sender.connection.sock = mock.MagicMock()
+
+        def fake_zero_copy_send(reader, wsockfd, timeout=None):
+            reader._bytes_read = 2
+
+        with mock.patch.object(diskfile.DiskFileReader, 'can_zero_copy_send',
+                               lambda r: True), \
+                mock.patch.object(diskfile.DiskFileReader, 'zero_copy_send',
+                                  fake_zero_copy_send):
+            exc = None
+            try:
+                self.sender.send_put('/a/c/o', df)
+            except exceptions.ReplicationException as err:
+                exc = err
+        self.assertEqual(
+            str(exc), 'Sent 2 of 4 bytes in send_put zero-copy chunk')
+
+    def test_compact_missing_check(self):
+        df1 = self._make_open_diskfile(obj='o1')
+        df2 = self._make_open_diskfile(obj='o2')
+        hash1 = utils.hash_path('a', 'c', 'o1')
+        hash2 = utils.hash_path('a', 'c', 'o2')
+        self.sender.connection = FakeConnection()
+        self.sender.job = {'device': 'dev', 'partition': '9'}
+        self.sender.suffixes = sorted([hash1[-3:], hash2[-3:]])
+        self.sender.compact = True
+        wanted = zlib.compress(hash2.decode('hex'))
+        self.sender.response = FakeResponse(
+            chunk_body=(
+                ':RANGE_CHECK: START\r\n%s\r\n:RANGE_CHECK: END\r\n'
+                ':MISSING_CHECK: START\r\n%x\r\n%s0\r\n'
+                ':MISSING_CHECK: END\r\n' % (
+                    hash2[-3:], len(wanted), wanted)))
+        self.sender.missing_check()
+        self.assertEqual(self.sender.send_list, [hash2])
+
+        sent = ''.join(self.sender.connection.sent)
+        # unwrap the http chunks
+        body = ''
+        while sent:
+            size, sent = sent.split('\r\n', 1)
+            size = int(size, 16)
+            body += sent[:size]
+            sent = sent[size + 2:]
+        range_check, missing = body.split(':RANGE_CHECK: END\r\n')
+        range_check = range_check.splitlines()
+        self.assertEqual(range_check[0], ':RANGE_CHECK: START')
+        expected = []
+        for h, df in ((hash1, df1), (hash2, df2)):
+            expected.append('%s %s' % (h[-3:], ssync_sender.suffix_digest(
+                [(h, df.timestamp.internal)])))
+        self.assertEqual(sorted(range_check[1:]), sorted(expected))
+        # only the differing suffix is listed in the compressed stream
+        self.assertTrue(missing.startswith(':MISSING_CHECK: START\r\n'))
+        self.assertTrue(missing.endswith('0\r\n:MISSING_CHECK: END\r\n'))
+        missing = missing[len(':MISSING_CHECK: START\r\n'):]
+        size, missing = missing.split('\r\n', 1)
+        data = zlib.decompressobj().decompress(missing[:int(size, 16)])
+        object_hash, ticks, offset, pos = ssync_receiver.decode_missing(
+            data, 0, 0)
+        self.assertEqual(pos, len(data))
+        self.assertEqual(object_hash, hash2)
+        self.assertEqual(utils.Timestamp(ticks / 100000.0, offset),
+                         df2.timestamp)
+
+    def test_connect_negotiates_compact(self):
+        self.sender.daemon.ssync_compact_missing_check = True
+        self.sender.node = {'replication_ip': '1.2.3.4',
+                            'replication_port': 5678, 'device': 'sda1'}
+        self.sender.job = {'partition': '9'}
+        headers = {}
+
+        class FakeBufferedHTTPConnection(NullBufferedHTTPConnection):
+
+            def putheader(self, name, value):
+                headers[name] = value
+
+            def getresponse(self):
+                response = FakeResponse()
+                response.headers = {
+                    'X-Backend-Ssync-Compact-Missing-Check': 'true'}
+                return response
+
+        with mock.patch.object(ssync_sender.bufferedhttp,
+                               'BufferedHTTPConnection',
+                               FakeBufferedHTTPConnection):
+            self.sender.connect()
+        self.assertEqual(
+            headers['X-Backend-Ssync-Compact-Missing-Check'], 'true')
+        self.assertTrue(self.sender.compact)
+
     def test_disconnect_timeout(self):
         self.sender.connection = FakeConnection()
         self.sender.connection.send = lambda d: eventlet.sleep(1)
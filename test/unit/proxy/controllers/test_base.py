@@ -14,20 +14,23 @@
 # limitations under the License.
 
 import itertools
+import time
 from collections import defaultdict
 import unittest
+from eventlet import sleep, GreenPile
 from mock import patch
 from swift.proxy.controllers.base import headers_to_container_info, \
     headers_to_account_info, headers_to_object_info, get_container_info, \
     get_container_memcache_key, get_account_info, get_account_memcache_key, \
     get_object_env_key, get_info, get_object_info, \
-    Controller, GetOrHeadHandler, _set_info_cache, _set_object_info_cache
+    Controller, GetOrHeadHandler, _set_info_cache, _set_object_info_cache, \
+    _info_cache, InfoCache
 from swift.common.swob import Request, HTTPException, HeaderKeyDict, \
     RESPONSE_REASONS
 from swift.common.utils import split_path
 from swift.common.http import is_success
 from swift.common.storage_policy import StoragePolicy
-from test.unit import fake_http_connect, FakeRing, FakeMemcache
+from test.unit import fake_http_connect, FakeRing, FakeMemcache, FakeLogger
 from swift.proxy import server as proxy_server
 from swift.common.request_helpers import get_sys_meta_prefix
 
@@ -358,6 +361,84 @@ class TestFuncs(unittest.TestCase):
         resp = get_container_info(req.environ, 'xxx')
         self.assertEquals(resp['bytes'], 3867)
 
+    def test_get_info_process_cache(self):
+        logger = FakeLogger()
+        _info_cache.clear()
+        with patch.multiple('swift.proxy.controllers.base',
+                            INFO_CACHE_SIZE=10, INFO_CACHE_LOGGER=logger):
+            app = FakeApp()
+            cache = FakeCache()
+            info = get_info(app, {'swift.cache': cache}, 'a')
+            self.assertEqual(info['status'], 200)
+            self.assertEqual(app.responses.stats['account'], 1)
+            # served from memory, without asking memcache or the backend
+            cache.store.clear()
+            info['bytes'] = 'changed'
+            info['meta']['color'] = 'changed'
+            info = get_info(app, {'swift.cache': cache}, 'a')
+            self.assertEqual(info['bytes'], 6666)
+            self.assertEqual(info['meta'], {})
+            self.assertEqual(app.responses.stats['account'], 1)
+            self.assertEqual(cache.store, {})
+
+            # not found is cached too
+            app = FakeApp(statuses=[404, 200, 404, 200])
+            self.assertEqual(get_info(app, {}, 'a', 'c'), None)
+            info = get_info(app, {}, 'a', 'c', ret_not_found=True)
+            self.assertEqual(info['status'], 404)
+            self.assertEqual(app.responses.stats['container'], 1)
+            self.assertEqual(app.responses.stats['account'], 0)
+
+            # until it expires, or is cleared
+            with patch('swift.proxy.controllers.base.time.time',
+                       return_value=time.time() + 2):
+                self.assertEqual(get_info(app, {}, 'a', 'c'), None)
+            self.assertEqual(app.responses.stats['container'], 2)
+            self.assertEqual(app.responses.stats['account'], 1)
+            _set_info_cache(app, {}, 'a', None, None)
+            get_info(app, {}, 'a')
+            self.assertEqual(app.responses.stats['account'], 2)
+        _info_cache.clear()
+
+        counts = logger.get_increment_counts()
+        self.assertEqual(counts['info_cache.l1.hits'], 3)
+        self.assertEqual(counts['info_cache.l1.misses'], 5)
+        self.assertEqual(counts['info_cache.l2.misses'], 1)
+
+    def test_info_cache_copies_infos(self):
+        info_cache = InfoCache()
+        info = {'status': 200, 'meta': {'color': 'red'},
+                'sysmeta': {'shape': 'round'}}
+        with patch('swift.proxy.controllers.base.INFO_CACHE_SIZE', 10):
+            info_cache.set('a', info)
+            info['meta']['color'] = 'changed'
+            cached = info_cache.get('a')
+            self.assertEqual(cached['meta'], {'color': 'red'})
+            cached['sysmeta']['shape'] = 'changed'
+            self.assertEqual(info_cache.get('a')['sysmeta'],
+                             {'shape': 'round'})
+
+    def test_get_info_collapses_fetches(self):
+        class SlowApp(FakeApp):
+            def __call__(self, environ, start_response):
+                sleep(0.01)
+                return super(SlowApp, self).__call__(environ, start_response)
+
+        _info_cache.clear()
+        app = SlowApp()
+        pile = GreenPile()
+        with patch('swift.proxy.controllers.base.INFO_CACHE_SIZE', 10):
+            for _junk in range(3):
+                pile.spawn(get_info, app, {}, 'a', 'c')
+            infos = list(pile)
+        self.assertEqual([info['status'] for info in infos], [200] * 3)
+        # each waiter gets its own copy of the info, down to its metadata
+        self.assertEqual(len(set(id(info['meta']) for info in infos)), 3)
+        self.assertEqual(app.responses.stats['account'], 1)
+        self.assertEqual(app.responses.stats['container'], 1)
+        self.assertEqual(_info_cache.fetches, {})
+        _info_cache.clear()
+
     def test_get_account_info_swift_source(self):
         app = FakeApp()
         req = Request.blank("/v1/a", environ={'swift.cache': FakeCache()})
@@ -599,6 +680,62 @@ class TestFuncs(unittest.TestCase):
         handler.fast_forward(20)
         self.assertEquals(handler.backend_headers['Range'], 'bytes=-80')
 
+    def test_hedged_get(self):
+        connected = []
+
+        def give_connect(ipaddr, port, device, *args, **kwargs):
+            connected.append(device)
+            if len(connected) == 1:
+                sleep(0.1)
+
+        for hedge_ratio, expected_hedges in (('1', 1), ('0', 0)):
+            del connected[:]
+            logger = FakeLogger()
+            app = proxy_server.Application(
+                {'hedge_delay': '0.01', 'hedge_ratio': hedge_ratio},
+                FakeMemcache(), logger=logger, account_ring=FakeRing(),
+                container_ring=FakeRing())
+            req = Request.blank('/v1/a/c/o')
+            handler = GetOrHeadHandler(app, req, 'Object', FakeRing(), 0,
+                                       '/a/c/o', {})
+            with patch('swift.proxy.controllers.base.http_connect',
+                       fake_http_connect(200, 200,
+                                         give_connect=give_connect)):
+                source, node = handler._get_source_and_node()
+                sleep(0.2)
+            self.assertEqual(source.status, 200)
+            # the slow first node loses to the hedged request, if allowed
+            self.assertEqual(len(connected), 1 + expected_hedges)
+            self.assertEqual(node['device'], connected[-1])
+            counts = logger.get_increment_counts()
+            self.assertEqual(counts.get('hedges', 0), expected_hedges)
+            self.assertEqual(counts.get('hedge_wins', 0), expected_hedges)
+
+    def test_hedged_get_refused_hedge_keeps_node(self):
+        connected = []
+
+        def give_connect(ipaddr, port, device, *args, **kwargs):
+            connected.append(ipaddr)
+            if len(connected) == 1:
+                sleep(0.1)
+
+        logger = FakeLogger()
+        app = proxy_server.Application(
+            {'hedge_delay': '0.01', 'hedge_ratio': '0'},
+            FakeMemcache(), logger=logger, account_ring=FakeRing(),
+            container_ring=FakeRing())
+        ring = FakeRing(replicas=2, max_more_nodes=2)
+        req = Request.blank('/v1/a/c/o')
+        handler = GetOrHeadHandler(app, req, 'Object', ring, 0, '/a/c/o', {})
+        with patch('swift.proxy.controllers.base.http_connect',
+                   fake_http_connect(503, 200, give_connect=give_connect)):
+            source, node = handler._get_source_and_node()
+        self.assertEqual(source.status, 200)
+        # the node the hedge would have gone to is the one failed over to
+        primaries = [dev['ip'] for dev in ring.get_part_nodes(0)]
+        self.assertEqual(sorted(connected), sorted(primaries))
+        self.assertEqual(logger.get_increment_counts().get('hedges', 0), 0)
+
     def test_transfer_headers_with_sysmeta(self):
         base = Controller(self.app)
         good_hdrs = {'x-base-sysmeta-foo': 'ok',
@@ -15,8 +15,11 @@
 
 import mock
 import unittest
+from urlparse import parse_qsl
 
-from swift.common.swob import Request
+from swift.common.swob import Request, HTTPUnauthorized
+from swift.common import constraints
+from swift.common.utils import json, ShardRange
 from swift.proxy import server as proxy_server
 from swift.proxy.controllers.base import headers_to_container_info
 from test.unit import fake_http_connect, FakeRing, FakeMemcache
@@ -68,6 +71,144 @@ class TestContainerController(TestRingBase):
         for key in owner_headers:
             self.assertTrue(key in resp.headers)
 
+    def test_GET_sharded(self):
+        shard_ranges = [ShardRange('c-1', '1', '', 'l/m'),
+                        ShardRange('c-2', '1', 'l/m', '')]
+        listings = [[{'name': 'a'}, {'subdir': 'l/'}],
+                    [{'subdir': 'l/'}, {'name': 'z'}]]
+        requests = []
+
+        def capture(ipaddr, port, device, partition, method, path,
+                    headers=None, query_string=None):
+            requests.append((path, dict(parse_qsl(query_string or '')),
+                             headers))
+
+        bodies = [''] + [json.dumps(body) for body in
+                         [[sr.as_dict() for sr in shard_ranges]] + listings]
+        controller = proxy_server.ContainerController(self.app, 'a', 'c')
+        req = Request.blank('/v1/a/c?delimiter=/&limit=10')
+        with mock.patch('swift.proxy.controllers.base.http_connect',
+                        fake_http_connect(
+                            200, 200, 200, 200, body_iter=bodies,
+                            headers={'X-Backend-Record-Type': 'shard'},
+                            give_connect=capture)):
+            resp = controller.GET(req)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.body, 'a\nl/\nz\n')
+        self.assertEqual(resp.content_type, 'text/plain')
+        self.assertFalse('X-Backend-Record-Type' in resp.headers)
+        self.assertEqual(requests[1][0], '/a/c')
+        self.assertEqual(requests[1][2]['X-Backend-Record-Type'], 'auto')
+        self.assertEqual([path for path, _, _ in requests[2:]],
+                         ['/.shards_a/c-1', '/.shards_a/c-2'])
+        self.assertEqual(requests[2][1], {'delimiter': '/', 'limit': '10',
+                                          'format': 'json'})
+        self.assertEqual(requests[3][1], {'delimiter': '/', 'limit': '8',
+                                          'marker': 'l/', 'format': 'json'})
+
+        # the listing stops once it's full
+        del requests[:]
+        req = Request.blank('/v1/a/c?format=json&limit=2')
+        with mock.patch('swift.proxy.controllers.base.http_connect',
+                        fake_http_connect(
+                            200, 200, body_iter=bodies[1:],
+                            headers={'X-Backend-Record-Type': 'shard'},
+                            give_connect=capture)):
+            resp = controller.GET(req)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(json.loads(resp.body), listings[0])
+        self.assertEqual(len(requests), 2)
+
+        # a limit that isn't a number of objects gets the default
+        for limit in ('foo', '-1'):
+            del requests[:]
+            req = Request.blank('/v1/a/c?format=json&limit=%s' % limit)
+            with mock.patch('swift.proxy.controllers.base.http_connect',
+                            fake_http_connect(
+                                200, 200, 200, body_iter=bodies[1:],
+                                headers={'X-Backend-Record-Type': 'shard'},
+                                give_connect=capture)):
+                resp = controller.GET(req)
+            self.assertEqual(resp.status_int, 200)
+            self.assertEqual(json.loads(resp.body),
+                             [{'name': 'a'}, {'subdir': 'l/'}, {'name': 'z'}])
+            self.assertEqual(requests[1][1]['limit'],
+                             str(constraints.CONTAINER_LISTING_LIMIT))
+
+    def test_GET_sharded_authorized_first(self):
+        shard_ranges = [ShardRange('c-1', '1', '', '')]
+        requests = []
+
+        def capture(ipaddr, port, device, partition, method, path,
+                    headers=None, query_string=None):
+            requests.append(path)
+
+        controller = proxy_server.ContainerController(self.app, 'a', 'c')
+        req = Request.blank('/v1/a/c', environ={
+            'swift.authorize': lambda req: HTTPUnauthorized(request=req)})
+        with mock.patch('swift.proxy.controllers.base.http_connect',
+                        fake_http_connect(
+                            200, 200, body_iter=[
+                                '', json.dumps([sr.as_dict()
+                                                for sr in shard_ranges])],
+                            headers={'X-Backend-Record-Type': 'shard'},
+                            give_connect=capture)):
+            resp = controller.GET(req)
+        self.assertEqual(resp.status_int, 401)
+        # no shard was listed for the unauthorized request
+        self.assertEqual(requests, ['/a', '/a/c'])
+
+    def test_GET_sharded_with_uncleaved_objects(self):
+        shard_ranges = [ShardRange('c-1', '1', '', 'm'),
+                        ShardRange('c-2', '1', 'm', '')]
+        requests = []
+
+        def capture(ipaddr, port, device, partition, method, path,
+                    headers=None, query_string=None):
+            requests.append((path, dict(parse_qsl(query_string or '')),
+                             headers))
+
+        # the first shard hasn't been created yet, and the root still has
+        # rows of both ranges, one of them newer than the shard's
+        root_listing = [{'name': 'a', 'last_modified': '1'},
+                        {'name': 'x', 'last_modified': '3'}]
+        shard_listing = [{'name': 'x', 'last_modified': '2'},
+                         {'name': 'y', 'last_modified': '2'}]
+        bodies = ['', json.dumps([sr.as_dict() for sr in shard_ranges]),
+                  json.dumps(root_listing), '', json.dumps(shard_listing)]
+        controller = proxy_server.ContainerController(self.app, 'a', 'c')
+        req = Request.blank('/v1/a/c?format=json&limit=10')
+        with mock.patch('swift.proxy.controllers.base.http_connect',
+                        fake_http_connect(
+                            200, 200, 200, 404, 200, body_iter=bodies,
+                            headers={'X-Backend-Record-Type': 'shard',
+                                     'X-Backend-Uncleaved-Objects': '2'},
+                            give_connect=capture)):
+            resp = controller.GET(req)
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(json.loads(resp.body),
+                         [{'name': 'a', 'last_modified': '1'},
+                          {'name': 'x', 'last_modified': '3'},
+                          {'name': 'y', 'last_modified': '2'}])
+        self.assertEqual(requests[2][0], '/a/c')
+        self.assertEqual(requests[2][1], {'limit': '10', 'format': 'json'})
+        self.assertEqual(requests[2][2]['X-Backend-Record-Type'], 'object')
+        self.assertEqual([path for path, _, _ in requests[3:]],
+                         ['/.shards_a/c-1', '/.shards_a/c-2'])
+
+        # the merged listing is cut down to the limit
+        del requests[:]
+        req = Request.blank('/v1/a/c?format=json&limit=2')
+        with mock.patch('swift.proxy.controllers.base.http_connect',
+                        fake_http_connect(
+                            200, 200, 404, 200, body_iter=bodies[1:],
+                            headers={'X-Backend-Record-Type': 'shard',
+                                     'X-Backend-Uncleaved-Objects': '2'},
+                            give_connect=capture)):
+            resp = controller.GET(req)
+        self.assertEqual([item['name'] for item in json.loads(resp.body)],
+                         ['a', 'x'])
+
     def _make_callback_func(self, context):
         def callback(ipaddr, port, device, partition, method, path,
                      headers=None, query_string=None, ssl=False):
@@ -21,6 +21,7 @@ import unittest
 from contextlib import contextmanager
 
 import mock
+from eventlet import sleep
 
 import swift
 from swift.common import utils, swob
@@ -113,6 +114,37 @@ class TestObjControllerWriteAffinity(unittest.TestCase):
             res = controller._connect_put_node(nodes, '', '', {}, ('', ''))
         self.assertTrue(res is None)
 
+    def test_connect_put_node_slow_copy(self):
+        controller = proxy_server.ObjectController(self.app, 'a', 'c', 'o')
+        self.app.node_timeout = 0.05
+        self.app.server_side_copy_timeout = 1
+        node = dict(ip='1.2.3.4', port=6000, device='sda')
+
+        def slow_copy(*args, **kwargs):
+            conn = mock.MagicMock()
+
+            def getexpect():
+                # the object server only responds once it has copied the
+                # object from the source
+                sleep(0.1)
+                return mock.MagicMock(status=201)
+            conn.getexpect = getexpect
+            return conn
+
+        with mock.patch('swift.proxy.controllers.obj.http_connect',
+                        slow_copy), \
+                mock.patch.object(self.app, 'exception_occurred') as errors:
+            conn = controller._connect_put_node(
+                [node], '0', '/a/c/o',
+                {'X-Backend-Copy-From-Path': '/0/a/c/src'}, ('', ''))
+            self.assertEqual(conn.resp.status, 201)
+            self.assertFalse(errors.called)
+            # other PUTs still wait no longer than node_timeout
+            conn = controller._connect_put_node(
+                [node], '0', '/a/c/o', {}, ('', ''))
+            self.assertTrue(conn is None)
+            self.assertEqual(errors.call_count, 1)
+
 
 @patch_policies([
     StoragePolicy(0, 'zero', True),
@@ -164,6 +196,69 @@ class TestObjController(unittest.TestCase):
             resp = req.get_response(self.app)
         self.assertEquals(resp.status_int, 201)
 
+    def test_PUT_return_at_quorum(self):
+        self.app.post_quorum_timeout = 10
+        self.app.return_at_put_quorum = True
+        fake_connect = fake_http_connect(201, 201, 503)
+
+        def slow_connect(*args, **kwargs):
+            conn = fake_connect(*args, **kwargs)
+            if conn.status == 503:
+                getresponse = conn.getresponse
+
+                def slow_getresponse():
+                    sleep(0.1)
+                    return getresponse()
+                conn.getresponse = slow_getresponse
+            return conn
+
+        req = swift.common.swob.Request.blank('/v1/a/c/o', method='PUT')
+        req.headers['content-length'] = '0'
+        with mock.patch('swift.proxy.controllers.obj.http_connect',
+                        slow_connect):
+            start = time.time()
+            resp = req.get_response(self.app)
+            self.assertTrue(time.time() - start < 0.1)
+            self.assertEquals(resp.status_int, 201)
+            counts = self.app.logger.get_increment_counts()
+            self.assertEqual(counts.get('put_quorum_returns'), 1)
+            self.assertFalse('put_late_failures' in counts)
+            # the slow replica's failure is noted once it comes in
+            sleep(0.2)
+        counts = self.app.logger.get_increment_counts()
+        self.assertEqual(counts.get('put_late_failures'), 1)
+
+    def test_PUT_buffers_client_chunks(self):
+        self.app.client_chunk_size = 4
+        self.app.put_buffer_size = 10
+        for chunked, expected in (
+                (False, ['abcdefghijkl', 'mnopqrstuvwx', 'yz']),
+                (True, ['c\r\nabcdefghijkl\r\n', 'c\r\nmnopqrstuvwx\r\n',
+                        '2\r\nyz\r\n', '0\r\n\r\n'])):
+            fake_connect = fake_http_connect(201, 201, 201)
+            sent = []
+
+            def connect(*args, **kwargs):
+                conn = fake_connect(*args, **kwargs)
+                conn.send = sent.append
+                return conn
+
+            req = swift.common.swob.Request.blank(
+                '/v1/a/c/o', method='PUT',
+                body='abcdefghijklmnopqrstuvwxyz')
+            if chunked:
+                del req.headers['content-length']
+                req.headers['transfer-encoding'] = 'chunked'
+            with mock.patch('swift.proxy.controllers.obj.http_connect',
+                            connect):
+                resp = req.get_response(self.app)
+            self.assertEquals(resp.status_int, 201)
+            self.assertEqual(sorted(sent), sorted(expected * 3))
+            # every connection is sent the same buffers, and the last chunk
+            # of a chunked request on its own
+            self.assertEqual(len(set(id(data) for data in sent)),
+                             len(expected))
+
     def test_PUT_if_none_match(self):
         req = swift.common.swob.Request.blank('/v1/a/c/o', method='PUT')
         req.headers['if-none-match'] = '*'
@@ -215,12 +310,138 @@ class TestObjController(unittest.TestCase):
             resp = req.get_response(self.app)
         self.assertEquals(resp.status_int, 404)
 
+    def test_GET_object_cache(self):
+        self.app.object_cache = proxy_server.ObjectCache(
+            1024, 10, 60, logger=self.app.logger)
+        req = swob.Request.blank('/v1/a/c/o')
+        with set_http_connect(200, body='abcdef', timestamps=['2']):
+            resp = req.get_response(self.app)
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(resp.body, 'abcdef')
+
+        # served from the cache, ranges and conditions included
+        with set_http_connect():
+            resp = swob.Request.blank('/v1/a/c/o').get_response(self.app)
+            self.assertEquals(resp.status_int, 200)
+            self.assertEquals(resp.body, 'abcdef')
+            self.assertEquals(resp.headers['X-Object-Meta-Test'], 'testing')
+            resp = swob.Request.blank(
+                '/v1/a/c/o', headers={'Range': 'bytes=1-2'}).get_response(
+                self.app)
+            self.assertEquals(resp.status_int, 206)
+            self.assertEquals(resp.body, 'bc')
+            resp = swob.Request.blank(
+                '/v1/a/c/o', headers={'If-None-Match': resp.etag}
+            ).get_response(self.app)
+            self.assertEquals(resp.status_int, 304)
+            resp = swob.Request.blank(
+                '/v1/a/c/o', method='HEAD').get_response(self.app)
+            self.assertEquals(resp.status_int, 200)
+            self.assertEquals(resp.content_length, 6)
+        self.assertEqual(
+            self.app.logger.get_increment_counts(),
+            {'object_cache.misses': 1, 'object_cache.hits': 4})
+
+        # but only once authorized
+        req = swob.Request.blank('/v1/a/c/o', environ={
+            'swift.authorize': lambda req: swob.HTTPUnauthorized()})
+        with set_http_connect():
+            resp = req.get_response(self.app)
+        self.assertEquals(resp.status_int, 401)
+
+        # X-Newest goes to the object servers
+        req = swob.Request.blank('/v1/a/c/o', headers={'X-Newest': 'true'})
+        codes = [200] * self.obj_ring.replicas
+        with set_http_connect(*codes, body='abcdef'):
+            resp = req.get_response(self.app)
+        self.assertEquals(resp.body, 'abcdef')
+
+        # larger objects aren't cached
+        self.app.object_cache.entries.clear()
+        for i in range(2):
+            with set_http_connect(200, body='abcdefghijk'):
+                resp = swob.Request.blank('/v1/a/c/o').get_response(self.app)
+                self.assertEquals(resp.body, 'abcdefghijk')
+
+    def test_object_cache_invalidated_by_writes(self):
+        def get(timestamp):
+            with set_http_connect(200, body='abc', timestamps=[timestamp]):
+                resp = swob.Request.blank('/v1/a/c/o').get_response(self.app)
+                self.assertEquals(resp.body, 'abc')
+
+        for method, codes in (('PUT', [201] * 3), ('DELETE', [204] * 3)):
+            self.app.object_cache = proxy_server.ObjectCache(1024, 10, 60)
+            get('2')
+            self.assertEqual(len(self.app.object_cache.entries), 1)
+            req = swob.Request.blank('/v1/a/c/o', method=method, body='')
+            with set_http_connect(*codes):
+                resp = req.get_response(self.app)
+            self.assertTrue(resp.is_success)
+            self.assertEqual(len(self.app.object_cache.entries), 0)
+            # a copy of the object from before the write isn't cached
+            get('2')
+            self.assertEqual(len(self.app.object_cache.entries), 0)
+            get(utils.Timestamp(time.time() + 1).internal)
+            self.assertEqual(len(self.app.object_cache.entries), 1)
+
+    def test_object_cache_size(self):
+        cache = proxy_server.ObjectCache(10, 5, 60, policy_indexes=[1])
+        self.assertEqual(cache.key(None, '/a/c/o'), None)
+        self.assertEqual(cache.key('1', '/a/c/o'), (1, '/a/c/o'))
+        for name in 'abc':
+            cache.set(name, {'X-Timestamp': '1'}, name * 4)
+        # the least recently used object made room for the newest
+        self.assertEqual(cache.entries.keys(), ['b', 'c'])
+        self.assertEqual(cache.bytes_used, 8)
+        self.assertEqual(cache.get('b'), ({'X-Timestamp': '1'}, 'bbbb'))
+        cache.set('d', {}, 'ddd')
+        self.assertEqual(cache.entries.keys(), ['b', 'd'])
+        self.assertEqual(cache.bytes_used, 7)
+        # expired objects and objects past their X-Delete-At are misses
+        cache.set('e', {'X-Delete-At': '1'}, 'e')
+        self.assertEqual(cache.get('e'), None)
+        with mock.patch('time.time', return_value=time.time() + 61):
+            self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.bytes_used, 3)
+
     def test_DELETE_simple(self):
         req = swift.common.swob.Request.blank('/v1/a/c/o', method='DELETE')
         with set_http_connect(204, 204, 204):
             resp = req.get_response(self.app)
         self.assertEquals(resp.status_int, 204)
 
+    def test_DELETE_sharded_container(self):
+        self.container_info = dict(self.container_info, sharded=True)
+        shard_ranges = [utils.ShardRange('c-1', '1', '', 'm'),
+                        utils.ShardRange('c-2', '1', 'm', '')]
+        requests = []
+
+        def capture(ipaddr, port, device, partition, method, path,
+                    headers=None, query_string=None):
+            requests.append((method, path, headers))
+
+        body = utils.json.dumps([sr.as_dict() for sr in shard_ranges])
+        for expected_requests in (4, 3):
+            del requests[:]
+            req = swift.common.swob.Request.blank(
+                '/v1/a/c/o', method='DELETE',
+                environ={'swift.cache': self.app.memcache})
+            statuses = [200, 204, 204, 204][-expected_requests:]
+            bodies = [body, '', '', ''][-expected_requests:]
+            with set_http_connect(*statuses, body_iter=bodies,
+                                  give_connect=capture):
+                resp = req.get_response(self.app)
+            self.assertEquals(resp.status_int, 204)
+            if expected_requests == 4:
+                # the shard ranges are fetched from the root, then cached
+                method, path, headers = requests.pop(0)
+                self.assertEqual((method, path), ('GET', '/a/c'))
+                self.assertEqual(headers['X-Backend-Record-Type'], 'shard')
+            for method, path, headers in requests:
+                self.assertEqual(method, 'DELETE')
+                self.assertEqual(headers['X-Backend-Container-Path'],
+                                 '.shards_a/c-2')
+
     def test_DELETE_missing_one(self):
         req = swift.common.swob.Request.blank('/v1/a/c/o', method='DELETE')
         with set_http_connect(404, 204, 204):
@@ -275,6 +496,45 @@ class TestObjController(unittest.TestCase):
             resp = req.get_response(self.app)
         self.assertEquals(resp.status_int, 202)
 
+    def test_COPY_server_side(self):
+        get_resp = [200] * self.obj_ring.replicas + \
+            [404] * self.obj_ring.max_more_nodes
+        put_resp = [201] * self.obj_ring.replicas
+        codes = get_resp + put_resp
+        for server_side_copy in (False, True):
+            self.app.server_side_copy = server_side_copy
+            req = swob.Request.blank('/v1/a/c/o', method='COPY',
+                                     headers={'Destination': 'c/o2'})
+            put_headers = []
+
+            def capture_headers(ip, port, device, part, method, path,
+                                headers, **kwargs):
+                if method == 'PUT':
+                    put_headers.append(headers)
+            with set_http_connect(*codes, timestamps=['2'] * len(codes),
+                                  body='abc', give_connect=capture_headers):
+                resp = req.get_response(self.app)
+            self.assertEquals(resp.status_int, 201)
+            self.assertEquals(len(put_headers), self.obj_ring.replicas)
+            for headers in put_headers:
+                if not server_side_copy:
+                    self.assertFalse('X-Backend-Copy-From-Path' in headers)
+                    self.assertEquals(headers['Content-Length'], '3')
+                    continue
+                # the object servers fetch the data themselves
+                self.assertEquals(headers['Content-Length'], '0')
+                self.assertFalse('Expect' in headers)
+                self.assertEquals(headers['X-Backend-Copy-From-Path'],
+                                  '/0/a/c/o')
+                self.assertEquals(headers['X-Backend-Copy-From-Timestamp'],
+                                  '2')
+                self.assertEquals(
+                    headers['X-Backend-Copy-From-Policy-Index'], '0')
+                self.assertEquals(
+                    sorted(headers['X-Backend-Copy-From-Nodes'].split(',')),
+                    ['10.0.0.0:1000/sda', '10.0.0.1:1001/sdb',
+                     '10.0.0.2:1002/sdc'])
+
     def test_POST_delete_at(self):
         t = str(int(time.time() + 100))
         req = swob.Request.blank('/v1/a/c/o', method='POST',
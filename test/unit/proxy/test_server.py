@@ -49,6 +49,7 @@ from swift.common.middleware import proxy_logging
 from swift.common.middleware.acl import parse_acl, format_acl
 from swift.common.exceptions import ChunkReadTimeout, DiskFileNotExist
 from swift.common import utils, constraints
+from swift.common.node_stats import NODE_STATS_FILE, read_node_stats
 from swift.common.utils import mkdirs, normalize_timestamp, NullLogger
 from swift.common.wsgi import monkey_patch_mimetools, loadapp
 from swift.proxy.controllers import base as proxy_base
@@ -641,6 +642,104 @@ class TestProxyServer(unittest.TestCase):
             self.assertRaises(ValueError, baseapp.get_object_ring, '99')
             self.assertRaises(ValueError, baseapp.get_object_ring, 'asdf')
 
+    def test_object_cache_config(self):
+        def make_app(conf):
+            return proxy_server.Application(conf, FakeMemcache(),
+                                            container_ring=FakeRing(),
+                                            account_ring=FakeRing())
+        self.assertEqual(make_app({}).object_cache, None)
+        with patch_policies([
+            StoragePolicy(0, 'zero', True, object_ring=FakeRing()),
+            StoragePolicy(1, 'one', False, object_ring=FakeRing())
+        ]):
+            cache = make_app({'object_cache_size': '1048576',
+                              'object_cache_ttl': '0.5'}).object_cache
+            self.assertEqual((cache.size, cache.max_object_size, cache.ttl,
+                              cache.policy_indexes),
+                             (1048576, 65536, 0.5, None))
+            cache = make_app({'object_cache_size': '1048576',
+                              'object_cache_policies': 'one'}).object_cache
+            self.assertEqual(cache.policy_indexes, set([1]))
+            self.assertRaises(ValueError, make_app,
+                              {'object_cache_size': '1048576',
+                               'object_cache_policies': 'one, two'})
+
+    def test_admission_control(self):
+        admission = proxy_server.AdmissionControl(2, 1, 1, 0.05,
+                                                  debug_logger())
+        self.assertTrue(admission.acquire(0, ['d1', 'd2']))
+        self.assertTrue(admission.acquire(0, ['d3', 'd4']))
+        self.assertEqual(dict(admission.in_flight), {
+            ('policy', 0): 2, ('device', 'd1'): 1, ('device', 'd2'): 1,
+            ('device', 'd3'): 1, ('device', 'd4'): 1})
+        # other policies have limits of their own
+        self.assertTrue(admission.acquire(1, ['d5']))
+
+        # a request waits for room...
+        results = []
+        waiter = spawn(lambda: results.append(admission.acquire(0, ['d5'])))
+        sleep(0)
+        self.assertEqual(admission.queued, 1)
+        # ...while the queue is full, others are shed at once
+        self.assertFalse(admission.acquire(1, ['d5']))
+        admission.release(0, ['d1', 'd2'])
+        # the device is still busy
+        sleep(0)
+        self.assertEqual(results, [])
+        admission.release(1, ['d5'])
+        waiter.wait()
+        self.assertEqual(results, [True])
+        self.assertEqual(admission.queued, 0)
+
+        # and is shed if no room is made in time
+        start = time.time()
+        self.assertFalse(admission.acquire(0, ['d7']))
+        self.assertTrue(time.time() - start >= 0.05)
+        self.assertEqual(admission.logger.get_increment_counts(),
+                         {'admission.1.shed': 1, 'admission.0.shed': 1})
+
+        for policy_index, devices in ((0, ['d3', 'd4']), (0, ['d5'])):
+            admission.release(policy_index, devices)
+        self.assertEqual(dict(admission.in_flight), {})
+
+    def test_admission_control_sheds_requests(self):
+        app = proxy_server.Application({'max_policy_requests': '1',
+                                        'admission_queue_size': '0'},
+                                       FakeMemcache(),
+                                       container_ring=FakeRing(),
+                                       account_ring=FakeRing())
+        in_flight = []
+
+        @utils.public
+        def fake_GET(controller, req):
+            in_flight.append(dict(app.admission_control.in_flight))
+            return Response(request=req)
+
+        container_info = {'status': 200, 'storage_policy': '0'}
+        with mock.patch.object(proxy_server.ObjectController, 'GET',
+                               fake_GET), \
+                mock.patch.object(proxy_server.base, 'get_container_info',
+                                  return_value=container_info):
+            req = Request.blank('/v1/a/c/o')
+            resp = app.handle_request(req)
+            self.assertEqual(resp.status_int, 200)
+            self.assertEqual(in_flight, [{('policy', 0): 1}])
+            self.assertEqual(dict(app.admission_control.in_flight), {})
+
+            app.admission_control.acquire(0, [])
+            req = Request.blank('/v1/a/c/o')
+            resp = app.handle_request(req)
+            self.assertEqual(resp.status_int, 503)
+            self.assertEqual(resp.headers['Retry-After'], '1')
+            self.assertEqual(len(in_flight), 1)
+
+            # account and container requests aren't limited
+            req = Request.blank('/v1/a/c', method='HEAD')
+            with mock.patch.object(proxy_server.ContainerController, 'HEAD',
+                                   fake_GET):
+                resp = app.handle_request(req)
+            self.assertEqual(resp.status_int, 200)
+
     def test_unhandled_exception(self):
 
         class MyApp(proxy_server.Application):
@@ -816,6 +915,34 @@ class TestProxyServer(unittest.TestCase):
                           {'region': 2, 'zone': 1, 'ip': '127.0.0.1'}]
             self.assertEquals(exp_sorted, app_sorted)
 
+    def test_node_latency(self):
+        cache_dir = mkdtemp()
+        try:
+            baseapp = proxy_server.Application(
+                {'sorting_method': 'latency', 'recon_cache_path': cache_dir},
+                FakeMemcache(), container_ring=FakeRing(),
+                account_ring=FakeRing())
+            # another worker on the same host shares what was seen
+            otherapp = proxy_server.Application(
+                {'sorting_method': 'latency', 'recon_cache_path': cache_dir},
+                FakeMemcache(), container_ring=FakeRing(),
+                account_ring=FakeRing())
+            nodes = [dict(ip='127.0.0.1', port=6000, device='sd%s' % d,
+                          region=1, zone=1) for d in 'abcd']
+            baseapp.set_response_timing(nodes[0], 'Object', 0.1)
+            baseapp.set_response_timing(nodes[1], 'Object', 0.0015)
+            baseapp.set_response_timing(nodes[2], 'Object', 0.001)
+            baseapp.error_occurred(nodes[3], 'oops')
+            with mock.patch('swift.proxy.server.shuffle', lambda l: l):
+                app_sorted = otherapp.sort_nodes(list(nodes))
+            # within a factor of two latencies count the same
+            self.assertEqual([node['device'] for node in app_sorted],
+                             ['sdb', 'sdc', 'sda', 'sdd'])
+            stats = read_node_stats(os.path.join(cache_dir, NODE_STATS_FILE))
+            self.assertEqual(stats['127.0.0.1:6000/sda']['latency'], 0.1)
+        finally:
+            rmtree(cache_dir)
+
     def test_info_defaults(self):
         app = proxy_server.Application({}, FakeMemcache(),
                                        account_ring=FakeRing(),
@@ -2433,6 +2560,27 @@ class TestObjectController(unittest.TestCase):
                 got_exc = True
             self.assert_(got_exc)
 
+    def test_node_read_timeout_retry_read_ahead(self):
+        with save_globals():
+            object_ring = self.app.get_object_ring(None)
+            object_ring.get_nodes('account')
+            for dev in object_ring.devs:
+                dev['ip'] = '127.0.0.1'
+                dev['port'] = 1
+            req = Request.blank('/v1/a/c/o', environ={'REQUEST_METHOD': 'GET'})
+            self.app.update_request(req)
+
+            self.app.recoverable_node_timeout = 0.1
+            self.app.read_ahead_chunks = 2
+            set_http_connect(200, 200, 200, body='lalala',
+                             slow=[1.0, 1.0])
+            resp = req.get_response(self.app)
+            self.assertEquals(resp.body, 'lalala')
+
+            set_http_connect(200, 200, 200, slow=[1.0, 1.0, 1.0])
+            resp = req.get_response(self.app)
+            self.assertRaises(ChunkReadTimeout, lambda: resp.body)
+
     def test_node_write_timeout(self):
         with save_globals():
             self.app.account_ring.get_nodes('account')